@@ -22,11 +22,102 @@
     const urlCheck = {}
     const cvwebrequestsLog = {}
     const tabStorage = {};
+    // version of the saved events, 2: details is an object (it used to be a JSON string)
+    const schemaVersion = 2;
+    // tabId --> {requestId: start time} of requests that did not complete yet
+    const pendingRequests = {};
+    // tabId --> time of the last webrequest event
+    const lastRequestEventTime = {};
     const networkFilters = {
         urls: [
         ]
     };
 
+    // Optional NDJSON output: when the crawler runs its local sink (see data_collect/ndjson_sink.py),
+    // every event is appended to the sink as one line instead of being kept in memory until the save.
+    // the crawler writes ndjson_sink.json into the extension directory when its sink uses another port
+    var streamSinkUrl = "http://127.0.0.1:8799";
+    const streamFlushInterval = 500;  // in ms
+    const streamSession = Math.random().toString(36).substring(2, 10);
+    const streamBuffers = {};
+    var streamMode = false;
+    var streamCount = 0;
+    var streamChain = Promise.resolve();
+
+    fetch(chrome.runtime.getURL("ndjson_sink.json")).then(function (response) {
+        return response.json();
+    }).then(function (sinkConfig) {
+        streamSinkUrl = sinkConfig.url;
+    }).catch(function () {
+        // no config: the sink (if any) uses the default port
+    }).then(function () {
+        return fetch(streamSinkUrl + "/ping");
+    }).then(function (response) {
+        streamMode = response.ok;
+        console.log("General: NDJSON stream mode: " + streamMode);
+    }).catch(function () {
+        console.log("General: No NDJSON sink found, keeping events in memory");
+    });
+
+    function postToSink(path, body) {
+        // chain the posts so the sink receives them in order
+        streamChain = streamChain.then(function () {
+            return fetch(streamSinkUrl + path, {method: "POST", body: body});
+        }).catch(function (error) {
+            console.log("General: Could not post to NDJSON sink: " + error);
+        });
+    }
+
+    function openStream() {
+        streamCount += 1;
+        const streamId = streamSession + "-" + streamCount;
+        streamBuffers[streamId] = {lines: [], eventCount: 0, startTime: ""};
+        return streamId;
+    }
+
+    function appendToStream(streamId, entry) {
+        const stream = streamBuffers[streamId];
+        if (stream.eventCount == 0) {
+            // take the first event as the starttime of the original url
+            stream.startTime = entry.time;
+        }
+        stream.eventCount += 1;
+        stream.lines.push(JSON.stringify(entry));
+    }
+
+    function flushStream(streamId) {
+        const stream = streamBuffers[streamId];
+        if (stream.lines.length > 0) {
+            postToSink("/append?stream=" + streamId, stream.lines.join("\n") + "\n");
+            stream.lines = [];
+        }
+    }
+
+    function closeStream(streamId, fileData) {
+        flushStream(streamId);
+        fileData.startTime = streamBuffers[streamId].startTime;
+        postToSink("/close?stream=" + streamId, JSON.stringify(fileData));
+        delete streamBuffers[streamId];
+    }
+
+    function saveStream(tabId) {
+        var filename = urlCheck[tabId].filename;
+        if (filename == null || filename.length == 0){
+            filename = urlCheck[tabId].url;
+        }
+        closeStream(urlCheck[tabId].streamId, {
+            url: urlCheck[tabId].url,
+            filename: filename + fileNameSuffix,
+            schemaVersion: schemaVersion,
+            endTime: new Date().getTime()
+        });
+        urlCheck[tabId].streamId = '';
+    }
+
+    setInterval(function () {
+        Object.keys(streamBuffers).forEach(flushStream);
+    }, streamFlushInterval);
+
     /*! @source http://purl.eligrey.com/github/FileSaver.js/blob/master/FileSaver.js */
     var saveAs = saveAs || (navigator.msSaveBlob && navigator.msSaveBlob.bind(navigator)) || (function (h) { var r = h.document, l = function () { return h.URL || h.webkitURL || h }, e = h.URL || h.webkitURL || h, n = r.createElementNS("http://www.w3.org/1999/xhtml", "a"), g = "download" in n, j = function (t) { var s = r.createEvent("MouseEvents"); s.initMouseEvent("click", true, false, h, 0, 0, 0, 0, 0, false, false, false, false, 0, null); t.dispatchEvent(s) }, o = h.webkitRequestFileSystem, p = h.requestFileSystem || o || h.mozRequestFileSystem, m = function (s) { (h.setImmediate || h.setTimeout)(function () { throw s }, 0) }, c = "application/octet-stream", k = 0, b = [], i = function () { var t = b.length; while (t--) { var s = b[t]; if (typeof s === "string") { e.revokeObjectURL(s) } else { s.remove() } } b.length = 0 }, q = function (t, s, w) { s = [].concat(s); var v = s.length; while (v--) { var x = t["on" + s[v]]; if (typeof x === "function") { try { x.call(t, w || t) } catch (u) { m(u) } } } }, f = function (t, u) { var v = this, B = t.type, E = false, x, w, s = function () { var F = l().createObjectURL(t); b.push(F); return F }, A = function () { q(v, "writestart progress write writeend".split(" ")) }, D = function () { if (E || !x) { x = s(t) } if (w) { w.location.href = x } v.readyState = v.DONE; A() }, z = function (F) { return function () { if (v.readyState !== v.DONE) { return F.apply(this, arguments) } } }, y = { create: true, exclusive: false }, C; v.readyState = v.INIT; if (!u) { u = "download" } if (g) { x = s(t); n.href = x; n.download = u; j(n); v.readyState = v.DONE; A(); return } if (h.chrome && B && B !== c) { C = t.slice || t.webkitSlice; t = C.call(t, 0, t.size, c); E = true } if (o && u !== "download") { u += ".download" } if (B === c || o) { w = h } else { w = h.open() } if (!p) { D(); return } k += t.size; p(h.TEMPORARY, k, z(function (F) { F.root.getDirectory("saved", y, z(function (G) { var H = function () { G.getFile(u, y, z(function (I) { I.createWriter(z(function (J) { J.onwriteend = function (K) { w.location.href = I.toURL(); b.push(I); v.readyState = v.DONE; q(v, "writeend", K) }; J.onerror = function () { var K = J.error; if (K.code !== K.ABORT_ERR) { D() } }; "writestart progress write abort".split(" ").forEach(function (K) { J["on" + K] = v["on" + K] }); J.write(t); v.abort = function () { J.abort(); v.readyState = v.DONE }; v.readyState = v.WRITING }), D) }), D) }; G.getFile(u, { create: false }, z(function (I) { I.remove(); H() }), z(function (I) { if (I.code === I.NOT_FOUND_ERR) { H() } else { D() } })) }), D) }), D) }, d = f.prototype, a = function (s, t) { return new f(s, t) }; d.abort = function () { var s = this; s.readyState = s.DONE; q(s, "abort") }; d.readyState = d.INIT = 0; d.WRITING = 1; d.DONE = 2; d.error = d.onwritestart = d.onprogress = d.onwrite = d.onabort = d.onerror = d.onwriteend = null; h.addEventListener("unload", i, false); return a }(self));
  
@@ -52,7 +143,7 @@
             // if urlCheck does not have tabId yet
             if (!urlCheck.hasOwnProperty(tabId)) {
                 console.log("General Starting a new tab in onUpdated: " + tabId);
-                urlCheck[tabId] = {url: '', loading: false, filename:''};
+                urlCheck[tabId] = {url: '', loading: false, filename: '', streamId: ''};
                 cvwebrequestsLog[tabId] = [];
             }
 
@@ -67,12 +158,17 @@
             console.log("General ChangeInfo: " + changeInfo.status);
             if(changeInfo.status == 'loading' && (urlCheck[tabId].url != tab.url) ) {
                 console.log("General: onUpdated 1");
-                if(urlCheck[tabId].url != '') {
+                if(urlCheck[tabId].url != '' && urlCheck[tabId].streamId) {
+                    // the events were already streamed, only tell the sink to finish the file
+                    console.log("General: onUpdated 2: Closing stream");
+                    saveStream(tabId);
+                } else if(urlCheck[tabId].url != '') {
                     console.log("General: onUpdated 2: Saving File");
 
                     var fileData = {
                         url: urlCheck[tabId].url,
-                        cvwebrequests: cvwebrequestsLog[tabId]
+                        cvwebrequests: cvwebrequestsLog[tabId],
+                        schemaVersion: schemaVersion
                     }
 
                     if (fileData.cvwebrequests.length > 0) {
@@ -98,7 +194,10 @@
                 urlCheck[tabId].url = tab.url;
                 urlCheck[tabId].loading = true;
                 urlCheck[tabId].filename = '';
+                urlCheck[tabId].streamId = streamMode ? openStream() : '';
                 cvwebrequestsLog[tabId] = [];
+                pendingRequests[tabId] = {};
+                lastRequestEventTime[tabId] = new Date().getTime();
 
                 logEvent('onTabNewURL', {"url": tab.url, "tabId": tabId}, tabId);
                 
@@ -142,44 +241,89 @@
 
         console.log("General: Adding event " + eventName + " to tabId: " + tabId);
 
-        cvwebrequestsLog[tabId].push({
+        const entry = {
             type: eventName,
             event: eventData
-        });
+        };
+        if (urlCheck.hasOwnProperty(tabId) && urlCheck[tabId].streamId) {
+            appendToStream(urlCheck[tabId].streamId, entry);
+        } else {
+            cvwebrequestsLog[tabId].push(entry);
+        }
+    }
+
+    function trackRequest(tabId, requestId, isPending) {
+        if (!pendingRequests.hasOwnProperty(tabId)) {
+            pendingRequests[tabId] = {};
+        }
+        const now = new Date().getTime();
+        if (isPending) {
+            if (!pendingRequests[tabId].hasOwnProperty(requestId)) {
+                pendingRequests[tabId][requestId] = now;
+            }
+        } else {
+            delete pendingRequests[tabId][requestId];
+        }
+        lastRequestEventTime[tabId] = now;
+    }
+
+    function getSettleState(tabId) {
+        const pending = pendingRequests[tabId] || {};
+        return {
+            pendingCount: Object.keys(pending).length,
+            pendingStartTimes: Object.values(pending),
+            lastEventTime: lastRequestEventTime[tabId] || 0
+        };
+    }
+
+    function isSinkRequest(details) {
+        // requests of the extensions to the NDJSON sink are not part of the page
+        return details.url.indexOf(streamSinkUrl) == 0;
     }
 
     chrome.webRequest.onSendHeaders.addListener((details) => {
         const { tabId, requestId } = details;
+        if (isSinkRequest(details)) {
+            return;
+        }
         var eventData = {
             tabId: tabId,
             requestId: requestId,
             url: details.url,
             requestTime: details.timeStamp,
             status: 'onSendHeaders',
-            details: JSON.stringify(details)
+            details: details
         };
         console.log(eventData);
         logEvent('onSendHeaders', eventData, tabId);
+        trackRequest(tabId, requestId, true);
 
     }, networkFilters, ['requestHeaders', 'extraHeaders']);
 
     chrome.webRequest.onBeforeRedirect.addListener((details) => {
         const { tabId, requestId } = details;
+        if (isSinkRequest(details)) {
+            return;
+        }
         var eventData = {
             tabId: tabId,
             requestId: requestId,
             url: details.url,
             requestTime: details.timeStamp,
             status: 'onBeforeRedirect',
-            details: JSON.stringify(details)
+            details: details
         };
         console.log(eventData);
         logEvent('onBeforeRedirect', eventData, tabId);
+        trackRequest(tabId, requestId, true);
 
     }, networkFilters, ['responseHeaders', 'extraHeaders']);
 
     chrome.webRequest.onCompleted.addListener((details) => {
         const { tabId, requestId } = details;
+        if (isSinkRequest(details)) {
+            return;
+        }
 
         var eventData = {
             tabId: tabId,
@@ -187,15 +331,19 @@
             url: details.url,
             requestTime: details.timeStamp,
             status: 'onCompleted',
-            details: JSON.stringify(details)
+            details: details
         };
         console.log(eventData);
         logEvent('onCompleted', eventData, tabId);
+        trackRequest(tabId, requestId, false);
 
     }, networkFilters, ['responseHeaders', 'extraHeaders']);
 
     chrome.webRequest.onErrorOccurred.addListener((details)=> {
         const { tabId, requestId } = details;
+        if (isSinkRequest(details)) {
+            return;
+        }
 
         var eventData = {
             tabId: tabId,
@@ -203,11 +351,12 @@
             url: details.url,
             requestTime: details.timeStamp,
             status: 'onErrorOccurred',
-            details: JSON.stringify(details)
+            details: details
         };
 
         console.log(eventData);
         logEvent('onErrorOccurred', eventData, tabId);
+        trackRequest(tabId, requestId, false);
 
     }, networkFilters);
 
@@ -224,6 +373,14 @@
                 //console.log("Setting filename " + message.event.filename)
                 urlCheck[tabId].filename = message.event.filename;
             }
+
+            // answer with the network counters, used to detect when the page settled
+            if (message.type == "AnticvSettleQueryEvent") {
+                port.postMessage({
+                    type: "AnticvNetworkSettleEvent",
+                    event: getSettleState(tabId)
+                });
+            }
             
         };
         port.onMessage.addListener(messageListener);
@@ -33,10 +33,25 @@ function fireContentLoadedEvent () {
             event: event.detail
         });
     }, true);
+
+    // selenium asks whether the network is quiet, the background has the counters
+    window.addEventListener("AnticvSettleQueryEvent", function(event) {
+        port.postMessage({
+            type: event.type
+        });
+    }, true);
 }
 
 var port = chrome.runtime.connect({name: portName});
 
+port.onMessage.addListener(function (message) {
+    if (message.type == "AnticvNetworkSettleEvent") {
+        // send as a string so the detail survives crossing into the page
+        var evt = new CustomEvent(message.type, {detail: JSON.stringify(message.event)});
+        window.dispatchEvent(evt);
+    }
+});
+
 port.postMessage({
     type: 'connected----'+document.URL
 });
@@ -24,6 +24,9 @@ var nodeRegistry = [];
 var nodeToParent = {};
 var domLoaded = false;
 var windowLoaded = false;
+// counters used to detect when the page settled (see AnticvSettleQueryEvent)
+var mutationCount = 0;
+var lastMutationTime = 0;
 
 var ABP_BLOCKED_KEY = 'abp-blocked-element';
 var ABP_SNIPPET_KEY = 'abp-blocked-snippet';
@@ -52,6 +55,15 @@ function fireContentLoadedEvent () {
             event: event.detail
         });
     }, true);
+
+    // selenium asks whether the DOM is quiet, answer with the mutation counters
+    window.addEventListener("AnticvSettleQueryEvent", function(event) {
+        var evt = new CustomEvent("AnticvDomSettleEvent", {detail: JSON.stringify({
+            mutationCount: mutationCount,
+            lastEventTime: lastMutationTime
+        })});
+        window.dispatchEvent(evt);
+    }, true);
 }
 
 
@@ -319,6 +331,9 @@ function hasParentABPBlocked(elements, includeSelf) {
  function onMutation(records) {
         var record, i, l;
 
+        mutationCount += records.length;
+        lastMutationTime = new Date().getTime();
+
         for (i = 0, l = records.length; i < l; i++) {
             record = records[i];
             const targetElement = record.target;
@@ -15,7 +15,7 @@
 
 import logging
 
-from cvinspector.common.utils import ABP_BLOCKED_SNIPPET, get_css_dict
+from cvinspector.common.utils import ABP_BLOCKED_SNIPPET, get_css_keys
 
 logger = logging.getLogger(__name__)
 # logger.setLevel("DEBUG")
@@ -132,48 +132,48 @@ def get_node_info_str(
         NODE_STYLE_KEY_THRESHOLD=10,
         ignore_attrs=["transform", "d", "x", "x1", "x2", "y", "y1", "y2",
                       "r"]):
-    node_info = ""
+    node_info_parts = []
     # add in node info object information
-    if node_info_obj.get("nodeName"):
-        node_info += "_NodeName" + node_info_obj.get("nodeName") + "_"
-    if node_info_obj.get("NoChildNodes"):
-        node_info += "_ChildCount" + str(
-            node_info_obj.get("NoChildNodes")) + "_"
-    if node_info_obj.get("NodeValue"):
-        node_info += "_NodeValueLen" + str(len(
-            node_info_obj.get("NodeValue"))) + "_"
-    if node_info_obj.get("NodeType"):
-        node_info += "_NodeType" + str(node_info_obj.get("NodeType")) + "_"
+    node_name = node_info_obj.get("nodeName")
+    if node_name:
+        node_info_parts.append("_NodeName" + node_name + "_")
+    child_count = node_info_obj.get("NoChildNodes")
+    if child_count:
+        node_info_parts.append("_ChildCount" + str(child_count) + "_")
+    node_value = node_info_obj.get("NodeValue")
+    if node_value:
+        node_info_parts.append("_NodeValueLen" + str(len(node_value)) + "_")
+    node_type = node_info_obj.get("NodeType")
+    if node_type:
+        node_info_parts.append("_NodeType" + str(node_type) + "_")
 
     # add node info attributes
-    if node_info_obj.get("NodesAttributes") and len(
-            node_info_obj.get("NodesAttributes")) > 0:
-        for node_attr in node_info_obj.get("NodesAttributes"):
+    node_attributes = node_info_obj.get("NodesAttributes")
+    if node_attributes:
+        for node_attr in node_attributes:
             if len(node_attr) == 2:
-                node_attr_key = node_attr[0]
-                node_attr_val = node_attr[1]
+                node_attr_key, node_attr_val = node_attr
                 if not use_attribute_values:
                     if len(node_attr_key) <= 2:
                         continue
-                    node_info += node_attr_key
+                    node_info_parts.append(node_attr_key)
                     if node_attr_key == "style":
                         # for style, make the string into the style key only like:
                         # style[height][width]
-                        for index, style_key in enumerate(
-                                get_css_dict(node_attr_val), start=0):
-                            if index > NODE_STYLE_KEY_THRESHOLD:
-                                break
-                            node_info += "[" + style_key + "]"
+                        for style_key in get_css_keys(
+                                node_attr_val)[:NODE_STYLE_KEY_THRESHOLD + 1]:
+                            node_info_parts.append("[" + style_key + "]")
 
                     elif node_attr_key not in ignore_attrs:
-                        node_info += str(len(node_attr_val))
+                        node_info_parts.append(str(len(node_attr_val)))
 
                 else:
                     if "doctype" in node_attr_val:
                         continue
-                    node_info += node_attr_key + node_attr_val[:
-                                                               NODE_ATTR_VAL_THRESHOLD]
+                    node_info_parts.append(
+                        node_attr_key + node_attr_val[:NODE_ATTR_VAL_THRESHOLD])
 
+    node_info = "".join(node_info_parts)
     if len(node_info) == 0:
         node_info = "ninfonull"
 
@@ -474,3 +474,103 @@ def get_text_changed_key(event,
 
     key = target_selector + delimiter + "oldvalue" + old_value_key + delimiter + "newvalue" + new_value_key
     return key.lower(), text_diff
+
+
+def _get_node_info_signature(node_info_obj):
+    # everything of a nodeInfo object that get_node_single_added_key reads
+    node_attributes = node_info_obj.get("NodesAttributes")
+    return (node_info_obj.get("nodeName"), node_info_obj.get("NoChildNodes"),
+            node_info_obj.get("NodeValue"), node_info_obj.get("NodeType"),
+            node_info_obj.get("parentNode"),
+            tuple(map(tuple, node_attributes)) if node_attributes else None)
+
+
+class DomMutationKeyBuilder:
+    """
+    Gives the same keys as get_nodes_added_key, get_nodes_removed_key,
+    get_attribute_changed_key and get_text_changed_key, for the dom mutations of one
+    diff group. Mutation streams repeat the same changes many times, so:
+    - keys are interned: equal keys are the same string object, kept once
+    - the key of an added/removed node is cached by the fields it is built from
+      (selectors and node info), repeated nodes skip get_node_info_str and the string
+      building
+    """
+    def __init__(self):
+        self.interned = dict()
+        # (options, target selector, node selector, node info signature) --> key tuple
+        self.node_keys = dict()
+        self.node_key_hits = 0
+        self.node_key_misses = 0
+
+    def intern(self, value):
+        return self.interned.setdefault(value, value)
+
+    def _get_node_key(self, event_target, event_node, event_node_info,
+                      options):
+        try:
+            signature = (options, event_target.get("selector"),
+                         event_node.get("selector"),
+                         _get_node_info_signature(event_node_info[0])
+                         if event_node_info else None)
+            result = self.node_keys.get(signature)
+        except TypeError:
+            # unhashable values in the event, not cached
+            signature = None
+            result = None
+
+        if result is not None:
+            self.node_key_hits += 1
+            return result
+
+        self.node_key_misses += 1
+        use_attribute_values, use_target_selector, NODE_ATTR_VAL_THRESHOLD = options
+        key, defining_text, is_text_node, has_snippet_blocked = get_node_single_added_key(
+            event_target,
+            event_node,
+            event_node_info,
+            use_attribute_values=use_attribute_values,
+            use_target_selector=use_target_selector,
+            NODE_ATTR_VAL_THRESHOLD=NODE_ATTR_VAL_THRESHOLD)
+        result = (self.intern(key), defining_text, is_text_node,
+                  has_snippet_blocked)
+        if signature is not None:
+            self.node_keys[signature] = result
+        return result
+
+    def get_nodes_added_key(self,
+                            event,
+                            use_attribute_values=False,
+                            use_target_selector=True,
+                            NODE_ATTR_VAL_THRESHOLD=50):
+        options = (use_attribute_values, use_target_selector,
+                   NODE_ATTR_VAL_THRESHOLD)
+        event_target = event.get("target")
+        event_nodes = event.get("nodes")
+        event_node_info = event.get("nodeInfo")
+        result_keys = []
+        if event_nodes:
+            # for selector we should account for multiple changes
+            for index, event_node in enumerate(event_nodes, start=0):
+                if event_node_info is not None and len(event_node_info) > index:
+                    result_keys.append(
+                        self._get_node_key(event_target, event_node,
+                                           event_node_info[index], options))
+
+        return result_keys
+
+    def get_nodes_removed_key(self,
+                              event,
+                              use_attribute_values=False,
+                              use_target_selector=True):
+        return self.get_nodes_added_key(
+            event,
+            use_attribute_values=use_attribute_values,
+            use_target_selector=use_target_selector)
+
+    def get_attribute_changed_key(self, event, **kwargs):
+        key, defining_text = get_attribute_changed_key(event, **kwargs)
+        return self.intern(key), self.intern(defining_text)
+
+    def get_text_changed_key(self, event, **kwargs):
+        key, text_diff = get_text_changed_key(event, **kwargs)
+        return self.intern(key), text_diff
@@ -0,0 +1,310 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+
+import numpy as np
+
+from cvinspector.common.filter_matcher import FilterMatcher, get_filter_list_paths
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+FILTER_LIST_SNAPSHOT_MAGIC = b"CVFLSNP\0"
+
+# bump when the snapshot layout or the FilterMatcher data changes, older snapshots are rebuilt
+FILTER_LIST_SNAPSHOT_VERSION = 2
+
+FILTER_LIST_SNAPSHOT_SUFFIX = ".snapshot"
+
+# magic + header length
+_SNAPSHOT_PREFIX = struct.Struct("<8sQ")
+
+# sections start on multiples of this, so the offset arrays can be read in place
+_SECTION_ALIGNMENT = 8
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_sha256(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as hash_file:
+        for chunk in iter(lambda: hash_file.read(_HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_line_offsets(text_bytes):
+    # start of each line, plus the end of the text, so line i is [offsets[i], offsets[i + 1])
+    newlines = np.flatnonzero(
+        np.frombuffer(text_bytes, dtype=np.uint8) == ord("\n"))
+    offsets = [np.zeros(1, dtype=np.uint64), (newlines + 1).astype(np.uint64)]
+    if len(text_bytes) > 0 and not text_bytes.endswith(b"\n"):
+        offsets.append(np.array([len(text_bytes)], dtype=np.uint64))
+    return np.concatenate(offsets)
+
+
+def _align(offset):
+    return (offset + _SECTION_ALIGNMENT - 1) // _SECTION_ALIGNMENT * _SECTION_ALIGNMENT
+
+
+def build_filter_list_snapshot(filter_list_path, snapshot_path):
+    """
+    Compiles a filter list into a snapshot file:
+        header           json: version, source path/sha256/size, line count
+                         and the section offsets
+        text             the filter list as is
+        line_offsets     uint64 (lines + 1), see get_line_offsets
+        matcher          pickle of FilterMatcher.to_data (rules and token index)
+    Returns the header.
+    """
+    with open(filter_list_path, "rb") as filter_list_file:
+        text_bytes = filter_list_file.read()
+
+    line_offsets = get_line_offsets(text_bytes)
+    # split on "\n" only (not str.splitlines), so lines match the offsets
+    lines = [
+        text_bytes[line_offsets[i]:line_offsets[i + 1]].decode(
+            "utf-8", errors="ignore").rstrip("\r\n")
+        for i in range(len(line_offsets) - 1)
+    ]
+
+    matcher = FilterMatcher()
+    matcher.add_rules(lines)
+    matcher.build_index()
+
+    sections = [
+        ("text", text_bytes),
+        ("line_offsets", line_offsets.tobytes()),
+        ("matcher",
+         pickle.dumps(matcher.to_data(), protocol=pickle.HIGHEST_PROTOCOL)),
+    ]
+
+    header = {
+        "version": FILTER_LIST_SNAPSHOT_VERSION,
+        "source_path": os.path.abspath(filter_list_path),
+        "source_sha256": hashlib.sha256(text_bytes).hexdigest(),
+        "source_size": len(text_bytes),
+        "line_count": len(lines),
+        "matcher_stats": matcher.get_stats(),
+        "sections": dict()
+    }
+    # offsets are relative to the end of the header, so they do not depend on its length
+    offset = 0
+    for name, section_bytes in sections:
+        offset = _align(offset)
+        header["sections"][name] = [offset, len(section_bytes)]
+        offset += len(section_bytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(_SNAPSHOT_PREFIX.size + len(header_bytes))
+
+    # write under a temporary name so a crash never leaves a partial snapshot
+    tmp_snapshot_path = snapshot_path + ".tmp"
+    with open(tmp_snapshot_path, "wb") as snapshot_file:
+        snapshot_file.write(
+            _SNAPSHOT_PREFIX.pack(FILTER_LIST_SNAPSHOT_MAGIC,
+                                  len(header_bytes)))
+        snapshot_file.write(header_bytes)
+        for name, section_bytes in sections:
+            section_start = data_start + header["sections"][name][0]
+            snapshot_file.write(b"\0" * (section_start - snapshot_file.tell()))
+            snapshot_file.write(section_bytes)
+    os.replace(tmp_snapshot_path, snapshot_path)
+    logger.info("Built filter list snapshot %s (%d lines)", snapshot_path,
+                len(lines))
+    return header
+
+
+def read_filter_list_snapshot_header(snapshot_path):
+    # returns (header, start of the sections), None when it is not a snapshot
+    with open(snapshot_path, "rb") as snapshot_file:
+        prefix = snapshot_file.read(_SNAPSHOT_PREFIX.size)
+        if len(prefix) != _SNAPSHOT_PREFIX.size:
+            return None
+        magic, header_length = _SNAPSHOT_PREFIX.unpack(prefix)
+        if magic != FILTER_LIST_SNAPSHOT_MAGIC:
+            return None
+        try:
+            header = json.loads(
+                snapshot_file.read(header_length).decode("utf-8"))
+        except ValueError:
+            return None
+    return header, _align(_SNAPSHOT_PREFIX.size + header_length)
+
+
+class FilterListSnapshot:
+    """
+    A filter list snapshot (see build_filter_list_snapshot), memory-mapped.
+    Lines are read from the mapping when asked for, the FilterMatcher
+    is unpickled on first use. Read-only, so it can be shared between threads.
+    """
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        snapshot_header = read_filter_list_snapshot_header(snapshot_path)
+        if snapshot_header is None:
+            raise ValueError("Not a filter list snapshot: %s" % snapshot_path)
+        self.header, self.data_start = snapshot_header
+        self.line_count = self.header["line_count"]
+
+        with open(snapshot_path, "rb") as snapshot_file:
+            self.mmap = mmap.mmap(snapshot_file.fileno(),
+                                  0,
+                                  access=mmap.ACCESS_READ)
+        self.line_offsets = self._get_array("line_offsets", np.uint64)
+        self.text_start = self._get_section_start("text")
+        self.matcher = None
+        self.lock = threading.Lock()
+
+    def _get_section_start(self, name):
+        return self.data_start + self.header["sections"][name][0]
+
+    def _get_array(self, name, dtype):
+        section_offset, section_length = self.header["sections"][name]
+        return np.frombuffer(self.mmap,
+                             dtype=dtype,
+                             count=section_length // np.dtype(dtype).itemsize,
+                             offset=self.data_start + section_offset)
+
+    def get_source_sha256(self):
+        return self.header["source_sha256"]
+
+    def get_text_bytes(self):
+        # the filter list as it was compiled
+        _, text_length = self.header["sections"]["text"]
+        return self.mmap[self.text_start:self.text_start + text_length]
+
+    def get_text(self):
+        return self.get_text_bytes().decode("utf-8", errors="ignore")
+
+    def get_line(self, line_index):
+        start = self.text_start + int(self.line_offsets[line_index])
+        end = self.text_start + int(self.line_offsets[line_index + 1])
+        return self.mmap[start:end].decode("utf-8",
+                                           errors="ignore").rstrip("\r\n")
+
+    def iter_lines(self):
+        for line_index in range(self.line_count):
+            yield self.get_line(line_index)
+
+    def get_filter_matcher(self):
+        with self.lock:
+            if self.matcher is None:
+                section_offset, section_length = self.header["sections"][
+                    "matcher"]
+                start = self.data_start + section_offset
+                self.matcher = FilterMatcher.from_data(
+                    pickle.loads(self.mmap[start:start + section_length]))
+            return self.matcher
+
+    def close(self):
+        # the offset arrays point into the mapping, drop them first
+        self.line_offsets = None
+        self.matcher = None
+        self.mmap.close()
+
+    def _reset_after_fork(self):
+        # another thread of the parent may have held the lock while forking.
+        # The mapping stays, the child shares it
+        self.lock = threading.Lock()
+
+
+def get_filter_list_snapshot_path(filter_list_path, snapshot_directory=None):
+    # next to the filter list by default: easylist.txt --> easylist.txt.snapshot
+    if snapshot_directory is None:
+        return filter_list_path + FILTER_LIST_SNAPSHOT_SUFFIX
+    return snapshot_directory + os.sep + os.path.basename(
+        filter_list_path) + FILTER_LIST_SNAPSHOT_SUFFIX
+
+
+def is_filter_list_snapshot_current(snapshot_path, source_sha256):
+    if not os.path.isfile(snapshot_path):
+        return False
+    snapshot_header = read_filter_list_snapshot_header(snapshot_path)
+    if snapshot_header is None:
+        return False
+    header, _ = snapshot_header
+    return header.get("version") == FILTER_LIST_SNAPSHOT_VERSION and header.get(
+        "source_sha256") == source_sha256
+
+
+# snapshot path --> FilterListSnapshot, per process
+_LOADED_SNAPSHOTS = dict()
+_LOADED_SNAPSHOTS_LOCK = threading.Lock()
+
+
+def _reset_loaded_snapshots_after_fork():
+    global _LOADED_SNAPSHOTS_LOCK
+    _LOADED_SNAPSHOTS_LOCK = threading.Lock()
+    for snapshot in _LOADED_SNAPSHOTS.values():
+        snapshot._reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_loaded_snapshots_after_fork)
+
+
+def load_filter_list_snapshot(filter_list_path, snapshot_directory=None):
+    """
+    Returns the FilterListSnapshot of the filter list, building the snapshot when
+    there is none yet, it is from another snapshot version or the sha256 of the
+    filter list changed.
+    """
+    snapshot_path = get_filter_list_snapshot_path(filter_list_path,
+                                                  snapshot_directory)
+    source_sha256 = get_file_sha256(filter_list_path)
+
+    with _LOADED_SNAPSHOTS_LOCK:
+        snapshot = _LOADED_SNAPSHOTS.get(snapshot_path)
+        if snapshot is not None and snapshot.get_source_sha256(
+        ) == source_sha256:
+            return snapshot
+
+        if not is_filter_list_snapshot_current(snapshot_path, source_sha256):
+            if snapshot_directory is not None:
+                os.makedirs(snapshot_directory, exist_ok=True)
+            build_filter_list_snapshot(filter_list_path, snapshot_path)
+
+        # the previous mapping stays valid for whoever still holds it
+        snapshot = FilterListSnapshot(snapshot_path)
+        _LOADED_SNAPSHOTS[snapshot_path] = snapshot
+        logger.debug("Loaded filter list snapshot %s", snapshot_path)
+        return snapshot
+
+
+def clear_loaded_filter_list_snapshots():
+    # later loads map the snapshots again, mappings already handed out stay valid
+    with _LOADED_SNAPSHOTS_LOCK:
+        _LOADED_SNAPSHOTS.clear()
+
+
+def create_filter_matcher_from_snapshots(filter_list_paths,
+                                         snapshot_directory=None):
+    # like create_filter_matcher, with the rules and index of each list taken from its snapshot
+    matchers = [
+        load_filter_list_snapshot(filter_list_path,
+                                  snapshot_directory).get_filter_matcher()
+        for filter_list_path in get_filter_list_paths(filter_list_paths)
+    ]
+    matcher = FilterMatcher.merge(matchers)
+    logger.info("Loaded filter matcher from snapshots: %s",
+                str(matcher.get_stats()))
+    return matcher
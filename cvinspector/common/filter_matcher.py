@@ -0,0 +1,552 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import re
+
+from cvinspector.common.url_parts import get_url_parts
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# resource types of the filter list syntax, one bit each
+FILTER_RESOURCE_TYPES = [
+    "other", "script", "image", "stylesheet", "object", "subdocument",
+    "xmlhttprequest", "websocket", "webrtc", "ping", "font", "media",
+    "document", "popup"
+]
+_RESOURCE_TYPE_BITS = dict(
+    (resource_type, 1 << index)
+    for index, resource_type in enumerate(FILTER_RESOURCE_TYPES))
+
+# requests without a known type (resource type "None" in the urls file)
+_UNKNOWN_TYPE_BIT = 1 << len(FILTER_RESOURCE_TYPES)
+_ALL_TYPES_MASK = (_UNKNOWN_TYPE_BIT << 1) - 1
+
+# rules without type options do not apply to whole pages or popups
+_DEFAULT_TYPES_MASK = _ALL_TYPES_MASK & ~(_RESOURCE_TYPE_BITS["document"]
+                                          | _RESOURCE_TYPE_BITS["popup"])
+
+_RESOURCE_TYPE_ALIASES = {
+    "xhr": "xmlhttprequest",
+    "css": "stylesheet",
+    "frame": "subdocument",
+    "object-subrequest": "object",
+    "background": "image",
+    "xbl": "other",
+    "dtd": "other"
+}
+
+# chrome webRequest types --> filter list types
+WEBREQUEST_TO_FILTER_RESOURCE_TYPE = {
+    "main_frame": "document",
+    "sub_frame": "subdocument",
+    "stylesheet": "stylesheet",
+    "script": "script",
+    "image": "image",
+    "imageset": "image",
+    "font": "font",
+    "object": "object",
+    "xmlhttprequest": "xmlhttprequest",
+    "ping": "ping",
+    "beacon": "ping",
+    "csp_report": "other",
+    "media": "media",
+    "websocket": "websocket",
+    "other": "other"
+}
+
+# options that do not change whether a request is blocked
+_IGNORED_OPTIONS = set(["collapse", "~collapse", "important"])
+
+# cosmetic (element hiding and snippet) rules are not network rules
+_COSMETIC_SEPARATORS = ["##", "#@#", "#?#", "#$#", "#@$#", "#@?#"]
+
+# anything but a letter, digit or one of _-.%  (or the end of the url)
+_SEPARATOR_REGEX = r"(?:[^a-zA-Z0-9_.%-]|$)"
+
+# scheme and any subdomains before a || anchored host
+_HOST_ANCHOR_REGEX = r"^(?:[^:/?#]+:)?(?://(?:[^/?#]*\.)?)?"
+
+_TOKEN_RE = re.compile(r"[a-z0-9%]+")
+
+# $domain= rules are keyed by page domain when their best token is in more rules
+FILTER_INDEX_COMMON_TOKEN_RULES = 16
+
+_NO_DOMAINS = frozenset()
+
+
+class NetworkRule:
+    """
+    One blocking or exception (@@) rule of a filter list.
+    The regex is compiled the first time the rule is checked, most rules never are.
+    """
+    __slots__ = [
+        "text", "pattern", "match_case", "is_exception", "types_mask",
+        "third_party", "include_domains", "exclude_domains", "regex"
+    ]
+
+    def __init__(self, text, pattern, match_case, is_exception, types_mask,
+                 third_party, include_domains, exclude_domains):
+        self.text = text
+        self.pattern = pattern
+        self.match_case = match_case
+        self.is_exception = is_exception
+        self.types_mask = types_mask
+        # None when the rule has no third-party option
+        self.third_party = third_party
+        # most rules have no $domain=, they share one empty set
+        self.include_domains = frozenset(
+            include_domains) if include_domains else _NO_DOMAINS
+        self.exclude_domains = frozenset(
+            exclude_domains) if exclude_domains else _NO_DOMAINS
+        self.regex = None
+
+    def to_tuple(self):
+        return (self.text, self.pattern, self.match_case,
+                self.is_exception, self.types_mask, self.third_party,
+                tuple(self.include_domains), tuple(self.exclude_domains))
+
+    def matches_url(self, url):
+        if self.regex is None:
+            flags = 0 if self.match_case else re.IGNORECASE
+            try:
+                self.regex = re.compile(pattern_to_regex(self.pattern), flags)
+            except re.error:
+                logger.debug("Could not compile filter rule %s", self.text)
+                self.regex = re.compile(r"(?!)")
+        return self.regex.search(url) is not None
+
+    def matches_page_domain(self, page_domains):
+        # page_domains: the page host and its parent domains, most specific first
+        if not self.include_domains and not self.exclude_domains:
+            return True
+
+        # the most specific domain decides, like example.com|~sub.example.com
+        for domain in page_domains:
+            if domain in self.exclude_domains:
+                return False
+            if domain in self.include_domains:
+                return True
+        return not self.include_domains
+
+
+def get_page_domains(page_host):
+    # sub.example.com --> [sub.example.com, example.com, com]
+    if not page_host:
+        return []
+    labels = page_host.split(".")
+    return [".".join(labels[index:]) for index in range(len(labels))]
+
+
+def _split_rule_options(line):
+    # the options start at the last $, unless the rule is a /regex/
+    dollar_index = line.rfind("$")
+    if dollar_index <= 0:
+        return line, []
+    pattern = line[:dollar_index]
+    options = line[dollar_index + 1:]
+    if pattern.startswith("/") and not pattern.endswith("/") and line.endswith(
+            "/"):
+        return line, []
+    return pattern, [x.strip() for x in options.split(",") if x.strip()]
+
+
+def pattern_to_regex(pattern):
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return pattern[1:-1]
+
+    prefix = ""
+    if pattern.startswith("||"):
+        prefix = _HOST_ANCHOR_REGEX
+        pattern = pattern[2:]
+    elif pattern.startswith("|"):
+        prefix = "^"
+        pattern = pattern[1:]
+
+    suffix = ""
+    if pattern.endswith("|"):
+        suffix = "$"
+        pattern = pattern[:-1]
+
+    if not prefix:
+        pattern = pattern.lstrip("*")
+    if not suffix:
+        pattern = pattern.rstrip("*")
+
+    regex_parts = []
+    for char in pattern:
+        if char == "*":
+            if not regex_parts or regex_parts[-1] != ".*":
+                regex_parts.append(".*")
+        elif char == "^":
+            regex_parts.append(_SEPARATOR_REGEX)
+        else:
+            regex_parts.append(re.escape(char))
+    return prefix + "".join(regex_parts) + suffix
+
+
+def get_pattern_tokens(pattern):
+    """
+    Tokens ([a-z0-9%]+) of a rule pattern that any url matching it also has as a
+    whole token, so the rule only needs to be checked for urls with that token.
+    """
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return []
+
+    start_anchored = pattern.startswith("|")
+    body = pattern.lstrip("|")
+    end_anchored = body.endswith("|")
+    body = body.rstrip("|").lower()
+
+    tokens = []
+    for match in _TOKEN_RE.finditer(body):
+        start, end = match.span()
+        if start == 0:
+            bounded_before = start_anchored
+        else:
+            bounded_before = body[start - 1] != "*"
+        if end == len(body):
+            bounded_after = end_anchored
+        else:
+            bounded_after = body[end] != "*"
+        if bounded_before and bounded_after:
+            tokens.append(match.group())
+    return tokens
+
+
+def parse_network_rule(line):
+    """
+    Returns the NetworkRule of one filter list line, or None for comments,
+    cosmetic rules and rules with options that do not block requests (csp=, ...)
+    """
+    line = line.strip()
+    if not line or line.startswith("!") or line.startswith("["):
+        return None
+    for separator in _COSMETIC_SEPARATORS:
+        if separator in line:
+            return None
+
+    is_exception = line.startswith("@@")
+    rule_line = line[2:] if is_exception else line
+    pattern, options = _split_rule_options(rule_line)
+
+    match_case = False
+    third_party = None
+    include_types = 0
+    exclude_types = 0
+    include_domains = []
+    exclude_domains = []
+    for option in options:
+        option_name = option.lower()
+        is_negated = option_name.startswith("~")
+        type_name = _RESOURCE_TYPE_ALIASES.get(option_name.lstrip("~"),
+                                               option_name.lstrip("~"))
+
+        if option_name in _IGNORED_OPTIONS:
+            continue
+        elif option_name == "match-case":
+            match_case = True
+        elif option_name in ("third-party", "3p", "~first-party", "~1p"):
+            third_party = True
+        elif option_name in ("~third-party", "~3p", "first-party", "1p"):
+            third_party = False
+        elif option_name.startswith("domain="):
+            for domain in option[len("domain="):].split("|"):
+                domain = domain.strip().lower()
+                if domain.startswith("~"):
+                    exclude_domains.append(domain[1:])
+                elif domain:
+                    include_domains.append(domain)
+        elif type_name in _RESOURCE_TYPE_BITS:
+            if is_negated:
+                exclude_types |= _RESOURCE_TYPE_BITS[type_name]
+            else:
+                include_types |= _RESOURCE_TYPE_BITS[type_name]
+        else:
+            # elemhide, csp=, rewrite=, sitekey=, ...
+            return None
+
+    if include_types:
+        types_mask = include_types
+    elif exclude_types:
+        types_mask = _DEFAULT_TYPES_MASK & ~exclude_types
+    else:
+        types_mask = _DEFAULT_TYPES_MASK
+
+    return NetworkRule(line, pattern, match_case,
+                       is_exception, types_mask, third_party,
+                       tuple(include_domains), tuple(exclude_domains))
+
+
+def get_resource_type_bit(resource_type):
+    if resource_type is None or resource_type == "None":
+        return _UNKNOWN_TYPE_BIT
+    filter_type = WEBREQUEST_TO_FILTER_RESOURCE_TYPE.get(resource_type)
+    if filter_type is None:
+        filter_type = _RESOURCE_TYPE_ALIASES.get(resource_type, resource_type)
+    return _RESOURCE_TYPE_BITS.get(filter_type, _UNKNOWN_TYPE_BIT)
+
+
+class _RuleIndex:
+    """
+    Rules keyed by one of their tokens. Rules limited to some pages ($domain=) whose
+    tokens are all common (like |https://) are keyed by those page domains instead.
+    Rules with neither are always checked.
+    """
+    def __init__(self,
+                 rule_ids_by_token=None,
+                 rule_ids_by_page_domain=None,
+                 untokenized_rule_ids=None):
+        self.rule_ids_by_token = rule_ids_by_token or dict()
+        self.rule_ids_by_page_domain = rule_ids_by_page_domain or dict()
+        self.untokenized_rule_ids = untokenized_rule_ids or []
+
+    @classmethod
+    def build(cls, rules, rule_ids):
+        tokens_of_rules = dict()
+        token_counts = dict()
+        for rule_id in rule_ids:
+            tokens = get_pattern_tokens(rules[rule_id].pattern)
+            tokens_of_rules[rule_id] = tokens
+            for token in tokens:
+                token_counts[token] = token_counts.get(token, 0) + 1
+
+        index = cls()
+        for rule_id in rule_ids:
+            tokens = tokens_of_rules[rule_id]
+            best_token = None
+            if tokens:
+                # the rarest token spreads the rules the most, longer ones win ties
+                best_token = min(tokens,
+                                 key=lambda x: (token_counts[x], -len(x)))
+
+            include_domains = rules[rule_id].include_domains
+            if include_domains and (best_token is None
+                                    or token_counts[best_token] >
+                                    FILTER_INDEX_COMMON_TOKEN_RULES):
+                for domain in include_domains:
+                    index.rule_ids_by_page_domain.setdefault(domain,
+                                                             []).append(rule_id)
+            elif best_token is not None:
+                index.rule_ids_by_token.setdefault(best_token,
+                                                   []).append(rule_id)
+            else:
+                index.untokenized_rule_ids.append(rule_id)
+        return index
+
+    def to_tuple(self):
+        return (self.rule_ids_by_token, self.rule_ids_by_page_domain,
+                self.untokenized_rule_ids)
+
+    def extend(self, other, rule_id_offset):
+        # adds the rule ids of other, whose rules start at rule_id_offset
+        def offset_rule_ids(rule_ids):
+            if rule_id_offset == 0:
+                return rule_ids
+            return [rule_id + rule_id_offset for rule_id in rule_ids]
+
+        for key, rule_ids in other.rule_ids_by_token.items():
+            self.rule_ids_by_token.setdefault(key, []).extend(
+                offset_rule_ids(rule_ids))
+        for key, rule_ids in other.rule_ids_by_page_domain.items():
+            self.rule_ids_by_page_domain.setdefault(key, []).extend(
+                offset_rule_ids(rule_ids))
+        self.untokenized_rule_ids.extend(
+            offset_rule_ids(other.untokenized_rule_ids))
+
+    def iter_rule_ids(self, url_tokens, page_domains):
+        for rule_id in self.untokenized_rule_ids:
+            yield rule_id
+        for token in url_tokens:
+            rule_ids = self.rule_ids_by_token.get(token)
+            if rule_ids:
+                for rule_id in rule_ids:
+                    yield rule_id
+        for domain in page_domains:
+            rule_ids = self.rule_ids_by_page_domain.get(domain)
+            if rule_ids:
+                for rule_id in rule_ids:
+                    yield rule_id
+
+
+class FilterMatcher:
+    """
+    In-process matcher of the network rules of EasyList style filter lists
+    (EasyList, EasyPrivacy, ...). Supports ||, |, ^ and * patterns, /regex/ rules,
+    @@ exceptions (including $document exceptions of the page), $third-party,
+    $domain= and resource type options.
+    Each rule is indexed by one token (or its page domains), so a url only checks
+    the few rules that could match it.
+    """
+    def __init__(self):
+        self.rules = []
+        self.lines_skipped = 0
+        self.block_index = None
+        self.exception_index = None
+
+    def add_rules(self, lines):
+        for line in lines:
+            rule = parse_network_rule(line)
+            if rule is None:
+                self.lines_skipped += 1
+                continue
+            self.rules.append(rule)
+        self.block_index = None
+        self.exception_index = None
+
+    def add_filter_list(self, filter_list_path):
+        with open(filter_list_path, "r", encoding="utf-8",
+                  errors="ignore") as filter_list_file:
+            self.add_rules(filter_list_file)
+        logger.debug("Loaded filter list %s, rules: %d", filter_list_path,
+                     len(self.rules))
+
+    def build_index(self):
+        block_rule_ids = []
+        exception_rule_ids = []
+        for rule_id, rule in enumerate(self.rules):
+            if rule.is_exception:
+                exception_rule_ids.append(rule_id)
+            else:
+                block_rule_ids.append(rule_id)
+        self.block_index = _RuleIndex.build(self.rules, block_rule_ids)
+        self.exception_index = _RuleIndex.build(self.rules,
+                                                exception_rule_ids)
+
+    def _find_rule(self, index, url, url_tokens, type_bit, is_third_party,
+                   page_domains):
+        for rule_id in index.iter_rule_ids(url_tokens, page_domains):
+            rule = self.rules[rule_id]
+            if not rule.types_mask & type_bit:
+                continue
+            if rule.third_party is not None and rule.third_party != is_third_party:
+                continue
+            if not rule.matches_page_domain(page_domains):
+                continue
+            if rule.matches_url(url):
+                return rule
+        return None
+
+    def get_matching_rule(self, url, resource_type=None, page_url=None):
+        """
+        Returns the blocking rule that applies to the request, None when no blocking
+        rule matches or an exception rule allows it.
+        page_url is the url of the page that made the request, it decides
+        $third-party, $domain= and $document exceptions.
+        """
+        if self.block_index is None:
+            self.build_index()
+
+        url_tokens = set(_TOKEN_RE.findall(url.lower()))
+        type_bit = get_resource_type_bit(resource_type)
+
+        page_domains = []
+        is_third_party = None
+        if page_url:
+            page_parts = get_url_parts(page_url)
+            page_domains = get_page_domains((page_parts.host or "").lower())
+            is_third_party = get_url_parts(url).sld != page_parts.sld
+
+        block_rule = self._find_rule(self.block_index, url, url_tokens,
+                                     type_bit, is_third_party, page_domains)
+        if block_rule is None:
+            return None
+
+        if self._find_rule(self.exception_index, url, url_tokens, type_bit,
+                           is_third_party, page_domains) is not None:
+            return None
+
+        if page_url:
+            # @@...$document exceptions allow everything on the page
+            page_tokens = set(_TOKEN_RE.findall(page_url.lower()))
+            if self._find_rule(self.exception_index, page_url, page_tokens,
+                               _RESOURCE_TYPE_BITS["document"], False,
+                               page_domains) is not None:
+                return None
+
+        return block_rule
+
+    def matches(self, url, resource_type=None, page_url=None):
+        return self.get_matching_rule(url,
+                                      resource_type=resource_type,
+                                      page_url=page_url) is not None
+
+    def to_data(self):
+        # plain tuples/dicts/lists, see filter_list_snapshot
+        if self.block_index is None:
+            self.build_index()
+        return {
+            "lines_skipped": self.lines_skipped,
+            "rules": [rule.to_tuple() for rule in self.rules],
+            "block_index": self.block_index.to_tuple(),
+            "exception_index": self.exception_index.to_tuple()
+        }
+
+    @classmethod
+    def from_data(cls, matcher_data):
+        matcher = cls()
+        matcher.lines_skipped = matcher_data["lines_skipped"]
+        matcher.rules = [NetworkRule(*x) for x in matcher_data["rules"]]
+        matcher.block_index = _RuleIndex(*matcher_data["block_index"])
+        matcher.exception_index = _RuleIndex(*matcher_data["exception_index"])
+        return matcher
+
+    @classmethod
+    def merge(cls, matchers):
+        # one matcher with the rules of all, keeping the index of each one
+        merged = cls()
+        merged.block_index = _RuleIndex()
+        merged.exception_index = _RuleIndex()
+        for matcher in matchers:
+            if matcher.block_index is None:
+                matcher.build_index()
+            rule_id_offset = len(merged.rules)
+            merged.rules += matcher.rules
+            merged.lines_skipped += matcher.lines_skipped
+            merged.block_index.extend(matcher.block_index, rule_id_offset)
+            merged.exception_index.extend(matcher.exception_index,
+                                          rule_id_offset)
+        return merged
+
+    def get_stats(self):
+        exception_count = len([x for x in self.rules if x.is_exception])
+        stats = {
+            "rules": len(self.rules),
+            "exceptions": exception_count,
+            "lines_skipped": self.lines_skipped
+        }
+        if self.block_index is not None:
+            stats["always_checked_rules"] = len(
+                self.block_index.untokenized_rule_ids) + len(
+                    self.exception_index.untokenized_rule_ids)
+        return stats
+
+
+def get_filter_list_paths(filter_list_paths):
+    # filter lists are given comma separated, like --filter_list_paths
+    if isinstance(filter_list_paths, str):
+        filter_list_paths = filter_list_paths.split(",")
+    return [x.strip() for x in filter_list_paths if x.strip()]
+
+
+def create_filter_matcher(filter_list_paths):
+    # parses the comma separated filter lists, see also create_filter_matcher_from_snapshots
+    matcher = FilterMatcher()
+    for filter_list_path in get_filter_list_paths(filter_list_paths):
+        matcher.add_filter_list(filter_list_path)
+    matcher.build_index()
+    logger.info("Built filter matcher: %s", str(matcher.get_stats()))
+    return matcher
@@ -0,0 +1,111 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import os
+import threading
+
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# connection pool of each shared client (pymongo defaults)
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+
+
+class MongoClientRegistry:
+    """
+    One pooled MongoClient per process for each host/port/credentials.
+    MongoClient is thread-safe, so threads share the client (and its pool).
+    Clients are not fork-safe: a forked child (like the multiprocessing.Process
+    workers) drops the inherited clients and lazily creates its own.
+    Shared clients must not be closed by callers, use close_all at the end of a run.
+    """
+    def __init__(self, client_factory=MongoClient):
+        self.client_factory = client_factory
+        self.max_pool_size = MONGO_MAX_POOL_SIZE
+        self.min_pool_size = MONGO_MIN_POOL_SIZE
+        self.lock = threading.Lock()
+        self.clients = dict()
+        self.pid = os.getpid()
+
+    def _reset_after_fork(self):
+        # the parent's clients (and their sockets and monitor threads) are unusable here
+        self.lock = threading.Lock()
+        self.clients = dict()
+        self.pid = os.getpid()
+
+    def get_client(self, host, port, username=None, password=None,
+                   authSource=None):
+        if self.pid != os.getpid():
+            self._reset_after_fork()
+
+        key = (host, port, username, password, authSource)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                kwargs = {
+                    "maxPoolSize": self.max_pool_size,
+                    "minPoolSize": self.min_pool_size
+                }
+                if username and password:
+                    kwargs["username"] = username
+                    kwargs["password"] = password
+                    kwargs["authSource"] = authSource
+                client = self.client_factory(host, port, **kwargs)
+                self.clients[key] = client
+                logger.debug("Created mongo client for %s:%s in process %d",
+                             str(host), str(port), self.pid)
+            return client
+
+    def close_all(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                for client in self.clients.values():
+                    client.close()
+            self.clients = dict()
+
+
+MONGO_CLIENT_REGISTRY = MongoClientRegistry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        after_in_child=lambda: MONGO_CLIENT_REGISTRY._reset_after_fork())
+
+
+def set_mongo_pool_size(max_pool_size=None, min_pool_size=None):
+    # only applies to clients created afterwards
+    if max_pool_size is not None:
+        MONGO_CLIENT_REGISTRY.max_pool_size = max_pool_size
+    if min_pool_size is not None:
+        MONGO_CLIENT_REGISTRY.min_pool_size = min_pool_size
+
+
+def get_shared_mongo_client(host,
+                            port,
+                            username=None,
+                            password=None,
+                            authSource=None):
+    return MONGO_CLIENT_REGISTRY.get_client(host,
+                                            port,
+                                            username=username,
+                                            password=password,
+                                            authSource=authSource)
+
+
+def close_shared_mongo_clients():
+    MONGO_CLIENT_REGISTRY.close_all()
@@ -19,23 +19,24 @@ import logging
 import os
 import re
 import subprocess
-import threading
-import time
 from json import JSONDecodeError
-from multiprocessing import Queue, Process, Event
+from multiprocessing import Queue, Process
 
 from cvinspector.common.utils import JSON_WEBREQUEST_KEY, JSON_DOMMUTATION_KEY, \
     MONGODB_COLLECTION_CRAWL_INSTANCE, MONGODB_COLLECTION_WEBREQUESTS_CONTROL, \
     MONGODB_COLLECTION_WEBREQUESTS_VARIANT, MONGODB_COLLECTION_DOMMUTATION_CONTROL, \
     MONGODB_COLLECTION_DOMMUTATION_VARIANT
 from cvinspector.common.utils import randomword, CONTROL, VARIANT, get_ground_truth, chunk, OutputCSVProcess, \
-    get_trial_file_name_details, get_trial_label
+    get_trial_file_name_details, get_trial_label, put_output_rows
+from cvinspector.common.work_executor import WorkExecutor, WorkProcessError, SiteTaskError, SiteTaskErrors, \
+    join_work_processes
 from cvinspector.data_migrate.migrate_dommutation import migrate_json_to_mongodb as migrate_json_to_mongdo_dommutation
 from cvinspector.data_migrate.migrate_webrequest import migrate_json_to_mongodb as migrate_json_to_mongdo_webrequest
 from cvinspector.data_migrate.utils import MONGO_CLIENT_HOST, MONGO_CLIENT_PORT, get_anticv_mongo_client_and_db
 from cvinspector.diff_analysis.utils import get_crawl_groups_by_csv
 from cvinspector.ml.output_features_to_csv import CV_DETECT_TARGET_NAME
-from cvinspector.ml.plot import auto_bin_time_series_csv
+from cvinspector.ml.plot import bin_time_series, write_time_series_csv
+from cvinspector.ml.time_series_store import TimeSeriesStoreWriter, TIME_SERIES_STORE_SUFFIX
 
 logger = logging.getLogger(__name__)
 #logger.setLevel("DEBUG")
@@ -665,10 +666,9 @@ def diff_groups(client,
     logger.debug("Total valid grouped dom mutation diff groups %d",
                  len(crawl_instances_list_dom))
 
-    client.close()
 
-
-class TimeseriesPrepThread(threading.Thread):
+class TimeseriesPrepThread:
+    # one chunk of rows, run as a task of a WorkExecutor
     def __init__(self,
                  threadID,
                  name,
@@ -678,9 +678,9 @@ class TimeseriesPrepThread(threading.Thread):
                  chunk_csv=None,
                  positive_label_domains=None,
                  negative_label_domains=None,
-                 trials=4):
+                 trials=4,
+                 export_csv=False):
 
-        threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
         self.rows = rows
@@ -690,109 +690,160 @@ class TimeseriesPrepThread(threading.Thread):
         self.positive_label_domains = positive_label_domains
         self.negative_label_domains = negative_label_domains
         self.trials=trials
+        self.export_csv = export_csv
 
-    def run(self):
-        logger.debug("Running thread %s", self.name)
-
+    def run_per_row(self, row, store_writers, store_csv_rows):
         FILE_PATH_WR_CONTROL = "File Path WR Vanilla"
         FILE_PATH_WR_VARIANT = "File Path WR"
         FILE_PATH_DOM_CONTROL = "File Path DOM Vanilla"
         FILE_PATH_DOM_VARIANT = "File Path DOM"
 
-        for row in self.rows:
-            url = row[URL_CRAWLED]
-            logger.info("%s - Processing URL %s", self.name, url)
-
-            crawl_chunk = row["Chunk"]
-
-            if self.chunk_csv and self.chunk_csv != crawl_chunk:
-                continue
-
-            cv_detect = row[CV_DETECT_TARGET_NAME]
-
-            if self.positive_label_domains or self.negative_label_domains:
-                if url not in self.positive_label_domains and url not in self.negative_label_domains:
-                    continue
-
-            ts_trials_json = dict()
-            for trial_index in range(self.trials):
-                trial_label = get_trial_label(trial_index)
-                dom_control_name = FILE_PATH_DOM_CONTROL + " " + trial_label
-                wr_control_name = FILE_PATH_WR_CONTROL + " " + trial_label
-
-                dom_variant_name = FILE_PATH_DOM_VARIANT + " " + trial_label
-                wr_variant_name = FILE_PATH_WR_VARIANT + " " + trial_label
+        url = row[URL_CRAWLED]
+        logger.info("%s - Processing URL %s", self.name, url)
+
+        crawl_chunk = row["Chunk"]
+
+        if self.chunk_csv and self.chunk_csv != crawl_chunk:
+            return
+
+        cv_detect = row[CV_DETECT_TARGET_NAME]
+
+        if self.positive_label_domains or self.negative_label_domains:
+            if url not in self.positive_label_domains and url not in self.negative_label_domains:
+                return
+
+        # read every trial column first, a missing one fails before the store is touched
+        trial_file_paths = []
+        for trial_index in range(self.trials):
+            trial_label = get_trial_label(trial_index)
+            trial_file_paths.append(
+                (row[FILE_PATH_DOM_CONTROL + " " + trial_label] or "",
+                 row[FILE_PATH_WR_CONTROL + " " + trial_label] or "",
+                 row[FILE_PATH_DOM_VARIANT + " " + trial_label] or "",
+                 row[FILE_PATH_WR_VARIANT + " " + trial_label] or ""))
+
+        chunk_path = self.output_directory + os.sep + crawl_chunk
+        if crawl_chunk not in store_writers:
+            if not os.path.isdir(chunk_path):
+                os.makedirs(chunk_path, exist_ok=True)
+            store_writers[crawl_chunk] = TimeSeriesStoreWriter(
+                chunk_path + os.sep + randomword(10) +
+                TIME_SERIES_STORE_SUFFIX,
+                trials=self.trials)
+            store_csv_rows[crawl_chunk] = []
+        store_writer = store_writers[crawl_chunk]
+        url_index = store_writer.add_url(url)
+
+        ts_trials_json = dict()
+        for trial_index in range(self.trials):
+            trial_label = get_trial_label(trial_index)
+            control_file_dom, control_file_wr, variant_file_dom, variant_file_wr = trial_file_paths[
+                trial_index]
+
+            # if all file exists
+            random_part = randomword(10)
+            if len(control_file_dom) > 0 and len(control_file_wr) > 0 and \
+                len(variant_file_dom) > 0 and len(variant_file_wr) > 0:
+
+                try:
+                    control_range_keys, control_rows = prep_timeseries_bins(
+                        control_file_dom, control_file_wr)
+                    variant_range_keys, variant_rows = prep_timeseries_bins(
+                        variant_file_dom, variant_file_wr)
+
+                    # csv export of the bins, only for debugging
+                    if self.export_csv:
+                        control_prep = chunk_path + os.sep + random_part + trial_label + "_control"
+                        write_time_series_csv(control_prep,
+                                              control_range_keys,
+                                              control_rows)
+                        variant_prep = chunk_path + os.sep + random_part + trial_label + "_variant"
+                        write_time_series_csv(variant_prep,
+                                              variant_range_keys,
+                                              variant_rows)
 
-                control_file_dom = row[dom_control_name] or ""
-                control_file_wr = row[wr_control_name] or ""
-                variant_file_dom = row[dom_variant_name] or ""
-                variant_file_wr = row[wr_variant_name] or ""
+                    logger.debug(
+                        "%s - Success creating control+variant time series %s",
+                        self.name, url)
+                    control_ref = store_writer.add(
+                        url_index, CONTROL, trial_index,
+                        control_range_keys, control_rows)
+                    variant_ref = store_writer.add(
+                        url_index, VARIANT, trial_index,
+                        variant_range_keys, variant_rows)
+                    ts_trials_json[trial_label] = (control_ref,
+                                                   variant_ref)
+                except Exception as e:
+                    logger.error(e)
+                    logger.warning(
+                        "%s - Could not create plot for %s, exception plotting",
+                        self.name, url + " " + str(trial_label))
+                    ts_trials_json[trial_label] = (None, None)
 
-                # if all file exists
-                random_part = randomword(10)
-                if len(control_file_dom) > 0 and len(control_file_wr) > 0 and \
-                    len(variant_file_dom) > 0 and len(variant_file_wr) > 0:
+            else:
+                ts_trials_json[trial_label] = (None, None)
+                logger.warning(
+                    "%s - Could not create plot for %s, not enough files",
+                    self.name, url + " " + str(trial_label))
 
-                    try:
+        # write out rows
+        csv_row = [url, crawl_chunk, cv_detect]
+        for trial_index in range(self.trials):
+            trial_label = get_trial_label(trial_index)
+            ctr_prep, var_prep = ts_trials_json.get(trial_label)
+            csv_row.append(ctr_prep if ctr_prep else "")
+            csv_row.append(var_prep if var_prep else "")
 
-                        chunk_path = self.output_directory + os.sep + crawl_chunk
-                        if not os.path.isdir(chunk_path):
-                            os.mkdir(chunk_path)
+        store_csv_rows[crawl_chunk].append(csv_row)
 
-                        control_prep = chunk_path + os.sep + random_part + trial_label + "_control"
-                        prep_timeseries_file_json(control_file_dom,
-                                                  control_file_wr,
-                                                  control_prep)
+    def run(self):
+        logger.debug("Running thread %s", self.name)
 
-                        variant_prep = chunk_path + os.sep + random_part + trial_label + "_variant"
-                        prep_timeseries_file_json(variant_file_dom,
-                                                  variant_file_wr,
-                                                  variant_prep)
+        # one time series store per crawl chunk, its rows are queued once it is saved
+        store_writers = dict()
+        store_csv_rows = dict()
 
-                        control_prep_csv = control_prep + ".csv"
-                        variant_prep_csv = variant_prep + ".csv"
+        # a failed row only loses its own site, the others are still saved and queued
+        site_errors = []
+        for row in self.rows:
+            try:
+                self.run_per_row(row, store_writers, store_csv_rows)
+            except Exception as e:
+                logger.warning("%s - Could not create time series for %s: %s",
+                               self.name, str(row.get(URL_CRAWLED)), repr(e))
+                site_error = SiteTaskError(row.get(URL_CRAWLED), e)
+                site_error.__cause__ = e
+                site_errors.append(site_error)
+
+        for crawl_chunk, store_writer in store_writers.items():
+            try:
+                store_writer.save()
+            except Exception as e:
+                logger.error(e)
+                logger.warning("%s - Could not save time series store %s",
+                               self.name, store_writer.file_path)
+                continue
 
-                        if os.path.isfile(control_prep_csv) and os.path.isfile(
-                                variant_prep_csv):
-                            logger.debug(
-                                "%s - Success creating control+variant json for time series %s",
-                                self.name, url)
-                            ts_trials_json[trial_label] = (control_prep_csv,
-                                                           variant_prep_csv)
-                            time.sleep(2)
-                    except Exception as e:
-                        logger.error(e)
-                        logger.warning(
-                            "%s - Could not create plot for %s, exception plotting",
-                            self.name, url + " " + str(trial_label))
-                        ts_trials_json[trial_label] = (None, None)
+            # add to queue
+            put_output_rows(self.output_csv_queue,
+                            store_csv_rows[crawl_chunk])
 
-                else:
-                    ts_trials_json[trial_label] = (None, None)
-                    logger.warning(
-                        "%s - Could not create plot for %s, not enough files",
-                        self.name, url + " " + str(trial_label))
+        if site_errors:
+            raise SiteTaskErrors(site_errors)
 
-            # write out rows
-            csv_row = [url, crawl_chunk, cv_detect]
-            for trial_index in range(self.trials):
-                trial_label = get_trial_label(trial_index)
-                ctr_prep, var_prep = ts_trials_json.get(trial_label)
-                csv_row.append(ctr_prep if ctr_prep else "")
-                csv_row.append(var_prep if var_prep else "")
 
-            # add to queue
-            self.output_csv_queue.put(csv_row)
+def prep_timeseries_bins(dom_file_path, wr_file_path):
+    auto_determine_time = False
+    return bin_time_series(dom_file_path,
+                           wr_file_path,
+                           100,
+                           max_seconds_later=25,
+                           auto_determine_time=auto_determine_time)
 
 
 def prep_timeseries_file_json(dom_file_path, wr_file_path, output_file_name):
-    auto_determine_time = False
-    auto_bin_time_series_csv(dom_file_path,
-                             wr_file_path,
-                             output_file_name,
-                             100,
-                             max_seconds_later=25,
-                             auto_determine_time=auto_determine_time)
+    range_keys, rows = prep_timeseries_bins(dom_file_path, wr_file_path)
+    write_time_series_csv(output_file_name, range_keys, rows)
 
 
 def plot_time_series_process(process_index,
@@ -804,63 +855,35 @@ def plot_time_series_process(process_index,
                              chunk_csv=None,
                              trials=4,
                              thread_limit=5,
-                             chunk_size=50):
+                             chunk_size=50,
+                             export_csv=False):
 
     logger.debug("Starting process " + str(process_index))
 
     # chunking
-    THREADS_LIMIT = thread_limit  # how many threads can run each thread
     chunks = chunk(all_rows, n=chunk_size)
-
     chunk_count = len(chunks)
-    current_threads = []
-    chunk_index = 0
-    chunk_completed = 0
-    logger.debug("Processing chunk %d out of %d",
-                 chunk_index + 1, chunk_count)
-
-    stop = False
-    while chunk_completed < chunk_count and not stop:
-        if len(current_threads) < THREADS_LIMIT and chunk_index < chunk_count:
-            thread_name = "Thread-" + randomword(5)
-            logger.debug("Creating " + thread_name)
 
-            some_thread = TimeseriesPrepThread(
+    with WorkExecutor(thread_limit,
+                      name="Process-" + str(process_index)) as executor:
+        for chunk_index, rows_chunk in enumerate(chunks):
+            thread_name = "Thread-" + randomword(5)
+            logger.debug("Processing chunk %d out of %d with thread %s",
+                         chunk_index + 1, chunk_count, thread_name)
+            prep_thread = TimeseriesPrepThread(
                 chunk_index,
                 thread_name,
-                chunks[chunk_index],
+                rows_chunk,
                 output_directory,
                 output_csv_queue,
                 chunk_csv=chunk_csv,
                 positive_label_domains=positive_label_domains,
                 negative_label_domains=negative_label_domains,
-                trials=trials)
-
-            # Start new Threads
-            some_thread.start()
-            logger.debug("Processing chunk %d out of %d with thread %s",
-                         chunk_index + 1, chunk_count, some_thread.name)
-            current_threads.append(some_thread)
-            chunk_index += 1
-            time.sleep(1)
-        else:
-            done_threads = []
-            for t in current_threads:
-                if not t.is_alive():
-                    done_threads.append(t)
-
-            if len(done_threads) == 0:
-                logger.debug("Found no done threads")
-                time.sleep(2)
-            else:
-                for done_thread in done_threads:
-                    logger.debug(
-                        "Done with thread %s and chunk index %d out of %d",
-                        done_thread.name, done_thread.threadID + 1,
-                         chunk_count)
-                    chunk_completed += 1
-                    current_threads.remove(done_thread)
-                time.sleep(2)
+                trials=trials,
+                export_csv=export_csv)
+            executor.submit(prep_thread.run, task_name=thread_name)
+        # a failed task exits the process non-zero, so the stage is not done
+        executor.wait(raise_failures=True)
 
 
 def create_time_series_csvs(csv_file_path,
@@ -870,7 +893,8 @@ def create_time_series_csvs(csv_file_path,
                             thread_limit=20,
                             chunk_size=50,
                             csv_file_existing=None,
-                            trials=4):
+                            trials=4,
+                            export_csv=False):
 
     output_name_mapping = output_directory + os.sep + "filename_mapping.csv"
 
@@ -904,11 +928,10 @@ def create_time_series_csvs(csv_file_path,
 
     # start process to write out csv
     output_csv_queue = Queue()
-    output_csv_shutdown_event = Event()
     output_csv_process = OutputCSVProcess("1",
                                           "output_csv",
                                           output_name_mapping,
-                                          output_csv_shutdown_event,
+                                          None,
                                           output_csv_queue,
                                           header_row=header_row)
     output_csv_process.start()
@@ -961,20 +984,19 @@ def create_time_series_csvs(csv_file_path,
         p = Process(target=plot_time_series_process,
                     args=(process_index, process_chunk_tmp, output_csv_queue,
                           output_directory, positive_label_domains,
-                          negative_label_domains, chunk_csv, trials))
+                          negative_label_domains, chunk_csv, trials),
+                    kwargs={"export_csv": export_csv})
         p.start()
 
         process_list.append(p)
 
     # wait for all to be done
-    for p in process_list:
-        p.join()
+    failed_processes = join_work_processes(process_list)
 
     logger.debug("All work process are done")
 
-    time.sleep(10)
-    logger.debug("Cleaning up all output processes")
-    output_csv_shutdown_event.set()
-    logger.debug("Waiting for output csv processes to complete")
-    output_csv_process.join()
+    logger.debug("Closing the output csv process")
+    output_csv_process.close()
+    if failed_processes:
+        raise WorkProcessError(failed_processes)
     logger.info("DONE")
@@ -0,0 +1,366 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from cvinspector.common.work_executor import WorkExecutor, WorkExecutorError
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# bump when the fingerprints change, older manifests are then ignored
+STAGE_MANIFEST_VERSION = 1
+STAGE_MANIFEST_FILE_NAME = "stage_manifest.json"
+
+STAGE_HASH_BLOCK_SIZE = 1024 * 1024
+
+# how a stage was handled by StageRunner.run
+STAGE_STATUS_RAN = "ran"
+STAGE_STATUS_SKIPPED = "skipped"
+STAGE_STATUS_DISABLED = "disabled"
+
+
+def _get_value(value):
+    # stage paths and fingerprints can be given lazily, since they can depend on
+    # the results of earlier stages
+    if callable(value):
+        return value()
+    return value
+
+
+def _get_fingerprint(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class Stage:
+    """
+    One step of a StageRunner.
+    - func() does the work, its return value (json serializable) is the result of the
+      stage, kept in the manifest so it is still available when the stage is skipped
+    - depends_on: names of the stages that must be done first
+    - input_paths/output_paths: files or directories (or a function returning them,
+      output_paths can use the result of the stage through StageRunner.get_result)
+    - params: anything else the outcome depends on (arguments)
+    - fingerprints/output_fingerprints: name --> function returning a json
+      serializable value, for inputs and outputs that are not files (mongo queries)
+    - always_run: never skipped (cheap stages that pick up new data)
+    - enabled: a disabled stage is not run, the stages depending on it still are
+    """
+    def __init__(self,
+                 name,
+                 func,
+                 depends_on=None,
+                 input_paths=None,
+                 output_paths=None,
+                 params=None,
+                 fingerprints=None,
+                 output_fingerprints=None,
+                 always_run=False,
+                 enabled=True):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on or [])
+        self.input_paths = input_paths
+        self.output_paths = output_paths
+        self.params = params
+        self.fingerprints = fingerprints or dict()
+        self.output_fingerprints = output_fingerprints or dict()
+        self.always_run = always_run
+        self.enabled = enabled
+
+
+class StageManifest:
+    """
+    Json file with the input/output fingerprints and result of every completed stage,
+    and the sha256 of the files hashed so far, keyed by path and reused while the
+    size and mtime of the file do not change.
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.stages = dict()
+        self.file_hashes = dict()
+        self.used_file_hashes = set()
+        self.load()
+
+    def load(self):
+        if not self.manifest_path or not os.path.isfile(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read stage manifest %s: %s",
+                           self.manifest_path, str(e))
+            return
+        if manifest.get("version") != STAGE_MANIFEST_VERSION:
+            logger.info("Ignoring stage manifest %s of an older version",
+                        self.manifest_path)
+            return
+        self.stages = manifest.get("stages", dict())
+        self.file_hashes = manifest.get("file_hashes", dict())
+
+    def save(self, prune_file_hashes=False):
+        if not self.manifest_path:
+            return
+        with self.lock:
+            if prune_file_hashes:
+                self.file_hashes = {
+                    path: value
+                    for path, value in self.file_hashes.items()
+                    if path in self.used_file_hashes
+                }
+            manifest = {
+                "version": STAGE_MANIFEST_VERSION,
+                "stages": self.stages,
+                "file_hashes": self.file_hashes
+            }
+            tmp_manifest_path = self.manifest_path + ".tmp"
+            with open(tmp_manifest_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+            os.replace(tmp_manifest_path, self.manifest_path)
+
+    def get_stage(self, name):
+        with self.lock:
+            return self.stages.get(name)
+
+    def set_stage(self, name, entry):
+        with self.lock:
+            self.stages[name] = entry
+
+    def get_file_hash(self, file_path):
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        file_key = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            self.used_file_hashes.add(file_path)
+            known = self.file_hashes.get(file_path)
+        if known is not None and known[:2] == file_key:
+            return known[2]
+
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as opened_file:
+            for block in iter(lambda: opened_file.read(STAGE_HASH_BLOCK_SIZE),
+                              b""):
+                sha256.update(block)
+        file_hash = sha256.hexdigest()
+        with self.lock:
+            self.file_hashes[file_path] = file_key + [file_hash]
+        return file_hash
+
+    def get_path_hash(self, path):
+        # None when missing, directories hash the relative paths and hashes of their files
+        if not path:
+            return None
+        if os.path.isfile(path):
+            return self.get_file_hash(path)
+        if not os.path.isdir(path):
+            return None
+
+        sha256 = hashlib.sha256()
+        for root, directories, file_names in os.walk(path):
+            directories.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                sha256.update(os.path.relpath(file_path, path).encode("utf-8"))
+                sha256.update(self.get_file_hash(file_path).encode("utf-8"))
+        return sha256.hexdigest()
+
+
+class StageRunner:
+    """
+    Runs a DAG of Stage on a WorkExecutor: a stage starts as soon as the stages it
+    depends on are done, so independent stages run concurrently (max_workers).
+    A stage is skipped when the manifest has it completed with the same input
+    fingerprint (its input files, params, fingerprints and the output fingerprints
+    of the stages it depends on) and its outputs did not change since.
+    When a stage fails, no new stage is started and WorkExecutorError is raised once
+    the running ones are done. The completed stages are in the manifest, so the next
+    run resumes from the failed stage.
+    """
+    def __init__(self, manifest_path, max_workers=1, rerun_stages=None):
+        self.manifest = StageManifest(manifest_path)
+        self.max_workers = max_workers
+        self.rerun_stages = set(rerun_stages or [])
+        self.stages = dict()
+        self.results = dict()
+        self.statuses = dict()
+        self.output_fingerprints = dict()
+
+    def add_stage(self, stage):
+        if stage.name in self.stages:
+            raise ValueError("Stage %s was added twice" % stage.name)
+        self.stages[stage.name] = stage
+        return stage
+
+    def get_result(self, name):
+        return self.results.get(name)
+
+    def _check_stages(self):
+        for stage in self.stages.values():
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError("Stage %s depends on unknown stage %s" %
+                                     (stage.name, dependency))
+        unknown_rerun_stages = self.rerun_stages - set(self.stages.keys())
+        if unknown_rerun_stages:
+            raise ValueError("Unknown stages to rerun: %s" %
+                             ", ".join(sorted(unknown_rerun_stages)))
+
+        # cycles: repeatedly drop the stages without remaining dependencies
+        remaining = {
+            name: set(stage.depends_on)
+            for name, stage in self.stages.items()
+        }
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError("Stages have a dependency cycle: %s" %
+                                 ", ".join(sorted(remaining.keys())))
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def _get_input_fingerprint(self, stage):
+        input_paths = _get_value(stage.input_paths) or []
+        return _get_fingerprint({
+            "params": _get_value(stage.params),
+            "input_paths": {
+                path: self.manifest.get_path_hash(path)
+                for path in input_paths
+            },
+            "fingerprints": {
+                name: _get_value(func)
+                for name, func in stage.fingerprints.items()
+            },
+            "depends_on": {
+                name: self.output_fingerprints.get(name)
+                for name in stage.depends_on
+            }
+        })
+
+    def _get_output_fingerprint(self, stage):
+        output_paths = _get_value(stage.output_paths) or []
+        return _get_fingerprint({
+            "output_paths": {
+                path: self.manifest.get_path_hash(path)
+                for path in output_paths
+            },
+            "output_fingerprints": {
+                name: _get_value(func)
+                for name, func in stage.output_fingerprints.items()
+            }
+        })
+
+    def _run_stage(self, stage):
+        # runs on a worker thread, the dependencies of the stage are done
+        if not stage.enabled:
+            logger.info("Stage %s: disabled", stage.name)
+            return STAGE_STATUS_DISABLED, None, None
+
+        input_fingerprint = self._get_input_fingerprint(stage)
+        entry = self.manifest.get_stage(stage.name)
+        if entry is not None and not stage.always_run and stage.name not in self.rerun_stages \
+                and entry.get("input_fingerprint") == input_fingerprint:
+            # output_paths can depend on the result, like the path of a written file
+            self.results[stage.name] = entry.get("result")
+            output_fingerprint = self._get_output_fingerprint(stage)
+            if entry.get("output_fingerprint") == output_fingerprint:
+                logger.info("Stage %s: skipped, inputs and outputs unchanged",
+                            stage.name)
+                return STAGE_STATUS_SKIPPED, entry.get(
+                    "result"), output_fingerprint
+            logger.info("Stage %s: outputs changed since it completed",
+                        stage.name)
+
+        logger.info("Stage %s: running", stage.name)
+        start_time = time.time()
+        result = stage.func()
+        self.results[stage.name] = result
+        output_fingerprint = self._get_output_fingerprint(stage)
+        self.manifest.set_stage(
+            stage.name, {
+                "input_fingerprint": input_fingerprint,
+                "output_fingerprint": output_fingerprint,
+                "result": result,
+                "completed_time": time.time(),
+                "duration": time.time() - start_time
+            })
+        self.manifest.save()
+        logger.info("Stage %s: done in %.1f seconds", stage.name,
+                    time.time() - start_time)
+        return STAGE_STATUS_RAN, result, output_fingerprint
+
+    def run(self):
+        """
+        Runs (or skips) every stage, returns the results by stage name.
+        """
+        self._check_stages()
+        waiting = dict(self.stages)
+        running = dict()
+        failed = False
+
+        # the executor fails the whole run, the stages log their own errors
+        with WorkExecutor(self.max_workers,
+                          max_pending=max(len(self.stages), 1),
+                          progress_callback=None,
+                          name="StageRunner") as executor:
+            while waiting or running:
+                if not failed:
+                    ready = [
+                        stage for stage in waiting.values()
+                        if all(dependency in self.statuses
+                               for dependency in stage.depends_on)
+                    ]
+                    for stage in ready:
+                        del waiting[stage.name]
+                        running[executor.submit(
+                            self._run_stage, stage,
+                            task_name=stage.name)] = stage
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running.keys(),
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if future.exception() is not None:
+                        failed = True
+                        continue
+                    status, result, output_fingerprint = future.result()
+                    self.statuses[stage.name] = status
+                    self.results[stage.name] = result
+                    self.output_fingerprints[stage.name] = output_fingerprint
+
+            failures = executor.wait()
+
+        self.manifest.save(prune_file_hashes=not failures)
+        if failures:
+            logger.error("Stages not run after the failure: %s",
+                         ", ".join(sorted(waiting.keys())) or "none")
+            raise WorkExecutorError(failures)
+
+        logger.info("Stages: %s", ", ".join(
+            "%s=%s" % (name, self.statuses[name]) for name in self.stages))
+        return self.results
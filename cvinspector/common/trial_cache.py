@@ -0,0 +1,156 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+TRIAL_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# parsed json takes several times the size of the file in memory.
+# Used to estimate the resident bytes of a parsed trial without walking it
+PARSED_BYTES_PER_FILE_BYTE = 4
+
+
+class ParsedTrial:
+    """
+    One raw trial file (webrequests or dom mutation), parsed once.
+    Webrequest details are already decoded (see load_webrequest_details).
+    Everything handed out is shared between consumers, so treat it as read-only.
+    """
+    def __init__(self, file_path, events_key, file_data, file_size):
+        self.file_path = file_path
+        self.events_key = events_key
+        self.has_events_key = events_key in file_data
+        self.events = file_data.get(events_key) or []
+        self.meta = dict()
+        for key, value in file_data.items():
+            if key != events_key:
+                self.meta[key] = value
+        self.resident_bytes = file_size * PARSED_BYTES_PER_FILE_BYTE
+
+        self.events_by_type = dict()
+        self.events_by_status = dict()
+        for entry in self.events:
+            event = entry.get("event")
+            if isinstance(event, dict):
+                if isinstance(event.get("details"), str):
+                    try:
+                        event["details"] = json.loads(event["details"])
+                    except ValueError:
+                        logger.debug("Could not parse details json in %s",
+                                     file_path)
+                if "status" in event:
+                    self.events_by_status.setdefault(event["status"],
+                                                     []).append(entry)
+            self.events_by_type.setdefault(entry.get("type"), []).append(entry)
+
+    def get_file_data(self):
+        # same shape as the json file, without copying the events
+        file_data = dict(self.meta)
+        file_data[self.events_key] = self.events
+        return file_data
+
+
+class TrialCache:
+    """
+    Process-local LRU of ParsedTrial, bounded by their estimated resident bytes.
+    Entries are keyed by path + mtime + size, so a rewritten file is parsed again.
+    """
+    def __init__(self, max_bytes=TRIAL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.trials = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_path, events_key):
+        file_stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), file_stat.st_mtime_ns,
+               file_stat.st_size, events_key)
+
+        with self.lock:
+            trial = self.trials.get(key)
+            if trial is not None:
+                self.trials.move_to_end(key)
+                self.hits += 1
+                return trial
+            self.misses += 1
+
+        # parse outside of the lock, two threads may parse the same file once each
+        with open(file_path) as f:
+            file_data = json.load(f)
+        trial = ParsedTrial(file_path, events_key, file_data,
+                            file_stat.st_size)
+
+        with self.lock:
+            if key not in self.trials:
+                self.trials[key] = trial
+                self.resident_bytes += trial.resident_bytes
+                self._evict()
+        return trial
+
+    def _evict(self):
+        # keep at least the newest trial even if it alone is over the limit
+        while self.resident_bytes > self.max_bytes and len(self.trials) > 1:
+            _, trial = self.trials.popitem(last=False)
+            self.resident_bytes -= trial.resident_bytes
+            self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.trials),
+                "resident_bytes": self.resident_bytes
+            }
+
+    def clear(self):
+        with self.lock:
+            self.trials = OrderedDict()
+            self.resident_bytes = 0
+
+    def _reset_after_fork(self):
+        # another thread of the parent may have held the lock while forking.
+        # The parsed trials stay, the child shares them copy-on-write
+        self.lock = threading.Lock()
+
+
+TRIAL_CACHE = TrialCache()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: TRIAL_CACHE._reset_after_fork())
+
+
+# returns None when the file can not be parsed (like the raw json getters)
+def get_parsed_trial(file_path, events_key):
+    try:
+        return TRIAL_CACHE.get(file_path, events_key)
+    except (ValueError, AttributeError):
+        logger.debug("Could not load json file: %s", file_path)
+        return None
+
+
+def get_trial_cache_stats():
+    return TRIAL_CACHE.get_stats()
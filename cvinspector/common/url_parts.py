@@ -0,0 +1,184 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qsl
+
+import tldextract
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+URL_PARTS_CACHE_SIZE = 200000
+
+# pending memo rows are written to disk in batches of this size
+URL_PARTS_MEMO_BATCH_SIZE = 1000
+
+# Immutable decomposition of a url. It has the subdomain, domain and suffix attributes
+# of a tldextract result, so it can be passed to the *_from_tld helpers.
+# sld is domain + "." + suffix (see get_second_level_domain_from_tld)
+UrlParts = namedtuple("UrlParts", [
+    "scheme", "host", "subdomain", "domain", "suffix", "sld", "path", "query",
+    "query_pairs"
+])
+
+
+def parse_url_parts(url):
+    url_tld = tldextract.extract(url)
+    parsed_url = urlparse(url)
+
+    host = parsed_url.hostname
+    if not host:
+        # urls without a scheme like "example.com/path"
+        host = ".".join(
+            [x for x in [url_tld.subdomain, url_tld.domain, url_tld.suffix] if x])
+
+    return UrlParts(scheme=parsed_url.scheme,
+                    host=host,
+                    subdomain=url_tld.subdomain,
+                    domain=url_tld.domain,
+                    suffix=url_tld.suffix,
+                    sld=url_tld.domain + "." + url_tld.suffix,
+                    path=parsed_url.path,
+                    query=parsed_url.query,
+                    query_pairs=tuple(
+                        parse_qsl(parsed_url.query, keep_blank_values=True)))
+
+
+class UrlPartsDiskMemo:
+    """
+    Optional sqlite memo of UrlParts so other processes (and later runs) can skip
+    tldextract/urlparse for urls that were already seen.
+    New rows are written in batches, call flush() before the process exits.
+    Forked processes open their own connection; rows they have not flushed yet
+    are simply parsed again later.
+    """
+    def __init__(self, db_path, batch_size=URL_PARTS_MEMO_BATCH_SIZE):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pid = None
+        self.connection = None
+        self._connect()
+
+    def _connect(self):
+        # sqlite connections must not be used across a fork
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = []
+            self.connection = sqlite3.connect(self.db_path,
+                                              timeout=30,
+                                              check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS url_parts (url TEXT PRIMARY KEY, parts TEXT)"
+            )
+            self.connection.commit()
+
+    def get(self, url):
+        with self.lock:
+            self._connect()
+            row = self.connection.execute(
+                "SELECT parts FROM url_parts WHERE url = ?", (url, )).fetchone()
+        if row is None:
+            return None
+        fields = json.loads(row[0])
+        # query_pairs comes back as a list of lists
+        fields[-1] = tuple(tuple(pair) for pair in fields[-1])
+        return UrlParts(*fields)
+
+    def put(self, url, url_parts):
+        with self.lock:
+            self._connect()
+            self.pending.append((url, json.dumps(list(url_parts))))
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if self.pending and self.pid == os.getpid():
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO url_parts (url, parts) VALUES (?, ?)",
+                self.pending)
+            self.connection.commit()
+            self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        if self.pid == os.getpid():
+            self.connection.close()
+
+    def _reset_after_fork(self):
+        # another thread of the parent may have held the lock while forking,
+        # the connection is reopened by _connect
+        self.lock = threading.Lock()
+
+
+URL_PARTS_DISK_MEMO = None
+
+
+def _reset_url_parts_disk_memo_after_fork():
+    if URL_PARTS_DISK_MEMO is not None:
+        URL_PARTS_DISK_MEMO._reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_url_parts_disk_memo_after_fork)
+
+
+def enable_url_parts_disk_memo(db_path):
+    global URL_PARTS_DISK_MEMO
+    disable_url_parts_disk_memo()
+    URL_PARTS_DISK_MEMO = UrlPartsDiskMemo(db_path)
+    return URL_PARTS_DISK_MEMO
+
+
+def disable_url_parts_disk_memo():
+    global URL_PARTS_DISK_MEMO
+    if URL_PARTS_DISK_MEMO is not None:
+        URL_PARTS_DISK_MEMO.close()
+        URL_PARTS_DISK_MEMO = None
+
+
+@lru_cache(maxsize=URL_PARTS_CACHE_SIZE)
+def get_url_parts(url):
+    memo = URL_PARTS_DISK_MEMO
+    if memo is not None:
+        url_parts = memo.get(url)
+        if url_parts is None:
+            url_parts = parse_url_parts(url)
+            memo.put(url, url_parts)
+        return url_parts
+
+    return parse_url_parts(url)
+
+
+def get_url_parts_cache_stats():
+    cache_info = get_url_parts.cache_info()
+    return {
+        "hits": cache_info.hits,
+        "misses": cache_info.misses,
+        "entries": cache_info.currsize,
+        "max_entries": cache_info.maxsize
+    }
@@ -17,15 +17,20 @@ import csv
 import json
 import logging
 import math
+import os
+import queue
 import random
 import statistics
 import string
 import time
-from multiprocessing import Process
+from functools import lru_cache
+from multiprocessing import Event, Process
 
-from pymongo import MongoClient
 from scipy.stats import linregress
 
+from cvinspector.common.mongo_clients import get_shared_mongo_client
+from cvinspector.common.trial_cache import get_parsed_trial
+
 logger = logging.getLogger(__name__)
 
 # change these to connect to correct db
@@ -40,6 +45,13 @@ VARIANT = "variant"
 # JSON KEYS
 JSON_WEBREQUEST_KEY = "cvwebrequests"
 JSON_DOMMUTATION_KEY = "dommutation"
+JSON_SCHEMA_VERSION_KEY = "schemaVersion"
+
+# version of the webrequest events written by the extensions
+# 1 (files without schemaVersion): event details is a JSON string
+# 2: event details is an object
+WEBREQUEST_SCHEMA_VERSION_LEGACY = 1
+WEBREQUEST_SCHEMA_VERSION = 2
 
 # hardcoded collections
 MONGODB_COLLECTION_CRAWL_INSTANCE = "crawl_instance"
@@ -74,6 +86,10 @@ WEBREQUESTS_DATA_FILE_SUFFIX_VARIANT = "--cvwebrequests.json"
 DOMMUTATION_DATA_FILE_SUFFIX_CONTROL = "--cvdommutationvanilla.json"
 DOMMUTATION_DATA_FILE_SUFFIX_VARIANT = "--cvdommutation.json"
 
+# streamed data files (one event per line, the last line holds the metadata of the page)
+NDJSON_FILE_EXTENSION = ".ndjson"
+NDJSON_META_TYPE = "ndjsonMeta"
+
 PAGE_SOURCE_SUFFIX = "__pagesource.html"
 
 ERR_BLOCKED_BY_CLIENT = "ERR_BLOCKED_BY_CLIENT"
@@ -106,16 +122,17 @@ def chunk(some_list, n=4):
 
 
 def _get_mongo_client_and_db(client_host, client_port, db_name):
-    client = MongoClient(client_host, client_port)
+    # shared per process, do not close it (see mongo_clients)
+    client = get_shared_mongo_client(client_host, client_port)
     db = client[db_name]
 
-    if not client:
+    if client is None:
         logger.warn("No client was found for %s %s", 
                     client_host, client_port)
-    if not db:
+    if db is None:
         logger.warn("No db was found for %s", db_name)
 
-    if not client or not db:
+    if client is None or db is None:
         raise Exception("Could find mongo client or database")
 
     return client, db
@@ -272,24 +289,59 @@ def get_css_dict(css_string):
     return css_dict
 
 
+# style strings repeat a lot across dom mutation events
+CSS_KEYS_CACHE_SIZE = 100000
+
+
+@lru_cache(maxsize=CSS_KEYS_CACHE_SIZE)
+def get_css_keys(css_string):
+    # keys of get_css_dict, in order. Cached per style string, a tuple so it cannot be changed
+    return tuple(get_css_dict(css_string))
+
+
 def get_webrequests_from_raw_json(file_path, event_status):
-    webrequests = []
+    # parsed once per process, see trial_cache
+    trial = get_parsed_trial(file_path, JSON_WEBREQUEST_KEY)
+    if trial is None or not trial.has_events_key:
+        # return out of here
+        return
+
+    return list(trial.events_by_status.get(event_status, []))
+
+
+def load_webrequest_details(details):
+    # accepts both schema versions, raises like json.loads for a bad legacy string
+    if isinstance(details, str):
+        return json.loads(details)
+    return details
+
+
+def normalize_webrequests_json_file(file_path, output_file_path=None):
+    # one-shot upgrade of a legacy webrequests file to WEBREQUEST_SCHEMA_VERSION.
+    # Returns False when the file did not need it
     with open(file_path) as f:
-        try:
-            file_data = json.load(f)
-            requests = file_data[JSON_WEBREQUEST_KEY]
-            if requests and len(requests) > 0:
-                for req in requests:
-                    event = req["event"]
-                    if event and "status" in event and event[
-                            "status"] == event_status:
-                        webrequests.append(req)
-        except:
-            # return out of here
-            logger.debug("Could not load json file: %s", file_path)
-            return
+        file_data = json.load(f)
+
+    if file_data.get(JSON_SCHEMA_VERSION_KEY,
+                     WEBREQUEST_SCHEMA_VERSION_LEGACY) >= WEBREQUEST_SCHEMA_VERSION:
+        return False
 
-    return webrequests
+    for req in file_data.get(JSON_WEBREQUEST_KEY) or []:
+        event = req.get("event")
+        if event and isinstance(event.get("details"), str):
+            try:
+                event["details"] = json.loads(event["details"])
+            except ValueError:
+                logger.debug("Could not parse details json in %s", file_path)
+                event["details"] = None
+    file_data[JSON_SCHEMA_VERSION_KEY] = WEBREQUEST_SCHEMA_VERSION
+
+    output_file_path = output_file_path or file_path
+    temp_file_path = output_file_path + ".tmp"
+    with open(temp_file_path, 'w') as f:
+        json.dump(file_data, f)
+    os.replace(temp_file_path, output_file_path)
+    return True
 
 
 def get_blocked_webrequests(file_path):
@@ -301,7 +353,7 @@ def get_blocked_webrequests(file_path):
         details = event_inner.get("details")
         if details:
             try:
-                details_json = json.loads(details)
+                details_json = load_webrequest_details(details)
                 if ERR_BLOCKED_BY_CLIENT in details_json.get("error"):
                     blocked_urls.append(url)
                 else:
@@ -317,23 +369,180 @@ def get_blocked_webrequests(file_path):
 
 
 def get_dom_mutation_from_raw_json(file_path):
-    dom_events = []
+    # parsed once per process, see trial_cache
+    trial = get_parsed_trial(file_path, JSON_DOMMUTATION_KEY)
+    if trial is None or not trial.has_events_key:
+        # return out of here
+        return
+
+    return list(trial.events)
+
+
+def iter_events_from_ndjson(file_path):
+    with open(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line of a crashed trial can be cut off
+                logger.debug("Could not parse ndjson line in file: %s",
+                             file_path)
+                continue
+            if entry.get("type") == NDJSON_META_TYPE:
+                continue
+            yield entry
+
+
+def get_ndjson_meta(file_path):
+    # metadata (url, startTime, endTime) is only written once the page was saved
+    meta = None
     with open(file_path) as f:
-        try:
-            file_data = json.load(f)
-            events = file_data[JSON_DOMMUTATION_KEY]
-            if events and len(events) > 0:
-                for ev in events:
-                    dom_events.append(ev)
-        except:
-            # return out of here
-            print("Could not load json file: %s", file_path)
+        for line in f:
+            if NDJSON_META_TYPE in line:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("type") == NDJSON_META_TYPE:
+                    meta = entry
+    return meta
+
+
+def get_webrequests_from_ndjson(file_path, event_status):
+    # lazy version of get_webrequests_from_raw_json for streamed files
+    for req in iter_events_from_ndjson(file_path):
+        event = req.get("event")
+        if event and "status" in event and event["status"] == event_status:
+            yield req
+
+
+def get_dom_mutation_from_ndjson(file_path):
+    # lazy version of get_dom_mutation_from_raw_json for streamed files
+    for ev in iter_events_from_ndjson(file_path):
+        yield ev
+
+
+# seconds between checks of a shutdown event, for writers still stopped by an event
+OUTPUT_QUEUE_POLL_SECONDS = 1
+
+# seconds close() waits for a writer process to acknowledge its flush
+OUTPUT_QUEUE_CLOSE_TIMEOUT = 600
+
+
+class OutputQueueClose:
+    # put on the queue of a writer after the last row, see OutputQueueWriterProcess.close
+    pass
+
+
+class OutputRowsBatch:
+    # several rows put on the queue of a writer at once, see put_output_rows
+    def __init__(self, rows):
+        self.rows = rows
+
+
+def put_output_rows(output_queue, rows):
+    # one queue item (one pickle and pipe write) for all rows
+    rows = list(rows)
+    if rows:
+        output_queue.put(OutputRowsBatch(rows))
+
+
+def iter_output_queue_rows(output_queue, should_shut_down=None):
+    """
+    Yields the rows put on the queue of a writer, as lists, until OutputQueueClose.
+    Without a sentinel, stops once should_shut_down() is true and the queue is
+    empty, so rows that are still queued are not dropped.
+    """
+    while True:
+        if should_shut_down is None:
+            item = output_queue.get()
+        else:
+            try:
+                item = output_queue.get(timeout=OUTPUT_QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                if should_shut_down():
+                    return
+                continue
+
+        if isinstance(item, OutputQueueClose):
             return
+        if isinstance(item, OutputRowsBatch):
+            yield item.rows
+        else:
+            yield [item]
 
-    return dom_events
 
+class OutputQueueWriterBase:
+    """
+    Shutdown and flush handling of the Output*Base writers.
+    shutdown_output is None when the writer stops on the OutputQueueClose sentinel,
+    or a flag/event checked once the queue is empty.
+    """
+    shutdown_output = None
+    # set once the writer has written everything, see OutputQueueWriterProcess
+    flushed = None
 
-class OutputCSVBase:
+    def should_shut_down(self):
+        return self.shutdown_output
+
+    def get_shutdown_check(self):
+        if self.shutdown_output is None:
+            return None
+        return self.should_shut_down
+
+    def acknowledge_flush(self):
+        if self.flushed is not None:
+            self.flushed.set()
+
+
+class OutputQueueWriterProcess(Process):
+    """
+    Process that writes out what is put on its queue. Producers put rows (or
+    put_output_rows for several), then close() sends the OutputQueueClose sentinel
+    and waits for the writer to acknowledge that everything before it is on disk.
+    """
+    def __init__(self, output_queue):
+        Process.__init__(self)
+        self.writer_queue = output_queue
+        self.flushed = Event()
+
+    def put(self, row):
+        self.writer_queue.put(row)
+
+    def put_many(self, rows):
+        put_output_rows(self.writer_queue, rows)
+
+    def close(self, timeout=OUTPUT_QUEUE_CLOSE_TIMEOUT):
+        # returns whether the writer acknowledged its flush within timeout,
+        # gives up right away when the writer exited without acknowledging
+        self.writer_queue.put(OutputQueueClose())
+        deadline = time.monotonic() + timeout
+        flushed = False
+        while not flushed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning("%s - Writer did not acknowledge its flush",
+                               self.name)
+                break
+            flushed = self.flushed.wait(
+                min(OUTPUT_QUEUE_POLL_SECONDS, remaining))
+            if not flushed and not self.is_alive():
+                # it may have acknowledged right before exiting
+                flushed = self.flushed.is_set()
+                if not flushed:
+                    logger.error(
+                        "%s - Writer exited with %s without acknowledging its flush",
+                        self.name, str(self.exitcode))
+                    break
+        if flushed:
+            self.join()
+        return flushed
+
+
+class OutputCSVBase(OutputQueueWriterBase):
     def __init__(self,
                  id,
                  name,
@@ -352,29 +561,21 @@ class OutputCSVBase:
         self.cached_rows = []
         self.cache_row_limit = cache_row_limit
 
-    def should_shut_down(self):
-        return self.shutdown_output
-
     def run(self):
         with open(self.csv_file_path, 'w') as output_name_file:
             csvwriter = csv.writer(output_name_file)
             if self.header_row:
                 csvwriter.writerow(self.header_row)
-            while not self.should_shut_down():
-                try:
-                    row = self.output_csv_queue.get(timeout=10)
-                    self.cached_rows.append(row)
+            for rows in iter_output_queue_rows(self.output_csv_queue,
+                                               self.get_shutdown_check()):
+                self.cached_rows.extend(rows)
 
-                    if len(self.cached_rows) >= self.cache_row_limit:
-                        rows_count = len(self.cached_rows)
-                        csvwriter.writerows(self.cached_rows)
-                        logger.debug("%s - Wrote new rows: %d",
-                                     self.name, rows_count)
-                        self.cached_rows.clear()
-
-                    self.output_csv_queue.task_done()
-                except:
-                    pass
+                if len(self.cached_rows) >= self.cache_row_limit:
+                    rows_count = len(self.cached_rows)
+                    csvwriter.writerows(self.cached_rows)
+                    logger.debug("%s - Wrote new rows: %d",
+                                 self.name, rows_count)
+                    self.cached_rows.clear()
 
             if len(self.cached_rows) >= 0:
                 rows_count = len(self.cached_rows)
@@ -384,11 +585,10 @@ class OutputCSVBase:
                 self.cached_rows.clear()
 
             output_name_file.flush()
-
-            time.sleep(10)
+        self.acknowledge_flush()
 
 
-class OutputCSVForceHeaderBase:
+class OutputCSVForceHeaderBase(OutputQueueWriterBase):
     def __init__(self,
                  id,
                  name,
@@ -411,9 +611,6 @@ class OutputCSVForceHeaderBase:
         self.done_with_header = False
         assert header_delimiter is not None, "Header Delimiter cannot be None"
 
-    def should_shut_down(self):
-        return self.shutdown_output
-
     def get_header_from_cache(self):
         header_row_match = None
 
@@ -436,32 +633,26 @@ class OutputCSVForceHeaderBase:
                 csvwriter.writerow(self.header_row)
                 self.done_with_header = True
                 logger.debug("%s - Wrote header row", self.name)
-            while not self.should_shut_down():
-                try:
-                    row = self.output_csv_queue.get(timeout=10)
-                    self.cached_rows.append(row)
-
-                    if len(self.cached_rows) >= self.cache_row_limit:
-                        # find the header row first and write it
-                        if not self.done_with_header:
-                            header_row_match = self.get_header_from_cache()
-                            if header_row_match:
-                                csvwriter.writerow(header_row_match)
-                                self.done_with_header = True
-                                logger.debug("%s - Wrote header row",
-                                             self.name)
-
-                        # only output once the header row is done
-                        if self.done_with_header:
-                            rows_count = len(self.cached_rows)
-                            csvwriter.writerows(self.cached_rows)
-                            logger.debug("%s - Wrote new rows: %d",
-                                         self.name, rows_count)
-                            self.cached_rows.clear()
-
-                    self.output_csv_queue.task_done()
-                except:
-                    pass
+            for rows in iter_output_queue_rows(self.output_csv_queue,
+                                               self.get_shutdown_check()):
+                self.cached_rows.extend(rows)
+
+                if len(self.cached_rows) >= self.cache_row_limit:
+                    # find the header row first and write it
+                    if not self.done_with_header:
+                        header_row_match = self.get_header_from_cache()
+                        if header_row_match:
+                            csvwriter.writerow(header_row_match)
+                            self.done_with_header = True
+                            logger.debug("%s - Wrote header row", self.name)
+
+                    # only output once the header row is done
+                    if self.done_with_header:
+                        rows_count = len(self.cached_rows)
+                        csvwriter.writerows(self.cached_rows)
+                        logger.debug("%s - Wrote new rows: %d", self.name,
+                                     rows_count)
+                        self.cached_rows.clear()
 
             if len(self.cached_rows) >= 0:
                 if not self.done_with_header:
@@ -484,31 +675,31 @@ class OutputCSVForceHeaderBase:
                                self.name)
 
             output_name_file.flush()
-
-            time.sleep(10)
+        self.acknowledge_flush()
 
 
-class OutputCSVProcess(OutputCSVBase, Process):
+class OutputCSVProcess(OutputCSVBase, OutputQueueWriterProcess):
     def __init__(self, *args, **kwargs):
         OutputCSVBase.__init__(self, *args, **kwargs)
-        Process.__init__(self)
+        OutputQueueWriterProcess.__init__(self, self.output_csv_queue)
 
     def should_shut_down(self):
         # here shutdown is an event
         return self.shutdown_output.is_set()
 
 
-class OutputCSVForceHeaderProcess(OutputCSVForceHeaderBase, Process):
+class OutputCSVForceHeaderProcess(OutputCSVForceHeaderBase,
+                                  OutputQueueWriterProcess):
     def __init__(self, *args, **kwargs):
         OutputCSVForceHeaderBase.__init__(self, *args, **kwargs)
-        Process.__init__(self)
+        OutputQueueWriterProcess.__init__(self, self.output_csv_queue)
 
     def should_shut_down(self):
         # here shutdown is an event
         return self.shutdown_output.is_set()
 
 
-class OutputDebugBase:
+class OutputDebugBase(OutputQueueWriterBase):
     def __init__(self,
                  id,
                  name,
@@ -524,41 +715,33 @@ class OutputDebugBase:
         self.cached_rows = []
         self.cache_row_limit = cache_row_limit
 
-    def should_shut_down(self):
-        return self.shutdown_output
+    def write_cached_rows(self, output_name_file):
+        # one line per row, so the last row of a batch does not run into the next one
+        output_name_file.write("".join(row + "\n" for row in self.cached_rows))
+        logger.debug("%s - Wrote new rows %d", self.name,
+                     len(self.cached_rows))
+        self.cached_rows.clear()
 
     def run(self):
         with open(self.file_path, 'w') as output_name_file:
-            while not self.should_shut_down():
-                try:
-                    row = self.output_queue.get(timeout=10)
-                    self.cached_rows.append(row)
-                    if len(self.cached_rows) >= self.cache_row_limit:
-                        output_name_file.write("\n".join(self.cached_rows))
-                        logger.debug("%s - Wrote new rows %d",
-                                     self.name, len(self.cached_rows))
-                        self.cached_rows.clear()
+            for rows in iter_output_queue_rows(self.output_queue,
+                                               self.get_shutdown_check()):
+                self.cached_rows.extend(rows)
+                if len(self.cached_rows) >= self.cache_row_limit:
+                    self.write_cached_rows(output_name_file)
 
-                    self.output_queue.task_done()
-                except:
-                    pass
-                
             if len(self.cached_rows) >= 0:
-                output_name_file.write("\n".join(self.cached_rows))
-                logger.debug("%s - Wrote new rows %d",
-                             self.name, len(self.cached_rows))
-                self.cached_rows.clear()
+                self.write_cached_rows(output_name_file)
 
             # force flush
             output_name_file.flush()
+        self.acknowledge_flush()
 
-            time.sleep(10)
 
-
-class OutputDebugProcess(OutputDebugBase, Process):
+class OutputDebugProcess(OutputDebugBase, OutputQueueWriterProcess):
     def __init__(self, *args, **kwargs):
         OutputDebugBase.__init__(self, *args, **kwargs)
-        Process.__init__(self)
+        OutputQueueWriterProcess.__init__(self, self.output_queue)
 
     def should_shut_down(self):
         # here shutdown is an event
@@ -15,20 +15,21 @@
 
 import logging
 import re
-from urllib.parse import urlparse
 
 import numpy as np
-import tldextract
 from bson.objectid import ObjectId
 
-from cvinspector.common.utils import _get_common_stats_default, _get_common_stats_for_number_list, get_entropy
+from cvinspector.common.url_parts import get_url_parts
+from cvinspector.common.utils import _get_common_stats_default, _get_common_stats_for_number_list, get_entropy, \
+    load_webrequest_details
 
 logger = logging.getLogger(__name__)
 #logger.setLevel("DEBUG")
 
 
+# memoized, returns UrlParts which has the subdomain, domain and suffix of tldextract
 def extract_tld(url):
-    return tldextract.extract(url)
+    return get_url_parts(url)
 
 
 def get_second_level_domain_from_tld(url_tld):
@@ -126,8 +127,8 @@ def remove_last_path(path):
 
 
 def get_path_and_query_params(url):
-    parsed_url = urlparse(url)
-    return parsed_url.path, parsed_url.query
+    url_parts = get_url_parts(url)
+    return url_parts.path, url_parts.query
 
 
 def is_first_party_webrequest(webreq, crawled_url_domain_only):
@@ -624,12 +625,11 @@ def get_content_type_mapping(requests, content_type_resources):
 
 
 def get_webrequest_detail_value(webrequest, detail_name):
-    import json
     if webrequest and webrequest.get("event"):
         req_details = webrequest.get("event").get("details")
         if req_details:
             try:
-                req_details_json = json.loads(req_details)
+                req_details_json = load_webrequest_details(req_details)
                 if req_details_json.get("statusCode") != 200:
                     return None
                 if detail_name in req_details_json:
@@ -0,0 +1,300 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import concurrent.futures
+import logging
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# tasks that can wait in the queue per worker before submit blocks
+WORK_EXECUTOR_PENDING_PER_WORKER = 2
+
+# a task that raised or timed out, url is the site it was processing (if known)
+TaskFailure = namedtuple("TaskFailure",
+                         ["task_name", "url", "exception", "traceback"])
+
+
+class SiteTaskError(Exception):
+    """
+    Raised by a task for the exception of one site, so its TaskFailure has the url
+    even when the task processes a chunk of sites.
+    """
+    def __init__(self, url, exception):
+        Exception.__init__(self, "%s: %s" % (url, repr(exception)))
+        self.url = url
+        self.exception = exception
+
+
+class SiteTaskErrors(Exception):
+    """
+    Raised by a task for the exceptions of some sites of its chunk, after it finished
+    the other sites. Each SiteTaskError is reported as its own TaskFailure.
+    """
+    def __init__(self, site_errors):
+        Exception.__init__(
+            self, "%d sites failed: %s" %
+            (len(site_errors), ", ".join(str(site_error.url)
+                                         for site_error in site_errors)))
+        self.site_errors = site_errors
+
+
+class WorkExecutorError(Exception):
+    def __init__(self, failures):
+        Exception.__init__(
+            self, "%d tasks failed: %s" %
+            (len(failures), ", ".join(failure.task_name
+                                      for failure in failures)))
+        self.failures = failures
+
+
+class WorkProcessError(Exception):
+    """
+    Raised by the parent of worker processes when some of them exited non-zero
+    (a worker raises WorkExecutorError when one of its tasks failed).
+    """
+    def __init__(self, exitcodes):
+        Exception.__init__(
+            self, "%d worker processes failed: %s" %
+            (len(exitcodes), ", ".join("%s (exit code %s)" %
+                                       (name, str(exitcode))
+                                       for name, exitcode in exitcodes)))
+        self.exitcodes = exitcodes
+
+
+def join_work_processes(process_list):
+    """
+    Joins every process of process_list (multiprocessing.Process).
+    Returns (name, exitcode) of the processes that did not exit with 0.
+    """
+    failed = []
+    for process in process_list:
+        process.join()
+        if process.exitcode != 0:
+            logger.error("Worker process %s exited with %s", process.name,
+                         str(process.exitcode))
+            failed.append((process.name, process.exitcode))
+    return failed
+
+
+class _TaskInfo:
+    __slots__ = ["task_name", "url", "start_time", "timed_out"]
+
+    def __init__(self, task_name, url):
+        self.task_name = task_name
+        self.url = url
+        # set by the worker thread when the task starts
+        self.start_time = None
+        self.timed_out = False
+
+
+def log_task_progress(completed, submitted, task_name, failure):
+    logger.debug("Done with task %s, %d out of %d", task_name, completed,
+                 submitted)
+
+
+class WorkExecutor:
+    """
+    Runs tasks on up to max_workers threads (concurrent.futures), replacing the
+    threads lists polled with is_alive() and time.sleep.
+    - submit blocks while max_pending tasks are queued or running (backpressure)
+    - a task running for longer than task_timeout seconds is reported as failed,
+      no longer waited for and gives back its pending slot. Its thread cannot be
+      interrupted: it keeps running (and holding its worker) until the task returns,
+      and the interpreter still joins it at exit. So tasks should bound their own
+      blocking calls, the timeout only keeps wait and submit from hanging on them
+    - exceptions are kept as TaskFailure and logged by wait, with the url of the
+      site (from the url given to submit, or a SiteTaskError). A task of a chunk of
+      sites raises SiteTaskErrors for one TaskFailure per failed site
+    - progress_callback(completed, submitted, task_name, failure) is called once per
+      task, failure is None on success
+    Use it as a context manager, leaving the block waits for all tasks. It does not
+    raise their failures, call wait(raise_failures=True) in the block for that.
+    """
+    def __init__(self,
+                 max_workers,
+                 max_pending=None,
+                 task_timeout=None,
+                 progress_callback=log_task_progress,
+                 name="WorkExecutor"):
+        assert max_workers >= 1, "max_workers must be at least 1"
+        self.name = name
+        self.task_timeout = task_timeout
+        self.progress_callback = progress_callback
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name)
+        self.pending_slots = threading.BoundedSemaphore(
+            max_pending or max_workers * WORK_EXECUTOR_PENDING_PER_WORKER)
+        self.lock = threading.Lock()
+        self.tasks = dict()
+        self.submitted = 0
+        self.completed = 0
+        self.failures = []
+
+    def submit(self, func, *args, task_name=None, url=None, **kwargs):
+        self.pending_slots.acquire()
+        with self.lock:
+            self.submitted += 1
+            task_info = _TaskInfo(
+                task_name or "%s-%d" % (self.name, self.submitted), url)
+
+        try:
+            future = self.executor.submit(self._run_task, task_info, func,
+                                          args, kwargs)
+        except Exception:
+            self.pending_slots.release()
+            raise
+
+        with self.lock:
+            self.tasks[future] = task_info
+        # runs right away when the task is already done
+        future.add_done_callback(self._on_task_done)
+        return future
+
+    def _run_task(self, task_info, func, args, kwargs):
+        task_info.start_time = time.monotonic()
+        return func(*args, **kwargs)
+
+    def _on_task_done(self, future):
+        try:
+            self._record_task_done(future)
+        finally:
+            # the task stays in tasks until it is reported, so wait cannot return early
+            with self.lock:
+                task_info = self.tasks.pop(future, None)
+            # a timed out task already gave back its slot
+            if task_info is None or not task_info.timed_out:
+                self.pending_slots.release()
+
+    def _record_task_done(self, future):
+        with self.lock:
+            task_info = self.tasks.get(future)
+        if task_info is None or task_info.timed_out or future.cancelled():
+            return
+
+        failures = []
+        exception = future.exception()
+        if isinstance(exception, SiteTaskErrors):
+            for site_error in exception.site_errors:
+                failures.append(
+                    self._get_task_failure(task_info, site_error))
+        elif exception is not None:
+            failures.append(self._get_task_failure(task_info, exception))
+        self._report(task_info, failures)
+
+    def _get_task_failure(self, task_info, exception):
+        url = task_info.url
+        if isinstance(exception, SiteTaskError):
+            url = exception.url
+        return TaskFailure(
+            task_info.task_name, url, exception, "".join(
+                traceback.format_exception(type(exception), exception,
+                                           exception.__traceback__)))
+
+    def _report(self, task_info, failures):
+        with self.lock:
+            self.completed += 1
+            completed = self.completed
+            submitted = self.submitted
+            self.failures += failures
+
+        for failure in failures:
+            logger.error("%s - Task %s failed for %s: %s", self.name,
+                         failure.task_name, str(failure.url),
+                         repr(failure.exception))
+            logger.debug(failure.traceback)
+        if self.progress_callback:
+            # the first failure of the task, None on success
+            self.progress_callback(completed, submitted, task_info.task_name,
+                                   failures[0] if failures else None)
+
+    def _check_timeouts(self):
+        # returns the seconds until the next task could time out, None without timeout
+        if self.task_timeout is None:
+            return None
+
+        now = time.monotonic()
+        next_timeout = self.task_timeout
+        timed_out_tasks = []
+        with self.lock:
+            for future, task_info in self.tasks.items():
+                if task_info.timed_out or task_info.start_time is None or future.done(
+                ):
+                    continue
+                remaining = task_info.start_time + self.task_timeout - now
+                if remaining <= 0:
+                    task_info.timed_out = True
+                    timed_out_tasks.append(task_info)
+                else:
+                    next_timeout = min(next_timeout, remaining)
+
+        for task_info in timed_out_tasks:
+            self.pending_slots.release()
+            exception = TimeoutError("Task ran for more than %s seconds" %
+                                     str(self.task_timeout))
+            self._report(task_info, [
+                TaskFailure(task_info.task_name, task_info.url, exception,
+                            repr(exception))
+            ])
+        return next_timeout
+
+    def wait(self, raise_failures=False):
+        """
+        Waits until every submitted task is done or timed out.
+        Returns the failures, or raises them as WorkExecutorError.
+        """
+        while True:
+            wait_timeout = self._check_timeouts()
+            with self.lock:
+                waiting = [
+                    future for future, task_info in self.tasks.items()
+                    if not task_info.timed_out
+                ]
+            if not waiting:
+                break
+            concurrent.futures.wait(
+                waiting,
+                timeout=wait_timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+
+        with self.lock:
+            failures = list(self.failures)
+        if raise_failures and failures:
+            raise WorkExecutorError(failures)
+        return failures
+
+    def shutdown(self):
+        # does not join the threads of timed out tasks
+        with self.lock:
+            orphaned = [task_info.task_name for task_info in self.tasks.values()]
+        if orphaned:
+            logger.warning("%s - Not waiting for the threads of timed out tasks: %s",
+                           self.name, ", ".join(orphaned))
+        self.executor.shutdown(wait=not orphaned)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.shutdown()
+        return False
@@ -18,19 +18,37 @@ import logging
 import os
 import shutil
 import time
+from urllib.parse import urlparse
 
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 
 from cvinspector.common.utils import randomword
+from cvinspector.data_collect.profile_provisioner import DEFAULT_COPY_STRATEGY, get_profile_provisioner
 
 
 logger = logging.getLogger(__name__)
 #logger.setLevel("DEBUG")
 
+BLANK_CHROME_PAGE = "about:blank"
+
+# custom extensions that collect the webrequests and dom mutations
+CONTROL_CUSTOM_EXTENSIONS = [
+    "chromeext/vanilla_webrequests/build",
+    "chromeext/vanilla_dom_mutation/build"
+]
+VARIANT_CUSTOM_EXTENSIONS = [
+    "chromeext/circum_webrequests/build", "chromeext/circum_dom_mutation/build"
+]
+
+# storage types cleared for the contacted origins between trials
+RESET_STORAGE_TYPES = "local_storage,indexeddb,websql,service_workers,cache_storage,file_systems,shader_cache"
+
 
 def _get_common_driver_options(
     chrome_default_download_directory=None,
     allow_running_insecure_content=True,
+    display=None,
 ):
     # build options
     chrome_opt = webdriver.ChromeOptions()
@@ -38,6 +56,10 @@ def _get_common_driver_options(
     chrome_opt.add_argument('--disable-application-cache')
     chrome_opt.add_argument('--disable-infobars')
 
+    # render into a specific X display (used when running browsers in parallel)
+    if display:
+        chrome_opt.add_argument("--display=" + display)
+
     # trying no sandbox
     chrome_opt.add_argument('--no-sandbox')
 
@@ -64,15 +86,17 @@ def create_variant_driver(
         profile_path=None,
         allow_running_insecure_content=True,
         include_custom_extensions=True,
+        display=None,
         **kwargs):
 
     chrome_opt = _get_common_driver_options(
         chrome_default_download_directory=chrome_default_download_directory,
-        allow_running_insecure_content=allow_running_insecure_content)
+        allow_running_insecure_content=allow_running_insecure_content,
+        display=display)
 
     # load custom extension ABP, Web requests, DOM Mutations
     if include_custom_extensions:
-        custom_exts = chrome_ext_path + ",chromeext/circum_webrequests/build,chromeext/circum_dom_mutation/build"
+        custom_exts = ",".join([chrome_ext_path] + VARIANT_CUSTOM_EXTENSIONS)
         chrome_opt.add_argument("--load-extension=" + custom_exts)
 
     # Load profile
@@ -93,17 +117,18 @@ def create_control_driver(chrome_driver_path=None,
                           allow_running_insecure_content=True,
                           profile_path=None,
                           include_custom_extensions=True,
+                          display=None,
                           **kwargs):
 
     chrome_opt = _get_common_driver_options(
         chrome_default_download_directory=chrome_default_download_directory,
-        allow_running_insecure_content=allow_running_insecure_content)
+        allow_running_insecure_content=allow_running_insecure_content,
+        display=display)
 
     # load custom extension for webrequests collection
     if include_custom_extensions:
-        chrome_opt.add_argument(
-            "--load-extension=chromeext/vanilla_webrequests/build,chromeext/vanilla_dom_mutation/build"
-        )
+        chrome_opt.add_argument("--load-extension=" +
+                                ",".join(CONTROL_CUSTOM_EXTENSIONS))
 
     # Load profile
     if profile_path:
@@ -126,9 +151,110 @@ def quit_drivers(drivers):
             driver.quit()
 
 
+def _get_origin(url):
+    parsed_url = urlparse(url)
+    if parsed_url.scheme and parsed_url.netloc:
+        return parsed_url.scheme + "://" + parsed_url.netloc
+    return None
+
+
+def _get_frame_tree_urls(frame_tree):
+    urls = [frame_tree.get("frame", {}).get("url")]
+    urls += [
+        resource.get("url") for resource in frame_tree.get("resources", [])
+    ]
+    for child_frame_tree in frame_tree.get("childFrames", []):
+        urls += _get_frame_tree_urls(child_frame_tree)
+    return urls
+
+
+# Origins (scheme://host:port) of the documents and resources loaded in every window of the driver.
+# Must be called before leaving the page, third parties keep storage under these origins.
+def get_contacted_origins(driver):
+    urls = []
+    current_handle = driver.current_window_handle
+    for handle in driver.window_handles:
+        try:
+            driver.switch_to.window(handle)
+            # frames (including cross-origin iframes) and their subresources
+            frame_tree = driver.execute_cdp_cmd("Page.getResourceTree",
+                                                {}).get("frameTree", {})
+            urls += _get_frame_tree_urls(frame_tree)
+            # requests made by scripts (xhr, fetch, beacons) are only in the timing entries
+            urls += driver.execute_script(
+                "return window.performance.getEntriesByType('resource').map(function(entry) { return entry.name; });"
+            ) or []
+        except WebDriverException as e:
+            logger.debug("Could not get contacted origins of window %s: %s" %
+                         (handle, str(e)))
+    driver.switch_to.window(current_handle)
+
+    origins = set()
+    for url in urls:
+        if url and url.startswith("http"):
+            origin = _get_origin(url)
+            if origin:
+                origins.add(origin)
+    return sorted(origins)
+
+
+def reload_extensions(driver, ext_paths):
+    # chrome://extensions is allowed to call developerPrivate, which can reload unpacked extensions.
+    # Reloading drops whatever the extension kept in memory from the previous trial
+    ext_ids = [
+        get_id_of_unpacked_chrome_extension(os.path.abspath(ext_path))
+        for ext_path in ext_paths
+    ]
+    driver.get("chrome://extensions/")
+    for ext_id in ext_ids:
+        driver.execute_script(
+            "chrome.developerPrivate.reload(arguments[0], {failQuietly: true});",
+            ext_id)
+        logger.debug("reloaded extension %s" % ext_id)
+
+
+# Bring a driver that is reused across trials back to a clean state:
+# extra windows are closed, cookies/cache are cleared, storage is cleared for
+# the origins passed in (all origins the trial contacted, see get_contacted_origins)
+# and the extensions are reloaded.
+def reset_driver_state(driver_name,
+                       driver,
+                       origins=None,
+                       chrome_ext_path=None,
+                       include_custom_extensions=True):
+    # close popups and other windows opened by the page
+    window_handles = driver.window_handles
+    for handle in window_handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(window_handles[0])
+    driver.get(BLANK_CHROME_PAGE)
+
+    driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+    for origin in sorted(
+            set(_get_origin(url) for url in origins or []) - {None}):
+        driver.execute_cdp_cmd("Storage.clearDataForOrigin", {
+            "origin": origin,
+            "storageTypes": RESET_STORAGE_TYPES
+        })
+
+    if include_custom_extensions:
+        if driver_name == "control":
+            ext_paths = CONTROL_CUSTOM_EXTENSIONS
+        else:
+            ext_paths = VARIANT_CUSTOM_EXTENSIONS
+            if chrome_ext_path:
+                ext_paths = [chrome_ext_path] + ext_paths
+        reload_extensions(driver, ext_paths)
+
+    driver.get(BLANK_CHROME_PAGE)
+
+
 def create_new_profile(starting_profile_path,
                        profile_directory,
-                       new_profile_prefix=None):
+                       new_profile_prefix=None,
+                       copy_strategy=DEFAULT_COPY_STRATEGY):
     dest_profile_name = randomword(10)
     if new_profile_prefix:
         dest_profile_name = new_profile_prefix + dest_profile_name
@@ -138,7 +264,10 @@ def create_new_profile(starting_profile_path,
                  " FROM original profile " + starting_profile_path)
 
     try:
-        shutil.copytree(starting_profile_path, dest_profile_path)
+        # reflinks/hardlinks most of the profile instead of copying it
+        get_profile_provisioner(
+            starting_profile_path,
+            copy_strategy=copy_strategy).provision(dest_profile_path)
         return dest_profile_path
     except OSError as e:
         # If the error was caused because the source wasn't a directory
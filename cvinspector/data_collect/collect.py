@@ -22,10 +22,11 @@ import shutil
 import time
 from urllib.parse import urlparse
 
-import tldextract
 from pyvirtualdisplay import Display
 
+from cvinspector.common.url_parts import get_url_parts
 from cvinspector.data_collect.chrome import get_scroll_width_and_height
+from cvinspector.data_collect.page_settle import wait_for_page_settle
 
 logger = logging.getLogger(__name__)
 
@@ -222,11 +223,11 @@ def delete_profile(profile_path, thread_name=None):
 
 def is_first_party(url, original_domain, tld_result_orig=None):
     if tld_result_orig is None:
-        tld_result_orig = tldextract.extract(original_domain)
+        tld_result_orig = get_url_parts(original_domain)
 
     tld_result_orig_sld = _get_second_level_domain_from_tld(tld_result_orig)
 
-    tld_result_url = tldextract.extract(url)
+    tld_result_url = get_url_parts(url)
     tld_result_url_sld = _get_second_level_domain_from_tld(tld_result_url)
 
     if tld_result_orig_sld == tld_result_url_sld:
@@ -289,7 +290,7 @@ def process_beyond_landing_page(domain, hrefs):
 
     potential_crawl_pages = []
     if len(hrefs) > 0:
-        tld_result_orig = tldextract.extract(domain)
+        tld_result_orig = get_url_parts(domain)
         tld_result_orig_sld = _get_second_level_domain_from_tld(
             tld_result_orig)
         logger.debug("tld_result_orig %s" % str(tld_result_orig))
@@ -615,15 +616,50 @@ def _get_sleep_time(before_time, default_sleep_time):
     return sleep_time
 
 
-def start_virtual_screen(virtual_display_size=(1920, 3000)):
+def _wait_for_measurement(driver,
+                          before_time,
+                          thread_name=None,
+                          settle_quiet_window=0):
+    # settle_quiet_window > 0: stop early once the network and DOM were quiet that long.
+    # MEASUREMENT_TIMER stays the upper bound either way
+    if settle_quiet_window > 0:
+        wait_for_page_settle(driver,
+                             before_time,
+                             MEASUREMENT_TIMER,
+                             quiet_window=settle_quiet_window,
+                             thread_name=thread_name)
+        return
+
+    sleep_time = _get_sleep_time(before_time, MEASUREMENT_TIMER)
+    if sleep_time > 0:
+        logger.debug("%s - Sleeping for %d seconds" %
+                     (str(thread_name), sleep_time))
+        time.sleep(sleep_time)
+    else:
+        time.sleep(1)
+
+
+def start_virtual_screen(virtual_display_size=(1920, 3000),
+                         manage_global_env=True):
     width, height = virtual_display_size
     logger.debug("Creating virtual display with width %d and height %d" %
                  (width, height))
-    virtual_display = Display(visible=0, size=virtual_display_size)
+    if manage_global_env:
+        virtual_display = Display(visible=0, size=virtual_display_size)
+    else:
+        # do not touch $DISPLAY, callers pass the display to chrome directly
+        virtual_display = Display(visible=0,
+                                  size=virtual_display_size,
+                                  manage_global_env=False)
     virtual_display.start()
     return virtual_display
 
 
+def get_virtual_screen_name(virtual_display):
+    # value usable for chrome's --display argument, example ":1001"
+    return ":" + str(virtual_display.display)
+
+
 def stop_virtual_screen(virtual_display):
     if virtual_display:
         virtual_display.stop()
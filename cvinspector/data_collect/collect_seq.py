@@ -23,9 +23,13 @@ from selenium.common.exceptions import WebDriverException
 
 import cvinspector.data_collect.collect as collect_core
 from cvinspector.common.utils import randomword
-from cvinspector.data_collect.chrome import create_control_driver, create_variant_driver, \
+from cvinspector.data_collect.chrome import CONTROL_CUSTOM_EXTENSIONS, VARIANT_CUSTOM_EXTENSIONS, \
+    create_control_driver, create_variant_driver, \
     quit_drivers, save_screenshot_headless, set_all_hidden_imgs_iframes, \
-    create_new_profile, update_filter_list_adblock_plus_through_options
+    create_new_profile, get_contacted_origins, update_filter_list_adblock_plus_through_options
+from cvinspector.data_collect.driver_pool import DriverPool
+from cvinspector.data_collect.ndjson_sink import NDJSON_SINK_PORT, NDJSONSink
+from cvinspector.data_collect.trial_scheduler import TrialScheduler, interleave_trials
 
 logger = logging.getLogger(__name__)
 #logger.setLevel("DEBUG")
@@ -85,12 +89,14 @@ def _run_measurement_for_beyond_pages_only(
         domain_separator="__",
         trial_suffix="trial0",
         use_https=True,
+        settle_quiet_window=0,
         **kwargs):
 
     logger.debug("%s - Running measurements..." % str(thread_name))
 
     potential_pages = []
     success = False
+    contacted_origins = []
     original_domain = domain
     trunc_domain = domain
     random_suffix = random_suffix_input
@@ -142,14 +148,11 @@ def _run_measurement_for_beyond_pages_only(
 
         # sleeping
         if should_sleep:
-            sleep_time = collect_core._get_sleep_time(
-                before_time, collect_core.MEASUREMENT_TIMER)
-            if sleep_time > 0:
-                logger.debug("%s - Sleeping for %d seconds" %
-                             (str(thread_name), sleep_time))
-                time.sleep(sleep_time)
-            else:
-                time.sleep(1)
+            collect_core._wait_for_measurement(
+                driver,
+                before_time,
+                thread_name=thread_name,
+                settle_quiet_window=settle_quiet_window)
 
         # get domain from driver if it is really different
         domain_from_driver = driver.current_url
@@ -233,6 +236,8 @@ def _run_measurement(driver,
                      domain_separator="__",
                      trial_suffix="trial0",
                      use_https=True,
+                     driver_pool=None,
+                     settle_quiet_window=0,
                      **kwargs):
 
     logger.debug("%s - Running measurements..." % str(thread_name))
@@ -290,14 +295,11 @@ def _run_measurement(driver,
 
         # sleeping
         if should_sleep:
-            sleep_time = collect_core._get_sleep_time(
-                before_time, collect_core.MEASUREMENT_TIMER)
-            if sleep_time > 0:
-                logger.debug("%s - Sleeping for %d seconds" %
-                             (str(thread_name), sleep_time))
-                time.sleep(sleep_time)
-            else:
-                time.sleep(1)
+            collect_core._wait_for_measurement(
+                driver,
+                before_time,
+                thread_name=thread_name,
+                settle_quiet_window=settle_quiet_window)
 
         # get more pages from this domain
         if find_more_pages:
@@ -351,15 +353,20 @@ def _run_measurement(driver,
                                      source_file_name_directory,
                                      thread_name=thread_name)
 
+        # the pooled driver is reset for every origin of the trial, not only the site
+        if driver_pool:
+            contacted_origins = get_contacted_origins(driver)
+
         # save raw data
         collect_core._force_save_data([(driver_name, driver)],
                                       thread_name=thread_name,
                                       should_sleep=should_sleep)
 
-        # quit regular drivers
-        quit_drivers([(driver_name, driver)])
-        driver = None
-        driver_name = None
+        # quit regular drivers (pooled ones are handed back below)
+        if not driver_pool:
+            quit_drivers([(driver_name, driver)])
+            driver = None
+            driver_name = None
         success = True
 
     except Exception as e:
@@ -385,11 +392,26 @@ def _run_measurement(driver,
         time.sleep(sleep_time_sec)
 
         # cleanup
-        quit_drivers([(driver_name, driver)])
-        driver = None
-        driver_name = None
+        if not driver_pool:
+            quit_drivers([(driver_name, driver)])
+            driver = None
+            driver_name = None
         success = False
 
+    finally:
+        # hand a pooled driver back exactly once: reset and reused, or recycled on failure
+        if driver_pool and driver:
+            try:
+                if success:
+                    driver_pool.release(driver,
+                                        origins=[domain, original_domain] +
+                                        contacted_origins)
+                else:
+                    driver_pool.release(driver, crashed=True)
+            except Exception as e:
+                logger.warn("%s - Could not release driver: %s" %
+                            (str(thread_name), str(e)))
+
     time.sleep(1)
 
     logger.info("%s - Done with running measurements, domain %s, success: %s" %
@@ -404,6 +426,185 @@ def _clean_profile(profile_path, thread_name):
     collect_core.delete_profile(profile_path, thread_name=thread_name)
 
 
+def _start_worker_virtual_screen():
+    # each parallel browser gets its own Xvfb so they do not share a screen
+    virtual_display = collect_core.start_virtual_screen(
+        manage_global_env=False)
+    return virtual_display, collect_core.get_virtual_screen_name(
+        virtual_display)
+
+
+# Process one domain with control and variant trials spread over max_browsers browsers.
+# The first control trial runs alone since it decides the scroll height, random suffix
+# and http(s) used by every other trial. The remaining trials are interleaved.
+# Don't do variant if the first control trial did not work
+def _process_control_and_variant_parallel(domain,
+                                          rank,
+                                          pagesource_dir,
+                                          screenshot_dir,
+                                          downloads_dir,
+                                          find_more_pages=False,
+                                          thread_name=None,
+                                          trials=4,
+                                          anticv_on=False,
+                                          use_https=True,
+                                          max_browsers=2,
+                                          driver_factory=None,
+                                          display_factory=None,
+                                          settle_quiet_window=0,
+                                          **kwargs):
+
+    logger.info("%s - Starting control and variant with %d browsers: %s",
+                str(thread_name), max_browsers, str(domain))
+    logger.info("===============================")
+
+    dyn_profile_path__control = create_control_dyn_profiles(
+        anticv_on=anticv_on, thread_name=thread_name)
+
+    driver_name, control_driver = create_control_driver(
+        profile_path=dyn_profile_path__control,
+        chrome_default_download_directory=downloads_dir,
+        **kwargs)
+
+    control_success, scrollto_height, potential_pages, random_suffix, is_https = _run_measurement(
+        control_driver,
+        driver_name,
+        domain,
+        rank,
+        pagesource_dir,
+        screenshot_dir,
+        profile_path=dyn_profile_path__control,
+        thread_name=thread_name,
+        is_control=True,
+        find_more_pages=find_more_pages,
+        trial_suffix="trial0",
+        use_https=use_https,
+        settle_quiet_window=settle_quiet_window)
+
+    _clean_profile(dyn_profile_path__control, thread_name)
+
+    if not control_success:
+        logger.info("\t%s - First control trial failed, skipping variant: %s" %
+                    (str(thread_name), str(domain)))
+        return False, potential_pages, is_https
+
+    def _create_profile(is_control, worker_name):
+        if is_control:
+            return create_control_dyn_profiles(anticv_on=anticv_on,
+                                               thread_name=worker_name)
+        return create_variant_dyn_profiles(anticv_on=anticv_on,
+                                           thread_name=worker_name)
+
+    def _create_driver(is_control, profile_path, display_name):
+        if is_control:
+            return create_control_driver(
+                profile_path=profile_path,
+                chrome_default_download_directory=downloads_dir,
+                display=display_name,
+                **kwargs)
+        return create_variant_driver(
+            profile_path=profile_path,
+            chrome_default_download_directory=downloads_dir,
+            display=display_name,
+            **kwargs)
+
+    def _measure(driver, driver_name, trial, profile_path=None,
+                 thread_name=None):
+        if trial.is_control:
+            return _run_measurement(driver,
+                                    driver_name,
+                                    domain,
+                                    rank,
+                                    pagesource_dir,
+                                    screenshot_dir,
+                                    profile_path=profile_path,
+                                    thread_name=thread_name,
+                                    is_control=True,
+                                    find_more_pages=find_more_pages,
+                                    random_suffix_input=random_suffix,
+                                    trial_suffix="trial" +
+                                    str(trial.trial_number),
+                                    use_https=is_https,
+                                    settle_quiet_window=settle_quiet_window)
+        # make sure we scroll to same height and use the same random suffix for variant
+        return _run_measurement(driver,
+                                driver_name,
+                                domain,
+                                rank,
+                                pagesource_dir,
+                                screenshot_dir,
+                                profile_path=profile_path,
+                                thread_name=thread_name,
+                                is_control=False,
+                                scrollto_height=scrollto_height,
+                                random_suffix_input=random_suffix,
+                                trial_suffix="trial" + str(trial.trial_number),
+                                use_https=is_https,
+                                settle_quiet_window=settle_quiet_window,
+                                **kwargs)
+
+    scheduler = TrialScheduler(
+        driver_factory or _create_driver,
+        _measure,
+        max_browsers=max_browsers,
+        profile_factory=_create_profile,
+        profile_cleaner=_clean_profile,
+        display_factory=display_factory or _start_worker_virtual_screen,
+        display_cleaner=collect_core.stop_virtual_screen,
+        thread_name=thread_name)
+
+    scheduled_trials = interleave_trials(list(range(1, trials)),
+                                         list(range(trials)))
+    variant_success = True
+    for trial, result in scheduler.run(scheduled_trials):
+        trial_success, _, potential_pages_temp, _, _ = result
+        if trial.is_control:
+            control_success = control_success and trial_success
+            if len(potential_pages) == 0:
+                potential_pages = potential_pages_temp
+        else:
+            variant_success = variant_success and trial_success
+
+    logger.debug("Control Success %s, Variant Success %s" %
+                 (str(control_success), str(variant_success)))
+
+    overall_success = control_success and variant_success
+    return overall_success, potential_pages, is_https
+
+
+def create_driver_pool(downloads_dir,
+                       anticv_on=False,
+                       max_trials_per_driver=20,
+                       thread_name=None,
+                       **kwargs):
+    def _create_profile(is_control):
+        if is_control:
+            return create_control_dyn_profiles(anticv_on=anticv_on,
+                                               thread_name=thread_name)
+        return create_variant_dyn_profiles(anticv_on=anticv_on,
+                                           thread_name=thread_name)
+
+    def _create_driver(is_control, profile_path):
+        if is_control:
+            return create_control_driver(
+                profile_path=profile_path,
+                chrome_default_download_directory=downloads_dir,
+                **kwargs)
+        return create_variant_driver(
+            profile_path=profile_path,
+            chrome_default_download_directory=downloads_dir,
+            **kwargs)
+
+    return DriverPool(
+        _create_driver,
+        max_trials_per_driver=max_trials_per_driver,
+        profile_factory=_create_profile,
+        profile_cleaner=lambda profile_path: _clean_profile(
+            profile_path, thread_name),
+        reset_kwargs={"chrome_ext_path": kwargs.get("chrome_ext_path")},
+        thread_name=thread_name)
+
+
 # Process one domain only with control and variant sequentially
 # Don't do variant if control did not work
 def process_control_and_variant(domain,
@@ -416,8 +617,26 @@ def process_control_and_variant(domain,
                                 trials=4,
                                 anticv_on=False,
                                 use_https=True,
+                                max_browsers=1,
+                                driver_pool=None,
+                                settle_quiet_window=0,
                                 **kwargs):
 
+    if max_browsers > 1:
+        return _process_control_and_variant_parallel(
+            domain,
+            rank,
+            pagesource_dir,
+            screenshot_dir,
+            downloads_dir,
+            find_more_pages=find_more_pages,
+            thread_name=thread_name,
+            trials=trials,
+            anticv_on=anticv_on,
+            use_https=use_https,
+            max_browsers=max_browsers,
+            settle_quiet_window=settle_quiet_window,
+            **kwargs)
 
     logger.info("%s - Starting control: %s", str(thread_name), str(domain))
     logger.info("===============================")
@@ -431,17 +650,22 @@ def process_control_and_variant(domain,
         logger.info("\t%s - Starting control trial %d: %s" %
                     (str(thread_name), trial_number, str(domain)))
 
-        # make new profiles per domain
-        dyn_profile_path__control = create_control_dyn_profiles(
-            anticv_on=anticv_on, thread_name=thread_name)
-        logger.debug("\t%s - Creating control profile %s" %
-                     (str(thread_name), dyn_profile_path__control))
+        if driver_pool:
+            # reuse a warm driver, its profile is owned by the pool
+            dyn_profile_path__control = None
+            driver_name, control_driver = driver_pool.acquire(True)
+        else:
+            # make new profiles per domain
+            dyn_profile_path__control = create_control_dyn_profiles(
+                anticv_on=anticv_on, thread_name=thread_name)
+            logger.debug("\t%s - Creating control profile %s" %
+                         (str(thread_name), dyn_profile_path__control))
 
-        # create control driver
-        driver_name, control_driver = create_control_driver(
-            profile_path=dyn_profile_path__control,
-            chrome_default_download_directory=downloads_dir,
-            **kwargs)
+            # create control driver
+            driver_name, control_driver = create_control_driver(
+                profile_path=dyn_profile_path__control,
+                chrome_default_download_directory=downloads_dir,
+                **kwargs)
 
         # run measurement for control
         control_success_temp, scrollto_height_temp, potential_pages_temp, random_suffix_temp, is_https = _run_measurement(
@@ -457,7 +681,9 @@ def process_control_and_variant(domain,
             find_more_pages=find_more_pages,
             random_suffix_input=random_suffix,
             trial_suffix="trial" + str(trial_number),
-            use_https=is_https)
+            use_https=is_https,
+            driver_pool=driver_pool,
+            settle_quiet_window=settle_quiet_window)
 
         _clean_profile(dyn_profile_path__control, thread_name)
 
@@ -484,17 +710,23 @@ def process_control_and_variant(domain,
             logger.info("\t%s - Starting variant trial %d: %s" %
                         (str(thread_name), trial_number, str(domain)))
 
-            # make new profiles per domain
-            dyn_profile_path__variant = create_variant_dyn_profiles(
-                anticv_on=anticv_on, thread_name=thread_name)
-            logger.debug("\t%s - Creating variant profile %s" %
-                         (str(thread_name), dyn_profile_path__variant))
-
-            # move on to variant
-            variant_driver_name, variant_driver = create_variant_driver(
-                chrome_default_download_directory=downloads_dir,
-                profile_path=dyn_profile_path__variant,
-                **kwargs)
+            if driver_pool:
+                # reuse a warm driver, its profile is owned by the pool
+                dyn_profile_path__variant = None
+                variant_driver_name, variant_driver = driver_pool.acquire(
+                    False)
+            else:
+                # make new profiles per domain
+                dyn_profile_path__variant = create_variant_dyn_profiles(
+                    anticv_on=anticv_on, thread_name=thread_name)
+                logger.debug("\t%s - Creating variant profile %s" %
+                             (str(thread_name), dyn_profile_path__variant))
+
+                # move on to variant
+                variant_driver_name, variant_driver = create_variant_driver(
+                    chrome_default_download_directory=downloads_dir,
+                    profile_path=dyn_profile_path__variant,
+                    **kwargs)
 
             # run measurement for control
             # make sure we scroll to same height for variant
@@ -514,6 +746,8 @@ def process_control_and_variant(domain,
                 random_suffix_input=random_suffix,
                 trial_suffix="trial" + str(trial_number),
                 use_https=is_https,
+                driver_pool=driver_pool,
+                settle_quiet_window=settle_quiet_window,
                 **kwargs)
 
             _clean_profile(dyn_profile_path__variant, thread_name)
@@ -542,6 +776,8 @@ def process_sites(file_data,
                   beyond_landing_pages=True,
                   trials=4,
                   beyond_landing_pages_only=False,
+                  max_browsers=1,
+                  driver_pool=None,
                   **kwargs):
 
     BEYOND_LANDING_PAGE_LIMIT = 1
@@ -566,6 +802,8 @@ def process_sites(file_data,
                         thread_name=thread_name,
                         trials=trials,
                         anticv_on=anticv_on,
+                        max_browsers=max_browsers,
+                        driver_pool=driver_pool,
                         **kwargs)
                 else:
                     # make new profiles per domain
@@ -618,6 +856,8 @@ def process_sites(file_data,
                                                     trials=trials,
                                                     anticv_on=anticv_on,
                                                     use_https=is_https,
+                                                    max_browsers=max_browsers,
+                                                    driver_pool=driver_pool,
                                                     **kwargs)
 
             except WebDriverException as e:
@@ -656,6 +896,10 @@ def run_data_collection(csv_file_path,
                         beyond_landing_pages=True,
                         beyond_landing_pages_only=False,
                         by_rank=True,
+                        max_browsers=1,
+                        driver_pool_max_trials=0,
+                        stream_output=False,
+                        stream_output_port=NDJSON_SINK_PORT,
                         **kwargs):
 
     thread_name = "Process-" + randomword(5)
@@ -694,6 +938,14 @@ def run_data_collection(csv_file_path,
         # go by file index order and not rank
         file_data_chunk = file_data[start_index:end_index]
 
+    # the extensions stream their events to this sink instead of keeping them in memory
+    ndjson_sink = None
+    if stream_output:
+        ndjson_sink = NDJSONSink(downloads_dir, port=stream_output_port)
+        ndjson_sink.start()
+        ndjson_sink.write_extension_configs(CONTROL_CUSTOM_EXTENSIONS +
+                                            VARIANT_CUSTOM_EXTENSIONS)
+
     retry = True
     max_retry = 3
     retry_count = 0
@@ -702,6 +954,16 @@ def run_data_collection(csv_file_path,
         # start virtual display
         virtual_display = collect_core.start_virtual_screen()
 
+        # warm drivers are only used when trials run sequentially
+        driver_pool = None
+        if driver_pool_max_trials > 0 and max_browsers <= 1:
+            driver_pool = create_driver_pool(
+                downloads_dir,
+                anticv_on=anticv_on,
+                max_trials_per_driver=driver_pool_max_trials,
+                thread_name=thread_name,
+                **kwargs)
+
         try:
             process_sites(file_data_chunk,
                           pagesource_dir,
@@ -713,6 +975,8 @@ def run_data_collection(csv_file_path,
                           trials=trials,
                           beyond_landing_pages=beyond_landing_pages,
                           beyond_landing_pages_only=beyond_landing_pages_only,
+                          max_browsers=max_browsers,
+                          driver_pool=driver_pool,
                           **kwargs)
 
             retry = False
@@ -722,12 +986,18 @@ def run_data_collection(csv_file_path,
             logger.warn("%s - Major exception: Retrying crawling again %d" %
                         (str(thread_name), retry_count))
 
+        if driver_pool:
+            driver_pool.close()
+
         # stop the virtual display
         if virtual_display is not None:
             collect_core.stop_virtual_screen(virtual_display)
 
         time.sleep(30)
 
+    if ndjson_sink:
+        ndjson_sink.stop()
+
     logger.info("%s - Done" % str(thread_name))
 
 
@@ -0,0 +1,167 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import threading
+
+from cvinspector.data_collect.chrome import reset_driver_state
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+
+class PooledDriver:
+    def __init__(self, driver_name, driver, is_control, profile_path=None):
+        self.driver_name = driver_name
+        self.driver = driver
+        self.is_control = is_control
+        self.profile_path = profile_path
+        self.trials_used = 0
+
+
+class DriverPool:
+    """
+    Keeps chrome drivers (and their chromedriver processes) alive between trials.
+    A released driver is reset instead of quit, and it is only recycled
+    (quit + profile deleted) after max_trials_per_driver trials, when it crashed,
+    or when the reset itself fails.
+
+    driver_factory(is_control, profile_path) -> (driver_name, driver)
+    profile_factory(is_control) -> profile_path
+    profile_cleaner(profile_path)
+    reset_func(driver_name, driver, origins=None, **reset_kwargs)
+    """
+    def __init__(self,
+                 driver_factory,
+                 max_trials_per_driver=20,
+                 profile_factory=None,
+                 profile_cleaner=None,
+                 reset_func=reset_driver_state,
+                 reset_kwargs=None,
+                 thread_name=None):
+
+        assert max_trials_per_driver >= 1, "max_trials_per_driver must be at least 1"
+        self.driver_factory = driver_factory
+        self.max_trials_per_driver = max_trials_per_driver
+        self.profile_factory = profile_factory
+        self.profile_cleaner = profile_cleaner
+        self.reset_func = reset_func
+        self.reset_kwargs = reset_kwargs or dict()
+        self.thread_name = thread_name
+
+        self.lock = threading.Lock()
+        # is_control --> idle PooledDriver list
+        self.idle_drivers = {True: [], False: []}
+        # id(driver) --> PooledDriver that is currently handed out
+        self.busy_drivers = dict()
+
+        self.launch_count = 0
+        self.reuse_count = 0
+        self.recycle_count = 0
+        self.crash_count = 0
+
+    def _launch(self, is_control):
+        profile_path = None
+        if self.profile_factory:
+            profile_path = self.profile_factory(is_control)
+        driver_name, driver = self.driver_factory(is_control, profile_path)
+        with self.lock:
+            self.launch_count += 1
+        logger.debug("%s - Launched new %s driver", str(self.thread_name),
+                     driver_name)
+        return PooledDriver(driver_name, driver, is_control,
+                            profile_path=profile_path)
+
+    def _recycle(self, pooled):
+        logger.debug("%s - Recycling %s driver after %d trials",
+                     str(self.thread_name), pooled.driver_name,
+                     pooled.trials_used)
+        try:
+            pooled.driver.quit()
+        except Exception as e:
+            logger.debug("%s - Could not quit driver: %s",
+                         str(self.thread_name), str(e))
+        if self.profile_cleaner and pooled.profile_path:
+            self.profile_cleaner(pooled.profile_path)
+        with self.lock:
+            self.recycle_count += 1
+
+    def acquire(self, is_control):
+        pooled = None
+        with self.lock:
+            if self.idle_drivers[is_control]:
+                pooled = self.idle_drivers[is_control].pop()
+                self.reuse_count += 1
+
+        if pooled is None:
+            pooled = self._launch(is_control)
+
+        pooled.trials_used += 1
+        with self.lock:
+            self.busy_drivers[id(pooled.driver)] = pooled
+        return pooled.driver_name, pooled.driver
+
+    def release(self, driver, crashed=False, origins=None):
+        with self.lock:
+            pooled = self.busy_drivers.pop(id(driver), None)
+        assert pooled is not None, "Driver was not acquired from this pool"
+
+        if crashed:
+            with self.lock:
+                self.crash_count += 1
+            self._recycle(pooled)
+            return
+
+        if pooled.trials_used >= self.max_trials_per_driver:
+            self._recycle(pooled)
+            return
+
+        try:
+            self.reset_func(pooled.driver_name,
+                            pooled.driver,
+                            origins=origins,
+                            **self.reset_kwargs)
+        except Exception as e:
+            logger.warning("%s - Could not reset %s driver, recycling: %s",
+                           str(self.thread_name), pooled.driver_name, str(e))
+            with self.lock:
+                self.crash_count += 1
+            self._recycle(pooled)
+            return
+
+        with self.lock:
+            self.idle_drivers[pooled.is_control].append(pooled)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "launch_count": self.launch_count,
+                "reuse_count": self.reuse_count,
+                "recycle_count": self.recycle_count,
+                "crash_count": self.crash_count
+            }
+
+    def close(self):
+        with self.lock:
+            to_recycle = self.idle_drivers[True] + self.idle_drivers[False] + list(
+                self.busy_drivers.values())
+            self.idle_drivers = {True: [], False: []}
+            self.busy_drivers = dict()
+
+        for pooled in to_recycle:
+            self._recycle(pooled)
+
+        logger.info("%s - Driver pool closed: %s", str(self.thread_name),
+                    str(self.get_stats()))
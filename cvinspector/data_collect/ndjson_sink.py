@@ -0,0 +1,234 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import json
+import logging
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from cvinspector.common.utils import NDJSON_FILE_EXTENSION, NDJSON_META_TYPE, JSON_DOMMUTATION_KEY, \
+    JSON_WEBREQUEST_KEY
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# default streamSinkUrl in the background.js of the custom extensions
+NDJSON_SINK_HOST = "127.0.0.1"
+NDJSON_SINK_PORT = 8799
+# written into the custom extension directories, tells them the url of the sink
+NDJSON_SINK_CONFIG_FILE_NAME = "ndjson_sink.json"
+# only the custom extensions may post events, not the pages visited by the crawler
+NDJSON_SINK_ALLOWED_ORIGIN_PREFIX = "chrome-extension://"
+
+# a stream that was never closed (crashed trial) keeps this suffix
+NDJSON_PARTIAL_SUFFIX = ".partial" + NDJSON_FILE_EXTENSION
+
+_STREAM_ID_RE = re.compile(r"^[A-Za-z0-9_\-]+$")
+# characters chrome does not allow in downloaded file names
+_UNSAFE_FILE_NAME_RE = re.compile(r'[\\/:*?"<>|~\x00-\x1f]')
+
+
+def get_ndjson_file_name(file_name):
+    # same name as the json download of the extension, with the ndjson extension
+    return _UNSAFE_FILE_NAME_RE.sub("_", file_name) + NDJSON_FILE_EXTENSION
+
+
+def write_json_from_ndjson(ndjson_file_path, json_file_path, events_key,
+                           file_data):
+    # writes the same json the extension would have downloaded, one event at a time
+    with open(ndjson_file_path) as ndjson_file:
+        with open(json_file_path, 'w') as json_file:
+            json_file.write('{"url": ' + json.dumps(file_data.get("url")) +
+                            ', ' + json.dumps(events_key) + ': [')
+            is_first = True
+            for line in ndjson_file:
+                line = line.strip()
+                if not line or (NDJSON_META_TYPE in line and json.loads(
+                        line).get("type") == NDJSON_META_TYPE):
+                    continue
+                if not is_first:
+                    json_file.write(', ')
+                json_file.write(line)
+                is_first = False
+            json_file.write(']')
+            for key, value in file_data.items():
+                # startTime, endTime, schemaVersion
+                if key not in ["url", "filename", "type"]:
+                    json_file.write(', ' + json.dumps(key) + ': ' +
+                                    json.dumps(value))
+            json_file.write('}')
+
+
+class NDJSONSinkRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _respond(self, status_code, body=b"ok"):
+        self.send_response(status_code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/ping":
+            self._respond(200)
+        else:
+            self._respond(404, b"not found")
+
+    def do_POST(self):
+        url_parsed = urlparse(self.path)
+        stream_id = parse_qs(url_parsed.query).get("stream", [""])[0]
+        content_length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(content_length)
+
+        origin = self.headers.get("Origin", "")
+        if not origin.startswith(NDJSON_SINK_ALLOWED_ORIGIN_PREFIX):
+            logger.warning("NDJSON sink rejected %s from origin %s",
+                           url_parsed.path, origin or "None")
+            self._respond(403, b"forbidden")
+            return
+
+        if not _STREAM_ID_RE.match(stream_id):
+            self._respond(400, b"bad stream id")
+            return
+
+        try:
+            if url_parsed.path == "/append":
+                self.server.sink.append(stream_id, body)
+            elif url_parsed.path == "/close":
+                self.server.sink.close_stream(stream_id, json.loads(body))
+            else:
+                self._respond(404, b"not found")
+                return
+        except Exception as e:
+            logger.warning("NDJSON sink could not handle %s for stream %s: %s",
+                           url_parsed.path, stream_id, str(e))
+            self._respond(500, b"error")
+            return
+
+        self._respond(200)
+
+
+class NDJSONSink:
+    """
+    Local HTTP sink for the custom extensions. Each page visit of a tab is a stream.
+    Its events are appended as NDJSON lines to <stream id>.partial.ndjson and, once the
+    extension saves the page, a metadata line is added and the file is renamed to the
+    name the json download would have had (but with .ndjson).
+    With write_json, the closed stream is also written out in the json format of the
+    downloads so the rest of the pipeline can read it, and the .ndjson is only kept
+    when keep_ndjson is set.
+    The server handles one request at a time, so appends are written in order.
+    Only posts from extension origins are accepted. If the port is taken, the sink binds
+    to a free port instead; write_extension_configs tells the extensions where it is.
+    """
+    def __init__(self,
+                 output_directory,
+                 host=NDJSON_SINK_HOST,
+                 port=NDJSON_SINK_PORT,
+                 write_json=True,
+                 keep_ndjson=False):
+        self.output_directory = output_directory
+        self.host = host
+        self.port = port
+        self.write_json = write_json
+        self.keep_ndjson = keep_ndjson
+        self.server = None
+        self.thread = None
+        self.config_paths = []
+
+    def _get_partial_path(self, stream_id):
+        return os.path.join(self.output_directory,
+                            stream_id + NDJSON_PARTIAL_SUFFIX)
+
+    def append(self, stream_id, lines):
+        with open(self._get_partial_path(stream_id), 'ab') as stream_file:
+            stream_file.write(lines)
+
+    def close_stream(self, stream_id, file_data):
+        partial_path = self._get_partial_path(stream_id)
+        file_data["type"] = NDJSON_META_TYPE
+        with open(partial_path, 'a') as stream_file:
+            stream_file.write(json.dumps(file_data) + "\n")
+
+        file_name = file_data.get("filename") or stream_id
+        file_path = os.path.join(self.output_directory,
+                                 get_ndjson_file_name(file_name))
+        os.replace(partial_path, file_path)
+        logger.debug("Closed NDJSON stream %s as %s", stream_id, file_path)
+
+        if self.write_json:
+            events_key = JSON_WEBREQUEST_KEY
+            if JSON_DOMMUTATION_KEY in file_name:
+                events_key = JSON_DOMMUTATION_KEY
+            json_file_path = file_path[:-len(NDJSON_FILE_EXTENSION)] + ".json"
+            write_json_from_ndjson(file_path, json_file_path, events_key,
+                                   file_data)
+            if not self.keep_ndjson:
+                os.remove(file_path)
+
+    def get_url(self):
+        return "http://%s:%d" % (self.host, self.port)
+
+    def write_extension_configs(self, ext_paths):
+        # must be called before the drivers are launched, the extensions read it on startup
+        for ext_path in ext_paths:
+            if not os.path.isdir(ext_path):
+                logger.warning(
+                    "Could not write NDJSON sink config, %s does not exist",
+                    ext_path)
+                continue
+            with open(os.path.join(ext_path, NDJSON_SINK_CONFIG_FILE_NAME),
+                      'w') as config_file:
+                json.dump({"url": self.get_url()}, config_file)
+            self.config_paths.append(
+                os.path.join(ext_path, NDJSON_SINK_CONFIG_FILE_NAME))
+
+    def start(self):
+        try:
+            self.server = HTTPServer((self.host, self.port),
+                                     NDJSONSinkRequestHandler)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            logger.warning(
+                "NDJSON sink port %d is in use (another crawl?), using a free port",
+                self.port)
+            self.server = HTTPServer((self.host, 0), NDJSONSinkRequestHandler)
+        self.port = self.server.server_address[1]
+        self.server.sink = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        logger.info("Started NDJSON sink on %s:%d writing to %s", self.host,
+                    self.port, self.output_directory)
+
+    def stop(self):
+        # the extensions of a later crawl without the sink fall back to the default port
+        for config_path in self.config_paths:
+            if os.path.isfile(config_path):
+                os.remove(config_path)
+        self.config_paths = []
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+            self.thread = None
@@ -0,0 +1,191 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+SETTLE_STATE_WAITING = "waiting"
+SETTLE_STATE_QUIET = "quiet"
+SETTLE_STATE_TIMEOUT = "timeout"
+
+DEFAULT_SETTLE_QUIET_WINDOW = 3  # in seconds
+DEFAULT_SETTLE_MIN_WAIT = 5  # in seconds, never settle before this
+DEFAULT_SETTLE_POLL_INTERVAL = 0.5  # in seconds
+
+# requests pending longer than this are long-lived (websockets, long polling, streams)
+# and do not count as network activity, otherwise those pages would always time out
+SETTLE_MAX_PENDING_AGE = 10  # in seconds
+
+# how long the page waits for the extensions to answer a settle query, in ms
+SETTLE_QUERY_TIMEOUT_MS = 300
+
+# Asks the custom extensions for their counters through the same window event channel
+# used by AnticvFileNameEvent. The webrequests extension answers with AnticvNetworkSettleEvent
+# and the dom mutation extension with AnticvDomSettleEvent (details are JSON strings).
+SETTLE_QUERY_JS = """
+var callback = arguments[arguments.length - 1];
+var state = {now: new Date().getTime(), network: null, dom: null};
+var finished = false;
+function finish() {
+    if (finished) { return; }
+    finished = true;
+    window.removeEventListener("AnticvNetworkSettleEvent", onNetwork, true);
+    window.removeEventListener("AnticvDomSettleEvent", onDom, true);
+    callback(state);
+}
+function onNetwork(event) {
+    state.network = event.detail;
+    if (state.dom !== null) { finish(); }
+}
+function onDom(event) {
+    state.dom = event.detail;
+    if (state.network !== null) { finish(); }
+}
+window.addEventListener("AnticvNetworkSettleEvent", onNetwork, true);
+window.addEventListener("AnticvDomSettleEvent", onDom, true);
+window.dispatchEvent(new CustomEvent("AnticvSettleQueryEvent"));
+setTimeout(finish, %d);
+""" % SETTLE_QUERY_TIMEOUT_MS
+
+
+def find_settle_time(event_times,
+                     start_time,
+                     quiet_window=DEFAULT_SETTLE_QUIET_WINDOW,
+                     max_wait=None,
+                     min_wait=DEFAULT_SETTLE_MIN_WAIT):
+    """
+    Returns the first time (same unit as event_times) at which no event happened
+    for quiet_window, but not before start_time + min_wait.
+    When max_wait is given, the result is capped at start_time + max_wait.
+    """
+    settle_time = start_time + max(min_wait, quiet_window)
+    for event_time in sorted(event_times):
+        # quiet long enough before this event happened
+        if event_time > settle_time:
+            break
+        settle_time = max(settle_time, event_time + quiet_window)
+
+    if max_wait is not None:
+        settle_time = min(settle_time, start_time + max_wait)
+    return settle_time
+
+
+def get_settle_state(event_times,
+                     now,
+                     start_time,
+                     quiet_window=DEFAULT_SETTLE_QUIET_WINDOW,
+                     max_wait=None,
+                     min_wait=DEFAULT_SETTLE_MIN_WAIT):
+    # event_times must only contain events that happened up to now
+    if max_wait is not None and now >= start_time + max_wait:
+        return SETTLE_STATE_TIMEOUT
+
+    settle_time = find_settle_time(event_times,
+                                   start_time,
+                                   quiet_window=quiet_window,
+                                   min_wait=min_wait)
+    if now >= settle_time:
+        return SETTLE_STATE_QUIET
+    return SETTLE_STATE_WAITING
+
+
+def get_event_times_from_counters(counters, max_pending_age=SETTLE_MAX_PENDING_AGE):
+    """
+    Turns one answer of the extensions (see SETTLE_QUERY_JS) into event times in seconds.
+    A request that is still pending counts as activity happening now.
+    """
+    event_times = []
+    now = counters["now"] / 1000
+
+    for counter_key in ["network", "dom"]:
+        if counters.get(counter_key):
+            last_event_time = counters[counter_key].get("lastEventTime")
+            if last_event_time:
+                event_times.append(last_event_time / 1000)
+
+    if counters.get("network"):
+        for pending_start_time in counters["network"].get(
+                "pendingStartTimes", []):
+            if now - pending_start_time / 1000 <= max_pending_age:
+                event_times.append(now)
+                break
+
+    return event_times
+
+
+def query_settle_counters(driver):
+    counters = driver.execute_async_script(SETTLE_QUERY_JS)
+    for counter_key in ["network", "dom"]:
+        # the details cross from the extension world as JSON strings
+        if isinstance(counters.get(counter_key), str):
+            try:
+                counters[counter_key] = json.loads(counters[counter_key])
+            except ValueError:
+                counters[counter_key] = None
+    return counters
+
+
+def wait_for_page_settle(driver,
+                         start_time,
+                         max_wait,
+                         quiet_window=DEFAULT_SETTLE_QUIET_WINDOW,
+                         min_wait=DEFAULT_SETTLE_MIN_WAIT,
+                         poll_interval=DEFAULT_SETTLE_POLL_INTERVAL,
+                         thread_name=None):
+    """
+    Polls the extensions' counters until the network and the DOM were both quiet for
+    quiet_window seconds, or until start_time + max_wait (start_time from time.time()).
+    Without answers from the extensions it simply waits until start_time + max_wait.
+    Returns the settle state and the seconds waited since start_time.
+    """
+    event_times = []
+    state = SETTLE_STATE_WAITING
+    has_counters = False
+
+    while state == SETTLE_STATE_WAITING:
+        try:
+            counters = query_settle_counters(driver)
+        except Exception as e:
+            logger.debug("%s - Could not query settle counters: %s",
+                         str(thread_name), str(e))
+            counters = None
+        now = time.time()
+
+        if counters and (counters.get("network") or counters.get("dom")):
+            has_counters = True
+            # keep the whole stream so the decision can be replayed offline
+            event_times += get_event_times_from_counters(counters)
+
+        if has_counters:
+            state = get_settle_state(event_times,
+                                     now,
+                                     start_time,
+                                     quiet_window=quiet_window,
+                                     max_wait=max_wait,
+                                     min_wait=min_wait)
+        elif now >= start_time + max_wait:
+            state = SETTLE_STATE_TIMEOUT
+
+        if state == SETTLE_STATE_WAITING:
+            time.sleep(min(poll_interval, max(start_time + max_wait - now, 0)))
+
+    waited = time.time() - start_time
+    logger.debug("%s - Page settle state %s after %.1f seconds",
+                 str(thread_name), state, waited)
+    return state, waited
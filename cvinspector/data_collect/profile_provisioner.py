@@ -0,0 +1,197 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import fnmatch
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# ioctl that clones a file's extents (btrfs, xfs with reflink=1, ...)
+FICLONE = 0x40049409
+
+COPY_STRATEGY_AUTO = "auto"  # reflink, else hardlink immutable files, else copy
+COPY_STRATEGY_REFLINK = "reflink"  # reflink, else copy
+COPY_STRATEGY_HARDLINK = "hardlink"  # hardlink immutable files, else copy
+COPY_STRATEGY_COPY = "copy"  # plain shutil.copytree
+COPY_STRATEGIES = [
+    COPY_STRATEGY_AUTO, COPY_STRATEGY_REFLINK, COPY_STRATEGY_HARDLINK,
+    COPY_STRATEGY_COPY
+]
+DEFAULT_COPY_STRATEGY = COPY_STRATEGY_AUTO
+
+# Files chrome never rewrites in place, so a hardlink to the template is safe.
+# LevelDB tables (.ldb) are write-once: compaction writes new tables and deletes old ones.
+# This is where the extensions keep their storage (including the filter lists).
+# Nothing else is linked: any other file could be rewritten in place and corrupt the template.
+IMMUTABLE_FILE_PATTERNS = ["*.ldb"]
+
+# chrome locks of the running template browser, must not be carried over
+SKIP_FILE_PATTERNS = ["Singleton*", "*/Singleton*"]
+
+# errors meaning the filesystem cannot reflink/hardlink (fall back to a copy)
+_LINK_UNSUPPORTED_ERRNOS = [
+    errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EPERM,
+    errno.EMLINK
+]
+
+
+def _matches_any(rel_path, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(rel_path, pattern):
+            return True
+    return False
+
+
+def reflink_file(src_path, dest_path):
+    import fcntl
+
+    with open(src_path, 'rb') as src_file:
+        with open(dest_path, 'wb') as dest_file:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                dest_file.close()
+                os.remove(dest_path)
+                raise
+    shutil.copystat(src_path, dest_path)
+
+
+class ProfileProvisioner:
+    """
+    Builds trial profiles from a template profile without copying every byte.
+    Each file is reflinked (copy-on-write) when the filesystem supports it,
+    hardlinked when it matches IMMUTABLE_FILE_PATTERNS, and copied otherwise.
+    Once reflink or hardlink fails with an unsupported error, it is not tried again.
+    """
+    def __init__(self,
+                 template_path,
+                 copy_strategy=DEFAULT_COPY_STRATEGY,
+                 immutable_patterns=None,
+                 skip_patterns=None):
+
+        assert copy_strategy in COPY_STRATEGIES, "Unknown copy strategy " + str(
+            copy_strategy)
+        self.template_path = template_path
+        self.copy_strategy = copy_strategy
+        self.immutable_patterns = immutable_patterns or IMMUTABLE_FILE_PATTERNS
+        self.skip_patterns = skip_patterns or SKIP_FILE_PATTERNS
+
+        self.use_reflink = copy_strategy in [
+            COPY_STRATEGY_AUTO, COPY_STRATEGY_REFLINK
+        ]
+        self.use_hardlink = copy_strategy in [
+            COPY_STRATEGY_AUTO, COPY_STRATEGY_HARDLINK
+        ]
+
+        self.lock = threading.Lock()
+        self.stats = self._get_default_stats()
+
+    @staticmethod
+    def _get_default_stats():
+        return {
+            "profiles": 0,
+            "files_reflinked": 0,
+            "files_hardlinked": 0,
+            "files_copied": 0,
+            "bytes_copied": 0
+        }
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def _add_stat(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def _provision_file(self, src_path, dest_path, rel_path):
+        if self.use_reflink:
+            try:
+                reflink_file(src_path, dest_path)
+                self._add_stat("files_reflinked")
+                return
+            except OSError as e:
+                if e.errno not in _LINK_UNSUPPORTED_ERRNOS:
+                    raise
+                logger.debug("Reflink not supported for %s, disabling: %s",
+                             self.template_path, str(e))
+                self.use_reflink = False
+
+        if self.use_hardlink and _matches_any(rel_path,
+                                              self.immutable_patterns):
+            try:
+                os.link(src_path, dest_path)
+                self._add_stat("files_hardlinked")
+                return
+            except OSError as e:
+                if e.errno not in _LINK_UNSUPPORTED_ERRNOS:
+                    raise
+                logger.debug("Hardlink not supported for %s, disabling: %s",
+                             self.template_path, str(e))
+                self.use_hardlink = False
+
+        shutil.copy2(src_path, dest_path)
+        self._add_stat("files_copied")
+        self._add_stat("bytes_copied", os.path.getsize(dest_path))
+
+    def provision(self, dest_path):
+        if self.copy_strategy == COPY_STRATEGY_COPY:
+            shutil.copytree(self.template_path, dest_path)
+            self._add_stat("profiles")
+            return dest_path
+
+        template_path = os.path.normpath(self.template_path)
+        for root, dirs, files in os.walk(template_path):
+            rel_root = os.path.relpath(root, template_path)
+            dest_root = dest_path if rel_root == "." else os.path.join(
+                dest_path, rel_root)
+            os.makedirs(dest_root, exist_ok=True)
+
+            for name in dirs + files:
+                src_path = os.path.join(root, name)
+                rel_path = name if rel_root == "." else os.path.join(
+                    rel_root, name)
+                rel_path = rel_path.replace(os.sep, "/")
+                if _matches_any(rel_path, self.skip_patterns):
+                    continue
+
+                item_dest_path = os.path.join(dest_root, name)
+                if os.path.islink(src_path):
+                    os.symlink(os.readlink(src_path), item_dest_path)
+                elif name in files:
+                    self._provision_file(src_path, item_dest_path, rel_path)
+
+        self._add_stat("profiles")
+        return dest_path
+
+
+# one provisioner per template so reflink/hardlink support is only probed once
+PROFILE_PROVISIONERS = dict()
+PROFILE_PROVISIONERS_LOCK = threading.Lock()
+
+
+def get_profile_provisioner(template_path,
+                            copy_strategy=DEFAULT_COPY_STRATEGY):
+    key = (os.path.abspath(template_path), copy_strategy)
+    with PROFILE_PROVISIONERS_LOCK:
+        if key not in PROFILE_PROVISIONERS:
+            PROFILE_PROVISIONERS[key] = ProfileProvisioner(
+                template_path, copy_strategy=copy_strategy)
+        return PROFILE_PROVISIONERS[key]
@@ -0,0 +1,198 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import queue
+import threading
+from collections import namedtuple
+
+from cvinspector.common.utils import randomword
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# one control or variant trial of a single url
+Trial = namedtuple("Trial", ["is_control", "trial_number"])
+
+
+def interleave_trials(control_trial_numbers, variant_trial_numbers):
+    # alternate control and variant trials so that both sides are crawled
+    # around the same time and see similar network conditions
+    # example: [1, 2], [0, 1, 2] --> C1, V0, C2, V1, V2
+    trials = []
+    max_len = max(len(control_trial_numbers), len(variant_trial_numbers))
+    for index in range(max_len):
+        if index < len(control_trial_numbers):
+            trials.append(Trial(True, control_trial_numbers[index]))
+        if index < len(variant_trial_numbers):
+            trials.append(Trial(False, variant_trial_numbers[index]))
+    return trials
+
+
+class TrialWorkerThread(threading.Thread):
+    """
+    One isolated browser worker. It owns its own virtual display and creates
+    a fresh profile directory + driver for every trial it pulls off the queue.
+    """
+    def __init__(self,
+                 threadID,
+                 name,
+                 trial_queue,
+                 results,
+                 driver_factory,
+                 measure_func,
+                 profile_factory=None,
+                 profile_cleaner=None,
+                 display_factory=None,
+                 display_cleaner=None):
+
+        threading.Thread.__init__(self)
+        self.threadID = threadID
+        self.name = name
+        self.trial_queue = trial_queue
+        self.results = results
+        self.driver_factory = driver_factory
+        self.measure_func = measure_func
+        self.profile_factory = profile_factory
+        self.profile_cleaner = profile_cleaner
+        self.display_factory = display_factory
+        self.display_cleaner = display_cleaner
+
+    def run_trial(self, trial, display_name):
+        profile_path = None
+        if self.profile_factory:
+            profile_path = self.profile_factory(trial.is_control, self.name)
+            logger.debug("%s - Created profile %s for trial %s", self.name,
+                         profile_path, str(trial))
+        try:
+            driver_name, driver = self.driver_factory(trial.is_control,
+                                                      profile_path,
+                                                      display_name)
+            return self.measure_func(driver,
+                                     driver_name,
+                                     trial,
+                                     profile_path=profile_path,
+                                     thread_name=self.name)
+        finally:
+            if self.profile_cleaner and profile_path:
+                self.profile_cleaner(profile_path, self.name)
+
+    def run(self):
+        logger.debug("Running worker %s", self.name)
+
+        virtual_display = None
+        display_name = None
+        if self.display_factory:
+            virtual_display, display_name = self.display_factory()
+            logger.debug("%s - Using display %s", self.name,
+                         str(display_name))
+
+        try:
+            while True:
+                try:
+                    trial_index, trial = self.trial_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                logger.info("\t%s - Starting %s trial %d", self.name,
+                            "control" if trial.is_control else "variant",
+                            trial.trial_number)
+                try:
+                    self.results[trial_index] = (trial,
+                                                 self.run_trial(
+                                                     trial, display_name),
+                                                 None)
+                except Exception as e:
+                    logger.warning("%s - Trial %s raised %s", self.name,
+                                   str(trial), str(e))
+                    self.results[trial_index] = (trial, None, e)
+                finally:
+                    self.trial_queue.task_done()
+        finally:
+            if self.display_cleaner and virtual_display is not None:
+                self.display_cleaner(virtual_display)
+
+
+class TrialScheduler:
+    """
+    Runs control/variant trials concurrently on up to max_browsers workers.
+
+    driver_factory(is_control, profile_path, display_name) -> (driver_name, driver)
+    measure_func(driver, driver_name, trial, profile_path=, thread_name=) -> result
+    profile_factory(is_control, thread_name) -> profile_path
+    profile_cleaner(profile_path, thread_name)
+    display_factory() -> (virtual_display, display_name)
+    display_cleaner(virtual_display)
+
+    Only driver_factory and measure_func are required, which keeps the
+    scheduler usable with fake drivers that do not need chrome.
+    """
+    def __init__(self,
+                 driver_factory,
+                 measure_func,
+                 max_browsers=1,
+                 profile_factory=None,
+                 profile_cleaner=None,
+                 display_factory=None,
+                 display_cleaner=None,
+                 thread_name=None):
+
+        assert max_browsers >= 1, "max_browsers must be at least 1"
+        self.driver_factory = driver_factory
+        self.measure_func = measure_func
+        self.max_browsers = max_browsers
+        self.profile_factory = profile_factory
+        self.profile_cleaner = profile_cleaner
+        self.display_factory = display_factory
+        self.display_cleaner = display_cleaner
+        self.thread_name = thread_name
+
+    # returns a list of (trial, result) in the same order as trials.
+    # The first exception raised by a trial is re-raised after all workers are done
+    def run(self, trials):
+        trial_queue = queue.Queue()
+        for trial_index, trial in enumerate(trials):
+            trial_queue.put((trial_index, trial))
+
+        results = [None] * len(trials)
+        worker_count = min(self.max_browsers, len(trials))
+
+        workers = []
+        for worker_index in range(worker_count):
+            worker_name = str(self.thread_name) + "-Browser-" + randomword(5)
+            worker = TrialWorkerThread(worker_index,
+                                       worker_name,
+                                       trial_queue,
+                                       results,
+                                       self.driver_factory,
+                                       self.measure_func,
+                                       profile_factory=self.profile_factory,
+                                       profile_cleaner=self.profile_cleaner,
+                                       display_factory=self.display_factory,
+                                       display_cleaner=self.display_cleaner)
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+        logger.debug("%s - All %d trials done with %d browsers",
+                     str(self.thread_name), len(trials), worker_count)
+
+        for _, _, exception in results:
+            if exception is not None:
+                raise exception
+
+        return [(trial, result) for trial, result, _ in results]
@@ -13,13 +13,13 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-import json
 import logging
 import os
 
 import pymongo.errors
 from pymongo import UpdateOne
 
+from cvinspector.common.trial_cache import get_parsed_trial
 from cvinspector.data_migrate.utils import get_anticv_mongo_client_and_db, get_file_name, \
     process_url_for_special_cases
 
@@ -30,14 +30,13 @@ logger = logging.getLogger(__name__)
 def create_crawler_instance(file_path, file_name, crawler_group_name,
                             webrequests_key, control_or_variant):
 
-    file_data = None
-    with open(file_path) as f:
-        try:
-            file_data = json.load(f)
-        except:
-            # return out of here
-            logger.debug("Could not load json file: " + file_path)
-            return None, None, None
+    # parsed once per process and shared with the diff stages, see trial_cache
+    trial = get_parsed_trial(file_path, webrequests_key)
+    if trial is None:
+        # return out of here
+        logger.debug("Could not load json file: " + file_path)
+        return None, None, None
+    file_data = trial.get_file_data()
 
     # extract crawler instance, we ignore the webrequests
     crawler_instance = {
@@ -115,8 +114,8 @@ def migrate_json_to_mongodb_by_file_path(file_path,
                     % (crawler_group_name, crawl_instance_id))
                 return
 
-            # extract webrequests using key
-            webrequests = file_data[webrequests_key]
+            # extract webrequests using key (copies, the cached ones are shared)
+            webrequests = [dict(webreq) for webreq in file_data[webrequests_key]]
 
             # attach the crawler_group_name and document_id to each request as well
             for webreq in webrequests:
@@ -205,5 +204,3 @@ def migrate_json_to_mongodb(file_or_dir_path,
 
     else:
         logger.warn("Collection " + collection_name + " was not found")
-
-    client.close()
@@ -15,7 +15,7 @@
 
 import os
 
-from pymongo import MongoClient
+from cvinspector.common.mongo_clients import get_shared_mongo_client
 
 # change these to connect to correct db
 MONGO_CLIENT_HOST = 'localhost'
@@ -29,24 +29,25 @@ def get_mongo_client_and_db(client,
                             username=None,
                             password=None,
                             authSource=None):
+    # shared per process, do not close it (see mongo_clients)
     if username and password:
-        client = MongoClient(client,
-                             port,
-                             username=username,
-                             password=password,
-                             authSource=authSource)
+        client = get_shared_mongo_client(client,
+                                         port,
+                                         username=username,
+                                         password=password,
+                                         authSource=authSource)
     else:
         # default to just regular localhost
-        client = MongoClient(client, port)
+        client = get_shared_mongo_client(client, port)
 
     db = client[db_name]
 
-    if not client:
-        print("No client was found for " + client + " " + port)
-    if not db:
+    if client is None:
+        print("No client was found for " + str(client) + " " + str(port))
+    if db is None:
         print("No db was found for " + db_name)
 
-    if not client or not db:
+    if client is None or db is None:
         raise Exception("Could find mongo client or database")
 
     return client, db
@@ -14,9 +14,10 @@
 #  limitations under the License.
 
 import logging
+import os
+from collections import Counter
 
-from cvinspector.common.dommutation_utils import get_nodes_added_key, get_nodes_removed_key, get_attribute_changed_key, \
-    get_text_changed_key, \
+from cvinspector.common.dommutation_utils import DomMutationKeyBuilder, \
     NODES_ADDED, NODES_REMOVED, ATTRIBUTE_CHANGED, TEXT_CHANGED
 from cvinspector.common.utils import ABP_BLOCKED_ELEMENT, ABP_BLOCKED_SNIPPET, ANTICV_ANNOTATION_PREFIX, CONTROL, \
     VARIANT, get_dom_mutation_from_raw_json
@@ -27,13 +28,264 @@ logger = logging.getLogger(__name__)
 
 # logger.setLevel("DEBUG")
 
+# kinds of keyed dom mutations compared between control and variant (names of the row fields)
+DOM_NODE_ADDED = "node_added"
+DOM_NODE_REMOVED = "node_removed"
+DOM_ATTRIBUTE_CHANGED = "attribute_changed"
+DOM_TEXT_CHANGED = "text_changed"
+DOM_TEXT_NODE_ADDED = "text_node_added"
+DOM_TEXT_NODE_REMOVED = "text_node_removed"
+DOM_DIFF_CATEGORIES = [
+    DOM_NODE_ADDED, DOM_NODE_REMOVED, DOM_ATTRIBUTE_CHANGED, DOM_TEXT_CHANGED,
+    DOM_TEXT_NODE_ADDED, DOM_TEXT_NODE_REMOVED
+]
+# our custom block events, only in variant and never compared
+DOM_BLOCKED = "blocked_events"
+# diff groups whose trial files add up to more than this are diffed in two passes:
+# lower peak memory, but trials that left the trial_cache are parsed twice
+DOM_DIFF_TWO_PASS_MIN_BYTES = 256 * 1024 * 1024
+
+
+def set_dom_diff_two_pass_min_bytes(min_bytes):
+    # before the worker processes are forked, so they share it. 0 always uses two passes
+    global DOM_DIFF_TWO_PASS_MIN_BYTES
+    DOM_DIFF_TWO_PASS_MIN_BYTES = min_bytes
+
+
+def _iter_trial_dom_events(trial_inst, key_builder, is_variant):
+    """
+    Yields (category, key, value) for the dom mutations of a trial, in order.
+    value is what the diff keeps of the event:
+    - node added/removed: (trial_inst, event, defining_text, index of the node)
+    - text node added/removed: (trial_inst, event, index of the node)
+    - attribute changed: (trial_inst, event, defining_text)
+    - text changed: (trial_inst, event, text_diff)
+    - blocked (variant only): (trial_inst, event, defining_text, index of the node)
+    """
+    event_cursor = get_dom_mutation_from_raw_json(trial_inst.get("file_path"))
+    for event in event_cursor:
+        event_item = event.get("event")
+        if event_item is None:
+            continue
+        event_type = event_item.get("type")
+        if event_type is None:
+            continue
+
+        if event_type == NODES_ADDED or event_type == NODES_REMOVED:
+            # get_nodes_added_key returns list of tuples
+            index_node = 0
+            for key, defining_text, is_text_node, is_snippet_blocked in key_builder.get_nodes_added_key(
+                    event_item):
+                ## REMINDER: control side has no custom events like ABP_BLOCKED_SNIPPET
+                if is_variant and event_type == NODES_ADDED and is_snippet_blocked:
+                    # skip our custom block events
+                    yield DOM_BLOCKED, key_builder.intern(
+                        key + ABP_BLOCKED_SNIPPET), (trial_inst, event,
+                                                     defining_text, index_node)
+                    continue
+                if is_text_node:
+                    category = DOM_TEXT_NODE_ADDED if event_type == NODES_ADDED else DOM_TEXT_NODE_REMOVED
+                    yield category, key, (trial_inst, event, index_node)
+                else:
+                    category = DOM_NODE_ADDED if event_type == NODES_ADDED else DOM_NODE_REMOVED
+                    yield category, key, (trial_inst, event, defining_text,
+                                          index_node)
+                index_node += 1
+
+        if event_type == ATTRIBUTE_CHANGED:
+            attribute = event_item.get("attribute")
+            # ignore short attributes that are usually used for svgs
+            if len(attribute) <= 2:
+                continue
+            # skip our custom event for whether element is hidden
+            if ANTICV_ANNOTATION_PREFIX in attribute:
+                continue
+
+            key, defining_text = key_builder.get_attribute_changed_key(
+                event_item)
+
+            # skip our custom block events
+            if is_variant and ABP_BLOCKED_ELEMENT == attribute:
+                yield DOM_BLOCKED, key_builder.intern(
+                    key + ABP_BLOCKED_ELEMENT), (trial_inst, event,
+                                                 defining_text, 0)
+                continue
+            yield DOM_ATTRIBUTE_CHANGED, key, (trial_inst, event, defining_text)
+
+        if event_type == TEXT_CHANGED:
+            key, text_diff = key_builder.get_text_changed_key(event_item)
+            yield DOM_TEXT_CHANGED, key, (trial_inst, event, text_diff)
+
+
+def _get_trials_file_size(trials):
+    total_size = 0
+    for trial_inst in trials:
+        try:
+            total_size += os.path.getsize(trial_inst.get("file_path"))
+        except (OSError, TypeError):
+            continue
+    return total_size
+
+
+def _get_side_dom_events(trials, key_builder, is_variant, blocked_events):
+    # single pass over the trials of a side: category -> key -> list of event values
+    side_events = dict()
+    for category in DOM_DIFF_CATEGORIES:
+        side_events[category] = dict()
+    for trial_inst in trials:
+        for category, key, value in _iter_trial_dom_events(
+                trial_inst, key_builder, is_variant):
+            if category == DOM_BLOCKED:
+                category_events = blocked_events
+            else:
+                category_events = side_events[category]
+            if key not in category_events:
+                category_events[key] = []
+            category_events[key].append(value)
+    return side_events
+
+
+def _dom_diff(main_set, second_set):
+    # find all events not in second_set, remove common ones
+    # each dict is key -> list(events)
+    main_set_remaining = dict()
+    for key in main_set:
+        # add all into remaining
+        if key not in second_set:
+            main_set_remaining[key] = main_set.get(key)
+            continue
+
+        main_events = main_set.get(key)
+        second_events = second_set.get(key)
+        diff = len(main_events) - len(second_events)
+        if diff > 0:
+            # retrieve the last elements not in common
+            main_events_remaining = main_events[-1 * diff:]
+            main_set_remaining[key] = main_events_remaining
+
+    return main_set_remaining
+
+
+def _count_trial_dom_keys(trial_inst, key_builder, is_variant,
+                          blocked_events):
+    # first pass over a trial: category -> Counter of keys, the blocked events are kept
+    trial_counts = dict()
+    for category in DOM_DIFF_CATEGORIES:
+        trial_counts[category] = Counter()
+    for category, key, value in _iter_trial_dom_events(trial_inst, key_builder,
+                                                       is_variant):
+        if category == DOM_BLOCKED:
+            if key not in blocked_events:
+                blocked_events[key] = []
+            blocked_events[key].append(value)
+            continue
+        trial_counts[category][key] += 1
+    return trial_counts
+
+
+def _get_side_dom_key_counts(trials_counts):
+    # keys in the order they first appear, like the event lists they replace
+    side_counts = dict()
+    for category in DOM_DIFF_CATEGORIES:
+        side_counts[category] = Counter()
+        for trial_counts in trials_counts:
+            side_counts[category].update(trial_counts[category])
+    return side_counts
+
+
+def _get_remaining_dom_events(trials, trials_counts, main_counts, second_counts,
+                              key_builder, is_variant):
+    """
+    Second pass: the events of main that are not in second, per category
+    key -> list of event values (see _iter_trial_dom_events).
+    Keys missing from second keep all their events, keys that main has diff more
+    times keep their last diff events (the ones from index count in second on).
+    Only the trials holding some of those events are scanned again.
+    """
+    first_remaining_index = dict()
+    main_remaining = dict()
+    for category in DOM_DIFF_CATEGORIES:
+        first_remaining_index[category] = dict()
+        main_remaining[category] = dict()
+        for key, count in main_counts[category].items():
+            second_count = second_counts[category].get(key, 0)
+            if count > second_count:
+                first_remaining_index[category][key] = second_count
+                main_remaining[category][key] = []
+
+    # events of each key in the trials before each trial
+    trials_seen_counts = []
+    seen_counts = dict()
+    for category in DOM_DIFF_CATEGORIES:
+        seen_counts[category] = Counter()
+    for trial_counts in trials_counts:
+        trials_seen_counts.append(seen_counts)
+        next_seen_counts = dict()
+        for category in DOM_DIFF_CATEGORIES:
+            next_seen_counts[category] = seen_counts[category] + trial_counts[
+                category]
+        seen_counts = next_seen_counts
+
+    # the last trials first, they are the likeliest to still be in the trial_cache
+    trials_remaining = [None] * len(trials)
+    for trial_index in reversed(range(len(trials))):
+        trial_counts = trials_counts[trial_index]
+        trial_seen_counts = trials_seen_counts[trial_index]
+        has_remaining = False
+        for category in DOM_DIFF_CATEGORIES:
+            for key, count in trial_counts[category].items():
+                first_index = first_remaining_index[category].get(key)
+                if first_index is not None and trial_seen_counts[category][
+                        key] + count > first_index:
+                    has_remaining = True
+                    break
+            if has_remaining:
+                break
+        if not has_remaining:
+            continue
+
+        trial_remaining = dict()
+        key_indexes = dict()
+        for category in DOM_DIFF_CATEGORIES:
+            trial_remaining[category] = dict()
+            key_indexes[category] = Counter(trial_seen_counts[category])
+        for category, key, value in _iter_trial_dom_events(
+                trials[trial_index], key_builder, is_variant):
+            if category == DOM_BLOCKED:
+                continue
+            first_index = first_remaining_index[category].get(key)
+            if first_index is None:
+                continue
+            if key_indexes[category][key] >= first_index:
+                if key not in trial_remaining[category]:
+                    trial_remaining[category][key] = []
+                trial_remaining[category][key].append(value)
+            key_indexes[category][key] += 1
+        trials_remaining[trial_index] = trial_remaining
+
+    # events in the order of the trials
+    for trial_remaining in trials_remaining:
+        if trial_remaining is None:
+            continue
+        for category in DOM_DIFF_CATEGORIES:
+            for key, values in trial_remaining[category].items():
+                main_remaining[category][key] += values
+
+    return main_remaining
+
 
 def get_dom_differences_only(diff_group,
                              crawler_group_name,
                              crawl_collection,
                              debug_queue,
                              thread_name=None,
-                             output_external_logs=True):
+                             output_external_logs=True,
+                             two_pass=None):
+    """
+    two_pass: diff in two passes (see _get_remaining_dom_events) instead of keeping
+    every event of the diff group. Default=None, two passes only when the trial files
+    add up to more than DOM_DIFF_TWO_PASS_MIN_BYTES
+    """
     crawl_trial_group = create_trial_group(diff_group, crawl_collection)
     control_instance_ids = []
     control_instance_ids_str = []
@@ -45,293 +297,92 @@ def get_dom_differences_only(diff_group,
         control_instance_ids.append(trial_inst.get("_id"))
         control_instance_ids_str.append(str(trial_inst.get("_id")))
 
-    control_node_added_events = dict()
-    control_node_removed_events = dict()
-    control_attribute_changed_events = dict()
-    control_text_changed_events = dict()
-    control_text_node_added_events = dict()
-    control_text_node_removed_events = dict()
-
-    # we parse all trials (control)
-    for trial_key in crawl_trial_group[CONTROL].keys():
-        trial_inst = crawl_trial_group[CONTROL].get(trial_key)
-        crawl_instance_id = trial_inst.get("_id")
-
-        control_event_cursor = get_dom_mutation_from_raw_json(
-            trial_inst.get("file_path"))
-        for event in control_event_cursor:
-            event_item = event.get("event")
-            if event_item is None:
-                continue
-            event_type = event_item.get("type")
-            if event_type is None:
-                continue
-
-            ## REMINDER: control side has no custom events like ABP_BLOCKED_SNIPPET
-            if event_type == NODES_ADDED:
-                # get_nodes_added_key returns list of tuples
-                index_node_added = 0
-                for key, defining_text, is_text_node, _ in get_nodes_added_key(
-                        event_item):
-                    if is_text_node:
-                        if key not in control_text_node_added_events:
-                            control_text_node_added_events[key] = []
-                        control_text_node_added_events[key].append(
-                            (trial_inst, event, index_node_added))
-                    else:
-                        if key not in control_node_added_events:
-                            control_node_added_events[key] = []
-                        control_node_added_events[key].append(
-                            (trial_inst, event, defining_text,
-                             index_node_added))
-                    index_node_added += 1
-
-            if event_type == NODES_REMOVED:
-                index_node_removed = 0
-                # get_nodes_removed_key returns list of tuples
-                for key, defining_text, is_text_node, _ in get_nodes_removed_key(
-                        event_item):
-                    if is_text_node:
-                        if key not in control_text_node_removed_events:
-                            control_text_node_removed_events[key] = []
-                        control_text_node_removed_events[key].append(
-                            (trial_inst, event, index_node_removed))
-                    else:
-                        if key not in control_node_removed_events:
-                            control_node_removed_events[key] = []
-                        control_node_removed_events[key].append(
-                            (trial_inst, event, defining_text,
-                             index_node_removed))
-                    index_node_removed += 1
-
-            if event_type == ATTRIBUTE_CHANGED:
-                attribute = event_item.get("attribute")
-                # ignore short attributes that are usually used for svgs
-                if len(attribute) <= 2:
-                    continue
-                if ANTICV_ANNOTATION_PREFIX in attribute:
-                    continue
-
-                key, defining_text = get_attribute_changed_key(event_item)
+    # equal keys share one string, see DomMutationKeyBuilder
+    key_builder = DomMutationKeyBuilder()
 
-                if key not in control_attribute_changed_events:
-                    control_attribute_changed_events[key] = []
-                control_attribute_changed_events[key].append(
-                    (trial_inst, event, defining_text))
-
-            if event_type == TEXT_CHANGED:
-                key, text_diff = get_text_changed_key(event_item)
-                if key not in control_text_changed_events:
-                    control_text_changed_events[key] = []
-                control_text_changed_events[key].append(
-                    (trial_inst, event, text_diff))
-
-    variant_node_added_events = dict()
-    variant_node_removed_events = dict()
-    variant_attribute_changed_events = dict()
-    variant_text_changed_events = dict()
-    variant_text_node_added_events = dict()
-    variant_text_node_removed_events = dict()
-
-    # this only exists in variant
-    variant_blocked_events = dict()
+    control_trials = list(crawl_trial_group[CONTROL].values())
+    variant_trials = list(crawl_trial_group[VARIANT].values())
 
     # we parse all trials (variant)
     variant_instance_ids = []
     variant_instance_ids_str = []
-    for trial_key in crawl_trial_group[VARIANT].keys():
-        trial_inst = crawl_trial_group[VARIANT].get(trial_key)
+    for trial_inst in variant_trials:
         crawl_instance_id = trial_inst.get("_id")
         variant_instance_ids_str.append(str(crawl_instance_id))
         variant_instance_ids.append(crawl_instance_id)
-        variant_event_cursor = get_dom_mutation_from_raw_json(
-            trial_inst.get("file_path"))
-
-        for event in variant_event_cursor:
-            event_item = event.get("event")
-            if event_item is None:
-                continue
-            event_type = event_item.get("type")
-            if event_type is None:
-                continue
 
-            if event_type == NODES_ADDED:
-                index_node_added = 0
-                for key, defining_text, is_text_node, is_snippet_blocked in get_nodes_added_key(
-                        event_item):
-                    # skip our custom block events
-                    if is_snippet_blocked:
-                        tmp_key = key + ABP_BLOCKED_SNIPPET
-                        if tmp_key not in variant_blocked_events:
-                            variant_blocked_events[tmp_key] = []
-                        variant_blocked_events[tmp_key].append(
-                            (trial_inst, event, defining_text,
-                             index_node_added))
-                        continue
-                    if is_text_node:
-                        if key not in variant_text_node_added_events:
-                            variant_text_node_added_events[key] = []
-                        variant_text_node_added_events[key].append(
-                            (trial_inst, event, index_node_added))
-                    else:
-                        if key not in variant_node_added_events:
-                            variant_node_added_events[key] = []
-                        variant_node_added_events[key].append(
-                            (trial_inst, event, defining_text,
-                             index_node_added))
-                    index_node_added += 1
-
-            if event_type == NODES_REMOVED:
-                index_node_removed = 0
-                for key, defining_text, is_text_node, _ in get_nodes_removed_key(
-                        event_item):
-                    if is_text_node:
-                        if key not in variant_text_node_removed_events:
-                            variant_text_node_removed_events[key] = []
-                        variant_text_node_removed_events[key].append(
-                            (trial_inst, event, index_node_removed))
-                    else:
-                        if key not in variant_node_removed_events:
-                            variant_node_removed_events[key] = []
-                        variant_node_removed_events[key].append(
-                            (trial_inst, event, defining_text,
-                             index_node_removed))
-                    index_node_removed += 1
-
-            if event_type == ATTRIBUTE_CHANGED:
-                attribute = event_item.get("attribute")
-                # ignore short attributes that are usually used for svgs
-                if len(attribute) <= 2:
-                    continue
-                # skip our custom event for whether element is hidden
-                if ANTICV_ANNOTATION_PREFIX in attribute:
-                    continue
-
-                key, defining_text = get_attribute_changed_key(event_item)
-
-                # skip our custom block events
-                if ABP_BLOCKED_ELEMENT == attribute:
-                    tmp_key = key + ABP_BLOCKED_ELEMENT
-                    if tmp_key not in variant_blocked_events:
-                        variant_blocked_events[tmp_key] = []
-                    variant_blocked_events[tmp_key].append(
-                        (trial_inst, event, defining_text, 0))
-                    continue
-                if key not in variant_attribute_changed_events:
-                    variant_attribute_changed_events[key] = []
-                variant_attribute_changed_events[key].append(
-                    (trial_inst, event, defining_text))
-            if event_type == TEXT_CHANGED:
-                key, text_diff = get_text_changed_key(event_item)
-                if key not in variant_text_changed_events:
-                    variant_text_changed_events[key] = []
-                variant_text_changed_events[key].append(
-                    (trial_inst, event, text_diff))
-
-    # turn keys into sets and subtract control and variant
-    # find all events not in second_set, remove common ones
-    # each dict is key -> list(events)
-    def _dom_diff(main_set, second_set):
-        main_set_remaining = dict()
-        for key in main_set:
-            # add all into remaining
-            if key not in second_set:
-                main_set_remaining[key] = main_set.get(key)
-                continue
+    # this only exists in variant
+    variant_blocked_events = dict()
 
-            main_events = main_set.get(key)
-            second_events = second_set.get(key)
-            diff = len(main_events) - len(second_events)
-            if diff > 0:
-                # retrieve the last elements not in common
-                main_events_remaining = main_events[-1 * diff:]
-                main_set_remaining[key] = main_events_remaining
-
-        return main_set_remaining
-
-    ## Nodes added
-    logger.debug("%s - Original node added: control %d , variant  %d" %
-                 (str(thread_name), len(control_node_added_events),
-                  len(variant_node_added_events)))
-    control_only__node_added = _dom_diff(control_node_added_events,
-                                         variant_node_added_events)
-    variant_only__node_added = _dom_diff(variant_node_added_events,
-                                         control_node_added_events)
-    logger.debug("%s - After node added subtracted: control %d, variant : %d" %
-                 (str(thread_name), len(control_only__node_added),
-                  len(variant_only__node_added)))
-
-    ## Nodes removed
-
-    logger.debug("%s - Original node removed: control %d , variant  %d" %
-                 (str(thread_name), len(control_node_removed_events),
-                  len(variant_node_removed_events)))
-    control_only__node_removed = _dom_diff(control_node_removed_events,
-                                           variant_node_removed_events)
-    variant_only__node_removed = _dom_diff(variant_node_removed_events,
-                                           control_node_removed_events)
-    logger.debug(
-        "%s - After node removed subtracted: control %d, variant : %d" %
-        (str(thread_name), len(control_only__node_removed),
-         len(variant_only__node_removed)))
-
-    ## Attribute Changed
-    logger.debug("%s - Original node attr changed: control %d , variant  %d" %
-                 (str(thread_name), len(control_attribute_changed_events),
-                  len(variant_attribute_changed_events)))
-    control_only__attribute_changed = _dom_diff(
-        control_attribute_changed_events, variant_attribute_changed_events)
-    variant_only__attribute_changed = _dom_diff(
-        variant_attribute_changed_events, control_attribute_changed_events)
-    logger.debug(
-        "%s - After node attr changed subtracted: control %d, variant : %d" %
-        (str(thread_name), len(control_only__attribute_changed),
-         len(variant_only__attribute_changed)))
-
-    ## Text Changed
-    logger.debug(
-        "%s - Original node text node added changed: control %d , variant  %d , url: %s"
-        % (str(thread_name), len(control_text_node_added_events),
-           len(variant_text_node_added_events), main_url))
-    control_only__text_node_added = _dom_diff(control_text_node_added_events,
-                                              variant_text_node_added_events)
-    variant_only__text_node_added = _dom_diff(variant_text_node_added_events,
-                                              control_text_node_added_events)
-    logger.debug(
-        "%s - After node text node added subtracted: control %d, variant : %d, url: %s"
-        % (str(thread_name), len(control_only__text_node_added),
-           len(variant_only__text_node_added), main_url))
-
-    logger.debug(
-        "%s - Original node text node removed changed: control %d , variant  %d , url: %s"
-        % (str(thread_name), len(control_text_node_removed_events),
-           len(variant_text_node_removed_events), main_url))
-    control_only__text_node_removed = _dom_diff(
-        control_text_node_removed_events, variant_text_node_removed_events)
-    variant_only__text_node_removed = _dom_diff(
-        variant_text_node_removed_events, control_text_node_removed_events)
-    logger.debug(
-        "%s - After node text node removed subtracted: control %d, variant : %d, url: %s"
-        % (str(thread_name), len(control_only__text_node_removed),
-           len(variant_only__text_node_removed), main_url))
-
-    logger.debug(
-        "%s - Original node text changed: control %d , variant  %d , url: %s" %
-        (str(thread_name), len(control_text_changed_events),
-         len(variant_text_changed_events), main_url))
-    control_only__text_changed = _dom_diff(control_text_changed_events,
-                                           variant_text_changed_events)
-    variant_only__text_changed = _dom_diff(variant_text_changed_events,
-                                           control_text_changed_events)
-    logger.debug(
-        "%s - After node text changed subtracted: control %d, variant : %d, url: %s"
-        % (str(thread_name), len(control_only__text_changed),
-           len(variant_only__text_changed), main_url))
+    if two_pass is None:
+        two_pass = _get_trials_file_size(
+            control_trials + variant_trials) > DOM_DIFF_TWO_PASS_MIN_BYTES
+
+    # per category, the keys of each side (key -> count or key -> events)
+    if two_pass:
+        # Two passes, so the events of all trials are never held at once:
+        # first count the keys of every trial, then scan again only for the events
+        # of the keys that differ (trials are parsed again unless still in the trial_cache)
+        control_trials_counts = []
+        for trial_inst in control_trials:
+            control_trials_counts.append(
+                _count_trial_dom_keys(trial_inst, key_builder, False, None))
+        control_side = _get_side_dom_key_counts(control_trials_counts)
+
+        variant_trials_counts = []
+        for trial_inst in variant_trials:
+            variant_trials_counts.append(
+                _count_trial_dom_keys(trial_inst, key_builder, True,
+                                      variant_blocked_events))
+        variant_side = _get_side_dom_key_counts(variant_trials_counts)
+
+        # variant first, its trials were parsed last
+        variant_only = _get_remaining_dom_events(variant_trials,
+                                                 variant_trials_counts,
+                                                 variant_side, control_side,
+                                                 key_builder, True)
+        control_only = _get_remaining_dom_events(control_trials,
+                                                 control_trials_counts,
+                                                 control_side, variant_side,
+                                                 key_builder, False)
+    else:
+        control_side = _get_side_dom_events(control_trials, key_builder, False,
+                                            None)
+        variant_side = _get_side_dom_events(variant_trials, key_builder, True,
+                                            variant_blocked_events)
+        control_only = dict()
+        variant_only = dict()
+        for category in DOM_DIFF_CATEGORIES:
+            control_only[category] = _dom_diff(control_side[category],
+                                               variant_side[category])
+            variant_only[category] = _dom_diff(variant_side[category],
+                                               control_side[category])
+
+    for category in DOM_DIFF_CATEGORIES:
+        logger.debug(
+            "%s - Original %s: control %d , variant  %d , after subtracted: control %d, variant : %d, url: %s"
+            % (str(thread_name), category, len(control_side[category]),
+               len(variant_side[category]), len(control_only[category]),
+               len(variant_only[category]), main_url))
+
+    control_only__node_added = control_only[DOM_NODE_ADDED]
+    control_only__node_removed = control_only[DOM_NODE_REMOVED]
+    control_only__attribute_changed = control_only[DOM_ATTRIBUTE_CHANGED]
+    control_only__text_node_added = control_only[DOM_TEXT_NODE_ADDED]
+    control_only__text_node_removed = control_only[DOM_TEXT_NODE_REMOVED]
+    control_only__text_changed = control_only[DOM_TEXT_CHANGED]
+
+    variant_only__node_added = variant_only[DOM_NODE_ADDED]
+    variant_only__node_removed = variant_only[DOM_NODE_REMOVED]
+    variant_only__attribute_changed = variant_only[DOM_ATTRIBUTE_CHANGED]
+    variant_only__text_node_added = variant_only[DOM_TEXT_NODE_ADDED]
+    variant_only__text_node_removed = variant_only[DOM_TEXT_NODE_REMOVED]
+    variant_only__text_changed = variant_only[DOM_TEXT_CHANGED]
 
     if output_external_logs:
         if len(variant_only__text_changed) > 0:
-            control_keys = list(control_text_changed_events.keys())
-            variant_keys = list(variant_text_changed_events.keys())
+            control_keys = list(control_side[DOM_TEXT_CHANGED].keys())
+            variant_keys = list(variant_side[DOM_TEXT_CHANGED].keys())
             variant_remaining_values = list(
                 variant_only__text_changed.values())
             debug_queue.put(
@@ -346,8 +397,10 @@ def get_dom_differences_only(diff_group,
                     variant_remaining_values[:10]), main_url))
 
         if len(variant_only__attribute_changed.values()) > 500:
-            control_keys = list(control_attribute_changed_events.keys())
-            variant_keys = list(variant_attribute_changed_events.keys())
+            control_keys = list(
+                control_side[DOM_ATTRIBUTE_CHANGED].keys())
+            variant_keys = list(
+                variant_side[DOM_ATTRIBUTE_CHANGED].keys())
             variant_remaining_values = list(
                 variant_only__attribute_changed.values())
             debug_queue.put(
@@ -0,0 +1,194 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+from collections import Counter
+
+import textdistance
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# subdomains at least this similar (normalized levenshtein) are grouped together
+SUBDOMAIN_MATCH_THRESHOLD = 0.7
+
+# size of the character n-grams used to find the candidates of a subdomain
+SUBDOMAIN_QGRAM_SIZE = 2
+
+
+def get_subdomain_similarity(subdomain, other_subdomain):
+    return textdistance.levenshtein.normalized_similarity(
+        subdomain, other_subdomain)
+
+
+def get_bounded_levenshtein(value, other_value, max_distance):
+    """
+    Levenshtein distance of the two strings, None when it is over max_distance.
+    Stops at the first row of the dynamic program whose minimum is over
+    max_distance (row minimums never decrease).
+    """
+    if len(value) < len(other_value):
+        value, other_value = other_value, value
+    if len(value) - len(other_value) > max_distance:
+        return None
+    if not other_value:
+        return len(value)
+
+    previous_row = list(range(len(other_value) + 1))
+    for row_index, char in enumerate(value, 1):
+        current_row = [row_index]
+        for column_index, other_char in enumerate(other_value, 1):
+            current_row.append(
+                min(previous_row[column_index] + 1,
+                    current_row[column_index - 1] + 1,
+                    previous_row[column_index - 1] + (char != other_char)))
+        if min(current_row) > max_distance:
+            return None
+        previous_row = current_row
+
+    distance = previous_row[-1]
+    if distance > max_distance:
+        return None
+    return distance
+
+
+def _get_qgrams(value, qgram_size=SUBDOMAIN_QGRAM_SIZE):
+    return Counter(value[index:index + qgram_size]
+                   for index in range(len(value) - qgram_size + 1))
+
+
+class SubdomainClusterIndex:
+    """
+    The subdomains (cluster keys) grouped under one second level domain, in the
+    order they were added.
+    find_best_match gives the same answer as comparing the subdomain to every key
+    with get_subdomain_similarity (the most similar key at or above the threshold,
+    the last one added on ties), but only computes the similarity of plausible keys:
+    - similarity >= threshold means levenshtein distance <= (1 - threshold) * the
+      longest length, so keys whose length differs more than that are skipped
+    - within that distance, two strings of longest length m still share at least
+      m - q + 1 - q * distance character q-grams, so keys are counted through a
+      q-gram index and only those with enough shared q-grams are compared
+    - the distance of those is computed with get_bounded_levenshtein, and the
+      similarity with the same formula as textdistance (1 - distance / m)
+    """
+    def __init__(self,
+                 threshold=SUBDOMAIN_MATCH_THRESHOLD,
+                 qgram_size=SUBDOMAIN_QGRAM_SIZE):
+        self.threshold = threshold
+        self.qgram_size = qgram_size
+        self.keys = []
+        self.key_positions = dict()
+        self.keys_by_length = dict()
+        # q-gram --> {key position: count of the q-gram in the key}
+        self.qgram_postings = dict()
+        # longest length --> max distance of a match
+        self.max_distances = dict()
+        self.comparisons = 0
+
+    def __contains__(self, subdomain):
+        return subdomain in self.key_positions
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, subdomain):
+        if subdomain in self.key_positions:
+            return
+        position = len(self.keys)
+        self.keys.append(subdomain)
+        self.key_positions[subdomain] = position
+        self.keys_by_length.setdefault(len(subdomain), []).append(position)
+        for qgram, count in _get_qgrams(subdomain, self.qgram_size).items():
+            self.qgram_postings.setdefault(qgram, dict())[position] = count
+
+    def _get_max_distance(self, longest_length):
+        # the largest distance whose similarity (as computed by textdistance) still
+        # reaches the threshold, found with the same float arithmetic
+        max_distance = self.max_distances.get(longest_length)
+        if max_distance is None:
+            max_distance = 0
+            while max_distance < longest_length and self._get_similarity(
+                    max_distance + 1, longest_length) >= self.threshold:
+                max_distance += 1
+            self.max_distances[longest_length] = max_distance
+        return max_distance
+
+    @staticmethod
+    def _get_similarity(distance, longest_length):
+        # textdistance.levenshtein.normalized_similarity
+        if longest_length == 0:
+            return 1 - 0
+        return 1 - distance / longest_length
+
+    def _get_candidates(self, subdomain):
+        length = len(subdomain)
+        # key length --> shared q-grams needed, 0 when every key of that length qualifies
+        min_shared_by_length = dict()
+        for key_length in self.keys_by_length:
+            longest_length = max(length, key_length)
+            max_distance = self._get_max_distance(longest_length)
+            if abs(length - key_length) > max_distance:
+                continue
+            min_shared_by_length[key_length] = max(
+                longest_length - self.qgram_size + 1 -
+                self.qgram_size * max_distance, 0)
+
+        candidates = []
+        counted_lengths = []
+        for key_length, min_shared in min_shared_by_length.items():
+            if min_shared == 0:
+                candidates += self.keys_by_length[key_length]
+            else:
+                counted_lengths.append(key_length)
+        if not counted_lengths:
+            return candidates
+
+        shared_counts = Counter()
+        for qgram, count in _get_qgrams(subdomain, self.qgram_size).items():
+            postings = self.qgram_postings.get(qgram)
+            if postings:
+                for position, key_count in postings.items():
+                    shared_counts[position] += min(count, key_count)
+        for position, shared_count in shared_counts.items():
+            min_shared = min_shared_by_length.get(len(self.keys[position]))
+            if min_shared and shared_count >= min_shared:
+                candidates.append(position)
+        return candidates
+
+    def find_best_match(self, subdomain):
+        """
+        Returns (key, similarity) of the best matching key, or (None, threshold)
+        """
+        best_position = None
+        best_similarity = self.threshold
+        for position in self._get_candidates(subdomain):
+            self.comparisons += 1
+            key = self.keys[position]
+            longest_length = max(len(key), len(subdomain))
+            distance = get_bounded_levenshtein(
+                key, subdomain, self._get_max_distance(longest_length))
+            if distance is None:
+                continue
+            similarity = self._get_similarity(distance, longest_length)
+            if similarity > best_similarity or (
+                    similarity == best_similarity and
+                (best_position is None or position > best_position)):
+                best_similarity = similarity
+                best_position = position
+
+        if best_position is None:
+            return None, self.threshold
+        return self.keys[best_position], best_similarity
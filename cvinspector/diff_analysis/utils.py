@@ -14,6 +14,9 @@
 #  limitations under the License.
 
 import logging
+import os
+import threading
+import time
 
 from pymongo import UpdateOne
 
@@ -25,6 +28,12 @@ logger = logging.getLogger(__name__)
 
 PATH_ENDING_RESOURCES = [".css", ".js", ".png", "jpeg", "gif", "jpg", "webp"]
 
+# max number of values in one $in query, keeps each query well under the BSON limit
+RESOLVER_IN_BATCH_SIZE = 1000
+
+# a miss is only remembered this long, so instances inserted later in the run are found
+RESOLVER_MISS_TTL_SEC = 60
+
 
 def contains_important_resource(path):
     for extension in PATH_ENDING_RESOURCES:
@@ -33,6 +42,154 @@ def contains_important_resource(path):
     return False
 
 
+class CrawlInstanceResolver:
+    """
+    Resolves crawl instances by file name or by _id with one $in query per batch,
+    instead of one find_one per instance. Resolved instances (and misses) are kept
+    for the rest of the run, so treat the returned documents as read-only.
+    Misses are only kept for miss_ttl_sec.
+    """
+    def __init__(self,
+                 crawl_collection,
+                 batch_size=RESOLVER_IN_BATCH_SIZE,
+                 miss_ttl_sec=RESOLVER_MISS_TTL_SEC):
+        self.crawl_collection = crawl_collection
+        self.batch_size = batch_size
+        self.miss_ttl_sec = miss_ttl_sec
+        self.lock = threading.Lock()
+        self.by_id = dict()
+        self.by_file_name = dict()
+        # key --> time the miss expires
+        self.missed_ids = dict()
+        self.missed_file_names = dict()
+
+    @staticmethod
+    def _is_resolved(key, found, missed, now):
+        if key in found:
+            return True
+        expires = missed.get(key)
+        if expires is None:
+            return False
+        if expires > now:
+            return True
+        del missed[key]
+        return False
+
+    def _find_in(self, field, values, query=None):
+        # yields the documents whose field is in values, one query per batch
+        for index in range(0, len(values), self.batch_size):
+            find_query = dict(query or {})
+            find_query[field] = {"$in": values[index:index + self.batch_size]}
+            for doc in self.crawl_collection.find(find_query):
+                yield doc
+
+    def prefetch_ids(self, mongo_ids):
+        with self.lock:
+            now = time.monotonic()
+            missing_ids = list(
+                dict.fromkeys(x for x in mongo_ids if not self._is_resolved(
+                    x, self.by_id, self.missed_ids, now)))
+        if not missing_ids:
+            return
+
+        found = dict()
+        for doc in self._find_in("_id", missing_ids):
+            found[doc.get("_id")] = doc
+
+        with self.lock:
+            expires = time.monotonic() + self.miss_ttl_sec
+            for mongo_id in missing_ids:
+                doc = found.get(mongo_id)
+                if doc is None:
+                    self.missed_ids[mongo_id] = expires
+                else:
+                    self.by_id[mongo_id] = doc
+
+    def prefetch_file_names(self, crawler_group_name, file_names):
+        with self.lock:
+            now = time.monotonic()
+            missing_file_names = list(
+                dict.fromkeys(
+                    x for x in file_names
+                    if not self._is_resolved((crawler_group_name, x),
+                                             self.by_file_name,
+                                             self.missed_file_names, now)))
+        if not missing_file_names:
+            return
+
+        found = dict()
+        for doc in self._find_in("file_name", missing_file_names,
+                                 query={"crawl_group_name": crawler_group_name}):
+            # keep the first match like find_one would
+            found.setdefault(doc.get("file_name"), doc)
+
+        with self.lock:
+            expires = time.monotonic() + self.miss_ttl_sec
+            for file_name in missing_file_names:
+                doc = found.get(file_name)
+                if doc is None:
+                    self.missed_file_names[(crawler_group_name,
+                                            file_name)] = expires
+                else:
+                    self.by_file_name[(crawler_group_name, file_name)] = doc
+                    self.by_id[doc.get("_id")] = doc
+
+    def get_by_id(self, mongo_id):
+        self.prefetch_ids([mongo_id])
+        return self.by_id.get(mongo_id)
+
+    def get_by_file_name(self, crawler_group_name, file_name):
+        self.prefetch_file_names(crawler_group_name, [file_name])
+        return self.by_file_name.get((crawler_group_name, file_name))
+
+    def _reset_after_fork(self):
+        # another thread of the parent may have held the lock while forking.
+        # The resolved instances stay, the child shares them copy-on-write
+        self.lock = threading.Lock()
+
+
+_CRAWL_INSTANCE_RESOLVERS = dict()
+_CRAWL_INSTANCE_RESOLVERS_LOCK = threading.Lock()
+
+
+def _reset_crawl_instance_resolvers_after_fork():
+    global _CRAWL_INSTANCE_RESOLVERS_LOCK
+    _CRAWL_INSTANCE_RESOLVERS_LOCK = threading.Lock()
+    for resolver in _CRAWL_INSTANCE_RESOLVERS.values():
+        resolver._reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_crawl_instance_resolvers_after_fork)
+
+
+def get_crawl_instance_resolver(crawl_collection):
+    # one resolver per collection for the run, shared by threads with their own clients
+    with _CRAWL_INSTANCE_RESOLVERS_LOCK:
+        resolver = _CRAWL_INSTANCE_RESOLVERS.get(crawl_collection.full_name)
+        if resolver is None:
+            resolver = CrawlInstanceResolver(crawl_collection)
+            _CRAWL_INSTANCE_RESOLVERS[crawl_collection.full_name] = resolver
+        return resolver
+
+
+def get_diff_group_instance_ids(diff_group):
+    mongo_ids = []
+    for crawl_type in [CONTROL, VARIANT]:
+        mongo_ids += diff_group.get(crawl_type + "_crawl_instance_ids") or []
+    return mongo_ids
+
+
+def prefetch_diff_groups_instances(diff_groups, crawl_collection):
+    # resolves the crawl instances of all diff groups with O(1) queries
+    resolver = get_crawl_instance_resolver(crawl_collection)
+    mongo_ids = []
+    for diff_group in diff_groups:
+        mongo_ids += get_diff_group_instance_ids(diff_group)
+    resolver.prefetch_ids(mongo_ids)
+    return resolver
+
+
 def get_crawl_groups_by_csv(csv_reader,
                             event_key,
                             crawler_group_name,
@@ -83,7 +240,10 @@ def get_crawl_groups_by_csv(csv_reader,
 
     trials_set = []
 
-    # we do this to get the instances or else the cursor object will stay a cursor object
+    resolver = get_crawl_instance_resolver(crawl_collection)
+
+    # first pass collects the trial files, so the crawl instances are resolved at once
+    trial_files = []
     for row in csv_reader:
         for col_key in row.keys():
             file_path = row[col_key]
@@ -92,35 +252,37 @@ def get_crawl_groups_by_csv(csv_reader,
                 file_key, trial_number, _, control_or_variant, _ = get_trial_file_name_details(
                     file_name, file_path)
 
-                is_control = control_or_variant == CONTROL
-
                 # skip ones that have not trials
                 if trial_number is None:
                     logger.debug("skipping due to trial number being None")
                     continue
 
-                if file_key not in crawl_instances_dict:
-                    crawl_instances_dict[file_key] = {}
-                    crawl_instances_dict[file_key]["url"] = row["URL Crawled"]
-                    crawl_instances_dict[file_key]["chunk"] = row["Chunk"]
-                if CONTROL not in crawl_instances_dict[file_key]:
-                    crawl_instances_dict[file_key][CONTROL] = {}
-                if VARIANT not in crawl_instances_dict[file_key]:
-                    crawl_instances_dict[file_key][VARIANT] = {}
-
-                crawl_inst = crawl_collection.find_one({
-                    "crawl_group_name": crawler_group_name,
-                    "file_name": file_name
-                })
-                if crawl_inst is None:
-                    logger.debug("Could not find crawl instance for %s" %
-                                 row["URL Crawled"])
-
-                crawl_instances_dict[file_key][control_or_variant][str(
-                    trial_number)] = crawl_inst
-
-                if trial_number is not None and trial_number not in trials_set:
-                    trials_set.append(str(trial_number))
+                trial_files.append((row, file_name, file_key, trial_number,
+                                    control_or_variant))
+
+    resolver.prefetch_file_names(crawler_group_name,
+                                 [x[1] for x in trial_files])
+
+    for row, file_name, file_key, trial_number, control_or_variant in trial_files:
+        if file_key not in crawl_instances_dict:
+            crawl_instances_dict[file_key] = {}
+            crawl_instances_dict[file_key]["url"] = row["URL Crawled"]
+            crawl_instances_dict[file_key]["chunk"] = row["Chunk"]
+        if CONTROL not in crawl_instances_dict[file_key]:
+            crawl_instances_dict[file_key][CONTROL] = {}
+        if VARIANT not in crawl_instances_dict[file_key]:
+            crawl_instances_dict[file_key][VARIANT] = {}
+
+        crawl_inst = resolver.get_by_file_name(crawler_group_name, file_name)
+        if crawl_inst is None:
+            logger.debug("Could not find crawl instance for %s" %
+                         row["URL Crawled"])
+
+        crawl_instances_dict[file_key][control_or_variant][str(
+            trial_number)] = crawl_inst
+
+        if trial_number is not None and trial_number not in trials_set:
+            trials_set.append(str(trial_number))
 
     discard_crawl_instances = []
     discard_operations = []
@@ -250,7 +412,12 @@ def get_crawl_groups_by_csv(csv_reader,
     return crawl_instances_list
 
 
-def create_trial_group(diff_group, crawl_collection):
+def create_trial_group(diff_group, crawl_collection, resolver=None):
+    if resolver is None:
+        resolver = get_crawl_instance_resolver(crawl_collection)
+    # one query for all trials (none if the chunk was prefetched)
+    resolver.prefetch_ids(get_diff_group_instance_ids(diff_group))
+
     crawl_trial_group = dict()
     crawl_trial_group["url"] = diff_group.get("url")
     for crawl_type in [CONTROL, VARIANT]:
@@ -259,7 +426,7 @@ def create_trial_group(diff_group, crawl_collection):
         diff_key = crawl_type + "_crawl_instance_ids"
 
         for mongo_id in diff_group.get(diff_key):
-            trial_inst = crawl_collection.find_one({"_id": mongo_id})
+            trial_inst = resolver.get_by_id(mongo_id)
             assert (trial_inst
                     is not None), "Cannot find crawl_instance " + str(mongo_id)
             crawl_trial_group[crawl_type][str(trial_index)] = trial_inst
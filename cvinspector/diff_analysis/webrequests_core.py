@@ -13,20 +13,98 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-import json
 import logging
-import textdistance
 
-from cvinspector.common.utils import CONTROL, VARIANT, get_webrequests_from_raw_json, get_blocked_webrequests
+from cvinspector.common.utils import CONTROL, VARIANT, get_webrequests_from_raw_json, get_blocked_webrequests, \
+    load_webrequest_details
 from cvinspector.common.webrequests_utils import get_domain_only_from_url, get_path_and_query_params, remove_last_path, \
     extract_tld, get_second_level_domain_from_tld, get_domain_only_from_tld
+from cvinspector.diff_analysis.subdomain_clusters import SubdomainClusterIndex, SUBDOMAIN_MATCH_THRESHOLD
 from cvinspector.diff_analysis.utils import contains_important_resource, create_trial_group
+from cvinspector.diff_analysis.wr_diff_cache import get_wr_diff_cache, get_wr_diff_cache_key
 
 logger = logging.getLogger(__name__)
 #logger.setLevel("DEBUG")
 
 UNKNOWN_REQ_CONTENT_LENGTH = -1
 
+# marks the end of a path in a path trie
+_PATH_TRIE_END = None
+
+
+def _get_trimmed_path(path, lvl=3, delimiter="/"):
+    path_split = path.split(delimiter)
+    if len(path_split) > lvl:
+        trim_path_split = path_split[:lvl]
+        return delimiter.join(trim_path_split)
+    return path
+
+
+def _create_path_trie(paths):
+    # character trie of the paths, nested dicts
+    trie = dict()
+    for path in paths:
+        node = trie
+        for char in path:
+            node = node.setdefault(char, dict())
+        node[_PATH_TRIE_END] = True
+    return trie
+
+
+def _contains_any_path(value, path_trie):
+    # same as any(path in value for path in paths), walking the trie from every position
+    if _PATH_TRIE_END in path_trie:
+        # the empty path is in every string
+        return True
+    for start in range(len(value)):
+        node = path_trie
+        for char in value[start:]:
+            node = node.get(char)
+            if node is None:
+                break
+            if _PATH_TRIE_END in node:
+                return True
+    return False
+
+
+def get_important_path_to_requests(webreqs):
+    """
+    Groups the requests for important resources (see contains_important_resource)
+    by (domain, path without the last part), a multiset of the resources per path.
+    Returns that dict and the distinct trimmed paths (in order, for logging)
+    """
+    path_to_request = dict()
+    trim_paths = dict()
+    for req in webreqs:
+        domain = get_domain_only_from_url(req)
+        # we keep track of potential requests that may be a problem
+        path, _ = get_path_and_query_params(req)
+        if contains_important_resource(path):
+            path = remove_last_path(path)
+            if len(path) > 0:
+                trim_paths[_get_trimmed_path(path)] = None
+                if (domain, path) not in path_to_request:
+                    path_to_request[(domain, path)] = []
+                path_to_request[(domain, path)].append(req)
+    return path_to_request, list(trim_paths)
+
+
+def get_path_resource_mismatches(control_path_to_request,
+                                 variant_path_to_request):
+    """
+    Paths that both sides requested, but not the same number of times.
+    Returns the requests of those paths, for control and for variant.
+    """
+    control_path_resource_mismatch = []
+    variant_path_resource_mismatch = []
+    for key, control_requests in control_path_to_request.items():
+        variant_requests = variant_path_to_request.get(key)
+        if variant_requests is not None and len(control_requests) != len(
+                variant_requests):
+            control_path_resource_mismatch += control_requests
+            variant_path_resource_mismatch += variant_requests
+    return control_path_resource_mismatch, variant_path_resource_mismatch
+
 
 def get_wr_trial_aggregate(crawl_trial_group,
                            control_or_variant,
@@ -77,7 +155,7 @@ def get_wr_trial_aggregate(crawl_trial_group,
             response_headers = None
             if req_details:
                 try:
-                    req_details_json = json.loads(req_details)
+                    req_details_json = load_webrequest_details(req_details)
                     if req_details_json.get("statusCode") != 200:
                         continue
                     req_resource_type = req_details_json.get("type")
@@ -257,24 +335,22 @@ def get_diff_requests_sets(control_domain_path_to_requests,
             str(thread_name) + " - Variant Matching SLD to domain path: " +
             str(match_variant_sld_to_domain_path))
 
-    threshold_match = 0.7
+    threshold_match = SUBDOMAIN_MATCH_THRESHOLD
     # sld -> subdomain -> CONTROL|VARIANT -> tuple list (subdomain, tld, domain, domain_path)
     sld_group = dict()  
+    # sld -> index of the subdomains of sld_group[sld], to find the highest match
+    sld_subdomain_clusters = dict()
     # group together with highest match (within variant first)
     for sld_url in match_variant_sld_to_domain_path:
         variant_items = match_variant_sld_to_domain_path.get(sld_url)
         for variant_subdomain, variant_tld, variant_domain, variant_domain_path in variant_items:
             if sld_url not in sld_group:
                 sld_group[sld_url] = dict()
+                sld_subdomain_clusters[sld_url] = SubdomainClusterIndex(
+                    threshold_match)
 
-            highest_match_subdomain = None
-            highest_match_threshold = threshold_match
-
-            for subdomain in sld_group[sld_url]:
-                match_ratio = textdistance.levenshtein.normalized_similarity(subdomain, variant_subdomain)
-                if match_ratio >= highest_match_threshold:
-                    highest_match_threshold = match_ratio
-                    highest_match_subdomain = subdomain
+            highest_match_subdomain, highest_match_threshold = sld_subdomain_clusters[
+                sld_url].find_best_match(variant_subdomain)
 
             if highest_match_subdomain is not None:
                 if debug_queue and output_external_logs:
@@ -291,6 +367,7 @@ def get_diff_requests_sets(control_domain_path_to_requests,
             else:
                 if variant_subdomain not in sld_group[sld_url]:
                     sld_group[sld_url][variant_subdomain] = dict()
+                    sld_subdomain_clusters[sld_url].add(variant_subdomain)
                 if VARIANT not in sld_group[sld_url][variant_subdomain]:
                     sld_group[sld_url][variant_subdomain][VARIANT] = []
                     sld_group[sld_url][variant_subdomain][VARIANT].append(
@@ -302,14 +379,8 @@ def get_diff_requests_sets(control_domain_path_to_requests,
         control_items = control_sld_to_domain_path.get(sld_url)
         for control_subdomain, control_tld, control_domain, control_domain_path in control_items:
             if sld_url in sld_group:
-                highest_match_subdomain = None
-                highest_match_threshold = threshold_match
-
-                for subdomain in sld_group[sld_url]:
-                    match_ratio = textdistance.levenshtein.normalized_similarity(subdomain, control_subdomain)
-                    if match_ratio >= highest_match_threshold:
-                        highest_match_threshold = match_ratio
-                        highest_match_subdomain = subdomain
+                highest_match_subdomain, highest_match_threshold = sld_subdomain_clusters[
+                    sld_url].find_best_match(control_subdomain)
 
                 if highest_match_subdomain is not None:
                     if debug_queue and output_external_logs:
@@ -363,14 +434,14 @@ def get_diff_requests_sets(control_domain_path_to_requests,
             str(len(set_variant_domain_paths_only)))
 
     # remove the domain_paths that have the same paths (from the intersection paths)
-    for intersected_path in intersection_paths:
-        for domain_path in list(set_control_domain_paths_only):
-            if intersected_path in domain_path:
-                set_control_domain_paths_only.remove(domain_path)
-
-        for domain_path in list(set_variant_domain_paths_only):
-            if intersected_path in domain_path:
-                set_variant_domain_paths_only.remove(domain_path)
+    if intersection_paths:
+        intersection_path_trie = _create_path_trie(intersection_paths)
+        set_control_domain_paths_only = set(
+            domain_path for domain_path in set_control_domain_paths_only
+            if not _contains_any_path(domain_path, intersection_path_trie))
+        set_variant_domain_paths_only = set(
+            domain_path for domain_path in set_variant_domain_paths_only
+            if not _contains_any_path(domain_path, intersection_path_trie))
     if debug_queue and output_external_logs:
         debug_queue.put(
             str(thread_name) + " - Domain Paths: Control After: " +
@@ -406,6 +477,44 @@ def get_wr_differences_only(diff_group,
     # create custom structure
     crawl_trial_group = create_trial_group(diff_group, crawl_collection)
 
+    # the same diff is needed by write_urls_txt and write_feature_csv, see wr_diff_cache
+    diff_cache = get_wr_diff_cache()
+    diff_cache_key = None
+    diff_result = None
+    if diff_cache is not None:
+        diff_cache_key = get_wr_diff_cache_key(diff_group, crawl_trial_group,
+                                               crawler_group_name)
+        diff_result = diff_cache.get(diff_cache_key)
+        if diff_result is not None and debug_queue and output_external_logs:
+            debug_queue.put(
+                str(thread_name) + " - Webrequest diff read from cache " +
+                diff_cache_key)
+
+    if diff_result is None:
+        diff_result = _get_wr_differences_only(
+            crawl_trial_group,
+            crawler_group_name,
+            debug_queue=debug_queue,
+            thread_name=thread_name,
+            output_external_logs=output_external_logs)
+        if diff_cache is not None:
+            diff_cache.put(diff_cache_key, diff_result)
+
+    control_only_diff, variant_only_diff = diff_result
+
+    # collect requests that we want to parse for tracking later
+    if debug_collect_urls and urls_collector_queue:
+        for req in variant_only_diff.get("urls"):
+            urls_collector_queue.put(req)
+
+    return control_only_diff, variant_only_diff
+
+
+def _get_wr_differences_only(crawl_trial_group,
+                             crawler_group_name,
+                             debug_queue=None,
+                             thread_name=None,
+                             output_external_logs=True):
     main_url = ""
     for trial_key in crawl_trial_group[CONTROL].keys():
         trial_inst = crawl_trial_group[CONTROL].get(trial_key)
@@ -430,68 +539,23 @@ def get_wr_differences_only(diff_group,
         output_external_logs=output_external_logs,
         thread_name=thread_name)
 
-    # collect requests that we want to parse for tracking later
-    if debug_collect_urls and urls_collector_queue:
-        for req in variant_only_webreqs:
-            urls_collector_queue.put(req)
-
-    def _get_trimmed_path(path, lvl=3, delimiter="/"):
-        path_split = path.split(delimiter)
-        if len(path_split) > lvl:
-            trim_path_split = path_split[:lvl]
-            return delimiter.join(trim_path_split)
-        return path
-
-    control_path_to_request = dict()
-    control_trim_paths = []
-    for req in control_only_webreqs:
-        domain = get_domain_only_from_url(req)
-        # we keep track of potential requests that may be a problem
-        path, _ = get_path_and_query_params(req)
-        if contains_important_resource(path):
-            path = remove_last_path(path)
-            if len(path) > 0:
-                trim_path = _get_trimmed_path(path)
-                if trim_path not in control_trim_paths:
-                    control_trim_paths.append(trim_path)
-                if (domain, path) not in control_path_to_request:
-                    control_path_to_request[(domain, path)] = []
-                control_path_to_request[(domain, path)].append(req)
+    control_path_to_request, control_trim_paths = get_important_path_to_requests(
+        control_only_webreqs)
 
     logger.debug("%s - Control Trimmed paths: %s" %
                  (str(thread_name), str(control_trim_paths)))
 
-    variant_path_to_request = dict()
-    variant_trim_paths = []
-    for req in variant_only_webreqs:
-        domain = get_domain_only_from_url(req)
-        # we keep track of potential requests that may be a problem
-        path, _ = get_path_and_query_params(req)
-        if contains_important_resource(path):
-            path = remove_last_path(path)
-            trim_path = _get_trimmed_path(path)
-            if len(path) > 0:
-                if trim_path not in variant_trim_paths:
-                    variant_trim_paths.append(trim_path)
-                if (domain, path) not in variant_path_to_request:
-                    variant_path_to_request[(domain, path)] = []
-                variant_path_to_request[(domain, path)].append(req)
+    variant_path_to_request, variant_trim_paths = get_important_path_to_requests(
+        variant_only_webreqs)
 
     logger.debug("%s - Variant Trimmed paths: %s" %
                  (str(thread_name), str(variant_trim_paths)))
 
-    path_resource_mismatch_found = []
-    for key in control_path_to_request.keys():
-        if key in variant_path_to_request:
-            if len(control_path_to_request.get(key)) != len(
-                    variant_path_to_request.get(key)):
-                path_resource_mismatch_found.append(key)
-
-    control_path_resource_mismatch = []
-    variant_path_resource_mismatch = []
-    for key in path_resource_mismatch_found:
-        control_path_resource_mismatch += control_path_to_request.get(key)
-        variant_path_resource_mismatch += variant_path_to_request.get(key)
+    control_path_resource_mismatch, variant_path_resource_mismatch = get_path_resource_mismatches(
+        control_path_to_request, variant_path_to_request)
+    # membership checks below, the lists keep the order for the output
+    control_path_resource_mismatch_set = set(control_path_resource_mismatch)
+    variant_path_resource_mismatch_set = set(variant_path_resource_mismatch)
 
     # filter down the types that we only care about
     control_req_to_type_final = dict()
@@ -500,7 +564,7 @@ def get_wr_differences_only(diff_group,
     # here we find only
     for req_item in control_req_to_type:
         #if req_item in control_path_resource_mismatch.get("mismatch") or req_item in control_only_webreqs:
-        if req_item in control_path_resource_mismatch or req_item in control_only_webreqs:
+        if req_item in control_path_resource_mismatch_set or req_item in control_only_webreqs:
 
             ctr_content_type = control_req_to_type.get(req_item)
             if ctr_content_type is not None:
@@ -523,7 +587,7 @@ def get_wr_differences_only(diff_group,
 
     for req_item in variant_req_to_type:
         #if req_item in variant_path_resource_mismatch.get("mismatch") or req_item in variant_only_webreqs:
-        if req_item in variant_path_resource_mismatch or req_item in variant_only_webreqs:
+        if req_item in variant_path_resource_mismatch_set or req_item in variant_only_webreqs:
 
             var_content_type = variant_req_to_type.get(req_item)
             if var_content_type is not None:
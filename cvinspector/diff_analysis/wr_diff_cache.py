@@ -0,0 +1,188 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import importlib.util
+import logging
+import os
+import pickle
+import threading
+import zlib
+from functools import lru_cache
+
+from cvinspector.common.utils import CONTROL, VARIANT
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# bump when get_wr_differences_only returns something else for the same trials
+WR_DIFF_CACHE_VERSION = 1
+
+# modules that compute the diff, their source is part of the key, so editing them
+# invalidates the cache even when WR_DIFF_CACHE_VERSION is not bumped
+WR_DIFF_CACHE_CODE_MODULES = [
+    "cvinspector.diff_analysis.webrequests_core",
+    "cvinspector.diff_analysis.subdomain_clusters",
+    "cvinspector.diff_analysis.utils", "cvinspector.common.webrequests_utils",
+    "cvinspector.common.url_parts", "cvinspector.common.utils",
+    "cvinspector.common.trial_cache"
+]
+
+WR_DIFF_CACHE_MAGIC = b"CVWRDIF\0"
+WR_DIFF_CACHE_SUFFIX = ".wrdiff"
+
+# fast compression: the entries are written once and read once or twice
+WR_DIFF_CACHE_COMPRESS_LEVEL = 1
+
+
+@lru_cache(maxsize=None)
+def get_wr_diff_code_fingerprint():
+    # sha256 of the source of WR_DIFF_CACHE_CODE_MODULES, read once per process
+    sha256 = hashlib.sha256()
+    for module_name in WR_DIFF_CACHE_CODE_MODULES:
+        module_spec = importlib.util.find_spec(module_name)
+        with open(module_spec.origin, 'rb') as module_file:
+            sha256.update(module_file.read())
+    return sha256.hexdigest()
+
+
+def get_wr_diff_cache_key(diff_group, crawl_trial_group, crawler_group_name):
+    """
+    Content address of the diff of a diff group: the diff code (version and source),
+    its id, the trial files it diffs (path, size and mtime, in trial order) and the
+    parameters of the diff.
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(
+        repr((WR_DIFF_CACHE_VERSION, get_wr_diff_code_fingerprint(),
+              crawler_group_name, str(diff_group.get("_id")))).encode("utf-8"))
+    for crawl_type in [CONTROL, VARIANT]:
+        for trial_key, trial_inst in crawl_trial_group[crawl_type].items():
+            file_path = trial_inst.get("file_path")
+            try:
+                file_stat = os.stat(file_path)
+                file_key = (file_stat.st_size, file_stat.st_mtime_ns)
+            except (OSError, TypeError):
+                file_key = None
+            sha256.update(
+                repr((crawl_type, trial_key, str(trial_inst.get("_id")),
+                      file_path, file_key)).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+class WebRequestDiffCache:
+    """
+    Directory of get_wr_differences_only results, one file per content address
+    (see get_wr_diff_cache_key): magic + zlib compressed pickle.
+    Files are written under a temporary name and renamed, so processes (forked
+    workers of write_urls_txt and write_feature_csv) can share the directory.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.bytes_written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key):
+        return self.directory + os.sep + key + WR_DIFF_CACHE_SUFFIX
+
+    def get(self, key):
+        # None when missing or unreadable
+        try:
+            with open(self._get_path(key), 'rb') as cache_file:
+                data = cache_file.read()
+            if not data.startswith(WR_DIFF_CACHE_MAGIC):
+                raise ValueError("not a webrequest diff cache file")
+            value = pickle.loads(
+                zlib.decompress(data[len(WR_DIFF_CACHE_MAGIC):]))
+        except FileNotFoundError:
+            value = None
+        except Exception as e:
+            logger.warning("Could not read webrequest diff cache %s: %s", key,
+                           repr(e))
+            value = None
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key, value):
+        data = WR_DIFF_CACHE_MAGIC + zlib.compress(
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+            WR_DIFF_CACHE_COMPRESS_LEVEL)
+        cache_path = self._get_path(key)
+        tmp_cache_path = "%s.%d.%d.tmp" % (cache_path, os.getpid(),
+                                          threading.get_ident())
+        with open(tmp_cache_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_cache_path, cache_path)
+
+        with self.lock:
+            self.writes += 1
+            self.bytes_written += len(data)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "bytes_written": self.bytes_written
+            }
+
+    def _reset_after_fork(self):
+        # another thread of the parent may have held the lock while forking
+        self.lock = threading.Lock()
+
+
+WR_DIFF_CACHE = None
+
+
+def _reset_wr_diff_cache_after_fork():
+    if WR_DIFF_CACHE is not None:
+        WR_DIFF_CACHE._reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_wr_diff_cache_after_fork)
+
+
+def enable_wr_diff_cache(directory):
+    # before the worker processes are forked, so they share it
+    global WR_DIFF_CACHE
+    WR_DIFF_CACHE = WebRequestDiffCache(directory)
+    return WR_DIFF_CACHE
+
+
+def disable_wr_diff_cache():
+    global WR_DIFF_CACHE
+    WR_DIFF_CACHE = None
+
+
+def get_wr_diff_cache():
+    return WR_DIFF_CACHE
+
+
+def get_wr_diff_cache_stats():
+    # stats of this process only, the forked workers keep their own
+    if WR_DIFF_CACHE is None:
+        return None
+    return WR_DIFF_CACHE.get_stats()
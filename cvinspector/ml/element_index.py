@@ -0,0 +1,382 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import threading
+from collections import OrderedDict
+
+import soupsieve
+from bs4.element import Tag
+from soupsieve.css_match import CSSMatch
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# combinators that end a compound selector
+_COMBINATOR_CHARS = " \t\n\r\f>+~"
+
+# characters that start the next part of a compound selector
+_COMPOUND_PART_CHARS = "#.[:"
+
+_HEX_CHARS = "0123456789abcdefABCDEF"
+
+# whitespace that ends a hex escape ("\\31 abc" is one identifier)
+_ESCAPE_END_CHARS = " \t\n\r\f"
+
+# selectors whose matches are kept per document, the parent parts of the
+# get_corres_elements selectors repeat for images and iframes
+ELEMENT_INDEX_ANCHOR_CACHE_SIZE = 256
+
+
+def split_selector_compounds(selector):
+    """
+    Splits a css selector into its compound selectors and the combinators between
+    them (" ", ">", "+" or "~"), so len(combinators) == len(compounds) - 1.
+    Returns None for selector lists (top level commas) and relative selectors.
+    Brackets, parentheses, strings and escapes (with the whitespace ending a hex
+    escape) are skipped, so
+    "div:not([a='x y']) > img" gives (["div:not([a='x y'])", "img"], [">"])
+    """
+    compounds = []
+    combinators = []
+    combinator = None
+    current = []
+    depth = 0
+    quote = None
+    escaped = False
+    # hex digits read of a hex escape, None outside of one
+    hex_digits = None
+    for char in selector:
+        if hex_digits is not None:
+            # up to 6 hex digits, a whitespace after them belongs to the escape
+            if char in _HEX_CHARS and hex_digits < 6:
+                hex_digits += 1
+                current.append(char)
+                continue
+            hex_digits = None
+            if char in _ESCAPE_END_CHARS:
+                current.append(char)
+                continue
+        if escaped:
+            escaped = False
+            if char in _HEX_CHARS:
+                hex_digits = 1
+            current.append(char)
+            continue
+        if char == "\\":
+            escaped = True
+            current.append(char)
+            continue
+        if quote is not None:
+            if char == quote:
+                quote = None
+            current.append(char)
+            continue
+
+        if depth == 0 and char == ",":
+            return None
+        if depth == 0 and char in _COMBINATOR_CHARS:
+            if current:
+                compounds.append("".join(current))
+                current = []
+            if char in ">+~":
+                if combinator not in (None, " ") or not compounds:
+                    return None
+                combinator = char
+            elif combinator is None and compounds:
+                combinator = " "
+            continue
+
+        if not current and compounds:
+            combinators.append(combinator)
+            combinator = None
+        if char in "'\"":
+            quote = char
+        elif char in "[(":
+            depth += 1
+        elif char in "])":
+            depth -= 1
+        current.append(char)
+
+    if current:
+        compounds.append("".join(current))
+    elif combinator not in (None, " "):
+        # dangling combinator
+        return None
+    if not compounds:
+        return None
+    return compounds, combinators
+
+
+def join_selector_compounds(compounds, combinators):
+    selector = compounds[0]
+    for combinator, compound in zip(combinators, compounds[1:]):
+        if combinator == " ":
+            selector += " " + compound
+        else:
+            selector += " %s %s" % (combinator, compound)
+    return selector
+
+
+def _read_identifier(compound, position):
+    # reads up to the next unescaped part of the compound, resolving simple escapes
+    # like "fb\\:like". Returns (identifier, end), identifier is None for hex escapes
+    chars = []
+    length = len(compound)
+    while position < length and compound[position] not in _COMPOUND_PART_CHARS:
+        char = compound[position]
+        if char == "\\":
+            if position + 1 >= length or compound[position + 1] in _HEX_CHARS:
+                return None, position
+            char = compound[position + 1]
+            position += 1
+        chars.append(char)
+        position += 1
+    return "".join(chars), position
+
+
+def parse_simple_compound(compound):
+    """
+    Splits the leading tag/#id/.class parts of a compound selector.
+    Returns (tag, ids, classes, rest), where rest is whatever follows them
+    (attributes, pseudo classes), or None when soupsieve should handle it.
+    """
+    tag = None
+    ids = []
+    classes = []
+    position = 0
+    length = len(compound)
+
+    if position < length and compound[position] not in _COMPOUND_PART_CHARS:
+        tag, position = _read_identifier(compound, position)
+        if tag is None or "|" in tag:
+            # hex escapes and namespaces are left to soupsieve
+            return None
+        if tag == "*":
+            tag = None
+
+    while position < length and compound[position] in "#.":
+        name, end = _read_identifier(compound, position + 1)
+        if not name:
+            return None
+        if compound[position] == "#":
+            ids.append(name)
+        else:
+            classes.append(name)
+        position = end
+
+    return tag, ids, classes, compound[position:]
+
+
+class ElementIndex:
+    """
+    Index of the elements of one parsed document, built in a single pass:
+    tag, id and class --> elements (in document order) and element --> parent.
+    select() answers selectors made only of tag/#id/.class from those maps and
+    runs soupsieve only on the candidates of the rightmost compound otherwise,
+    instead of walking the whole document per selector.
+    The document must not be modified once indexed (see ParsedPageSource).
+    """
+    def __init__(self, soup):
+        self.soup = soup
+        self.namespaces = getattr(soup, "_namespaces", None)
+        self.elements = []
+        # keyed by id(element), Tag hashes by its markup
+        self.parents = dict()
+        self.by_tag = dict()
+        self.by_id = dict()
+        self.by_class = dict()
+        self.sibling_positions = dict()
+        self.anchor_cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.select_hits = 0
+        self.select_fallbacks = 0
+
+        for element in soup.descendants:
+            if not isinstance(element, Tag):
+                continue
+            self.elements.append(element)
+            self.parents[id(element)] = element.parent
+            self.by_tag.setdefault(element.name.lower(), []).append(element)
+
+            element_id = element.get("id")
+            if isinstance(element_id, str):
+                self.by_id.setdefault(element_id, []).append(element)
+            element_classes = element.get("class")
+            if isinstance(element_classes, str):
+                element_classes = element_classes.split()
+            if element_classes:
+                for element_class in set(element_classes):
+                    self.by_class.setdefault(element_class,
+                                             []).append(element)
+
+    def get_parent(self, element):
+        return self.parents.get(id(element), element.parent)
+
+    def get_parent_chain(self, element):
+        # parents of the element, closest first
+        chain = []
+        parent = self.get_parent(element)
+        while parent is not None:
+            chain.append(parent)
+            parent = self.get_parent(parent)
+        return chain
+
+    def get_sibling_position(self, element):
+        """
+        Returns (position, count) of the element among the children of its parent,
+        skipping "\\n" strings. position starts at 1, (0, 0) when there is no parent
+        """
+        parent = self.get_parent(element)
+        if parent is None:
+            return 0, 0
+
+        with self.lock:
+            positions = self.sibling_positions.get(id(parent))
+        if positions is None:
+            positions = dict()
+            children_count = 0
+            for child in parent.children:
+                # a tag never serializes to "\n", only strings need the check
+                if not isinstance(child, Tag) and str(child) == "\n":
+                    continue
+                children_count += 1
+                positions[id(child)] = children_count
+            positions = (positions, children_count)
+            with self.lock:
+                self.sibling_positions[id(parent)] = positions
+
+        child_positions, children_count = positions
+        return child_positions.get(id(element), 0), children_count
+
+    def _get_candidates(self, tag, ids, classes):
+        candidate_lists = []
+        if tag is not None:
+            candidate_lists.append(self.by_tag.get(tag.lower(), []))
+        for element_id in ids:
+            candidate_lists.append(self.by_id.get(element_id, []))
+        for element_class in classes:
+            candidate_lists.append(self.by_class.get(element_class, []))
+
+        if not candidate_lists:
+            return None
+
+        candidate_lists.sort(key=len)
+        candidates = candidate_lists[0]
+        for other_list in candidate_lists[1:]:
+            if not candidates:
+                break
+            other_keys = set(id(element) for element in other_list)
+            candidates = [
+                element for element in candidates
+                if id(element) in other_keys
+            ]
+        return candidates
+
+    def _get_matcher(self, selector):
+        # one matcher scoped on the document, like soup.select uses, so it is not
+        # set up again per candidate (as soupsieve.match would) and :scope still
+        # means the document
+        compiled = soupsieve.compile(selector, namespaces=self.namespaces)
+        return CSSMatch(compiled.selectors, self.soup, compiled.namespaces,
+                        compiled.flags)
+
+    def _get_anchor_keys(self, selector):
+        # ids of the elements matching selector, kept since the document does not change
+        with self.lock:
+            anchor_keys = self.anchor_cache.get(selector)
+            if anchor_keys is not None:
+                self.anchor_cache.move_to_end(selector)
+                return anchor_keys
+
+        anchor_keys = frozenset(id(element) for element in self.select(selector))
+        with self.lock:
+            self.anchor_cache[selector] = anchor_keys
+            if len(self.anchor_cache) > ELEMENT_INDEX_ANCHOR_CACHE_SIZE:
+                self.anchor_cache.popitem(last=False)
+        return anchor_keys
+
+    def _has_anchor_ancestor(self, element, anchor_keys):
+        parent = self.get_parent(element)
+        while parent is not None:
+            if id(parent) in anchor_keys:
+                return True
+            parent = self.get_parent(parent)
+        return False
+
+    def select(self, selector):
+        """
+        Same result as soup.select(selector): matching elements in document order.
+        For "A B" and "A > B", the elements matching A are found first (recursively)
+        and only the candidates of B below them are matched, so soupsieve never
+        walks up from every candidate.
+        """
+        split_selector = split_selector_compounds(selector.strip())
+        parsed = None
+        if split_selector is not None:
+            compounds, combinators = split_selector
+            parsed = parse_simple_compound(compounds[-1])
+
+        if parsed is None:
+            with self.lock:
+                self.select_fallbacks += 1
+            return self.soup.select(selector)
+
+        tag, ids, classes, rest = parsed
+        candidates = self._get_candidates(tag, ids, classes)
+        if candidates is None:
+            candidates = self.elements
+        elif len(compounds) == 1 and not rest:
+            # tag/#id/.class only, the maps are the answer
+            with self.lock:
+                self.select_hits += 1
+            return list(candidates)
+
+        with self.lock:
+            self.select_hits += 1
+
+        if len(compounds) == 1:
+            matcher = self._get_matcher(selector)
+            return [element for element in candidates if matcher.match(element)]
+
+        if combinators[-1] not in (" ", ">"):
+            # sibling combinators, let soupsieve match the whole selector
+            matcher = self._get_matcher(selector)
+            return [element for element in candidates if matcher.match(element)]
+
+        anchor_keys = self._get_anchor_keys(
+            join_selector_compounds(compounds[:-1], combinators[:-1]))
+        if not anchor_keys:
+            return []
+
+        matcher = self._get_matcher(compounds[-1])
+        matched = []
+        for element in candidates:
+            if combinators[-1] == ">":
+                if id(self.get_parent(element)) not in anchor_keys:
+                    continue
+            elif not self._has_anchor_ancestor(element, anchor_keys):
+                continue
+            if matcher.match(element):
+                matched.append(element)
+        return matched
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "elements": len(self.elements),
+                "select_hits": self.select_hits,
+                "select_fallbacks": self.select_fallbacks
+            }
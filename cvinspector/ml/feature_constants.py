@@ -25,3 +25,11 @@ BOOLEAN_FEATURES = [CRAWL_URL_COLUMN_NAME] + [
     "variant_subdomain_length_more5",
     "peak_sync_total_changes_offset_ispositive"
 ] + [TARGET_COLUMN_NAME]
+
+# columns of the feature store (see feature_store) that hold a url or name and are
+# dictionary-encoded, each value is kept once per partition
+DICTIONARY_ENCODED_COLUMNS = [CRAWL_URL_COLUMN_NAME, CHUNK_COLUMN_NAME]
+
+# integer columns of the feature store, BOOLEAN_FEATURES are int8 and every other
+# feature is a float64
+INTEGER_COLUMNS = [TARGET_COLUMN_NAME, RANK_COLUMN_NAME]
@@ -22,7 +22,6 @@ import re
 import time
 
 import numpy as np
-from bs4 import BeautifulSoup
 
 from cvinspector.common.dommutation_utils import get_attribute_changed_info, get_nodes_added__node_name
 from cvinspector.common.dommutation_utils import get_attribute_changed_key
@@ -43,6 +42,8 @@ from cvinspector.common.webrequests_utils import get_path_and_query_stats, has_s
     filter_requests_by_header, get_url_without_query
 from cvinspector.data_migrate.utils import get_file_name
 from cvinspector.diff_analysis.utils import create_trial_group
+from cvinspector.ml.page_source_cache import get_parsed_page_source
+from cvinspector.ml.time_series_store import TIME_SERIES_COLUMN_INDEX, load_time_series_rows
 
 logger = logging.getLogger(__name__)
 #logger.setLevel("DEBUG")
@@ -72,32 +73,28 @@ IMPORTANT_CSV_KEYS = [
 SPIKE_MIN = 2
 
 
-# given a last_event_key, get the time for that. Then count the occurrences specific_keys after that
-def get_count_of_events_after_last_event(specific_keys, last_event_key, rows):
-    def _has_spike(specific_keys, row):
-        for key in row.keys():
-            if key in specific_keys and int(row[key]) >= SPIKE_MIN:
-                return True
-        return False
+def _get_column(rows, key):
+    return rows[:, TIME_SERIES_COLUMN_INDEX[key]]
 
-    considered_rows = rows
-    last_event_index = 0
-    for index, row in enumerate(reversed(considered_rows), start=1):
-        if last_event_key in row and int(row[last_event_key]) > 0:
-            last_event_index = -1 * index
-            break
 
-    event_count = 0
+def _get_spike_mask(specific_keys, rows):
+    # bins where at least one of specific_keys has a spike
+    columns = [TIME_SERIES_COLUMN_INDEX[key] for key in specific_keys]
+    return (rows[:, columns] >= SPIKE_MIN).any(axis=1)
 
-    # only if find the last_event_key. Else return zero
-    if last_event_index < 0:
-        considered_rows = considered_rows[last_event_index:]
 
-        for row in considered_rows:
-            if _has_spike(specific_keys, row):
-                event_count += 1
+# given a last_event_key, get the time for that. Then count the occurrences specific_keys after that
+# rows are the (bins x columns) time series of a trial, see time_series_store
+def get_count_of_events_after_last_event(specific_keys, last_event_key, rows):
+    last_event_indexes = np.flatnonzero(_get_column(rows, last_event_key) > 0)
+
+    # only if find the last_event_key. Else return zero
+    if len(last_event_indexes) == 0:
+        return 0
 
-    return event_count
+    considered_rows = rows[last_event_indexes[-1]:]
+    return int(np.count_nonzero(_get_spike_mask(specific_keys,
+                                                considered_rows)))
 
 
 # get the average time between a block event and the first occurrence of spike after
@@ -107,19 +104,13 @@ def get_avg_time_after_blocked(specific_keys,
                                rows,
                                after_event_key=None,
                                logger_prefix=""):
-    def _has_spike(specific_keys, row):
-        for key in row.keys():
-            if key in specific_keys and int(row[key]) >= SPIKE_MIN:
-                return True
-        return False
-
     considered_rows = rows
     after_event_index = -1
     if after_event_key is not None:
-        for index, row in enumerate(considered_rows, start=0):
-            if after_event_key in row and int(row[after_event_key]) > 0:
-                after_event_index = index
-                break
+        after_event_indexes = np.flatnonzero(
+            _get_column(rows, after_event_key) > 0)
+        if len(after_event_indexes) > 0:
+            after_event_index = after_event_indexes[0]
 
     # only consider events after the event of the passed in after_event_key
     if after_event_index >= 0:
@@ -131,19 +122,20 @@ def get_avg_time_after_blocked(specific_keys,
     time_count = 0
     found_first_block = False
 
-    for row in considered_rows:
-        if blocked_key in row:
-            if int(row[blocked_key]) > 0:
-                # reset
+    is_blocked = (_get_column(considered_rows, blocked_key) > 0).tolist()
+    has_spike = _get_spike_mask(specific_keys, considered_rows).tolist()
+    for row_blocked, row_spike in zip(is_blocked, has_spike):
+        if row_blocked:
+            # reset
+            time_count = 0
+            found_first_block = True
+        elif row_spike:
+            # keep track of per spike
+            if found_first_block:
+                times.append(time_count)
+                #reset
+                found_first_block = False
                 time_count = 0
-                found_first_block = True
-            elif _has_spike(specific_keys, row):
-                # keep track of per spike
-                if found_first_block:
-                    times.append(time_count)
-                    #reset
-                    found_first_block = False
-                    time_count = 0
 
         time_count += 1
 
@@ -168,16 +160,16 @@ def get_clusters(property_name, rows):
     count = 0
 
     current_cluster = []
-    for row in rows:
-        if int(row[property_name]) == 0:
+    for value in _get_column(rows, property_name).tolist():
+        if value == 0:
             if count > 0:
                 count -= 1
         else:
             # reset count
             count = threshold
 
-        if count > 0 and int(row[property_name]) >= SPIKE_MIN:
-            current_cluster.append(int(row[property_name]))
+        if count > 0 and value >= SPIKE_MIN:
+            current_cluster.append(value)
 
         if count == 0:
             # end the current cluster
@@ -230,19 +222,15 @@ class BaseCVFeatureExtraction:
 
 class TimeSeriesDOMFeatureExtraction(BaseCVFeatureExtraction):
 
-    # we pass time_series_dict the mapping between and the time series csv file
+    # we pass time_series_dict the mapping between and the time series (store reference or csv file)
     def __init__(self, crawl_url, time_series_dict, logger_prefix="", trials=4):
         BaseCVFeatureExtraction.__init__(self, crawl_url, None, None, trials=trials)
         self.time_series_dict = time_series_dict
         self.logger_prefix = logger_prefix
 
     def get_event_frequency(self, property_key, rows, spike_min=1):
-        event_count = 0
-
-        for row in rows:
-            if property_key in row:
-                if int(row[property_key]) >= spike_min:
-                    event_count += 1
+        event_count = int(
+            np.count_nonzero(_get_column(rows, property_key) >= spike_min))
 
         event_freq = 0
         if len(rows) > 0:
@@ -251,17 +239,10 @@ class TimeSeriesDOMFeatureExtraction(BaseCVFeatureExtraction):
         return event_count, event_freq
 
     def get_time_between_event(self, property_key, rows, spike_min=1):
-        time_gaps = []
-        last_event_time = -1
-
         # we don't count the first occurrence as a time gap. we only look at the avg time between each event
-        for index, row in enumerate(rows, start=1):
-            if property_key in row and int(row[property_key]) >= spike_min:
-                if last_event_time > 0:
-                    gap = index - last_event_time
-                    time_gaps.append(gap)
-
-                last_event_time = index
+        event_indexes = np.flatnonzero(
+            _get_column(rows, property_key) >= spike_min)
+        time_gaps = np.diff(event_indexes).tolist()
 
         logger.debug("Gap found for get_time_between_event %s " % time_gaps)
 
@@ -353,84 +334,42 @@ class TimeSeriesDOMFeatureExtraction(BaseCVFeatureExtraction):
 
         _MIN = 10000
 
-        blocked_spikes = 0
-        wr_blocked_spikes = 0
-        elem_blocked_spikes = 0
-        snippet_blocked_spikes = 0
-        nodes_added_spikes = 0
-        nodes_removed_spikes = 0
-        attribute_changed_spikes = 0
-        text_changed_spikes = 0
-
-        max_nodes_added = 0
-        min_nodes_added = _MIN
-        max_nodes_removed = 0
-        min_nodes_removed = _MIN
-        max_attribute_changed = 0
-        min_attribute_changed = _MIN
-        max_text_changed = 0
-        min_text_changed = _MIN
-
-        rows = []
         feature_dict = dict()
 
-        with open(time_series) as time_file:
-
-            reader = csv.DictReader(time_file, delimiter=',')
-            rows = list(reader)
-            for row in rows:
-                csv_blocked = 0
-                csv_wr_blocked = 0
-                csv_elem_blocked = 0
-                csv_snippet_blocked = 0
-                # if it has blocked
-                if CSV_BLOCKED in row:
-                    csv_blocked = int(row[CSV_BLOCKED])
-                    csv_wr_blocked = int(row[CSV_WR_BLOCKED])
-                    csv_elem_blocked = int(row[CSV_ELEM_BLOCKED])
-                    if CSV_SNIPPET_BLOCKED in row:
-                        csv_snippet_blocked = int(row[CSV_SNIPPET_BLOCKED])
-
-                csv_nodes_added = int(row[CSV_NODES_ADDED])
-                csv_nodes_removed = int(row[CSV_NODES_REMOVED])
-                csv_attribute_changed = int(row[CSV_ATTRIBUTE_CHANGED])
-                csv_text_changed = int(row[CSV_TEXT_CHANGED])
-
-                # we treat a block as > 0
-                if csv_blocked > 0:
-                    blocked_spikes += 1
-                    if csv_wr_blocked > 0:
-                        wr_blocked_spikes += 1
-                    if csv_elem_blocked > 0:
-                        elem_blocked_spikes += 1
-                    if csv_snippet_blocked > 0:
-                        snippet_blocked_spikes += 1
-
-                # we treat a spike as having an event happen at least >= SPIKE_MIN
-                if csv_nodes_added >= SPIKE_MIN:
-                    nodes_added_spikes += 1
-                    if csv_nodes_added > max_nodes_added:
-                        max_nodes_added = csv_nodes_added
-                    if csv_nodes_added < min_nodes_added:
-                        min_nodes_added = csv_nodes_added
-                if csv_nodes_removed >= SPIKE_MIN:
-                    nodes_removed_spikes += 1
-                    if csv_nodes_removed > max_nodes_removed:
-                        max_nodes_removed = csv_nodes_removed
-                    if csv_nodes_removed < min_nodes_removed:
-                        min_nodes_removed = csv_nodes_removed
-                if csv_attribute_changed >= SPIKE_MIN:
-                    attribute_changed_spikes += 1
-                    if csv_attribute_changed > max_attribute_changed:
-                        max_attribute_changed = csv_attribute_changed
-                    if csv_attribute_changed < min_attribute_changed:
-                        min_attribute_changed = csv_attribute_changed
-                if csv_text_changed >= SPIKE_MIN:
-                    text_changed_spikes += 1
-                    if csv_text_changed > max_text_changed:
-                        max_text_changed = csv_text_changed
-                    if csv_text_changed < min_text_changed:
-                        min_text_changed = csv_text_changed
+        rows = load_time_series_rows(time_series)
+        if rows is None:
+            rows = np.zeros((0, len(TIME_SERIES_COLUMN_INDEX)), dtype=np.int64)
+
+        # we treat a block as > 0
+        blocked_mask = _get_column(rows, CSV_BLOCKED) > 0
+        blocked_spikes = int(np.count_nonzero(blocked_mask))
+        wr_blocked_spikes = int(
+            np.count_nonzero(blocked_mask
+                             & (_get_column(rows, CSV_WR_BLOCKED) > 0)))
+        elem_blocked_spikes = int(
+            np.count_nonzero(blocked_mask
+                             & (_get_column(rows, CSV_ELEM_BLOCKED) > 0)))
+        snippet_blocked_spikes = int(
+            np.count_nonzero(blocked_mask
+                             & (_get_column(rows, CSV_SNIPPET_BLOCKED) > 0)))
+
+        # we treat a spike as having an event happen at least >= SPIKE_MIN
+        def _get_spike_stats(csv_key):
+            values = _get_column(rows, csv_key)
+            spike_values = values[values >= SPIKE_MIN]
+            if len(spike_values) == 0:
+                return 0, 0, _MIN
+            return len(spike_values), int(spike_values.max()), int(
+                spike_values.min())
+
+        nodes_added_spikes, max_nodes_added, min_nodes_added = _get_spike_stats(
+            CSV_NODES_ADDED)
+        nodes_removed_spikes, max_nodes_removed, min_nodes_removed = _get_spike_stats(
+            CSV_NODES_REMOVED)
+        attribute_changed_spikes, max_attribute_changed, min_attribute_changed = _get_spike_stats(
+            CSV_ATTRIBUTE_CHANGED)
+        text_changed_spikes, max_text_changed, min_text_changed = _get_spike_stats(
+            CSV_TEXT_CHANGED)
 
         feature_dict["blocked_spikes"] = blocked_spikes
         feature_dict["wr_blocked_spikes"] = wr_blocked_spikes
@@ -459,12 +398,10 @@ class TimeSeriesDOMFeatureExtraction(BaseCVFeatureExtraction):
 
         last_time = 0
         # Find last spike
-        if len(rows) > 0:
-            # find last spike
-            for index, row in enumerate(reversed(rows)):
-                if int(row[CSV_TOTAL_CHANGES]) >= SPIKE_MIN:
-                    last_time = int(row[CSV_BIN_NORM])
-                    break
+        spike_indexes = np.flatnonzero(
+            _get_column(rows, CSV_TOTAL_CHANGES) >= SPIKE_MIN)
+        if len(spike_indexes) > 0:
+            last_time = int(_get_column(rows, CSV_BIN_NORM)[spike_indexes[-1]])
 
         features_dict[TIMESERIES_KEY + "_last_time"] = last_time
 
@@ -2318,7 +2255,8 @@ def get_element_selector(element,
 def find_iframe_parent_structure(iframe_elements,
                                  levels=3,
                                  log_prefix="",
-                                 reduce_random_attributes=False):
+                                 reduce_random_attributes=False,
+                                 element_index=None):
 
     iframe_parent_selectors = []
     iframe_parent_selectors_only = []
@@ -2346,15 +2284,19 @@ def find_iframe_parent_structure(iframe_elements,
             return iframe_parent_selectors
         else:
             # get siblings
-            grand_parent = current_parent.parent
-            parent_index = 0  # index of where parent is in regards to its siblings
-            children_count = 0
-            for child in grand_parent.children:
-                if str(child) == "\n":
-                    continue
-                children_count += 1
-                if child is current_parent:
-                    parent_index = children_count
+            if element_index is not None:
+                parent_index, children_count = element_index.get_sibling_position(
+                    current_parent)
+            else:
+                grand_parent = current_parent.parent
+                parent_index = 0  # index of where parent is in regards to its siblings
+                children_count = 0
+                for child in grand_parent.children:
+                    if str(child) == "\n":
+                        continue
+                    children_count += 1
+                    if child is current_parent:
+                        parent_index = children_count
 
             if children_count > 1:
                 if parent_index > 1:
@@ -3094,12 +3036,9 @@ class PageSourceFeatureNewExtraction(BaseCVFeatureExtraction):
                 abs_file_path = file_path + os.sep + file_name
                 if os.path.isfile(abs_file_path):
                     try:
-                        f = open(abs_file_path, 'r')
-                        soup = BeautifulSoup(f, 'html.parser')
-                        control_words += soup.get_text().split()
-                        # close soups and files
-                        soup.decompose()
-                        f.close()
+                        # parsed once per process, see page_source_cache
+                        page = get_parsed_page_source(abs_file_path)
+                        control_words += page.raw_words
                     except:
                         pass
 
@@ -3125,12 +3064,10 @@ class PageSourceFeatureNewExtraction(BaseCVFeatureExtraction):
                 trial_inst_control, CONTROL)
             abs_file_path_control = file_path_control + os.sep + file_name_control
             if os.path.isfile(abs_file_path):
-                soup_file = open(abs_file_path, 'r')
-                soup = BeautifulSoup(soup_file, 'html.parser')
-
-                # get rid of noscript
-                for noscript_el in soup.select("noscript"):
-                    noscript_el.extract()
+                # parsed once per process and shared by the PageSource extractors,
+                # noscript is already removed (see page_source_cache)
+                page = get_parsed_page_source(abs_file_path)
+                soup = page.soup
 
                 # open up control soup
                 soup_control = None
@@ -3139,19 +3076,14 @@ class PageSourceFeatureNewExtraction(BaseCVFeatureExtraction):
                         "%s - PAGESOURCE - loading control file : %s" %
                         (self.log_prefix, abs_file_path_control))
 
-                    soup_file_control = open(abs_file_path_control, 'r')
-                    soup_control = BeautifulSoup(soup_file_control,
-                                                 'html.parser')
-
-                    # get rid of noscript
-                    for noscript_el in soup_control.select("noscript"):
-                        noscript_el.extract()
+                    soup_control = get_parsed_page_source(
+                        abs_file_path_control).soup
                 else:
                     logger.debug(
                         "%s - PAGESOURCE - could not load control file : %s" %
                         (self.log_prefix, abs_file_path_control))
 
-                variant_words += soup.get_text().split()
+                variant_words += page.get_words()
 
                 start_time = time.time()
                 # use i for case insenstive
@@ -3398,11 +3330,7 @@ class PageSourceFeatureNewExtraction(BaseCVFeatureExtraction):
                     % (self.log_prefix, time.time() - start_time,
                        self.crawl_url))
 
-                # close soups and files
-                soup.decompose()
-                soup_control.decompose()
-                soup_file.close()
-                soup_file_control.close()
+                # the soups stay in the page source cache, do not decompose them
 
         pagesource_prefix = "pagesource_"
 
@@ -3461,7 +3389,7 @@ class PageSourceFeatureNewExtraction(BaseCVFeatureExtraction):
 
 
 class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
-    def get_corres_elements(self, soup, selectors_and_children_count,
+    def get_corres_elements(self, element_index, selectors_and_children_count,
                             crawl_url_sld):
         found_corresp_imgs = 0
         found_corresp_iframes = 0
@@ -3471,7 +3399,7 @@ class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
             #corresp_imgs_control = soup_control.select(selector + " img:not([abp-blocked-element]):not([anticv-hidden])")
             logger.debug("%s - PAGESOURCE CORRES: using selector %sd" %
                          (self.log_prefix, selector))
-            corresp_imgs = soup.select(
+            corresp_imgs = element_index.select(
                 selector +
                 ' img:not([abp-blocked-element]):not([height="0"]):not([height="1"]):not([width="0"]):not([width="1"]):not([style*="display:none"]):not([style*="display: none"]):not([style*="visibility:hidden"]):not([style*="visibility: hidden"]):not([style*="opacity: 0"]):not([style*="opacity:0"])'
             )
@@ -3501,7 +3429,7 @@ class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
                         % (self.log_prefix, selector, len(corresp_imgs),
                            children_count))
 
-            corresp_iframes = soup.select(
+            corresp_iframes = element_index.select(
                 selector +
                 ' iframe:not([abp-blocked-element]):not([height="0"]):not([height="1"]):not([width="0"]):not([width="1"]):not([style*="display:none"]):not([style*="display: none"]):not([style*="visibility:hidden"]):not([style*="visibility: hidden"]):not([style*="opacity: 0"]):not([style*="opacity:0"])'
             )
@@ -3572,32 +3500,24 @@ class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
             abs_file_path_control = file_path_control + os.sep + file_name_control
 
             if os.path.isfile(abs_file_path):
-                soup_file = open(abs_file_path, 'r')
-                soup = BeautifulSoup(soup_file, 'html.parser')
-
-                # get rid of noscript
-                for noscript_el in soup.select("noscript"):
-                    noscript_el.extract()
+                # shared with PageSourceFeatureNewExtraction, see page_source_cache
+                element_index = get_parsed_page_source(
+                    abs_file_path).get_element_index()
 
                 # open up control soup
-                soup_control = None
+                element_index_control = None
                 if os.path.isfile(abs_file_path_control):
                     logger.debug(
                         "%s - PAGESOURCE - loading control file : %s" %
                         (self.log_prefix, abs_file_path_control))
 
-                    soup_file_control = open(abs_file_path_control, 'r')
-                    soup_control = BeautifulSoup(soup_file_control,
-                                                 'html.parser')
-
-                    # get rid of noscript
-                    for noscript_el in soup_control.select("noscript"):
-                        noscript_el.extract()
+                    element_index_control = get_parsed_page_source(
+                        abs_file_path_control).get_element_index()
 
                 # find where control iframes are
                 start_time = time.time()
 
-                iframe_items_control = soup_control.select(
+                iframe_items_control = element_index_control.select(
                     ':not([abp-blocked-element]):not([anticv-hidden]) iframe[src]:not([abp-blocked-element]):not([anticv-hidden]):not([height="0"]):not([height="1"]):not([width="0"]):not([width="1"]):not([style*="display:none"]):not([style*="display: none"]):not([style*="visibility:hidden"]):not([style*="visibility: hidden"]):not([style*="opacity: 0"]):not([style*="opacity:0"])'
                 )
                 iframe_items_control_fp = []
@@ -3620,7 +3540,7 @@ class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
                             (self.log_prefix, str(iframe_el)))
 
                 # get iframes that have src docs and default to third party since there is no real url here
-                iframe_items_control_srcdoc = soup_control.select(
+                iframe_items_control_srcdoc = element_index_control.select(
                     ':not([abp-blocked-element]):not([anticv-hidden]) iframe[srcdoc]:not([abp-blocked-element]):not([anticv-hidden]):not([height="0"]):not([height="1"]):not([width="0"]):not([width="1"]):not([style*="display:none"]):not([style*="display: none"]):not([style*="visibility:hidden"]):not([style*="visibility: hidden"]):not([style*="opacity: 0"]):not([style*="opacity:0"])'
                 )
                 logger.debug(
@@ -3637,9 +3557,12 @@ class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
                         (self.log_prefix, str(iframe_party_items),
                          party_suffix))
                     iframe_parent_selectors_and_children_count = find_iframe_parent_structure(
-                        iframe_party_items, log_prefix=self.log_prefix)
+                        iframe_party_items,
+                        log_prefix=self.log_prefix,
+                        element_index=element_index_control)
                     found_corresp_imgs, found_corresp_iframes = self.get_corres_elements(
-                        soup, iframe_parent_selectors_and_children_count,
+                        element_index,
+                        iframe_parent_selectors_and_children_count,
                         crawl_url_sld)
                     if found_corresp_imgs == 0 and found_corresp_iframes == 0:
                         logger.debug(
@@ -3649,9 +3572,11 @@ class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
                         iframe_parent_selectors_and_children_count = find_iframe_parent_structure(
                             iframe_party_items,
                             log_prefix=self.log_prefix,
-                            reduce_random_attributes=True)
+                            reduce_random_attributes=True,
+                            element_index=element_index_control)
                         found_corresp_imgs, found_corresp_iframes = self.get_corres_elements(
-                            soup, iframe_parent_selectors_and_children_count,
+                            element_index,
+                            iframe_parent_selectors_and_children_count,
                             crawl_url_sld)
 
                     logger.debug(
@@ -3672,11 +3597,7 @@ class PageSourceCorrespFeatureNewExtraction(PageSourceFeatureNewExtraction):
                     % (self.log_prefix, time.time() - start_time,
                        self.crawl_url))
 
-                # close soups and files
-                soup.decompose()
-                soup_control.decompose()
-                soup_file.close()
-                soup_file_control.close()
+                # the soups stay in the page source cache, do not decompose them
 
         pagesource_prefix = "pagesourcecorres_"
 
@@ -0,0 +1,287 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+from cvinspector.common.utils import OutputQueueWriterBase, OutputQueueWriterProcess, iter_output_queue_rows
+from cvinspector.ml.feature_constants import BOOLEAN_FEATURES, DICTIONARY_ENCODED_COLUMNS, INTEGER_COLUMNS
+
+# optional, only needed for the feature store (pip install pyarrow)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+# a feature store is a directory of parquet partitions: <name>.parquet/part-00000.parquet
+FEATURE_STORE_SUFFIX = ".parquet"
+FEATURE_STORE_PART_NAME = "part-%05d.parquet"
+
+FEATURE_STORE_COMPRESSION = "snappy"
+
+# partitions are written here first, close() then swaps it in for the store
+FEATURE_STORE_TMP_SUFFIX = ".tmp"
+
+
+def is_feature_store_available():
+    return pa is not None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError(
+            "The feature store needs pyarrow, install it with: pip install pyarrow"
+        )
+
+
+def is_feature_store(file_path):
+    return file_path.endswith(FEATURE_STORE_SUFFIX) and os.path.isdir(
+        file_path)
+
+
+def get_feature_store_field(column):
+    if column in DICTIONARY_ENCODED_COLUMNS:
+        return pa.field(column, pa.dictionary(pa.int32(), pa.string()))
+    if column in INTEGER_COLUMNS:
+        return pa.field(column, pa.int64())
+    if column in BOOLEAN_FEATURES:
+        return pa.field(column, pa.int8())
+    return pa.field(column, pa.float64())
+
+
+def get_feature_store_schema(columns):
+    # explicit types from feature_constants, so partitions always agree
+    _require_pyarrow()
+    return pa.schema([get_feature_store_field(column) for column in columns])
+
+
+class FeatureStoreWriter:
+    """
+    Appends rows (lists in the order of columns, like the rows of the features csv)
+    to a feature store, one parquet partition per write_rows call.
+    The partitions go to a temporary directory, close() replaces the store with it,
+    so partitions of an earlier run are never read together with the new ones.
+    """
+    def __init__(self, store_path, columns):
+        _require_pyarrow()
+        self.store_path = store_path
+        self.tmp_store_path = store_path + FEATURE_STORE_TMP_SUFFIX
+        self.columns = list(columns)
+        self.schema = get_feature_store_schema(self.columns)
+        self.part_count = 0
+        self.row_count = 0
+        # left over from a run that did not close its writer
+        if os.path.isdir(self.tmp_store_path):
+            shutil.rmtree(self.tmp_store_path)
+        os.makedirs(self.tmp_store_path)
+
+    def _get_array(self, field, values):
+        if pa.types.is_dictionary(field.type):
+            return pa.array([None if x is None else str(x) for x in values],
+                            type=field.type)
+        # empty strings and other non numbers become nulls, like NaN in read_csv
+        numbers = pd.to_numeric(pd.Series(values, dtype=object),
+                                errors="coerce").astype("float64")
+        return pa.array(numbers.to_numpy(), type=field.type, from_pandas=True)
+
+    def write_rows(self, rows):
+        if not rows:
+            return None
+        arrays = [
+            self._get_array(field, [row[index] for row in rows])
+            for index, field in enumerate(self.schema)
+        ]
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+
+        part_path = self.tmp_store_path + os.sep + FEATURE_STORE_PART_NAME % self.part_count
+        # write under a temporary name so readers never see a partial partition
+        tmp_part_path = part_path + ".tmp"
+        pq.write_table(table,
+                       tmp_part_path,
+                       compression=FEATURE_STORE_COMPRESSION,
+                       use_dictionary=DICTIONARY_ENCODED_COLUMNS)
+        os.replace(tmp_part_path, part_path)
+        self.part_count += 1
+        self.row_count += len(rows)
+        logger.debug("Wrote feature store partition %s with %d rows",
+                     part_path, len(rows))
+        return part_path
+
+    def close(self):
+        # swaps the new partitions in for the store, an earlier store is removed
+        old_store_path = None
+        if os.path.isdir(self.store_path):
+            old_store_path = self.store_path + ".old"
+            if os.path.isdir(old_store_path):
+                shutil.rmtree(old_store_path)
+            os.replace(self.store_path, old_store_path)
+        os.replace(self.tmp_store_path, self.store_path)
+        if old_store_path:
+            shutil.rmtree(old_store_path)
+        logger.debug("Closed feature store %s: %d partitions, %d rows",
+                     self.store_path, self.part_count, self.row_count)
+        return self.store_path
+
+
+def _get_part_paths(store_path):
+    return sorted(store_path + os.sep + file_name
+                  for file_name in os.listdir(store_path)
+                  if file_name.endswith(FEATURE_STORE_SUFFIX))
+
+
+def get_feature_store_columns(store_path):
+    _require_pyarrow()
+    part_paths = _get_part_paths(store_path)
+    if not part_paths:
+        return []
+    return pq.read_schema(part_paths[0]).names
+
+
+def read_feature_store(store_path, columns=None):
+    """
+    Reads a feature store into a DataFrame, only the given columns when columns is
+    not None (columns that the store does not have are ignored).
+    Dictionary-encoded columns are returned as plain strings, not categoricals.
+    """
+    _require_pyarrow()
+    part_paths = _get_part_paths(store_path)
+    if not part_paths:
+        return pd.DataFrame(columns=columns or [])
+
+    if columns is not None:
+        store_columns = set(pq.read_schema(part_paths[0]).names)
+        columns = [column for column in columns if column in store_columns]
+
+    table = pa.concat_tables(
+        [pq.read_table(part_path, columns=columns) for part_path in part_paths])
+    for index, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(index, field.name,
+                                     table.column(index).cast(pa.string()))
+    return table.to_pandas()
+
+
+def get_feature_columns(file_path):
+    # column names of a features csv (its header) or feature store
+    if is_feature_store(file_path):
+        return get_feature_store_columns(file_path)
+    with open(file_path, 'r') as csv_file:
+        for line in csv_file:
+            return line.replace("\n", "").split(",")
+    return []
+
+
+def read_features(file_path, columns=None, index_col=0):
+    """
+    Reads a features csv or feature store like pd.read_csv(file_path, index_col=0):
+    the first column (crawl url) is the index. Only the given columns are read when
+    columns is not None, the index column is always kept.
+    """
+    if is_feature_store(file_path):
+        store_columns = get_feature_store_columns(file_path)
+        if not store_columns:
+            return pd.DataFrame()
+        index_name = store_columns[index_col]
+        if columns is not None:
+            # in the order of the store, like usecols of read_csv
+            wanted_columns = set(columns)
+            wanted_columns.add(index_name)
+            columns = [x for x in store_columns if x in wanted_columns]
+        pd_data = read_feature_store(file_path, columns=columns)
+        return pd_data.set_index(index_name)
+
+    usecols = None
+    if columns is not None:
+        index_name = get_feature_columns(file_path)[index_col]
+        wanted_columns = set(columns)
+        wanted_columns.add(index_name)
+        usecols = lambda column: column in wanted_columns
+    return pd.read_csv(file_path, index_col=index_col, usecols=usecols)
+
+
+class OutputFeatureStoreBase(OutputQueueWriterBase):
+    """
+    Like OutputCSVForceHeaderBase, but the rows go to a feature store.
+    Rows wait until the header row (the one with header_delimiter) arrives, then
+    every cache_row_limit rows are written as one partition.
+    """
+    def __init__(self,
+                 id,
+                 name,
+                 store_path,
+                 shutdown_output,
+                 output_csv_queue,
+                 header_delimiter,
+                 cache_row_limit=1000):
+        self.id = id
+        self.name = name
+        self.shutdown_output = shutdown_output
+        self.store_path = store_path
+        self.output_csv_queue = output_csv_queue
+        self.header_delimiter = header_delimiter
+        self.cached_rows = []
+        self.cache_row_limit = cache_row_limit
+        self.store_writer = None
+
+    def find_header(self):
+        for row in self.cached_rows:
+            if self.header_delimiter in row:
+                self.cached_rows.remove(row)
+                self.store_writer = FeatureStoreWriter(self.store_path, row)
+                logger.debug("%s - header row found", self.name)
+                return
+
+    def write_cached_rows(self):
+        if self.store_writer is None:
+            self.find_header()
+        if self.store_writer is not None:
+            self.store_writer.write_rows(self.cached_rows)
+            logger.debug("%s - Wrote new rows: %d", self.name,
+                         len(self.cached_rows))
+            self.cached_rows.clear()
+
+    def run(self):
+        for rows in iter_output_queue_rows(self.output_csv_queue,
+                                           self.get_shutdown_check()):
+            self.cached_rows.extend(rows)
+            if len(self.cached_rows) >= self.cache_row_limit:
+                self.write_cached_rows()
+
+        self.write_cached_rows()
+        if self.store_writer is None:
+            logger.warning("%s - Did not find header row by the end",
+                           self.name)
+        else:
+            self.store_writer.close()
+        self.acknowledge_flush()
+
+
+class OutputFeatureStoreProcess(OutputFeatureStoreBase,
+                                OutputQueueWriterProcess):
+    def __init__(self, *args, **kwargs):
+        OutputFeatureStoreBase.__init__(self, *args, **kwargs)
+        OutputQueueWriterProcess.__init__(self, self.output_csv_queue)
+
+    def should_shut_down(self):
+        # here shutdown is an event
+        return self.shutdown_output.is_set()
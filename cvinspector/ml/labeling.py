@@ -21,6 +21,7 @@ import pandas as pd
 
 from cvinspector.ml.feature_constants import TARGET_COLUMN_NAME, CRAWL_URL_COLUMN_NAME, CHUNK_COLUMN_NAME, \
     BOOLEAN_FEATURES
+from cvinspector.ml.feature_store import read_features, get_feature_columns
 
 logger = logging.getLogger(__name__)
 
@@ -55,15 +56,17 @@ def label_dataset_from_saved_clf(unlabel_file_name,
     csv_file_name = unlabel_file_name
     # csv_suffix = output_suffix
 
-    header = ""
-    with open(csv_file_name, 'r') as csv_file:
-        for line in csv_file:
-            header = line.replace("\n", "")
-            break
-    header_names = header.split(",")
+    header_names = get_feature_columns(csv_file_name)
+
+    # only the columns the model uses, plus the label and chunk to map the results back
+    read_columns = None
+    if test_features_only:
+        read_columns = [CRAWL_URL_COLUMN_NAME] + test_features_only + [
+            target_column, CHUNK_COLUMN_NAME
+        ]
 
     # ignore the index column
-    pd_data = pd.read_csv(csv_file_name, index_col=0)
+    pd_data = read_features(csv_file_name, columns=read_columns)
     logger.debug("Unlabel data shape: %s" % str(pd_data.shape))
     # scale the data
     if scaler_file_path and test_features_only:
@@ -19,9 +19,8 @@ import csv
 import logging
 import os
 import pickle
-import threading
 import time
-from multiprocessing import Event, Process, Queue
+from multiprocessing import Process, Queue
 
 import pandas as pd
 from sklearn.preprocessing import StandardScaler, RobustScaler, MinMaxScaler, QuantileTransformer, PowerTransformer
@@ -31,12 +30,20 @@ from cvinspector.common.utils import chunk, randomword, get_anticv_client_and_db
     MONGODB_DOM_DIFF_GROUP, get_ground_truth, OutputCSVProcess, \
     OutputDebugProcess, OutputCSVForceHeaderProcess, MONGODB_COLLECTION_CRAWL_INSTANCE, CONTROL, \
     VARIANT, TRIAL_PREFIX
+from cvinspector.common.filter_list_snapshot import create_filter_matcher_from_snapshots
+from cvinspector.common.filter_matcher import create_filter_matcher
 from cvinspector.common.webrequests_utils import extract_tld, find_all_first_and_third_party_webrequests, \
     get_second_level_domain_from_tld
+from cvinspector.common.work_executor import WorkExecutor, WorkExecutorError, WorkProcessError, SiteTaskError, \
+    join_work_processes
 from cvinspector.data_migrate.utils import get_anticv_mongo_client_and_db
 from cvinspector.diff_analysis.dommutation_core import get_dom_differences_only
+from cvinspector.diff_analysis.utils import prefetch_diff_groups_instances
 from cvinspector.diff_analysis.webrequests_core import get_wr_differences_only
+from cvinspector.diff_analysis.wr_diff_cache import get_wr_diff_cache_stats
 from cvinspector.ml.feature_constants import BOOLEAN_FEATURES, CRAWL_URL_COLUMN_NAME, TARGET_COLUMN_NAME
+from cvinspector.ml.feature_store import FEATURE_STORE_SUFFIX, OutputFeatureStoreProcess, read_features, \
+    get_feature_columns
 from cvinspector.ml.feature_extraction import WebRequestsFeatureExtraction, DOMMutationFeatureExtraction, \
     TimeSeriesDOMFeatureExtraction, PageSourceFeatureNewExtraction, \
     PageSourceCorrespFeatureNewExtraction
@@ -164,7 +171,8 @@ def write_main_row(wr_sorted_keys,
     return csv_has_header
 
 
-class WriteURLSThread(threading.Thread):
+class WriteURLSThread:
+    # one chunk of diff groups, run as a task of a WorkExecutor
     def __init__(self,
                  threadID,
                  name,
@@ -181,7 +189,6 @@ class WriteURLSThread(threading.Thread):
                  negative_label_domains=None,
                  adblock_parser=None):
 
-        threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
         self.crawl_group_name = crawl_group_name
@@ -251,12 +258,18 @@ class WriteURLSThread(threading.Thread):
                                                     password=self.password)
 
         crawl_collection = db[MONGODB_COLLECTION_CRAWL_INSTANCE]
+        # resolve the crawl instances of this chunk at once, see create_trial_group
+        prefetch_diff_groups_instances(self.diff_groups_wr, crawl_collection)
 
         for index, diff_group_wr in enumerate(self.diff_groups_wr, start=0):
-            self.run_per_diff_group(diff_group_wr, crawl_collection, db)
+            try:
+                self.run_per_diff_group(diff_group_wr, crawl_collection, db)
+            except Exception as e:
+                raise SiteTaskError(diff_group_wr.get("url"), e) from e
 
 
-class WriteFeatureCSVThread(threading.Thread):
+class WriteFeatureCSVThread:
+    # one chunk of diff groups, run as a task of a WorkExecutor
     def __init__(self,
                  threadID,
                  name,
@@ -280,7 +293,6 @@ class WriteFeatureCSVThread(threading.Thread):
                  output_external_logs=True,
                  trials=4):
 
-        threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
         self.crawl_group_name = crawl_group_name
@@ -621,15 +633,46 @@ class WriteFeatureCSVThread(threading.Thread):
                                                     password=self.password)
 
         crawl_collection = db[MONGODB_COLLECTION_CRAWL_INSTANCE]
+        # resolve the crawl instances of this chunk at once, see create_trial_group
+        prefetch_diff_groups_instances(self.diff_groups_wr, crawl_collection)
 
         for index, diff_group_wr in enumerate(self.diff_groups_wr, start=0):
-            if index == 0:
-                self.run_per_diff_group(diff_group_wr,
-                                        crawl_collection,
-                                        db,
-                                        already_has_header=self.csv_has_header)
-            else:
-                self.run_per_diff_group(diff_group_wr, crawl_collection, db)
+            try:
+                if index == 0:
+                    self.run_per_diff_group(
+                        diff_group_wr,
+                        crawl_collection,
+                        db,
+                        already_has_header=self.csv_has_header)
+                else:
+                    self.run_per_diff_group(diff_group_wr, crawl_collection,
+                                            db)
+            except Exception as e:
+                raise SiteTaskError(diff_group_wr.get("url"), e) from e
+
+
+def get_tracking_dict(tracking_file_path, remove_tracking_urls=False):
+    # main domain --> tracking url --> resource type.
+    # The tracking urls file has 4 field lines (see write_tracking_urls_txt), which the
+    # original reader skipped, so no tracking urls were removed from the features the
+    # shipped model was trained on. remove_tracking_urls reads them
+    tracking_dict = dict()
+    tracking_delimiter = ";;"
+    with open(tracking_file_path, "r") as tracking_file:
+        for line in tracking_file:
+            line_split = line.strip().split(tracking_delimiter)
+            if len(line_split) == 4 and remove_tracking_urls:
+                # same line as the urls file: crawl url, main domain, url, resource type
+                line_split = line_split[1:]
+            if len(line_split) == 3:
+                host_page = line_split[0]
+                tracking_url = line_split[1]
+                tracking_resource = line_split[2]
+                if host_page not in tracking_dict:
+                    tracking_dict[host_page] = dict()
+                if tracking_url not in tracking_dict[host_page]:
+                    tracking_dict[host_page][tracking_url] = tracking_resource
+    return tracking_dict
 
 
 def _write_feature_csv__process(process_index,
@@ -641,7 +684,7 @@ def _write_feature_csv__process(process_index,
                                 features_queue,
                                 features_debug,
                                 diff_debug,
-                                tracking_file_path,
+                                tracking_dict,
                                 positive_label_domains=None,
                                 negative_label_domains=None,
                                 csv_has_header=True,
@@ -653,35 +696,8 @@ def _write_feature_csv__process(process_index,
     logger.debug("Starting process " + str(process_index))
 
     # chunking
-    THREADS_LIMIT = thread_limit  # how many threads can run each thread
     chunks = chunk(diff_groups_wr, n=chunk_size)
-
     chunk_count = len(chunks)
-    current_threads = []
-    chunk_index = 0
-    chunk_completed = 0
-    logger.debug("Processing chunk %d out of %d" %
-                 (chunk_index + 1, chunk_count))
-
-    # parser for removing noise
-
-    # read in the tracking file
-    logger.debug("reading in tracking file %s" % tracking_file_path)
-    tracking_dict = dict()
-    tracking_delimiter = ";;"
-    with open(tracking_file_path, "r") as tracking_file:
-        # each line is: main domain, url, resource type
-        for line in tracking_file:
-            line_split = line.strip().split(tracking_delimiter)
-            if len(line_split) == 3:
-                host_page = line_split[0]
-                tracking_url = line_split[1]
-                tracking_resource = line_split[2]
-                if host_page not in tracking_dict:
-                    tracking_dict[host_page] = dict()
-                if tracking_url not in tracking_dict[host_page]:
-                    tracking_dict[host_page][tracking_url] = tracking_resource
-    logger.debug("done reading in tracking file %s" % tracking_file_path)
 
     # read in image dimension file
     img_dimension_dict = None
@@ -705,11 +721,12 @@ def _write_feature_csv__process(process_index,
         logger.debug("image dimension file found urls: %d" %
                      len(img_dimension_dict))
 
-    stop = False
-    while chunk_completed < chunk_count and not stop:
-        if len(current_threads) < THREADS_LIMIT and chunk_index < chunk_count:
+    with WorkExecutor(thread_limit,
+                      name="Process-" + str(process_index)) as executor:
+        for chunk_index, diff_groups_chunk in enumerate(chunks):
             thread_name = "Thread-" + randomword(5)
-            logger.debug("Creating " + thread_name)
+            logger.debug("Processing chunk %d out of %d with thread %s" %
+                         (chunk_index + 1, chunk_count, thread_name))
 
             # we only allow the header to be written once, then we reset it to True
             if chunk_index == 0 and not csv_has_header:
@@ -717,11 +734,11 @@ def _write_feature_csv__process(process_index,
             else:
                 csv_has_header = True
 
-            some_thread = WriteFeatureCSVThread(
+            feature_thread = WriteFeatureCSVThread(
                 chunk_index,
                 thread_name,
                 crawl_group_name,
-                chunks[chunk_index],
+                diff_groups_chunk,
                 time_series_dict,
                 features_queue,
                 features_debug,
@@ -735,36 +752,15 @@ def _write_feature_csv__process(process_index,
                 negative_label_domains=negative_label_domains,
                 img_dimension_dict=img_dimension_dict,
                 trials=trials)
+            executor.submit(feature_thread.run, task_name=thread_name)
+        failures = executor.wait()
 
-            # Start new Threads
-            some_thread.start()
-            logger.debug("Processing chunk %d out of %d with thread %s" %
-                         (chunk_index + 1, chunk_count, some_thread.name))
-            current_threads.append(some_thread)
-            chunk_index += 1
-            time.sleep(1)
-        else:
-            done_threads = []
-            for t in current_threads:
-                if not t.is_alive():
-                    done_threads.append(t)
-
-            if len(done_threads) == 0:
-                logger.debug(
-                    "Process %d : Found no done threads, still alive %d" %
-                    (process_index, len(current_threads)))
-                time.sleep(10)
-            else:
-                for done_thread in done_threads:
-                    logger.debug(
-                        "Done with thread %s and chunk index %d out of %d" %
-                        (done_thread.name, done_thread.threadID + 1,
-                         chunk_count))
-                    chunk_completed += 1
-                    current_threads.remove(done_thread)
-                time.sleep(2)
-
+    logger.debug("Process %s webrequest diff cache stats: %s",
+                 str(process_index), str(get_wr_diff_cache_stats()))
     features_debug.put("Done with process " + str(process_index))
+    # a failed task exits the process non-zero, so the stage is not done
+    if failures:
+        raise WorkExecutorError(failures)
 
 
 def _write_urls_csv__process(process_index,
@@ -782,27 +778,21 @@ def _write_urls_csv__process(process_index,
     logger.debug("Starting process " + str(process_index))
 
     # chunking
-    THREADS_LIMIT = thread_limit  # how many threads can run each thread
     chunks = chunk(diff_groups_wr, n=chunk_size)
-
     chunk_count = len(chunks)
-    current_threads = []
-    chunk_index = 0
-    chunk_completed = 0
-    logger.debug("Processing chunk %d out of %d" %
-                 (chunk_index + 1, chunk_count))
-
-    stop = False
-    while chunk_completed < chunk_count and not stop:
-        if len(current_threads) < THREADS_LIMIT and chunk_index < chunk_count:
+
+    with WorkExecutor(thread_limit,
+                      name="Process-" + str(process_index)) as executor:
+        for chunk_index, diff_groups_chunk in enumerate(chunks):
             thread_name = "Thread-" + randomword(5)
-            logger.debug("Creating " + thread_name)
+            logger.debug("Processing chunk %d out of %d with thread %s" %
+                         (chunk_index + 1, chunk_count, thread_name))
 
-            some_thread = WriteURLSThread(
+            urls_thread = WriteURLSThread(
                 chunk_index,
                 thread_name,
                 crawl_group_name,
-                chunks[chunk_index],
+                diff_groups_chunk,
                 output_queue,
                 output_queue_control,
                 mongodb_client,
@@ -811,34 +801,15 @@ def _write_urls_csv__process(process_index,
                 positive_label_domains=positive_label_domains,
                 negative_label_domains=negative_label_domains,
             )
+            executor.submit(urls_thread.run, task_name=thread_name)
+        failures = executor.wait()
 
-            # Start new Threads
-            some_thread.start()
-            logger.debug("Processing chunk %d out of %d with thread %s" %
-                         (chunk_index + 1, chunk_count, some_thread.name))
-            current_threads.append(some_thread)
-            chunk_index += 1
-            time.sleep(1)
-        else:
-            done_threads = []
-            for t in current_threads:
-                if not t.is_alive():
-                    done_threads.append(t)
-
-            if len(done_threads) == 0:
-                logger.debug("Found no done threads")
-                time.sleep(2)
-            else:
-                for done_thread in done_threads:
-                    logger.debug(
-                        "Done with thread %s and chunk index %d out of %d" %
-                        (done_thread.name, done_thread.threadID + 1,
-                         chunk_count))
-                    chunk_completed += 1
-                    current_threads.remove(done_thread)
-                time.sleep(2)
-
+    logger.debug("Process %s webrequest diff cache stats: %s",
+                 str(process_index), str(get_wr_diff_cache_stats()))
     logger.debug("Done with process " + str(process_index))
+    # a failed task exits the process non-zero, so the stage is not done
+    if failures:
+        raise WorkExecutorError(failures)
 
 
 def write_feature_csv(crawl_group_name,
@@ -857,7 +828,9 @@ def write_feature_csv(crawl_group_name,
                       rank_file=None,
                       rank_start=None,
                       rank_end=None,
-                      trials=4):
+                      trials=4,
+                      feature_store=False,
+                      remove_tracking_urls=False):
     # read in file with domains labeled as positives
     # if line starts with ! , then it means it is negative label
 
@@ -870,42 +843,46 @@ def write_feature_csv(crawl_group_name,
     client, db = get_anticv_client_and_db()
 
     # We create multiple csvs depending on split_by_party
-    raw_features_file_name = output_directory + os.sep + csv_file_name + ".csv"
     features_queue = Queue()
-    features_shutdown_event = Event()
-    features_process = OutputCSVForceHeaderProcess("1", "main_features_csv",
-                                                   raw_features_file_name,
-                                                   features_shutdown_event,
-                                                   features_queue, "crawl_url")
+    if feature_store:
+        # same rows, written as partitions of a columnar feature store
+        raw_features_file_name = output_directory + os.sep + csv_file_name + FEATURE_STORE_SUFFIX
+        features_process = OutputFeatureStoreProcess("1", "main_features_store",
+                                                     raw_features_file_name,
+                                                     None,
+                                                     features_queue, "crawl_url")
+    else:
+        raw_features_file_name = output_directory + os.sep + csv_file_name + ".csv"
+        features_process = OutputCSVForceHeaderProcess("1", "main_features_csv",
+                                                       raw_features_file_name,
+                                                       None,
+                                                       features_queue, "crawl_url")
     features_process.start()
 
     # file for debug information (features extraction)
     features_debug_file_name = output_directory + os.sep + csv_file_name + "__debug.txt"
     features_debug = Queue()
-    features_debug_shutdown_event = Event()
     features_debug_process = OutputDebugProcess("1", "main_features_debug",
                                                 features_debug_file_name,
-                                                features_debug_shutdown_event,
+                                                None,
                                                 features_debug)
     features_debug_process.start()
 
     # file for debug information (diff extraction)
     diff_debug_file_name = output_directory + os.sep + csv_file_name + "__diff_analysis_debug.txt"
     diff_debug = Queue()
-    diff_debug_shutdown_event = Event()
     diff_debug_process = OutputDebugProcess("1", "main_diff_debug",
                                             diff_debug_file_name,
-                                            diff_debug_shutdown_event,
+                                            None,
                                             diff_debug)
     diff_debug_process.start()
 
     # file for urls not found from ground truth
     url_not_found_file_name = output_directory + os.sep + csv_file_name + "__urls_not_found.txt"
     url_not_found_queue = Queue()
-    url_not_found_shutdown_event = Event()
     url_not_found_process = OutputDebugProcess("1", "url_not_found",
                                                url_not_found_file_name,
-                                               url_not_found_shutdown_event,
+                                               None,
                                                url_not_found_queue)
     url_not_found_process.start()
 
@@ -971,7 +948,7 @@ def write_feature_csv(crawl_group_name,
             logger.debug("Filtering sites based off existing file: %s" %
                          existing_file)
 
-            existing_file_pd = pd.read_csv(existing_file, index_col=0)
+            existing_file_pd = read_features(existing_file, columns=[])
             wr_crawl_diff_groups_list_new = []
             for x in wr_crawl_diff_groups_list:
                 url = x.get("url")
@@ -1022,6 +999,13 @@ def write_feature_csv(crawl_group_name,
         logger.debug("No time series found in %s" % time_series_mapping)
         time_series_dict = None
 
+    # read in the tracking file once, the processes inherit it
+    logger.debug("reading in tracking file %s" % tracking_file_path)
+    tracking_dict = get_tracking_dict(tracking_file_path,
+                                      remove_tracking_urls=remove_tracking_urls)
+    logger.debug("done reading in tracking file %s, main domains: %d" %
+                 (tracking_file_path, len(tracking_dict)))
+
     diff_groups_count = len(wr_crawl_diff_groups_list)
     process_limit = 10
     process_chunk_size = int(diff_groups_count / process_limit) + 1
@@ -1058,7 +1042,7 @@ def write_feature_csv(crawl_group_name,
                     args=(process_index, crawl_group_name, mongodb_client,
                           mongodb_port, process_chunk_tmp, time_series_dict,
                           features_queue, features_debug, diff_debug,
-                          tracking_file_path, positive_label_domains,
+                          tracking_dict, positive_label_domains,
                           negative_label_domains, csv_has_header,
                           output_external_logs, 20, 30,
                           img_dimension_file_path, trials))
@@ -1069,23 +1053,17 @@ def write_feature_csv(crawl_group_name,
     logger.debug("Created Processes %d" % len(process_list))
 
     # wait for all to be done
-    for p in process_list:
-        p.join()
+    failed_processes = join_work_processes(process_list)
 
     logger.debug("All work process are done")
-    client.close()
-
-    time.sleep(10)
-    logger.debug("Cleaning up all output processes")
-    features_shutdown_event.set()
-    features_debug_shutdown_event.set()
-    diff_debug_shutdown_event.set()
-    logger.debug("Waiting for output processes to complete")
-    features_process.join()
-    features_debug_process.join()
-    diff_debug_process.join()
-    url_not_found_shutdown_event.set()
-    url_not_found_process.join()
+
+    logger.debug("Closing all output processes")
+    features_process.close()
+    features_debug_process.close()
+    diff_debug_process.close()
+    url_not_found_process.close()
+    if failed_processes:
+        raise WorkProcessError(failed_processes)
     logger.info("DONE")
 
     return raw_features_file_name
@@ -1113,25 +1091,22 @@ def write_urls_txt(crawl_group_name,
     # We create multiple csvs depending on split_by_party
     raw_output_file_name = output_directory + os.sep + csv_file_name + ".txt"
     output_queue = Queue()
-    output_queue_shutdown_event = Event()
     output_queue_process = OutputDebugProcess("1", "output_queue_urls",
                                               raw_output_file_name,
-                                              output_queue_shutdown_event,
+                                              None,
                                               output_queue)
     output_queue_process.start()
 
     raw_output_file_name_control = output_directory + os.sep + csv_file_name + "_control" + ".txt"
     output_queue_control = Queue()
-    output_queue_shutdown_event_control = Event()
     output_queue_process_control = OutputDebugProcess(
         "2", "output_queue_urls_control", raw_output_file_name_control,
-        output_queue_shutdown_event_control, output_queue_control)
+        None, output_queue_control)
     output_queue_process_control.start()
 
     # We create multiple csvs depending on split_by_party
     raw_trials_file_name = output_directory + os.sep + "trials_urls_and_domains" + ".csv"
     trials_queue = Queue()
-    trials_shutdown_event = Event()
     trials_header_row = ["URL Crawled"]
     for trial_index in range(trial_count):
         trials_header_row.append(CONTROL + TRIAL_PREFIX + str(trial_index) +
@@ -1149,7 +1124,7 @@ def write_urls_txt(crawl_group_name,
     trials_process = OutputCSVProcess("1",
                                       "main_trials_csv",
                                       raw_trials_file_name,
-                                      trials_shutdown_event,
+                                      None,
                                       trials_queue,
                                       header_row=trials_header_row)
     trials_process.start()
@@ -1239,26 +1214,54 @@ def write_urls_txt(crawl_group_name,
         process_list.append(p)
 
     # wait for all to be done
-    for p in process_list:
-        p.join()
+    failed_processes = join_work_processes(process_list)
 
     logger.debug("All work process are done")
-    client.close()
-
-    time.sleep(10)
-    logger.debug("Cleaning up all output processes")
-    output_queue_shutdown_event.set()
-    output_queue_shutdown_event_control.set()
-    trials_shutdown_event.set()
-    logger.debug("Waiting for output processes to complete")
-    output_queue_process.join()
-    output_queue_process_control.join()
-    trials_process.join()
+
+    logger.debug("Closing all output processes")
+    output_queue_process.close()
+    output_queue_process_control.close()
+    trials_process.close()
+    if failed_processes:
+        raise WorkProcessError(failed_processes)
     logger.info("DONE")
 
     return ""
 
 
+def write_tracking_urls_txt(filter_list_paths,
+                            urls_file_path,
+                            output_file_path,
+                            filter_list_snapshot_directory=None):
+    # keeps the lines of the urls file (see write_urls_txt) whose url is blocked by the filter lists
+    if filter_list_snapshot_directory:
+        matcher = create_filter_matcher_from_snapshots(
+            filter_list_paths, snapshot_directory=filter_list_snapshot_directory)
+    else:
+        matcher = create_filter_matcher(filter_list_paths)
+
+    urls_delimiter = ";;"
+    urls_count = 0
+    tracking_count = 0
+    with open(urls_file_path, "r") as urls_file, open(output_file_path,
+                                                      "w") as output_file:
+        for line in urls_file:
+            line = line.strip()
+            line_split = line.split(urls_delimiter)
+            if len(line_split) != 4:
+                continue
+            crawl_url, _, target_url, resource_type = line_split
+            urls_count += 1
+            if matcher.matches(target_url,
+                               resource_type=resource_type,
+                               page_url=crawl_url):
+                output_file.write(line + "\n")
+                tracking_count += 1
+
+    logger.info("Tracking urls: %d out of %d" % (tracking_count, urls_count))
+    return output_file_path
+
+
 def _wrap_features(features):
     return [CRAWL_URL_COLUMN_NAME] + features + [TARGET_COLUMN_NAME]
 
@@ -1398,14 +1401,14 @@ def _clean_scale_data_for_training(csv_file_name,
     # read in inputs
     csv_suffix = output_suffix
 
-    header = ""
-    with open(csv_file_name, 'r') as csv_file:
-        for line in csv_file:
-            header = line.replace("\n", "")
-            break
-    header_names = header.split(",")
+    header_names = get_feature_columns(csv_file_name)
 
-    pd_data = pd.read_csv(csv_file_name)
+    # only the columns the model uses (and the label), when they are known
+    read_columns = None
+    if test_features_only is not None:
+        read_columns = _wrap_features(test_features_only)
+    # crawl url as a column, not the index
+    pd_data = read_features(csv_file_name, columns=read_columns).reset_index()
     logger.debug("Shape of main file: %s" % str(pd_data.shape))
 
     pd_data = _fillNA(pd_data)
@@ -1601,13 +1604,11 @@ def _clean_scale_data_for_labeling(csv_file_name,
     # read in inputs
     csv_suffix = output_suffix
 
-    header = ""
-    with open(csv_file_name, 'r') as csv_file:
-        for line in csv_file:
-            header = line.replace("\n", "")
-            break
-
-    pd_data = pd.read_csv(csv_file_name, index_col=0)
+    # only the columns the model uses (and the label), when they are known
+    read_columns = None
+    if test_features_only is not None:
+        read_columns = _wrap_features(test_features_only)
+    pd_data = read_features(csv_file_name, columns=read_columns)
     pd_data = _fillNA(pd_data)
 
     # filter by webshrinker
@@ -0,0 +1,228 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import importlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from bs4 import BeautifulSoup
+
+from cvinspector.ml.element_index import ElementIndex
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+PAGE_SOURCE_PARSER_AUTO = "auto"
+PAGE_SOURCE_PARSER_LXML = "lxml"
+PAGE_SOURCE_PARSER_HTML5 = "html5-parser"
+PAGE_SOURCE_PARSER_BUILTIN = "html.parser"
+
+# html.parser builds the trees the shipped model was trained on, so it stays the default.
+# Preferred order for auto, html.parser is always available
+PAGE_SOURCE_PARSERS = [
+    PAGE_SOURCE_PARSER_LXML, PAGE_SOURCE_PARSER_HTML5,
+    PAGE_SOURCE_PARSER_BUILTIN
+]
+
+# module that must be importable for each parser
+_PAGE_SOURCE_PARSER_MODULES = {
+    PAGE_SOURCE_PARSER_LXML: "lxml",
+    PAGE_SOURCE_PARSER_HTML5: "html5_parser",
+    PAGE_SOURCE_PARSER_BUILTIN: None
+}
+
+PAGE_SOURCE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# a soup takes several times the size of its html in memory.
+# Used to estimate the resident bytes of a parsed page without walking it
+PARSED_BYTES_PER_HTML_BYTE = 10
+
+
+def is_page_source_parser_available(parser_name):
+    module_name = _PAGE_SOURCE_PARSER_MODULES.get(parser_name)
+    if module_name is None:
+        return parser_name == PAGE_SOURCE_PARSER_BUILTIN
+    try:
+        importlib.import_module(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+def resolve_page_source_parser(parser_name=PAGE_SOURCE_PARSER_AUTO):
+    if parser_name == PAGE_SOURCE_PARSER_AUTO:
+        for candidate in PAGE_SOURCE_PARSERS:
+            if is_page_source_parser_available(candidate):
+                return candidate
+
+    if parser_name not in PAGE_SOURCE_PARSERS:
+        raise ValueError("Unknown page source parser: %s" % parser_name)
+    if not is_page_source_parser_available(parser_name):
+        logger.warning("Page source parser %s is not installed, using %s",
+                       parser_name, PAGE_SOURCE_PARSER_BUILTIN)
+        return PAGE_SOURCE_PARSER_BUILTIN
+    return parser_name
+
+
+def parse_page_source(markup, parser_name):
+    if parser_name == PAGE_SOURCE_PARSER_HTML5:
+        from html5_parser import parse
+        return parse(markup, treebuilder="soup", return_root=False)
+    return BeautifulSoup(markup, parser_name)
+
+
+class ParsedPageSource:
+    """
+    One page source html, parsed once. noscript elements are already removed from
+    the soup, like the PageSource extractors expect. raw_words are the words of the
+    page before removing them.
+    Shared between extractors and threads, so treat the soup as read-only.
+    """
+    def __init__(self, file_path, soup, file_size):
+        self.file_path = file_path
+        self.soup = soup
+        self.raw_words = set(soup.get_text().split())
+
+        # get rid of noscript
+        for noscript_el in soup.select("noscript"):
+            noscript_el.extract()
+
+        self.words = None
+        self.element_index = None
+        self.resident_bytes = file_size * PARSED_BYTES_PER_HTML_BYTE
+
+    def get_words(self):
+        # words without the noscript text
+        if self.words is None:
+            self.words = set(self.soup.get_text().split())
+        return self.words
+
+    def get_element_index(self):
+        # built on first use, after noscript elements are removed
+        if self.element_index is None:
+            self.element_index = ElementIndex(self.soup)
+        return self.element_index
+
+
+class PageSourceCache:
+    """
+    Process-local LRU of ParsedPageSource, bounded by their estimated resident bytes.
+    Entries are keyed by path + mtime + size, so a rewritten file is parsed again.
+    """
+    def __init__(self,
+                 parser_name=PAGE_SOURCE_PARSER_BUILTIN,
+                 max_bytes=PAGE_SOURCE_CACHE_MAX_BYTES):
+        self.parser_name = resolve_page_source_parser(parser_name)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_path):
+        file_stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), file_stat.st_mtime_ns,
+               file_stat.st_size)
+
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+                self.hits += 1
+                return page
+            self.misses += 1
+
+        # parse outside of the lock, two threads may parse the same file once each
+        with open(file_path, 'r') as soup_file:
+            soup = parse_page_source(soup_file.read(), self.parser_name)
+        page = ParsedPageSource(file_path, soup, file_stat.st_size)
+
+        with self.lock:
+            if key not in self.pages:
+                self.pages[key] = page
+                self.resident_bytes += page.resident_bytes
+                self._evict()
+        return page
+
+    def _evict(self):
+        # keep at least the newest page even if it alone is over the limit
+        while self.resident_bytes > self.max_bytes and len(self.pages) > 1:
+            _, page = self.pages.popitem(last=False)
+            self.resident_bytes -= page.resident_bytes
+            self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "parser": self.parser_name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.pages),
+                "resident_bytes": self.resident_bytes
+            }
+
+    def clear(self):
+        with self.lock:
+            self.pages = OrderedDict()
+            self.resident_bytes = 0
+
+    def _reset_after_fork(self):
+        # another thread of the parent may have held the lock while forking
+        self.lock = threading.Lock()
+
+
+PAGE_SOURCE_CACHE = None
+_PAGE_SOURCE_CACHE_LOCK = threading.Lock()
+
+
+def _reset_page_source_cache_after_fork():
+    global _PAGE_SOURCE_CACHE_LOCK
+    _PAGE_SOURCE_CACHE_LOCK = threading.Lock()
+    if PAGE_SOURCE_CACHE is not None:
+        PAGE_SOURCE_CACHE._reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_page_source_cache_after_fork)
+
+
+def set_page_source_parser(parser_name):
+    # replaces the cache, so pages are parsed again with the new parser
+    global PAGE_SOURCE_CACHE
+    with _PAGE_SOURCE_CACHE_LOCK:
+        PAGE_SOURCE_CACHE = PageSourceCache(parser_name=parser_name)
+        logger.info("Using page source parser %s",
+                    PAGE_SOURCE_CACHE.parser_name)
+
+
+def _get_page_source_cache():
+    global PAGE_SOURCE_CACHE
+    with _PAGE_SOURCE_CACHE_LOCK:
+        if PAGE_SOURCE_CACHE is None:
+            PAGE_SOURCE_CACHE = PageSourceCache()
+        return PAGE_SOURCE_CACHE
+
+
+def get_parsed_page_source(file_path):
+    return _get_page_source_cache().get(file_path)
+
+
+def get_page_source_cache_stats():
+    return _get_page_source_cache().get_stats()
@@ -15,15 +15,17 @@
 
 import csv
 import datetime
-import json
 import logging
 
+import numpy as np
+
 from cvinspector.common.dommutation_utils import NODES_ADDED, NODES_REMOVED, \
     ATTRIBUTE_CHANGED, TEXT_CHANGED, DOM_CONTENT_LOADED
 from cvinspector.common.dommutation_utils import get_nodes_added_key, get_nodes_removed_key
 from cvinspector.common.utils import ABP_BLOCKED_ELEMENT, ERR_BLOCKED_BY_CLIENT, JSON_DOMMUTATION_KEY, \
     JSON_WEBREQUEST_KEY
-from cvinspector.common.utils import ANTICV_ANNOTATION_PREFIX
+from cvinspector.common.trial_cache import get_parsed_trial
+from cvinspector.common.utils import ANTICV_ANNOTATION_PREFIX, load_webrequest_details
 
 logger = logging.getLogger(__name__)
 # logger.setLevel("DEBUG")
@@ -31,90 +33,194 @@ logger = logging.getLogger(__name__)
 TIME_KEY = "time"
 TIME_KEY__WR = "requestTime"
 
+TIME_SERIES_DATE_COLUMN = "Date"
+TIME_SERIES_HEADER = [
+    "bin_norm", TIME_SERIES_DATE_COLUMN, "blocked", "web_req_blocked",
+    "elem_blocked", "snippet_blocked", "nodes_added", "nodes_removed",
+    "attribute_changed", "text_changed", "dom_content_loaded",
+    "iframe_src_changed", "iframe_blocked", "total_changes"
+]
+# numeric columns, the Date of a bin is its start time
+TIME_SERIES_VALUE_COLUMNS = [
+    x for x in TIME_SERIES_HEADER if x != TIME_SERIES_DATE_COLUMN
+]
+
+
+# columns of get_time_series_event_counts, in the order of the csv (without total_changes)
+(_COUNT_BLOCKED, _COUNT_WR_BLOCKED, _COUNT_ELEM_BLOCKED, _COUNT_SNIPPET_BLOCKED,
+ _COUNT_NODES_ADDED, _COUNT_NODES_REMOVED, _COUNT_ATTRIBUTE_CHANGED,
+ _COUNT_TEXT_CHANGED, _COUNT_DOM_CONTENT_LOADED, _COUNT_IFRAME_SRC_CHANGED,
+ _COUNT_IFRAME_BLOCKED) = range(11)
+_COUNT_COLUMNS = 11
+
+
+def get_time_series_event_counts(event):
+    """
+    Returns what one DOM or webrequest event adds to each count column of its bin,
+    or None when the event does not count towards any of them.
+    """
+    event_item = event.get("event")
+    if event_item is None:
+        return None
+    event_type = event.get("type")
+    if event_type == "event":
+        event_type = event_item.get("type")
+    elif event_type != "onErrorOccurred":
+        return None
+
+    if event_type is None:
+        return None
+
+    counts = [0] * _COUNT_COLUMNS
+    is_blocked = False
+    if event_type == DOM_CONTENT_LOADED:
+        counts[_COUNT_DOM_CONTENT_LOADED] += 1
+    if event_type == NODES_ADDED:
+        for key, defining_text, is_text_node, is_snippet_blocked in get_nodes_added_key(
+                event_item):
+            # snippet blocks are considerd to be a node added, so count it only as a snippet block
+            if is_snippet_blocked:
+                is_blocked = True
+                counts[_COUNT_SNIPPET_BLOCKED] += 1
+            elif is_text_node:
+                counts[_COUNT_TEXT_CHANGED] += 1
+            else:
+                counts[_COUNT_NODES_ADDED] += 1
 
-def auto_bin_time_series_csv(json_file_path,
-                             json_file_path__wr,
-                             output_file_name,
-                             time_step_ms,
-                             max_seconds_later=None,
-                             auto_determine_time=True):
-    def _by_time(event):
-        return event[TIME_KEY]
-
-    def _by_time_wr(event):
-        return event["event"][TIME_KEY__WR]
-
-    def _get_range_key(event, range_keys, event_key=TIME_KEY):
-        event_time = event.get(event_key)
-        if event_time is None:
-            event_time = event["event"][event_key]
-
-        for index, range_step in enumerate(range_keys):
-            next_time_index = index + 1
-            if next_time_index == len(range_keys):
-                # we are at the last step, so only check if event_time is larger
-                if range_step <= event_time:
-                    return range_step
+    if event_type == NODES_REMOVED:
+        for key, defining_text, is_text_node, _ in get_nodes_removed_key(
+                event_item):
+            if is_text_node:
+                counts[_COUNT_TEXT_CHANGED] += 1
             else:
-                # if within current step and next step
-                if range_step <= event_time <= range_keys[next_time_index]:
-                    return range_step
-
-    def _write_header(csv_writer):
-        header = [
-            "bin_norm", "Date", "blocked", "web_req_blocked", "elem_blocked",
-            "snippet_blocked", "nodes_added", "nodes_removed",
-            "attribute_changed", "text_changed", "dom_content_loaded",
-            "iframe_src_changed", "iframe_blocked", "total_changes"
-        ]
-        csv_writer.writerow(header)
-
-    output_file_opened = open(output_file_name + ".csv", 'w')
-    csvwriter = csv.writer(output_file_opened)
-    _write_header(csvwriter)
-
-    dom_json_content = None
-    wr_json_content = None
-    # read in DOM Mutation file
-    with open(json_file_path, 'r') as json_file:
-        dom_json_content = json.load(json_file)
-
-    try:
-        dom_events = dom_json_content[JSON_DOMMUTATION_KEY]
-    except KeyError:
+                counts[_COUNT_NODES_REMOVED] += 1
+    if event_type == ATTRIBUTE_CHANGED:
+        target_type = event_item["targetType"] or ""
+        target_type = target_type.lower()
+        # we ignore events that we purposely made to mark hidden elements
+        if ANTICV_ANNOTATION_PREFIX in event_item["attribute"]:
+            return None
+        # here we don't count the block event as a real attribute change
+        if event_item["attribute"] == ABP_BLOCKED_ELEMENT:
+            is_blocked = True
+            counts[_COUNT_ELEM_BLOCKED] += 1
+            if "iframe" in target_type:
+                counts[_COUNT_IFRAME_BLOCKED] += 1
+        else:
+            new_value = event_item["newValue"] or ""
+            # mark as iframe_src_attribute_changed event as well
+            if event_item["attribute"] == "src" and \
+                    "iframe" in target_type and len(new_value) > 0:
+                counts[_COUNT_IFRAME_SRC_CHANGED] += 1
+            counts[_COUNT_ATTRIBUTE_CHANGED] += 1
+    if event_type == TEXT_CHANGED:
+        counts[_COUNT_TEXT_CHANGED] += 1
+    if event_type == "onErrorOccurred":
+        details = event_item.get("details")
+        if details:
+            try:
+                details_json = load_webrequest_details(details)
+                if ERR_BLOCKED_BY_CLIENT in details_json.get("error"):
+                    is_blocked = True
+                    counts[_COUNT_WR_BLOCKED] += 1
+                else:
+                    return None
+            except Exception as e:
+                logger.debug("Could not parse details json")
+                logger.debug(e)
+                return None
+        else:
+            return None
+
+    # keep track of blocked
+    if is_blocked:
+        counts[_COUNT_BLOCKED] += 1
+
+    return counts
+
+
+def get_time_series_bin_indexes(event_times, range_keys):
+    """
+    Index of the bin of each event time. Bin i holds range_keys[i] <= time <= range_keys[i+1],
+    a time on a boundary goes to the earlier bin and times after the last key go to the last bin.
+    Times are compared as float64, which is exact for epoch milliseconds.
+    """
+    event_times = np.asarray(event_times, dtype=np.float64)
+    range_keys = np.asarray(range_keys, dtype=np.float64)
+    bin_indexes = np.searchsorted(range_keys, event_times, side="left") - 1
+    # only a time equal to the first key lands before it
+    return np.maximum(bin_indexes, 0)
+
+
+def get_time_series_bin_counts(events, event_times, range_keys):
+    # (bins x count columns) array, summed with one bincount per column
+    bin_counts = np.zeros((len(range_keys), _COUNT_COLUMNS), dtype=np.int64)
+    event_counts = []
+    counted_times = []
+    for event, event_time in zip(events, event_times):
+        counts = get_time_series_event_counts(event)
+        if counts is not None:
+            event_counts.append(counts)
+            counted_times.append(event_time)
+
+    if len(event_counts) == 0 or len(range_keys) == 0:
+        return bin_counts
+
+    bin_indexes = get_time_series_bin_indexes(counted_times, range_keys)
+    event_counts = np.asarray(event_counts, dtype=np.int64)
+    for column in range(_COUNT_COLUMNS):
+        bin_counts[:, column] = np.bincount(bin_indexes,
+                                            weights=event_counts[:, column],
+                                            minlength=len(range_keys))
+    return bin_counts
+
+
+def bin_time_series(json_file_path,
+                    json_file_path__wr,
+                    time_step_ms,
+                    max_seconds_later=None,
+                    auto_determine_time=True):
+    """
+    Bins the DOM and webrequest events of one trial by time_step_ms.
+    Returns the start time (ms) of each bin and a (bins x TIME_SERIES_VALUE_COLUMNS)
+    int64 array with the rows of the time series csv, without the Date column.
+    A missing or unreadable DOM file, or one without timed events, gives no bins.
+    """
+    no_bins = [], np.zeros((0, len(TIME_SERIES_VALUE_COLUMNS)), dtype=np.int64)
+
+    # read in DOM Mutation file (parsed once per process, see trial_cache)
+    dom_trial = get_parsed_trial(json_file_path, JSON_DOMMUTATION_KEY)
+    if dom_trial is None or not dom_trial.has_events_key:
         logger.debug("DOM JSON has no content")
-        return
+        return no_bins
 
-    dom_events_filtered = [x for x in dom_events if TIME_KEY in x]
+    dom_events_filtered = [x for x in dom_trial.events if TIME_KEY in x]
+    if len(dom_events_filtered) == 0:
+        logger.debug("DOM JSON has no timed events")
+        return no_bins
 
     # read in WebRequest file
-    with open(json_file_path__wr, 'r') as json_file__wr:
-        wr_json_content = json.load(json_file__wr)
+    wr_trial = get_parsed_trial(json_file_path__wr, JSON_WEBREQUEST_KEY)
 
     wr_events = []
-    try:
-        wr_events = wr_json_content[JSON_WEBREQUEST_KEY]
-    except KeyError:
+    if wr_trial is not None and wr_trial.has_events_key:
+        wr_events = wr_trial.events
+    else:
         logger.debug("WR has no content")
 
     wr_events_filtered = [
         x for x in wr_events if TIME_KEY__WR in x.get("event")
     ]
 
-    # sort by time
-    dom_events_filtered.sort(key=_by_time)
-
-    # sort by time
-    wr_events_filtered.sort(key=_by_time_wr)
+    dom_times = [x[TIME_KEY] for x in dom_events_filtered]
+    wr_times = [x["event"][TIME_KEY__WR] for x in wr_events_filtered]
 
     # bin by time step
-    first_time = 0  # default it to zero just in case there are no events
+    first_time = min(dom_times)
+    last_time = max(dom_times)
     first_time__wr = 0
-    if len(dom_events_filtered) > 0:
-        first_time = dom_events_filtered[0][TIME_KEY]
-        last_time = dom_events_filtered[-1][TIME_KEY]
-    if len(wr_events_filtered) > 0:
-        first_time__wr = wr_events_filtered[0]["event"][TIME_KEY__WR]
+    if len(wr_times) > 0:
+        first_time__wr = min(wr_times)
 
     # if first_time__wr is smaller and not zero
     if first_time__wr != 0 and first_time > first_time__wr:
@@ -125,139 +231,45 @@ def auto_bin_time_series_csv(json_file_path,
     else:
         # add extra 2 seconds
         last_time = last_time + (2 * 1000)
-        last_time_based_on_max = first_time + (max_seconds_later * 1000)
-        if last_time > last_time_based_on_max:
-            last_time = last_time_based_on_max
+        if max_seconds_later is not None:
+            last_time_based_on_max = first_time + (max_seconds_later * 1000)
+            if last_time > last_time_based_on_max:
+                last_time = last_time_based_on_max
 
     range_keys = list(range(int(first_time), int(last_time), time_step_ms))
 
-    # build dict to hold range_key --> [events]
-    events_binned = dict()
-    for k in range_keys:
-        events_binned.setdefault(k, [])
-
-    for event in dom_events_filtered:
-        event_key = _get_range_key(event, range_keys)
-        events_binned[event_key].append(event)
-
-    for event in wr_events_filtered:
-        event_key = _get_range_key(event, range_keys, event_key=TIME_KEY__WR)
-        events_binned[event_key].append(event)
-
-    verify_event_count = 0
-    bin_norm = 0
-    bin_with_time_step = 0
-    for bin_key in events_binned.keys():
-        bin_size = len(events_binned.get(bin_key))
-        event_time_iso = datetime.datetime.fromtimestamp(bin_key /
-                                                         1000).isoformat()
-
-        verify_event_count += bin_size
-        block_count = 0
-        not_block_count = 0
-        attribute_changed_count = 0
-        iframe_src_attribute_changed_count = 0
-        iframe_blocked = 0
-        text_changed_count = 0
-        node_add_count = 0
-        node_remove_count = 0
-        wr_block_count = 0
-        elem_blocked_count = 0
-        snippet_blocked_count = 0
-        dom_content_loaded = 0  # we expect at most one event here
-
-        for event in events_binned.get(bin_key):
-            event_item = event.get("event")
-            if event_item is None:
-                continue
-            event_type = event.get("type")
-            if event_type == "event":
-                event_type = event_item.get("type")
-            elif event_type != "onErrorOccurred":
-                continue
-
-            if event_type is None:
-                continue
-
-            is_blocked = False
-            if event_type == DOM_CONTENT_LOADED:
-                dom_content_loaded += 1
-            if event_type == NODES_ADDED:
-                for key, defining_text, is_text_node, is_snippet_blocked in get_nodes_added_key(
-                        event_item):
-                    # snippet blocks are considerd to be a node added, so count it only as a snippet block
-                    if is_snippet_blocked:
-                        is_blocked = True
-                        snippet_blocked_count += 1
-                    elif is_text_node:
-                        text_changed_count += 1
-                    else:
-                        node_add_count += 1
-
-            if event_type == NODES_REMOVED:
-                for key, defining_text, is_text_node, _ in get_nodes_removed_key(
-                        event_item):
-                    if is_text_node:
-                        text_changed_count += 1
-                    else:
-                        node_remove_count += 1
-            if event_type == ATTRIBUTE_CHANGED:
-                target_type = event_item["targetType"] or ""
-                target_type = target_type.lower()
-                # we ignore events that we purposely made to mark hidden elements
-                if ANTICV_ANNOTATION_PREFIX in event_item["attribute"]:
-                    continue
-                # here we don't count the block event as a real attribute change
-                if event_item["attribute"] == ABP_BLOCKED_ELEMENT:
-                    is_blocked = True
-                    elem_blocked_count += 1
-                    if "iframe" in target_type:
-                        iframe_blocked += 1
-                else:
-                    new_value = event_item["newValue"] or ""
-                    # mark as iframe_src_attribute_changed event as well
-                    if event_item["attribute"] == "src" and \
-                            "iframe" in target_type and len(new_value) > 0:
-                        iframe_src_attribute_changed_count += 1
-                    attribute_changed_count += 1
-            if event_type == TEXT_CHANGED:
-                text_changed_count += 1
-            if event_type == "onErrorOccurred":
-                details = event_item.get("details")
-                if details:
-                    try:
-                        details_json = json.loads(details)
-                        if ERR_BLOCKED_BY_CLIENT in details_json.get("error"):
-                            is_blocked = True
-                            wr_block_count += 1
-                        else:
-                            continue
-                    except Exception as e:
-                        logger.debug("Could not parse details json")
-                        logger.debug(e)
-                        continue
-                else:
-                    continue
+    bin_counts = get_time_series_bin_counts(dom_events_filtered, dom_times,
+                                            range_keys)
+    bin_counts += get_time_series_bin_counts(wr_events_filtered, wr_times,
+                                             range_keys)
 
-            # keep track of blocked or not
-            if is_blocked:
-                block_count += 1
-            else:
-                not_block_count += 1
-
-        total_changes = node_add_count + node_remove_count + attribute_changed_count + text_changed_count
-        # write row
-        csvwriter.writerow([
-            bin_norm, event_time_iso, block_count, wr_block_count,
-            elem_blocked_count, snippet_blocked_count, node_add_count,
-            node_remove_count, attribute_changed_count, text_changed_count,
-            dom_content_loaded, iframe_src_attribute_changed_count,
-            iframe_blocked, total_changes
-        ])
-
-        # update bin_norm
-        bin_norm += time_step_ms
-        bin_with_time_step += time_step_ms
-
-    # close file
-    output_file_opened.close()
+    total_changes = bin_counts[:, _COUNT_NODES_ADDED] + bin_counts[:, _COUNT_NODES_REMOVED] + \
+        bin_counts[:, _COUNT_ATTRIBUTE_CHANGED] + bin_counts[:, _COUNT_TEXT_CHANGED]
+    bin_norms = np.arange(len(range_keys), dtype=np.int64) * time_step_ms
+
+    rows = np.column_stack([bin_norms, bin_counts, total_changes])
+    return range_keys, rows
+
+
+def write_time_series_csv(output_file_name, range_keys, rows):
+    with open(output_file_name + ".csv", 'w') as output_file_opened:
+        csvwriter = csv.writer(output_file_opened)
+        csvwriter.writerow(TIME_SERIES_HEADER)
+        for bin_key, row in zip(range_keys, rows.tolist()):
+            event_time_iso = datetime.datetime.fromtimestamp(
+                bin_key / 1000).isoformat()
+            csvwriter.writerow(row[:1] + [event_time_iso] + row[1:])
+
+
+def auto_bin_time_series_csv(json_file_path,
+                             json_file_path__wr,
+                             output_file_name,
+                             time_step_ms,
+                             max_seconds_later=None,
+                             auto_determine_time=True):
+    range_keys, rows = bin_time_series(json_file_path,
+                                       json_file_path__wr,
+                                       time_step_ms,
+                                       max_seconds_later=max_seconds_later,
+                                       auto_determine_time=auto_determine_time)
+    write_time_series_csv(output_file_name, range_keys, rows)
@@ -0,0 +1,146 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import logging
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from cvinspector.common.utils import CONTROL, VARIANT
+from cvinspector.ml.plot import TIME_SERIES_VALUE_COLUMNS
+
+logger = logging.getLogger(__name__)
+#logger.setLevel("DEBUG")
+
+TIME_SERIES_STORE_SUFFIX = "_timeseries.npz"
+
+# a time series in a store is referenced as <npz path>#<url index>#<crawl type>#<trial index>
+TIME_SERIES_REF_DELIMITER = "#"
+
+TIME_SERIES_CRAWL_TYPES = [CONTROL, VARIANT]
+
+# column name --> index in the rows of a time series
+TIME_SERIES_COLUMN_INDEX = dict(
+    (column, index) for index, column in enumerate(TIME_SERIES_VALUE_COLUMNS))
+
+# stores loaded per process, each one holds the trials of up to a few dozen urls
+TIME_SERIES_STORE_CACHE_SIZE = 16
+
+
+class TimeSeriesStoreWriter:
+    """
+    Collects the binned time series of the urls of one crawl chunk and saves them as one .npz:
+        urls         (urls)
+        rows         uint32 (urls x crawl types x trials x bins x TIME_SERIES_VALUE_COLUMNS)
+        lengths      int32 (urls x crawl types x trials), number of bins, -1 when missing
+        start_times  float64 (urls x crawl types x trials), start of the first bin in ms
+    Trials with fewer bins are padded with zeros up to the longest trial.
+    """
+    def __init__(self, file_path, trials=4):
+        self.file_path = file_path
+        self.trials = trials
+        self.urls = []
+        self.time_series = dict()
+
+    def add_url(self, url):
+        # returns the index of the url in the store
+        self.urls.append(url)
+        return len(self.urls) - 1
+
+    def add(self, url_index, crawl_type, trial_index, range_keys, rows):
+        self.time_series[(url_index, crawl_type, trial_index)] = (range_keys,
+                                                                  rows)
+        return get_time_series_ref(self.file_path, url_index, crawl_type,
+                                   trial_index)
+
+    def save(self):
+        max_bins = 0
+        for _, rows in self.time_series.values():
+            max_bins = max(max_bins, len(rows))
+
+        shape = (len(self.urls), len(TIME_SERIES_CRAWL_TYPES), self.trials)
+        tensor = np.zeros(shape + (max_bins, len(TIME_SERIES_VALUE_COLUMNS)),
+                          dtype=np.uint32)
+        lengths = np.full(shape, -1, dtype=np.int32)
+        start_times = np.zeros(shape, dtype=np.float64)
+
+        for (url_index, crawl_type,
+             trial_index), (range_keys, rows) in self.time_series.items():
+            type_index = TIME_SERIES_CRAWL_TYPES.index(crawl_type)
+            tensor[url_index, type_index, trial_index, :len(rows)] = rows
+            lengths[url_index, type_index, trial_index] = len(rows)
+            if len(range_keys) > 0:
+                start_times[url_index, type_index, trial_index] = range_keys[0]
+
+        # write under a temporary name so a crash never leaves a partial store
+        tmp_file_path = self.file_path + ".tmp"
+        with open(tmp_file_path, 'wb') as store_file:
+            np.savez_compressed(store_file,
+                                urls=np.array(self.urls, dtype=str),
+                                rows=tensor,
+                                lengths=lengths,
+                                start_times=start_times)
+        os.replace(tmp_file_path, self.file_path)
+        logger.debug("Saved time series of %d urls to %s", len(self.urls),
+                     self.file_path)
+
+
+def get_time_series_ref(file_path, url_index, crawl_type, trial_index):
+    return TIME_SERIES_REF_DELIMITER.join(
+        [file_path, str(url_index), crawl_type,
+         str(trial_index)])
+
+
+@lru_cache(maxsize=TIME_SERIES_STORE_CACHE_SIZE)
+def _load_time_series_store(file_path):
+    with np.load(file_path) as store:
+        return dict((key, store[key]) for key in store.files)
+
+
+def _load_time_series_csv(file_path):
+    # csv export (or mapping files from before the store), missing columns are zeros
+    with open(file_path) as time_file:
+        reader = csv.DictReader(time_file, delimiter=',')
+        csv_rows = list(reader)
+
+    rows = np.zeros((len(csv_rows), len(TIME_SERIES_VALUE_COLUMNS)),
+                    dtype=np.int64)
+    for row_index, csv_row in enumerate(csv_rows):
+        for column, column_index in TIME_SERIES_COLUMN_INDEX.items():
+            if csv_row.get(column):
+                rows[row_index, column_index] = int(csv_row[column])
+    return rows
+
+
+def load_time_series_rows(time_series_ref):
+    """
+    Returns the (bins x TIME_SERIES_VALUE_COLUMNS) int64 rows of one trial, given a
+    reference into a store or the path of a time series csv.
+    Returns None when the store does not have that trial.
+    """
+    if time_series_ref.endswith(".csv"):
+        return _load_time_series_csv(time_series_ref)
+
+    file_path, url_index, crawl_type, trial_index = time_series_ref.rsplit(
+        TIME_SERIES_REF_DELIMITER, 3)
+    store = _load_time_series_store(file_path)
+    index = (int(url_index), TIME_SERIES_CRAWL_TYPES.index(crawl_type),
+             int(trial_index))
+    length = store["lengths"][index]
+    if length < 0:
+        return None
+    return store["rows"][index][:length].astype(np.int64)
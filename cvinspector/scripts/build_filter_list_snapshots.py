@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import sys
+import time
+
+from cvinspector.common.filter_list_snapshot import load_filter_list_snapshot, get_filter_list_snapshot_path, \
+    create_filter_matcher_from_snapshots, clear_loaded_filter_list_snapshots
+from cvinspector.common.filter_matcher import create_filter_matcher, get_filter_list_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Compile filter lists into snapshots (rules and the matcher index), so they are not parsed again on startup'
+    )
+
+    # REQUIRED
+    parser.add_argument('--filter_list_paths',
+                        required=True,
+                        help='Filter lists to compile, comma separated')
+
+    # OPTIONAL
+    parser.add_argument('--snapshot_directory',
+                        help='Directory of the snapshots. Default=None (next to each filter list)')
+    parser.add_argument('--benchmark',
+                        default="false",
+                        help='Compare parsing the filter lists with loading their snapshots. Default=false')
+
+    args = parser.parse_args()
+    print(args)
+
+    for filter_list_path in get_filter_list_paths(args.filter_list_paths):
+        snapshot = load_filter_list_snapshot(filter_list_path, snapshot_directory=args.snapshot_directory)
+        print("%s --> %s (%d lines, %s)" %
+              (filter_list_path, get_filter_list_snapshot_path(filter_list_path, args.snapshot_directory),
+               snapshot.line_count, str(snapshot.header["matcher_stats"])))
+
+    if args.benchmark.lower() == "true":
+        start_time = time.time()
+        create_filter_matcher(args.filter_list_paths)
+        text_seconds = time.time() - start_time
+
+        # drop the snapshots mapped above, so they are loaded like on a fresh start
+        clear_loaded_filter_list_snapshots()
+        start_time = time.time()
+        create_filter_matcher_from_snapshots(args.filter_list_paths, snapshot_directory=args.snapshot_directory)
+        snapshot_seconds = time.time() - start_time
+
+        print("Filter matcher from text: %.3fs, from snapshots: %.3fs" % (text_seconds, snapshot_seconds))
+
+    print("DONE")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
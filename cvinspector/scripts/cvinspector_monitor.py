@@ -24,19 +24,100 @@ import shutil
 import string
 import sys
 
-from Naked.toolshed.shell import execute_js
-
 from cvinspector.common.script_utils import process_group_trails, transfer_prep, diff_groups, create_time_series_csvs
+from cvinspector.common.stage_runner import Stage, StageRunner, STAGE_MANIFEST_FILE_NAME
+from cvinspector.common.trial_cache import get_trial_cache_stats
+from cvinspector.common.mongo_clients import MONGO_MAX_POOL_SIZE, set_mongo_pool_size, close_shared_mongo_clients
+from cvinspector.common.url_parts import enable_url_parts_disk_memo, disable_url_parts_disk_memo, \
+    get_url_parts_cache_stats
 from cvinspector.common.utils import WEBREQUESTS_DATA_FILE_SUFFIX_CONTROL, WEBREQUESTS_DATA_FILE_SUFFIX_VARIANT, \
-    DOMMUTATION_DATA_FILE_SUFFIX_CONTROL, DOMMUTATION_DATA_FILE_SUFFIX_VARIANT
+    DOMMUTATION_DATA_FILE_SUFFIX_CONTROL, DOMMUTATION_DATA_FILE_SUFFIX_VARIANT, MONGODB_COLLECTION_CRAWL_INSTANCE, \
+    MONGODB_COLLECTION_WEBREQUESTS_CONTROL, MONGODB_COLLECTION_WEBREQUESTS_VARIANT, \
+    MONGODB_COLLECTION_DOMMUTATION_CONTROL, MONGODB_COLLECTION_DOMMUTATION_VARIANT, JSON_WEBREQUEST_KEY, \
+    JSON_DOMMUTATION_KEY, DIFF_GROUP_SUFFIX
 from cvinspector.data_collect.collect import get_downloads_directory
 from cvinspector.data_collect.collect_seq import run_data_collection, update_filter_list_for_default_profiles
-from cvinspector.data_migrate.utils import MONGO_CLIENT_HOST, MONGO_CLIENT_PORT
+from cvinspector.data_collect.ndjson_sink import NDJSON_SINK_PORT
+from cvinspector.diff_analysis.dommutation_core import DOM_DIFF_TWO_PASS_MIN_BYTES, set_dom_diff_two_pass_min_bytes
+from cvinspector.diff_analysis.wr_diff_cache import enable_wr_diff_cache, disable_wr_diff_cache, \
+    get_wr_diff_cache_stats
+from cvinspector.data_migrate.utils import MONGO_CLIENT_HOST, MONGO_CLIENT_PORT, get_anticv_mongo_client_and_db
 from cvinspector.ml.feature_constants import BOOLEAN_FEATURES
 from cvinspector.ml.labeling import label_dataset_from_saved_clf
 from cvinspector.ml.output_features_to_csv import _clean_scale_data_for_labeling, get_test_features_from_file
 from cvinspector.ml.output_features_to_csv import write_feature_csv
-from cvinspector.ml.output_features_to_csv import write_urls_txt, RAW_UNLABEL_FILE_KEY
+from cvinspector.ml.output_features_to_csv import write_urls_txt, write_tracking_urls_txt, RAW_UNLABEL_FILE_KEY
+from cvinspector.ml.page_source_cache import PAGE_SOURCE_PARSER_BUILTIN, set_page_source_parser, \
+    get_page_source_cache_stats
+
+# stages of the pipeline, in the order they used to run
+STAGE_UPDATE_FILTER_LIST = "update_filter_list"
+STAGE_COLLECT_DATA = "collect_data"
+STAGE_MOVE_DATA = "move_data"
+STAGE_GROUPS = "groups"
+STAGE_MIGRATE = "migrate"
+STAGE_DIFF_GROUPS = "diff_groups"
+STAGE_TIME_SERIES = "time_series"
+STAGE_URLS = "urls"
+STAGE_TRACKING_URLS = "tracking_urls"
+STAGE_FEATURES = "features"
+STAGE_CLEAN_FEATURES = "clean_features"
+STAGE_LABEL = "label"
+
+# collections written by the migrate and diff groups stages
+MIGRATE_COLLECTIONS = [
+    MONGODB_COLLECTION_CRAWL_INSTANCE, MONGODB_COLLECTION_WEBREQUESTS_CONTROL,
+    MONGODB_COLLECTION_WEBREQUESTS_VARIANT,
+    MONGODB_COLLECTION_DOMMUTATION_CONTROL,
+    MONGODB_COLLECTION_DOMMUTATION_VARIANT
+]
+DIFF_GROUP_COLLECTIONS = [
+    JSON_WEBREQUEST_KEY + DIFF_GROUP_SUFFIX,
+    JSON_DOMMUTATION_KEY + DIFF_GROUP_SUFFIX
+]
+
+
+def get_mongo_crawl_group_fingerprint(client,
+                                      port,
+                                      crawler_group_name,
+                                      collection_names,
+                                      mongodb_username=None,
+                                      mongodb_password=None):
+    # count and newest id of the documents of the crawl group in each collection
+    _, db = get_anticv_mongo_client_and_db(client,
+                                           port,
+                                           username=mongodb_username,
+                                           password=mongodb_password)
+    query = {"crawl_group_name": crawler_group_name}
+    fingerprint = dict()
+    for collection_name in collection_names:
+        collection = db[collection_name]
+        newest_doc = collection.find_one(query,
+                                         projection={"_id": 1},
+                                         sort=[("_id", -1)])
+        fingerprint[collection_name] = [
+            collection.count_documents(query),
+            str(newest_doc["_id"]) if newest_doc else None
+        ]
+    return fingerprint
+
+
+def get_crawl_data_directories(output_directory, crawler_group_name):
+    # crawl data and page source directories of the output directory and of its
+    # chunk directories
+    crawl_data_directory_names = [
+        "crawl_data_" + crawler_group_name, "pagesource_" + crawler_group_name
+    ]
+    crawl_data_directories = []
+    for root, directories, _ in os.walk(output_directory):
+        directories.sort()
+        for directory in directories:
+            if directory in crawl_data_directory_names:
+                crawl_data_directories.append(root + os.sep + directory)
+        # chunk directories are right below the output directory
+        if root != output_directory:
+            directories[:] = []
+    return crawl_data_directories
 
 
 def move_data_collected_to_output(downloads_directory, crawler_group_name,
@@ -134,6 +215,11 @@ def main():
     parser.add_argument('--filter_list_paths',
                         required=True,
                         help='Path to filter lists used to find tracking')
+    parser.add_argument(
+        '--filter_list_snapshot_directory',
+        help=
+        'Optional directory to keep compiled snapshots of the filter lists in, a snapshot is rebuilt when its filter list changes. Default=None (parse the filter lists every run)'
+    )
     parser.add_argument('--chrome_driver_path',
                         required=True,
                         help='Path to chrome driver file')
@@ -177,6 +263,58 @@ def main():
         type=int,
         default=4,
         help='Number of trials to do per website per control/variant')
+    parser.add_argument(
+        '--max_browsers',
+        type=int,
+        default=1,
+        help=
+        'Number of browsers (each with its own virtual display) used to run control/variant trials concurrently. Default=1 (sequential)'
+    )
+    parser.add_argument(
+        '--driver_pool_max_trials',
+        type=int,
+        default=0,
+        help=
+        'Reuse chrome drivers across trials (state is reset between trials) and relaunch them after this many trials. Only used when max_browsers=1. Default=0 (new driver per trial)'
+    )
+    parser.add_argument(
+        '--settle_quiet_window',
+        type=float,
+        default=0,
+        help=
+        'Stop waiting on a page once its network and DOM were quiet for this many seconds (still bounded by the measurement timer). Default=0 (always wait the full measurement timer)'
+    )
+    parser.add_argument(
+        '--stream_output',
+        default="false",
+        help=
+        'Whether the extensions stream their events as NDJSON to a local sink instead of keeping them in memory until the page is saved. Default=false'
+    )
+    parser.add_argument(
+        '--stream_output_port',
+        type=int,
+        default=NDJSON_SINK_PORT,
+        help=
+        'Port of the local NDJSON sink when stream_output is true. A free port is used if it is taken. Default=%d'
+        % NDJSON_SINK_PORT)
+    parser.add_argument(
+        '--url_parts_memo_path',
+        help=
+        'Optional sqlite file that memoizes parsed urls (tld and query parts) across processes and runs. Default=None (in-memory cache only)'
+    )
+    parser.add_argument(
+        '--wr_diff_cache',
+        default="false",
+        help=
+        'Keep the webrequest diff of every site on disk (in the output directory), so extracting the features reuses the diffs of the url extraction. Takes disk space for every site, the directory can be removed after the run. Default=false'
+    )
+    parser.add_argument(
+        '--dom_diff_two_pass_min_mb',
+        type=int,
+        default=DOM_DIFF_TWO_PASS_MIN_BYTES // (1024 * 1024),
+        help=
+        'Diff the dom mutations of a site in two passes (lower peak memory, but trials may be parsed twice) when its trial files add up to more than this many MB. 0 always uses two passes. Default=%d'
+        % (DOM_DIFF_TWO_PASS_MIN_BYTES // (1024 * 1024)))
     parser.add_argument('--beyond_landing_pages',
                         default="true",
                         help='Whether we crawl beyond the landing page')
@@ -194,6 +332,53 @@ def main():
         help=
         'Skip data collection, assuming the data collected is already there in the correct directories'
     )
+    parser.add_argument(
+        '--resume',
+        default="true",
+        help=
+        'Skip the stages that completed in an earlier run with the same crawler group name when their inputs did not change (kept in %s of the output directory). Default=true'
+        % STAGE_MANIFEST_FILE_NAME)
+    parser.add_argument(
+        '--rerun_stages',
+        help=
+        'Comma separated stages to run even when unchanged (%s). Default=None'
+        % ", ".join([
+            STAGE_UPDATE_FILTER_LIST, STAGE_COLLECT_DATA, STAGE_GROUPS,
+            STAGE_MIGRATE, STAGE_DIFF_GROUPS, STAGE_TIME_SERIES, STAGE_URLS,
+            STAGE_TRACKING_URLS, STAGE_FEATURES, STAGE_CLEAN_FEATURES,
+            STAGE_LABEL
+        ]))
+    parser.add_argument(
+        '--stage_workers',
+        type=int,
+        default=1,
+        help=
+        'Number of independent stages (like time series and url extraction) that can run at the same time. Stages fork worker processes, so above 1 a stage can fork while another one holds a lock: the caches reset theirs in the child, other module state may not. Default=1'
+    )
+    parser.add_argument(
+        '--export_time_series_csv',
+        default="false",
+        help=
+        'Also write the binned time series of each trial as csv (for debugging). Features always read the .npz time series stores. Default=false'
+    )
+    parser.add_argument(
+        '--feature_store',
+        default="false",
+        help=
+        'Write the features to a columnar feature store (parquet, needs pyarrow) instead of a csv. Default=false'
+    )
+    parser.add_argument(
+        '--remove_tracking_urls',
+        default="false",
+        help=
+        'Remove the tracking urls (matched by the filter lists) from the features. The shipped model was trained without removing them, so this changes the features. Default=false'
+    )
+    parser.add_argument(
+        '--page_source_parser',
+        default=PAGE_SOURCE_PARSER_BUILTIN,
+        help=
+        'Parser for the page sources: html.parser, lxml, html5-parser or auto (the fastest one installed). Parsers other than html.parser can build different trees, and so give different features than the shipped model was trained on. Default=html.parser'
+    )
     parser.add_argument('--ground_truth_file',
                         help='Ground truth file to mark rows as labeled')
     parser.add_argument(
@@ -208,6 +393,13 @@ def main():
     parser.add_argument('--mongodb_port',
                         default=MONGO_CLIENT_PORT,
                         help='Port of mongoDB')
+    parser.add_argument(
+        '--mongodb_max_pool_size',
+        type=int,
+        default=MONGO_MAX_POOL_SIZE,
+        help=
+        'Max connections of the mongoDB client shared by the threads of each process. Default=%d'
+        % MONGO_MAX_POOL_SIZE)
     parser.add_argument('--mongodb_username', help='username of mongoDB')
     parser.add_argument('--mongodb_password', help='password of mongoDB')
 
@@ -228,11 +420,31 @@ def main():
     beyond_landing_pages_only = args.beyond_landing_pages_only.lower() == "true"
     by_rank = args.by_rank.lower() == "true"
     skip_data_collection = args.skip_data_collection.lower() == "true"
+    stream_output = args.stream_output.lower() == "true"
+    export_time_series_csv = args.export_time_series_csv.lower() == "true"
+    feature_store = args.feature_store.lower() == "true"
+    resume = args.resume.lower() == "true"
+    wr_diff_cache = args.wr_diff_cache.lower() == "true"
+    remove_tracking_urls = args.remove_tracking_urls.lower() == "true"
+    rerun_stages = []
+    if args.rerun_stages:
+        rerun_stages = args.rerun_stages.split(",")
 
     logger.info("NOTE: Using use_dynamic_profile: %s", str(use_dynamic_profile))
     logger.info("NOTE: Using beyond_landing_pages: %s", str(beyond_landing_pages))
     logger.info("NOTE: Using beyond_landing_pages_only: %s",
                 str(beyond_landing_pages_only))
+    logger.info("NOTE: Using max_browsers: %d", args.max_browsers)
+    logger.info("NOTE: Using settle_quiet_window: %s",
+                str(args.settle_quiet_window))
+    logger.info("NOTE: Using stream_output: %s", str(stream_output))
+    logger.debug("NOTE: Using stream_output_port: %d", args.stream_output_port)
+    set_mongo_pool_size(max_pool_size=args.mongodb_max_pool_size)
+    set_page_source_parser(args.page_source_parser)
+    if args.url_parts_memo_path:
+        logger.info("NOTE: Using url_parts_memo_path: %s",
+                    args.url_parts_memo_path)
+        enable_url_parts_disk_memo(args.url_parts_memo_path)
     logger.debug("NOTE: Using by_rank: %s", str(by_rank))
     logger.debug("NOTE: Using skip_data_collection: %s", str(skip_data_collection))
 
@@ -267,33 +479,6 @@ def main():
             logger.error("Could not create MAIN output directory " + main_output_directory)
             sys.exit(1)
 
-    # Collect data for every site given
-    if not skip_data_collection:
-        # update the filter list first of the default chrome profiles
-        update_filter_list_for_default_profiles(
-            anticv_on=anticv_on,
-            abp_extension_absolute_path=args.chrome_adblockplus_ext_abs_path,
-            chrome_driver_path=args.chrome_driver_path,
-            chrome_ext_path=args.chrome_adblockplus_ext_abs_path)
-
-        # then collect the data
-        collect_data(args.sites_csv,
-                     main_output_directory,
-                     crawler_group_name,
-                     start_index=args.start_index,
-                     end_index=args.end_index,
-                     anticv_on=anticv_on,
-                     csv_delimiter=args.sites_csv_delimiter,
-                     use_dynamic_profile=use_dynamic_profile,
-                     trials=args.trials,
-                     beyond_landing_pages=beyond_landing_pages,
-                     beyond_landing_pages_only=beyond_landing_pages_only,
-                     by_rank=by_rank,
-                     chrome_driver_path=args.chrome_driver_path,
-                     chrome_ext_path=args.chrome_adblockplus_ext_abs_path)
-    else:
-        logger.warning("Note: Skipping data collection")
-
     # Make crawl data folder using crawler_group_name
     crawl_data_output = main_output_directory + os.sep + "crawl_data_" + crawler_group_name + os.sep
     crawl_data_output__webrequests_control = crawl_data_output + "control_webrequests" + os.sep
@@ -317,36 +502,6 @@ def main():
     downloads_dir = get_downloads_directory(main_output_directory,
                                             crawler_group_name)
 
-    # Move the data to the right output directory
-    move_data_collected_to_output(downloads_dir, crawler_group_name,
-                                  crawl_data_output__webrequests_control,
-                                  crawl_data_output__webrequests_variant,
-                                  crawl_data_output__dom_control,
-                                  crawl_data_output__dom_variant,
-                                  logger)
-
-    # Create group trials csv
-    groups_file_name = "groups_" + crawler_group_name + ".csv"
-    groups_file_name = groups_file_name.replace(" ", "_")
-    groups_file_path = process_group_trails(main_output_directory,
-                                            groups_file_name,
-                                            crawler_group_name,
-                                            logger,
-                                            trials=args.trials)
-    logger.debug("Created group files %s", groups_file_path)
-
-    # Transfer data to DB
-    transfer_prep(main_output_directory, crawler_group_name, logger)
-
-    # Create Diff Groups
-    diff_groups(args.mongodb_client,
-                args.mongodb_port,
-                crawler_group_name,
-                groups_file_path,
-                logger,
-                mongodb_username=args.mongodb_username,
-                mongodb_password=args.mongodb_password)
-
     # Create time series CSVs
     ts_output_directory = main_output_directory_ts + os.sep + "ts_" + crawler_group_name + os.sep
     if not os.path.isdir(ts_output_directory):
@@ -361,71 +516,312 @@ def main():
 
     # CSV output of timeseries file
     ts_file_mapping_file_path = ts_output_directory + "filename_mapping.csv"
-    create_time_series_csvs(groups_file_path, ts_output_directory, None, trials=args.trials)
-    logger.info("Created timeseries " + ts_file_mapping_file_path)
 
-    # Get variant urls (this grabs all outgoing URLs that will happen in variant side only)
+    groups_file_name = "groups_" + crawler_group_name + ".csv"
+    groups_file_name = groups_file_name.replace(" ", "_")
+
     variant_urls_output_file_name = crawler_group_name + "_variant_urls"
-    write_urls_txt(crawler_group_name,
-                   args.mongodb_client,
-                   args.mongodb_port,
-                   ground_truth_file_path=args.ground_truth_file,
-                   csv_file_name=variant_urls_output_file_name,
-                   output_directory=main_output_directory,
-                   ground_truth_only=False,
-                   trial_count=args.trials)
-    logger.debug("Got variant URLS %s", variant_urls_output_file_name)
-
-    # Call nodejs adblock parser to identify the tracking urls
     variant_urls_file_path = main_output_directory + os.sep + variant_urls_output_file_name + ".txt"
     # File of tracking urls
     variant_tracking_file_path = main_output_directory + os.sep + variant_urls_output_file_name + "_tracking.txt"
-    adblock_parser_arguments = args.filter_list_paths + " " + variant_urls_file_path + " " + variant_tracking_file_path
-    execute_js("./external_scripts/adblock_parser_tracking.js", adblock_parser_arguments)
-    logger.debug("Got tracking URLS %s", variant_tracking_file_path)
 
-    # Feature extraction (this is for unlabeled data for monitoring)
     features_file_name = crawler_group_name + "_features"
-    # Features File Path
-    features_file_path = main_output_directory + os.sep + features_file_name + ".csv"
-    write_feature_csv(crawler_group_name,
-                      args.mongodb_client,
-                      args.mongodb_port,
-                      variant_tracking_file_path,
-                      ground_truth_file_path=args.ground_truth_file,
-                      csv_file_name=features_file_name,
-                      output_directory=main_output_directory,
-                      ground_truth_only=False,
-                      time_series_mapping=ts_file_mapping_file_path,
-                      include_control=False,
-                      output_external_logs=args.output_external_logs,
-                      trials=args.trials)
-    logger.debug("Got features %s", features_file_path)
-
-    # Clean features for unlabeled data
-    test_features_only = get_test_features_from_file(
-        args.classifier_features_file_path)
-    result_files = _clean_scale_data_for_labeling(
-        features_file_path,
-        args.output_suffix,
-        main_output_directory,
-        BOOLEAN_FEATURES,
-        test_features_only=test_features_only,
-        ignore_labels=True)
-    logger.debug("Cleaned features")
-
-    unlabel_clean_file_path = result_files[RAW_UNLABEL_FILE_KEY]
-
-    # Label the file using classifier
+
     threshold = float(args.threshold)
     labeled_file_name = crawler_group_name + "_labeled.csv"
     labeled_file_path = main_output_directory + os.sep + labeled_file_name
-    label_dataset_from_saved_clf(unlabel_clean_file_path,
-                                 args.classifier_path,
-                                 labeled_file_name,
-                                 main_output_directory,
-                                 threshold=threshold,
-                                 test_features_only=test_features_only)
+
+    ground_truth_paths = []
+    if args.ground_truth_file:
+        ground_truth_paths = [args.ground_truth_file]
+
+    def get_crawl_group_fingerprint(collection_names):
+        # mongo query fingerprint: documents of the crawl group (count and newest id)
+        return get_mongo_crawl_group_fingerprint(
+            args.mongodb_client,
+            args.mongodb_port,
+            crawler_group_name,
+            collection_names,
+            mongodb_username=args.mongodb_username,
+            mongodb_password=args.mongodb_password)
+
+    # The stages of the pipeline, see StageRunner
+    manifest_path = None
+    if resume:
+        manifest_path = main_output_directory + os.sep + STAGE_MANIFEST_FILE_NAME
+    stage_runner = StageRunner(manifest_path,
+                               max_workers=args.stage_workers,
+                               rerun_stages=rerun_stages)
+
+    if skip_data_collection:
+        logger.warning("Note: Skipping data collection")
+
+    def _update_filter_list():
+        # update the filter list first of the default chrome profiles
+        update_filter_list_for_default_profiles(
+            anticv_on=anticv_on,
+            abp_extension_absolute_path=args.chrome_adblockplus_ext_abs_path,
+            chrome_driver_path=args.chrome_driver_path,
+            chrome_ext_path=args.chrome_adblockplus_ext_abs_path)
+
+    # the filter lists are updated again whenever the crawl is redone
+    collect_data_params = [
+        args.start_index, args.end_index, anticv_on, args.sites_csv_delimiter,
+        use_dynamic_profile, args.trials, beyond_landing_pages,
+        beyond_landing_pages_only, by_rank
+    ]
+    stage_runner.add_stage(
+        Stage(STAGE_UPDATE_FILTER_LIST,
+              _update_filter_list,
+              input_paths=[args.sites_csv],
+              params=collect_data_params +
+              [args.chrome_adblockplus_ext_abs_path],
+              enabled=not skip_data_collection))
+
+    def _collect_data():
+        # then collect the data
+        collect_data(args.sites_csv,
+                     main_output_directory,
+                     crawler_group_name,
+                     start_index=args.start_index,
+                     end_index=args.end_index,
+                     anticv_on=anticv_on,
+                     csv_delimiter=args.sites_csv_delimiter,
+                     use_dynamic_profile=use_dynamic_profile,
+                     trials=args.trials,
+                     beyond_landing_pages=beyond_landing_pages,
+                     beyond_landing_pages_only=beyond_landing_pages_only,
+                     by_rank=by_rank,
+                     max_browsers=args.max_browsers,
+                     driver_pool_max_trials=args.driver_pool_max_trials,
+                     settle_quiet_window=args.settle_quiet_window,
+                     stream_output=stream_output,
+                     stream_output_port=args.stream_output_port,
+                     chrome_driver_path=args.chrome_driver_path,
+                     chrome_ext_path=args.chrome_adblockplus_ext_abs_path)
+
+    # the crawl data is moved out of the downloads directory, so the crawl has no
+    # outputs to check: it is only redone when its arguments change
+    stage_runner.add_stage(
+        Stage(STAGE_COLLECT_DATA,
+              _collect_data,
+              depends_on=[STAGE_UPDATE_FILTER_LIST],
+              input_paths=[args.sites_csv],
+              params=collect_data_params,
+              enabled=not skip_data_collection))
+
+    def _move_data_collected():
+        # Move the data to the right output directory
+        move_data_collected_to_output(downloads_dir, crawler_group_name,
+                                      crawl_data_output__webrequests_control,
+                                      crawl_data_output__webrequests_variant,
+                                      crawl_data_output__dom_control,
+                                      crawl_data_output__dom_variant,
+                                      logger)
+
+    # cheap, so always run: its outputs (the crawl data) decide what runs after it
+    stage_runner.add_stage(
+        Stage(STAGE_MOVE_DATA,
+              _move_data_collected,
+              depends_on=[STAGE_COLLECT_DATA],
+              output_paths=lambda: get_crawl_data_directories(
+                  main_output_directory, crawler_group_name),
+              always_run=True))
+
+    def _create_groups():
+        # Create group trials csv
+        groups_file_path = process_group_trails(main_output_directory,
+                                                groups_file_name,
+                                                crawler_group_name,
+                                                logger,
+                                                trials=args.trials)
+        logger.debug("Created group files %s", groups_file_path)
+        return groups_file_path
+
+    def get_groups_file_path():
+        return stage_runner.get_result(STAGE_GROUPS)
+
+    stage_runner.add_stage(
+        Stage(STAGE_GROUPS,
+              _create_groups,
+              depends_on=[STAGE_MOVE_DATA],
+              output_paths=lambda: [get_groups_file_path()],
+              params=[args.trials]))
+
+    def _transfer_data():
+        # Transfer data to DB
+        transfer_prep(main_output_directory, crawler_group_name, logger)
+
+    stage_runner.add_stage(
+        Stage(STAGE_MIGRATE,
+              _transfer_data,
+              depends_on=[STAGE_MOVE_DATA],
+              output_fingerprints={
+                  "mongo":
+                  lambda: get_crawl_group_fingerprint(MIGRATE_COLLECTIONS)
+              }))
+
+    def _diff_groups():
+        # Create Diff Groups
+        diff_groups(args.mongodb_client,
+                    args.mongodb_port,
+                    crawler_group_name,
+                    get_groups_file_path(),
+                    logger,
+                    mongodb_username=args.mongodb_username,
+                    mongodb_password=args.mongodb_password)
+
+    stage_runner.add_stage(
+        Stage(STAGE_DIFF_GROUPS,
+              _diff_groups,
+              depends_on=[STAGE_GROUPS, STAGE_MIGRATE],
+              output_fingerprints={
+                  "mongo":
+                  lambda: get_crawl_group_fingerprint(DIFF_GROUP_COLLECTIONS)
+              }))
+
+    def _create_time_series():
+        create_time_series_csvs(get_groups_file_path(),
+                                ts_output_directory,
+                                None,
+                                trials=args.trials,
+                                export_csv=export_time_series_csv)
+        logger.info("Created timeseries " + ts_file_mapping_file_path)
+
+    # only needs the groups csv, so it runs next to migrate/diff/urls
+    stage_runner.add_stage(
+        Stage(STAGE_TIME_SERIES,
+              _create_time_series,
+              depends_on=[STAGE_GROUPS],
+              output_paths=[ts_output_directory],
+              params=[args.trials, export_time_series_csv]))
+
+    def _write_urls():
+        # Get variant urls (this grabs all outgoing URLs that will happen in variant side only)
+        write_urls_txt(crawler_group_name,
+                       args.mongodb_client,
+                       args.mongodb_port,
+                       ground_truth_file_path=args.ground_truth_file,
+                       csv_file_name=variant_urls_output_file_name,
+                       output_directory=main_output_directory,
+                       ground_truth_only=False,
+                       trial_count=args.trials)
+        logger.debug("Got variant URLS %s", variant_urls_output_file_name)
+
+    stage_runner.add_stage(
+        Stage(STAGE_URLS,
+              _write_urls,
+              depends_on=[STAGE_DIFF_GROUPS],
+              input_paths=ground_truth_paths,
+              output_paths=[variant_urls_file_path],
+              params=[args.trials]))
+
+    def _write_tracking_urls():
+        # Match the variant urls against the filter lists to identify the tracking urls
+        write_tracking_urls_txt(args.filter_list_paths,
+                                variant_urls_file_path,
+                                variant_tracking_file_path,
+                                filter_list_snapshot_directory=args.filter_list_snapshot_directory)
+        logger.debug("Got tracking URLS %s", variant_tracking_file_path)
+
+    stage_runner.add_stage(
+        Stage(STAGE_TRACKING_URLS,
+              _write_tracking_urls,
+              depends_on=[STAGE_URLS],
+              input_paths=args.filter_list_paths.split(","),
+              output_paths=[variant_tracking_file_path]))
+
+    def _write_features():
+        # Feature extraction (this is for unlabeled data for monitoring)
+        # Features File Path (a csv, or a feature store directory)
+        features_file_path = write_feature_csv(crawler_group_name,
+                                               args.mongodb_client,
+                                               args.mongodb_port,
+                                               variant_tracking_file_path,
+                                               ground_truth_file_path=args.ground_truth_file,
+                                               csv_file_name=features_file_name,
+                                               output_directory=main_output_directory,
+                                               ground_truth_only=False,
+                                               time_series_mapping=ts_file_mapping_file_path,
+                                               include_control=False,
+                                               output_external_logs=args.output_external_logs,
+                                               trials=args.trials,
+                                               feature_store=feature_store,
+                                               remove_tracking_urls=remove_tracking_urls)
+        logger.debug("Got features %s", features_file_path)
+        return features_file_path
+
+    stage_runner.add_stage(
+        Stage(STAGE_FEATURES,
+              _write_features,
+              depends_on=[STAGE_TRACKING_URLS, STAGE_TIME_SERIES],
+              input_paths=ground_truth_paths,
+              output_paths=lambda: [stage_runner.get_result(STAGE_FEATURES)],
+              params=[
+                  args.trials, feature_store, args.output_external_logs,
+                  remove_tracking_urls
+              ]))
+
+    test_features_only = get_test_features_from_file(
+        args.classifier_features_file_path)
+
+    def _clean_features():
+        # Clean features for unlabeled data
+        result_files = _clean_scale_data_for_labeling(
+            stage_runner.get_result(STAGE_FEATURES),
+            args.output_suffix,
+            main_output_directory,
+            BOOLEAN_FEATURES,
+            test_features_only=test_features_only,
+            ignore_labels=True)
+        logger.debug("Cleaned features")
+        return result_files[RAW_UNLABEL_FILE_KEY]
+
+    stage_runner.add_stage(
+        Stage(STAGE_CLEAN_FEATURES,
+              _clean_features,
+              depends_on=[STAGE_FEATURES],
+              input_paths=[args.classifier_features_file_path],
+              output_paths=lambda: [stage_runner.get_result(STAGE_CLEAN_FEATURES)],
+              params=[args.output_suffix]))
+
+    def _label():
+        # Label the file using classifier
+        label_dataset_from_saved_clf(stage_runner.get_result(STAGE_CLEAN_FEATURES),
+                                     args.classifier_path,
+                                     labeled_file_name,
+                                     main_output_directory,
+                                     threshold=threshold,
+                                     test_features_only=test_features_only)
+
+    stage_runner.add_stage(
+        Stage(STAGE_LABEL,
+              _label,
+              depends_on=[STAGE_CLEAN_FEATURES],
+              input_paths=[args.classifier_path],
+              output_paths=[labeled_file_path],
+              params=[threshold]))
+
+    # set before the feature stage forks its workers
+    set_dom_diff_two_pass_min_bytes(args.dom_diff_two_pass_min_mb * 1024 *
+                                    1024)
+
+    if wr_diff_cache:
+        # enabled before the url and feature stages fork their workers
+        enable_wr_diff_cache(main_output_directory + os.sep + "wr_diff_cache_" +
+                             crawler_group_name)
+
+    stage_runner.run()
+
+    logger.info("Trial cache stats: %s", str(get_trial_cache_stats()))
+    logger.info("Url parts cache stats: %s", str(get_url_parts_cache_stats()))
+    logger.info("Page source cache stats: %s",
+                str(get_page_source_cache_stats()))
+    logger.info("Webrequest diff cache stats: %s",
+                str(get_wr_diff_cache_stats()))
+    disable_url_parts_disk_memo()
+    disable_wr_diff_cache()
+    close_shared_mongo_clients()
 
     # DONE
     logger.info("DONE - Labeled file for %s located at %s",
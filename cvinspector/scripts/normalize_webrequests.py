@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import os
+import sys
+
+from cvinspector.common.utils import WEBREQUESTS_DATA_FILE_SUFFIX_CONTROL, WEBREQUESTS_DATA_FILE_SUFFIX_VARIANT, \
+    normalize_webrequests_json_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Upgrade webrequests json files written by older extensions (details as JSON strings) to the current schema, in place'
+    )
+
+    # REQUIRED
+    parser.add_argument('--input_path',
+                        required=True,
+                        help='Webrequests json file or directory of them (walked recursively)')
+
+    args = parser.parse_args()
+    print(args)
+
+    file_paths = []
+    if os.path.isfile(args.input_path):
+        file_paths.append(args.input_path)
+    else:
+        for root, _, files in os.walk(args.input_path):
+            for file_name in files:
+                if file_name.endswith(WEBREQUESTS_DATA_FILE_SUFFIX_CONTROL) or \
+                        file_name.endswith(WEBREQUESTS_DATA_FILE_SUFFIX_VARIANT):
+                    file_paths.append(root + os.sep + file_name)
+
+    normalized_count = 0
+    for file_path in file_paths:
+        try:
+            if normalize_webrequests_json_file(file_path):
+                normalized_count += 1
+        except ValueError as e:
+            print("Could not normalize " + file_path)
+            print(e)
+
+    print("Normalized %d of %d files" % (normalized_count, len(file_paths)))
+    print("DONE")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
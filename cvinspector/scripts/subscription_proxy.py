@@ -15,19 +15,50 @@
 
 import argparse
 import os
+import threading
 
 import requests
 from flask import Flask, request, Response
 
+from cvinspector.common.filter_list_snapshot import load_filter_list_snapshot
+
 app = Flask(__name__)
 SITE_NAME = 'https://easylist-downloads.adblockplus.org/'
 excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
 FILTER_LIST_DIR = ""
+# when set, the lists are loaded (and hash checked) from their snapshots
+FILTER_LIST_SNAPSHOT_DIR = None
+FILTER_LIST_NAMES = ['easylist.txt', 'abp-filters-anti-cv.txt']
+
+# filter list path --> (mtime_ns, size, content bytes), reloaded only when the file changes
+_FILTER_LIST_CONTENT = dict()
+_FILTER_LIST_CONTENT_LOCK = threading.Lock()
 
 
 # To get the frozen filter lists, use :
 # https://easylist-downloads.adblockplus.org/easylist.txt?addonName=adblockpluschrome&addonVersion=3.7&application=chrome&applicationVersion=78&platform=chromium&platformVersion=78&lastVersion=0&downloadCount=0
 
+def _load_filter_list(filter_list_path):
+    if FILTER_LIST_SNAPSHOT_DIR:
+        return load_filter_list_snapshot(filter_list_path, snapshot_directory=FILTER_LIST_SNAPSHOT_DIR).get_text_bytes()
+    with open(filter_list_path, 'rb') as filter_list_file:
+        return filter_list_file.read()
+
+
+def read_filter_list(filter_list_path):
+    # only a stat per request, the content is loaded again when the filter list changes
+    file_stat = os.stat(filter_list_path)
+    with _FILTER_LIST_CONTENT_LOCK:
+        cached = _FILTER_LIST_CONTENT.get(filter_list_path)
+        if cached is not None and cached[:2] == (file_stat.st_mtime_ns, file_stat.st_size):
+            return cached[2]
+
+        print("loading filter list " + filter_list_path)
+        content = _load_filter_list(filter_list_path)
+        _FILTER_LIST_CONTENT[filter_list_path] = (file_stat.st_mtime_ns, file_stat.st_size, content)
+        return content
+
+
 @app.route('/')
 def index():
     return 'Flask is running!'
@@ -46,10 +77,10 @@ def proxy(path):
         content = None
         if "easylist" in path:
             print("reading content from local easylist.txt")
-            content = open(FILTER_LIST_DIR + os.sep + 'easylist.txt', 'r').read()
+            content = read_filter_list(FILTER_LIST_DIR + os.sep + 'easylist.txt')
         else:
             print("reading content from local abp-filters-anti-cv.txt")
-            content = open(FILTER_LIST_DIR + os.sep + 'abp-filters-anti-cv.txt', 'r').read()
+            content = read_filter_list(FILTER_LIST_DIR + os.sep + 'abp-filters-anti-cv.txt')
         # print(content)
 
         headers = [(name, value) for (name, value) in resp.raw.headers.items() if name.lower() not in excluded_headers]
@@ -65,12 +96,20 @@ def main():
     parser.add_argument('--filter_list_directory',
                         required=True,
                         help='path to find the filter list easylist and anti-cv list')
+    parser.add_argument('--filter_list_snapshot_directory',
+                        help='Optional directory to keep compiled snapshots of the filter lists in. Default=None (read the filter lists as text)')
 
     args = parser.parse_args()
     print(args)
 
     global FILTER_LIST_DIR
     FILTER_LIST_DIR = args.filter_list_directory
+    global FILTER_LIST_SNAPSHOT_DIR
+    FILTER_LIST_SNAPSHOT_DIR = args.filter_list_snapshot_directory
+
+    # load (and check) the lists once before serving
+    for filter_list_name in FILTER_LIST_NAMES:
+        read_filter_list(FILTER_LIST_DIR + os.sep + filter_list_name)
 
     app.run(debug=True, port=5000)
 
@@ -17,15 +17,19 @@ setup(name='cv-inspector',
           'textdistance',
           'bs4',
           'scikit-learn>=0.23.1, <0.24',
-          'Naked',
           'flask'
       ],
+    extras_require={
+          'feature_store': ['pyarrow']
+      },
     entry_points={'console_scripts': [
         'cvinspector_monitor = cvinspector.scripts.cvinspector_monitor:main',
         'cvinspector_buildextensions = cvinspector.scripts.build_chrome_extensions:main',
         'cvinspector_abp_proxy = cvinspector.scripts.subscription_proxy:main',
         'cvinspector_check_chrome_profile = cvinspector.scripts.check_chrome_profile:main',
-        'cvinspector_create_chrome_profiles = cvinspector.scripts.create_chrome_profiles:main'
+        'cvinspector_create_chrome_profiles = cvinspector.scripts.create_chrome_profiles:main',
+        'cvinspector_normalize_webrequests = cvinspector.scripts.normalize_webrequests:main',
+        'cvinspector_build_filter_list_snapshots = cvinspector.scripts.build_filter_list_snapshots:main'
 
     ]}
 )
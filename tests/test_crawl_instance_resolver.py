@@ -0,0 +1,117 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import cvinspector.diff_analysis.utils as resolver_utils
+from cvinspector.common.utils import CONTROL, VARIANT
+from cvinspector.diff_analysis.utils import CrawlInstanceResolver, create_trial_group
+
+CRAWL_GROUP_NAME = "test_group"
+
+
+class CountingCollection:
+    # counts the queries sent to a mongomock collection
+    def __init__(self, collection):
+        self.collection = collection
+        self.full_name = collection.full_name
+        self.find_count = 0
+
+    def find(self, *args, **kwargs):
+        self.find_count += 1
+        return self.collection.find(*args, **kwargs)
+
+    def insert_one(self, doc):
+        return self.collection.insert_one(doc)
+
+
+@pytest.fixture
+def crawl_collection():
+    collection = mongomock.MongoClient().db.crawl_instances
+    counting = CountingCollection(collection)
+    for index in range(80):
+        counting.insert_one({
+            "crawl_group_name": CRAWL_GROUP_NAME,
+            "file_name": "file_%d" % index
+        })
+    return counting
+
+
+def _diff_groups(crawl_collection, count):
+    ids = [doc["_id"] for doc in crawl_collection.collection.find()]
+    groups = []
+    for index in range(count):
+        group_ids = ids[index * 8:(index + 1) * 8]
+        groups.append({
+            "url": "site%d.com" % index,
+            CONTROL + "_crawl_instance_ids": group_ids[:4],
+            VARIANT + "_crawl_instance_ids": group_ids[4:]
+        })
+    return groups
+
+
+def test_prefetched_diff_groups_take_one_query(crawl_collection):
+    diff_groups = _diff_groups(crawl_collection, 10)
+    resolver = CrawlInstanceResolver(crawl_collection)
+    mongo_ids = []
+    for diff_group in diff_groups:
+        mongo_ids += diff_group[CONTROL + "_crawl_instance_ids"]
+        mongo_ids += diff_group[VARIANT + "_crawl_instance_ids"]
+    resolver.prefetch_ids(mongo_ids)
+
+    for diff_group in diff_groups:
+        trial_group = create_trial_group(diff_group, crawl_collection,
+                                         resolver=resolver)
+        assert trial_group["url"] == diff_group["url"]
+        assert trial_group[CONTROL]["0"]["_id"] == diff_group[
+            CONTROL + "_crawl_instance_ids"][0]
+        assert len(trial_group[VARIANT]) == 4
+
+    assert crawl_collection.find_count == 1
+
+
+def test_batches_in_queries(crawl_collection):
+    resolver = CrawlInstanceResolver(crawl_collection, batch_size=30)
+    resolver.prefetch_file_names(CRAWL_GROUP_NAME,
+                                 ["file_%d" % x for x in range(80)])
+    assert crawl_collection.find_count == 3
+
+    doc = resolver.get_by_file_name(CRAWL_GROUP_NAME, "file_5")
+    assert doc["file_name"] == "file_5"
+    assert resolver.get_by_id(doc["_id"]) is doc
+    assert crawl_collection.find_count == 3
+
+
+def test_miss_expires(crawl_collection, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resolver_utils.time, "monotonic", lambda: now[0])
+    resolver = CrawlInstanceResolver(crawl_collection, miss_ttl_sec=60)
+    assert resolver.get_by_file_name(CRAWL_GROUP_NAME, "late_file") is None
+
+    crawl_collection.insert_one({
+        "crawl_group_name": CRAWL_GROUP_NAME,
+        "file_name": "late_file"
+    })
+    # the miss is remembered for a while
+    assert resolver.get_by_file_name(CRAWL_GROUP_NAME, "late_file") is None
+    assert crawl_collection.find_count == 1
+
+    # then the next lookup queries again and finds it
+    now[0] += 61
+    doc = resolver.get_by_file_name(CRAWL_GROUP_NAME, "late_file")
+    assert doc["file_name"] == "late_file"
+    assert crawl_collection.find_count == 2
@@ -0,0 +1,196 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import random
+import string
+
+import pytest
+
+import cvinspector.diff_analysis.dommutation_core as dommutation_core
+from cvinspector.common.dommutation_utils import NODES_ADDED, NODES_REMOVED, ATTRIBUTE_CHANGED, TEXT_CHANGED
+from cvinspector.common.utils import ABP_BLOCKED_ELEMENT, ABP_BLOCKED_SNIPPET, CONTROL, VARIANT, \
+    JSON_DOMMUTATION_KEY
+from cvinspector.diff_analysis.dommutation_core import DOM_DIFF_CATEGORIES, get_dom_differences_only
+
+TAGS = ["DIV", "SPAN", "IFRAME", "IMG", "A", "P", "INS"]
+
+
+def _random_string(rand, length):
+    return "".join(
+        rand.choice(string.ascii_lowercase + string.digits)
+        for _ in range(length))
+
+
+def _selector(rand):
+    parts = []
+    for _ in range(rand.randint(1, 3)):
+        tag = rand.choice(TAGS)
+        if rand.random() < 0.5:
+            tag += "." + _random_string(rand, rand.randint(3, 6))
+        parts.append(tag)
+    return " > ".join(parts)
+
+
+def _node_info(rand):
+    tag = rand.choice(TAGS)
+    attributes = [[
+        rand.choice(["class", "style", "src", "href", "width"]),
+        _random_string(rand, rand.randint(0, 20))
+    ] for _ in range(rand.randint(0, 3))]
+    return {
+        "id": "",
+        "NoChildNodes": rand.randint(0, 3),
+        "NodeType": 3 if rand.random() < 0.2 else 1,
+        "NodeValue": _random_string(rand, 8) if rand.random() < 0.3 else None,
+        "nodeName": tag,
+        "localName": tag.lower(),
+        "parentNode": rand.choice(["div", "body", ""]),
+        "NodesAttributes": attributes
+    }
+
+
+def _event_template(rand):
+    kind = rand.random()
+    if kind < 0.45:
+        node_count = rand.randint(1, 3)
+        nodes = []
+        for _ in range(node_count):
+            node_selector = _selector(rand)
+            if rand.random() < 0.05:
+                node_selector += "." + ABP_BLOCKED_SNIPPET
+            nodes.append({"selector": node_selector, "nodeId": 2})
+        return {
+            "type": rand.choice([NODES_ADDED, NODES_REMOVED]),
+            "target": {"selector": _selector(rand), "nodeId": 1},
+            "nodes": nodes,
+            "nodeInfo": [[_node_info(rand)] for _ in range(node_count)]
+        }
+    if kind < 0.85:
+        attribute = rand.choice(
+            ["class", "style", "src", "hidden", "d", ABP_BLOCKED_ELEMENT])
+        return {
+            "type": ATTRIBUTE_CHANGED,
+            "target": {"selector": _selector(rand), "nodeId": 3},
+            "targetType": rand.choice(TAGS),
+            "parentNode": "div",
+            "attribute": attribute,
+            "oldValue": _random_string(rand, 6) if rand.random() < 0.7 else None,
+            "newValue": _random_string(rand, 10),
+            "recd": [_node_info(rand)]
+        }
+    return {
+        "type": TEXT_CHANGED,
+        "target": {"selector": _selector(rand) + " > (text)", "nodeId": 4},
+        "newValue": " ".join(
+            _random_string(rand, 4) for _ in range(rand.randint(0, 4))),
+        "oldValue": _random_string(rand, 6) if rand.random() < 0.5 else None
+    }
+
+
+def _write_trial(file_path, rand, templates, event_count):
+    # trials draw from shared templates, so keys repeat within and across trials
+    events = []
+    for index in range(event_count):
+        if rand.random() < 0.1:
+            event_item = _event_template(rand)
+        else:
+            event_item = rand.choice(templates)
+        events.append({
+            "type": "event",
+            "event": event_item,
+            "time": 1586327346839 + index
+        })
+    with open(file_path, "w") as trial_file:
+        json.dump({"url": "https://site.com", JSON_DOMMUTATION_KEY: events},
+                  trial_file)
+
+
+def _make_trial_group(directory, seed, trials=3, event_count=300):
+    rand = random.Random(seed)
+    templates = [_event_template(rand) for _ in range(40)]
+    crawl_trial_group = {"url": "https://site.com", CONTROL: dict(),
+                         VARIANT: dict()}
+    for crawl_type in [CONTROL, VARIANT]:
+        for trial_index in range(trials):
+            file_path = str(directory / ("%s_%d.json" %
+                                         (crawl_type, trial_index)))
+            _write_trial(file_path, rand, templates,
+                         rand.randint(event_count // 2, event_count))
+            crawl_trial_group[crawl_type][str(trial_index)] = {
+                "_id": "%s-%d" % (crawl_type, trial_index),
+                "url": "https://site.com",
+                "file_path": file_path
+            }
+    return crawl_trial_group
+
+
+@pytest.fixture
+def trial_group(tmp_path, monkeypatch):
+    crawl_trial_group = _make_trial_group(tmp_path, 0)
+    monkeypatch.setattr(dommutation_core, "create_trial_group",
+                        lambda diff_group, crawl_collection: crawl_trial_group)
+    return crawl_trial_group
+
+
+def _diff(two_pass=None):
+    return get_dom_differences_only({"url": "https://site.com"},
+                                    "crawl",
+                                    None,
+                                    None,
+                                    output_external_logs=False,
+                                    two_pass=two_pass)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_two_pass_matches_single_pass(tmp_path, monkeypatch, seed):
+    crawl_trial_group = _make_trial_group(tmp_path, seed)
+    monkeypatch.setattr(dommutation_core, "create_trial_group",
+                        lambda diff_group, crawl_collection: crawl_trial_group)
+
+    single_pass = _diff(two_pass=False)
+    assert _diff(two_pass=True) == single_pass
+
+    control_row, variant_row = single_pass
+    # the synthetic trials exercise the categories and the blocked events
+    for category in DOM_DIFF_CATEGORIES:
+        assert control_row[category] or variant_row[category]
+    assert variant_row["blocked_events"]
+
+
+def test_small_diff_group_uses_single_pass(trial_group, monkeypatch):
+    two_pass_calls = []
+    get_remaining_dom_events = dommutation_core._get_remaining_dom_events
+
+    def _counting_get_remaining_dom_events(*args):
+        two_pass_calls.append(args)
+        return get_remaining_dom_events(*args)
+
+    monkeypatch.setattr(dommutation_core, "_get_remaining_dom_events",
+                        _counting_get_remaining_dom_events)
+    single_pass = _diff()
+    assert not two_pass_calls
+
+    # above the threshold (0: always) the same diff comes from two passes
+    monkeypatch.setattr(dommutation_core, "DOM_DIFF_TWO_PASS_MIN_BYTES", 0)
+    assert _diff() == single_pass
+    assert len(two_pass_calls) == 2
+
+
+def test_set_two_pass_min_bytes(monkeypatch):
+    monkeypatch.setattr(dommutation_core, "DOM_DIFF_TWO_PASS_MIN_BYTES",
+                        dommutation_core.DOM_DIFF_TWO_PASS_MIN_BYTES)
+    dommutation_core.set_dom_diff_two_pass_min_bytes(1024)
+    assert dommutation_core.DOM_DIFF_TWO_PASS_MIN_BYTES == 1024
@@ -0,0 +1,315 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import copy
+import itertools
+import random
+import string
+import time
+import tracemalloc
+
+import pytest
+
+from cvinspector.common.dommutation_utils import ATTRIBUTE_CHANGED, NODES_ADDED, NODES_REMOVED, TEXT_CHANGED, \
+    DomMutationKeyBuilder, get_attribute_changed_key, get_nodes_added_key, get_nodes_removed_key, \
+    get_text_changed_key
+from cvinspector.common.utils import ABP_BLOCKED_ELEMENT, ABP_BLOCKED_SNIPPET
+
+TAGS = ["DIV", "SPAN", "IFRAME", "IMG", "A", "P", "INS", "svg", "path"]
+ATTRIBUTES = [
+    "class", "style", "src", "href", "width", "id", "d", "x", "data-id",
+    "data-src", "transform", ABP_BLOCKED_ELEMENT
+]
+STYLES = [
+    "display: none", "width: 300px; height: 250px", "opacity:0; top: 1px",
+    "background-image: url(a;b.png); color: red", "", "transform: scale(1.5)"
+]
+
+NODE_KEY_OPTIONS = list(
+    itertools.product([False, True], [True, False], [50, 5]))
+ATTRIBUTE_KEY_OPTIONS = [
+    dict(),
+    dict(use_attribute_values=True),
+    dict(use_target_selector=False),
+    dict(use_compare_values=True),
+    dict(use_compare_values=True, truncate_length=4, NODE_ATTR_VAL_THRESHOLD=5),
+]
+TEXT_KEY_OPTIONS = [dict(), dict(truncate_length=3)]
+
+
+def _random_string(rand, length):
+    return "".join(
+        rand.choice(string.ascii_letters + string.digits + "-_ ")
+        for _ in range(length))
+
+
+def _selector(rand):
+    parts = []
+    for _ in range(rand.randint(1, 4)):
+        tag = rand.choice(TAGS)
+        if rand.random() < 0.4:
+            tag += "." + _random_string(rand, rand.randint(2, 8)).strip()
+        if rand.random() < 0.1:
+            tag += ":nth-child(%d)" % rand.randint(1, 9)
+        parts.append(tag)
+    return " > ".join(parts)
+
+
+def _attribute_value(rand, attribute):
+    if attribute == "style":
+        return rand.choice(STYLES)
+    if attribute in ["width", "x", "d"]:
+        return rand.choice(["300", "1.5", "0,1.25", "M0 0L1 1", ""])
+    return _random_string(rand, rand.randint(0, 80))
+
+
+def _node_info(rand):
+    tag = rand.choice(TAGS)
+    attributes = []
+    for _ in range(rand.randint(0, 4)):
+        attribute = rand.choice(ATTRIBUTES)
+        attributes.append([attribute, _attribute_value(rand, attribute)])
+    if rand.random() < 0.05:
+        attributes.append(["doctype", "<!doctype html>"])
+    node_info = {
+        "id": "",
+        "NoChildNodes": rand.randint(0, 3),
+        "NodeType": 3 if rand.random() < 0.2 else 1,
+        "NodeValue": _random_string(rand, 8) if rand.random() < 0.3 else None,
+        "nodeName": tag,
+        "localName": tag.lower(),
+        "parentNode": rand.choice(["div", "body", "", "DIV.x > SPAN", None]),
+        "NodesAttributes": attributes
+    }
+    if rand.random() < 0.1:
+        del node_info["NodesAttributes"]
+    return node_info
+
+
+def _node_event(rand):
+    node_count = rand.randint(0, 3)
+    nodes = []
+    for _ in range(node_count):
+        node_selector = _selector(rand) if rand.random() < 0.95 else ""
+        if rand.random() < 0.1:
+            node_selector += "." + ABP_BLOCKED_SNIPPET
+        nodes.append({"selector": node_selector, "nodeId": 2})
+    node_info = [[_node_info(rand)] if rand.random() < 0.9 else []
+                 for _ in range(node_count)]
+    if rand.random() < 0.1:
+        # fewer nodeInfo entries than nodes
+        node_info = node_info[:-1]
+    event = {
+        "type": rand.choice([NODES_ADDED, NODES_REMOVED]),
+        "target": {"selector": _selector(rand), "nodeId": 1},
+        "nodes": nodes,
+        "nodeInfo": node_info
+    }
+    if rand.random() < 0.05:
+        del event["nodeInfo"]
+    return event
+
+
+def _attribute_event(rand):
+    attribute = rand.choice(ATTRIBUTES)
+    return {
+        "type": ATTRIBUTE_CHANGED,
+        "target": {"selector": _selector(rand), "nodeId": 3},
+        "targetType": rand.choice(TAGS),
+        "parentNode": "div",
+        "attribute": attribute,
+        "oldValue": _attribute_value(rand, attribute)
+        if rand.random() < 0.7 else None,
+        "newValue": _attribute_value(rand, attribute)
+        if rand.random() < 0.9 else None,
+        "recd": [_node_info(rand)] if rand.random() < 0.9 else []
+    }
+
+
+def _text_event(rand):
+    return {
+        "type": TEXT_CHANGED,
+        "target": {"selector": _selector(rand) + " > (text)", "nodeId": 4},
+        "newValue": " ".join(
+            _random_string(rand, 4) for _ in range(rand.randint(0, 4)))
+        if rand.random() < 0.9 else None,
+        "oldValue": _random_string(rand, 20) if rand.random() < 0.5 else None
+    }
+
+
+def _make_event_stream(seed, count, template_count=200, drift=0.05):
+    # mutation streams repeat the same changes, with some new ones
+    rand = random.Random(seed)
+    makers = [_node_event, _node_event, _attribute_event, _text_event]
+    templates = [rand.choice(makers)(rand) for _ in range(template_count)]
+    events = []
+    for _ in range(count):
+        if rand.random() < drift:
+            events.append(rand.choice(makers)(rand))
+        else:
+            # a copy, like a re-parsed trial: equal, but not the same objects
+            events.append(copy.deepcopy(rand.choice(templates)))
+    return events
+
+
+def _module_keys(event, node_options, attribute_options, text_options):
+    if event["type"] == NODES_ADDED:
+        use_attribute_values, use_target_selector, threshold = node_options
+        return get_nodes_added_key(event,
+                                   use_attribute_values=use_attribute_values,
+                                   use_target_selector=use_target_selector,
+                                   NODE_ATTR_VAL_THRESHOLD=threshold)
+    if event["type"] == NODES_REMOVED:
+        use_attribute_values, use_target_selector, _ = node_options
+        return get_nodes_removed_key(event,
+                                     use_attribute_values=use_attribute_values,
+                                     use_target_selector=use_target_selector)
+    if event["type"] == ATTRIBUTE_CHANGED:
+        return get_attribute_changed_key(event, **attribute_options)
+    return get_text_changed_key(event, **text_options)
+
+
+def _builder_keys(key_builder, event, node_options, attribute_options,
+                  text_options):
+    if event["type"] == NODES_ADDED:
+        use_attribute_values, use_target_selector, threshold = node_options
+        return key_builder.get_nodes_added_key(
+            event,
+            use_attribute_values=use_attribute_values,
+            use_target_selector=use_target_selector,
+            NODE_ATTR_VAL_THRESHOLD=threshold)
+    if event["type"] == NODES_REMOVED:
+        use_attribute_values, use_target_selector, _ = node_options
+        return key_builder.get_nodes_removed_key(
+            event,
+            use_attribute_values=use_attribute_values,
+            use_target_selector=use_target_selector)
+    if event["type"] == ATTRIBUTE_CHANGED:
+        return key_builder.get_attribute_changed_key(event, **attribute_options)
+    return key_builder.get_text_changed_key(event, **text_options)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_builder_keys_match_module_functions(seed):
+    events = _make_event_stream(seed, 1500)
+    for index, node_options in enumerate(NODE_KEY_OPTIONS):
+        attribute_options = ATTRIBUTE_KEY_OPTIONS[index %
+                                                  len(ATTRIBUTE_KEY_OPTIONS)]
+        text_options = TEXT_KEY_OPTIONS[index % len(TEXT_KEY_OPTIONS)]
+        # one builder per diff group, used with the same options for the group
+        key_builder = DomMutationKeyBuilder()
+        for event in events:
+            assert _builder_keys(key_builder, event, node_options,
+                                 attribute_options,
+                                 text_options) == _module_keys(
+                                     event, node_options, attribute_options,
+                                     text_options), event
+        # the repeated nodes came from the cache
+        assert key_builder.node_key_hits > key_builder.node_key_misses
+
+
+def test_builder_options_do_not_share_cached_keys():
+    events = [event for event in _make_event_stream(4, 500)
+              if event["type"] == NODES_ADDED]
+    key_builder = DomMutationKeyBuilder()
+    for event in events:
+        for use_attribute_values, use_target_selector, threshold in NODE_KEY_OPTIONS:
+            assert key_builder.get_nodes_added_key(
+                event,
+                use_attribute_values=use_attribute_values,
+                use_target_selector=use_target_selector,
+                NODE_ATTR_VAL_THRESHOLD=threshold) == get_nodes_added_key(
+                    event,
+                    use_attribute_values=use_attribute_values,
+                    use_target_selector=use_target_selector,
+                    NODE_ATTR_VAL_THRESHOLD=threshold)
+
+
+def test_builder_interns_keys():
+    events = _make_event_stream(5, 1000)
+    key_builder = DomMutationKeyBuilder()
+    keys = dict()
+    for event in events:
+        if event["type"] in [NODES_ADDED, NODES_REMOVED]:
+            event_keys = [result[0] for result in key_builder.get_nodes_added_key(event)]
+        elif event["type"] == ATTRIBUTE_CHANGED:
+            event_keys = [key_builder.get_attribute_changed_key(event)[0]]
+        else:
+            event_keys = [key_builder.get_text_changed_key(event)[0]]
+        for key in event_keys:
+            # equal keys are one string object
+            assert keys.setdefault(key, key) is key
+
+
+def test_builder_handles_unhashable_node_info():
+    node_info = _node_info(random.Random(6))
+    # values the extension should not send, the key is still built, just not cached
+    node_info["NodesAttributes"] = [["class", ["not", "a", "string"]]]
+    event = {
+        "type": NODES_ADDED,
+        "target": {"selector": "DIV.a > SPAN", "nodeId": 1},
+        "nodes": [{"selector": "IMG", "nodeId": 2}],
+        "nodeInfo": [[node_info]]
+    }
+    key_builder = DomMutationKeyBuilder()
+    for _ in range(2):
+        assert key_builder.get_nodes_added_key(event) == get_nodes_added_key(
+            event)
+    assert key_builder.node_key_hits == 0
+
+
+def _collect_keys(events, get_keys):
+    # like a diff group: every key of every event is kept until the diff is done
+    collected = []
+    for event in events:
+        collected.append(get_keys(event))
+    return collected
+
+
+@pytest.mark.benchmark
+def test_benchmark_key_builder_before_after():
+    events = _make_event_stream(100000,
+                                100000,
+                                template_count=5000,
+                                drift=0.05)
+    options = (NODE_KEY_OPTIONS[0], ATTRIBUTE_KEY_OPTIONS[0],
+               TEXT_KEY_OPTIONS[0])
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    module_keys = _collect_keys(events,
+                                lambda event: _module_keys(event, *options))
+    module_seconds = time.perf_counter() - start
+    module_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    key_builder = DomMutationKeyBuilder()
+    tracemalloc.start()
+    start = time.perf_counter()
+    builder_keys = _collect_keys(
+        events, lambda event: _builder_keys(key_builder, event, *options))
+    builder_seconds = time.perf_counter() - start
+    builder_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("\nkeys of %d dom mutation events: before %.2fs (%.0f events/s) %.1fMB, "
+          "after %.2fs (%.0f events/s) %.1fMB, node key cache hits %d misses %d"
+          % (len(events), module_seconds, len(events) / module_seconds,
+             module_bytes / 1024 / 1024, builder_seconds,
+             len(events) / builder_seconds, builder_bytes / 1024 / 1024,
+             key_builder.node_key_hits, key_builder.node_key_misses))
+    assert builder_keys == module_keys
+    assert builder_seconds < module_seconds
+    assert builder_bytes < module_bytes
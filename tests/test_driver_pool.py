@@ -0,0 +1,248 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+import cvinspector.data_collect.collect as collect_core
+import cvinspector.data_collect.collect_seq as collect_seq
+from cvinspector.data_collect.chrome import get_contacted_origins, reset_driver_state
+from cvinspector.data_collect.driver_pool import DriverPool
+
+# what the stub windows loaded: the site, a third-party iframe with its own resources
+# and a popup. Script requests only show up in the performance entries
+SITE_FRAME_TREE = {
+    "frame": {"url": "https://example.com/"},
+    "resources": [{"url": "https://cdn.example.net/a.js"},
+                  {"url": "data:image/png;base64,AAAA"}],
+    "childFrames": [{
+        "frame": {"url": "https://ads.tracker.com/frame.html"},
+        "resources": [{"url": "https://static.tracker.com:8443/b.js"}]
+    }]
+}
+SITE_RESOURCE_ENTRIES = [
+    "https://api.example.com/xhr", "https://cdn.example.net/a.js"
+]
+POPUP_FRAME_TREE = {"frame": {"url": "http://popup.com/landing"}}
+
+
+class StubSwitchTo:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        self.driver.current_window_handle = handle
+
+
+class StubWebDriver:
+    # stands in for a selenium WebDriver
+    def __init__(self, is_control):
+        self.is_control = is_control
+        self.current_url = "https://example.com/"
+        self.quit_count = 0
+        self.reset_count = 0
+        self.window_handles = ["site", "popup"]
+        self.current_window_handle = "site"
+        self.switch_to = StubSwitchTo(self)
+        self.cdp_commands = []
+
+    def quit(self):
+        self.quit_count += 1
+
+    def close(self):
+        self.window_handles.remove(self.current_window_handle)
+
+    def get(self, url):
+        self.current_url = url
+
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        self.cdp_commands.append((cmd, cmd_args))
+        if cmd == "Page.getResourceTree":
+            if self.current_window_handle == "site":
+                return {"frameTree": SITE_FRAME_TREE}
+            return {"frameTree": POPUP_FRAME_TREE}
+        return {}
+
+    def execute_script(self, script, *args):
+        if self.current_window_handle == "site":
+            return SITE_RESOURCE_ENTRIES
+        return []
+
+
+def stub_driver_factory(is_control, profile_path):
+    return "control" if is_control else "variant", StubWebDriver(is_control)
+
+
+def stub_reset(driver_name, driver, origins=None):
+    driver.reset_count += 1
+
+
+def create_pool(**kwargs):
+    return DriverPool(stub_driver_factory, reset_func=stub_reset, **kwargs)
+
+
+def test_release_resets_and_reuses_driver():
+    pool = create_pool()
+    _, driver = pool.acquire(True)
+    pool.release(driver, origins=["example.com"])
+    _, reused = pool.acquire(True)
+
+    assert reused is driver
+    assert driver.reset_count == 1
+    assert driver.quit_count == 0
+    # control and variant drivers are never shared
+    _, variant = pool.acquire(False)
+    assert variant is not driver
+    assert pool.get_stats()["launch_count"] == 2
+    assert pool.get_stats()["reuse_count"] == 1
+
+
+def test_crashed_driver_is_recycled():
+    cleaned = []
+    pool = create_pool(profile_factory=lambda is_control: "profile",
+                       profile_cleaner=cleaned.append)
+    _, driver = pool.acquire(True)
+    pool.release(driver, crashed=True)
+
+    assert driver.quit_count == 1
+    assert cleaned == ["profile"]
+    _, new_driver = pool.acquire(True)
+    assert new_driver is not driver
+    assert pool.get_stats()["crash_count"] == 1
+
+
+def test_driver_recycled_after_max_trials():
+    pool = create_pool(max_trials_per_driver=2)
+    _, driver = pool.acquire(True)
+    pool.release(driver)
+    pool.acquire(True)
+    pool.release(driver)
+
+    assert driver.quit_count == 1
+    assert pool.get_stats()["recycle_count"] == 1
+
+
+def test_double_release_is_rejected():
+    pool = create_pool()
+    _, driver = pool.acquire(True)
+    pool.release(driver)
+    with pytest.raises(AssertionError):
+        pool.release(driver)
+
+
+class CountingPool:
+    # records how _run_measurement hands back its driver
+    def __init__(self):
+        self.releases = []
+
+    def release(self, driver, crashed=False, origins=None):
+        self.releases.append(crashed)
+        self.origins = origins
+
+
+@pytest.fixture
+def fake_collect(monkeypatch, tmp_path):
+    monkeypatch.setattr(collect_core, "_visit_domain",
+                        lambda *args, **kwargs: (False, True))
+    monkeypatch.setattr(collect_core, "_simulate_scrolling",
+                        lambda *args, **kwargs: 100)
+    monkeypatch.setattr(collect_core, "trigger_js_event_for_filename",
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(collect_core, "_save_page_source",
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(collect_core, "_save_page_source_exception",
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(collect_core, "get_screenshot_filename",
+                        lambda *args, **kwargs: str(tmp_path / "shot.png"))
+    monkeypatch.setattr(collect_core, "_force_save_data",
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(collect_seq, "set_all_hidden_imgs_iframes",
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(collect_seq, "save_screenshot_headless",
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(collect_seq.time, "sleep", lambda seconds: None)
+    return tmp_path
+
+
+def _run(driver_pool, tmp_path):
+    return collect_seq._run_measurement(StubWebDriver(True),
+                                        "control",
+                                        "example.com",
+                                        1,
+                                        str(tmp_path),
+                                        str(tmp_path),
+                                        driver_pool=driver_pool)
+
+
+def test_run_measurement_releases_once_on_success(fake_collect):
+    pool = CountingPool()
+    success = _run(pool, fake_collect)[0]
+    assert success
+    assert pool.releases == [False]
+    # every origin of the trial is handed to the reset, not only the site
+    assert set(pool.origins) >= set(get_contacted_origins(
+        StubWebDriver(True)))
+
+
+def test_run_measurement_releases_once_on_failure(fake_collect, monkeypatch):
+    def failing_force_save(*args, **kwargs):
+        raise RuntimeError("chrome went away")
+
+    monkeypatch.setattr(collect_core, "_force_save_data", failing_force_save)
+    pool = CountingPool()
+    success = _run(pool, fake_collect)[0]
+    assert not success
+    assert pool.releases == [True]
+
+
+def test_run_measurement_survives_failing_release(fake_collect):
+    class FailingPool(CountingPool):
+        def release(self, driver, crashed=False, origins=None):
+            CountingPool.release(self, driver, crashed=crashed, origins=origins)
+            raise RuntimeError("reset failed")
+
+    pool = FailingPool()
+    success = _run(pool, fake_collect)[0]
+    # the measurement itself succeeded; a failing release is not retried
+    assert success
+    assert pool.releases == [False]
+
+
+def test_get_contacted_origins():
+    driver = StubWebDriver(True)
+    assert get_contacted_origins(driver) == [
+        "http://popup.com", "https://ads.tracker.com", "https://api.example.com",
+        "https://cdn.example.net", "https://example.com",
+        "https://static.tracker.com:8443"
+    ]
+    # back on the window it started from
+    assert driver.current_window_handle == "site"
+
+
+def test_reset_clears_storage_of_every_origin():
+    driver = StubWebDriver(True)
+    origins = get_contacted_origins(driver)
+    reset_driver_state("control",
+                       driver,
+                       origins=["https://example.com/page"] + origins,
+                       include_custom_extensions=False)
+
+    cleared = [
+        cmd_args["origin"] for cmd, cmd_args in driver.cdp_commands
+        if cmd == "Storage.clearDataForOrigin"
+    ]
+    # each origin once, including the third parties
+    assert cleared == origins
+    assert driver.window_handles == ["site"]
+    assert driver.current_url == "about:blank"
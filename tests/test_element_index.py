@@ -0,0 +1,221 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import random
+
+import pytest
+import soupsieve
+from bs4 import BeautifulSoup
+
+from cvinspector.ml.element_index import ElementIndex, join_selector_compounds, split_selector_compounds
+from cvinspector.ml.feature_extraction import find_iframe_parent_structure, get_element_selector
+from cvinspector.ml.page_source_cache import PAGE_SOURCE_PARSER_BUILTIN, PAGE_SOURCE_PARSER_LXML, \
+    is_page_source_parser_available
+
+PARSERS = [
+    PAGE_SOURCE_PARSER_BUILTIN,
+    pytest.param(PAGE_SOURCE_PARSER_LXML,
+                 marks=pytest.mark.skipif(
+                     not is_page_source_parser_available(
+                         PAGE_SOURCE_PARSER_LXML),
+                     reason="lxml is not installed"))
+]
+
+TAGS = ["div", "span", "section", "ul", "li", "a", "p", "ins", "aside"]
+LEAF_TAGS = ["img", "iframe"]
+# ids and classes that need escaping in a selector
+IDS = ["main", "ad-1", "fb:like", "a.b", "1abc", "x_y", "top"]
+CLASSES = ["ad", "banner", "col-md-6", "a.b", "sm:flex", "w-1/2", "box"]
+
+# the suffixes get_corres_elements appends to the parent selectors
+IMG_SUFFIX = ' img:not([abp-blocked-element]):not([height="0"]):not([height="1"]):not([width="0"]):not([width="1"]):not([style*="display:none"]):not([style*="display: none"]):not([style*="visibility:hidden"]):not([style*="visibility: hidden"]):not([style*="opacity: 0"]):not([style*="opacity:0"])'
+IFRAME_SUFFIX = ' iframe:not([abp-blocked-element]):not([height="0"]):not([height="1"]):not([width="0"]):not([width="1"]):not([style*="display:none"]):not([style*="display: none"]):not([style*="visibility:hidden"]):not([style*="visibility: hidden"]):not([style*="opacity: 0"]):not([style*="opacity:0"])'
+
+
+def _attributes(rand):
+    attributes = []
+    if rand.random() < 0.3:
+        attributes.append('id="%s"' % rand.choice(IDS))
+    if rand.random() < 0.6:
+        attributes.append('class="%s"' % " ".join(
+            rand.sample(CLASSES, rand.randint(1, 3))))
+    if rand.random() < 0.2:
+        attributes.append('style="%s"' % rand.choice(
+            ["display: none", "width: 300px", "opacity:0", "margin: 0"]))
+    if rand.random() < 0.2:
+        attributes.append('width="%s"' % rand.choice(["0", "1", "300"]))
+    if rand.random() < 0.1:
+        attributes.append("abp-blocked-element")
+    if rand.random() < 0.2:
+        attributes.append("data-slot=\"%s\"" % rand.choice(
+            ["top", "it's", "a b", "x"]))
+    return (" " + " ".join(attributes)) if attributes else ""
+
+
+def _make_element(rand, depth):
+    if depth >= 5 or rand.random() < 0.2:
+        tag = rand.choice(LEAF_TAGS)
+        if tag == "img":
+            return '<img src="/i/%d.png"%s>' % (rand.randint(0, 9),
+                                                _attributes(rand))
+        return '<iframe src="/f/%d.html"%s></iframe>' % (rand.randint(
+            0, 9), _attributes(rand))
+    tag = rand.choice(TAGS)
+    children = "\n".join(
+        _make_element(rand, depth + 1) for _ in range(rand.randint(0, 4)))
+    return "<%s%s>\n%s\n</%s>" % (tag, _attributes(rand), children, tag)
+
+
+def _make_document(seed):
+    rand = random.Random(seed)
+    body = "\n".join(_make_element(rand, 0) for _ in range(rand.randint(3, 6)))
+    return "<html><head><title>t</title></head><body>\n%s\n</body></html>" % body
+
+
+def _compound(rand):
+    parts = []
+    if rand.random() < 0.7:
+        parts.append(rand.choice(TAGS + LEAF_TAGS + ["*"]))
+    if rand.random() < 0.3:
+        parts.append("#" + soupsieve.escape(rand.choice(IDS)))
+    for _ in range(rand.randint(0, 2)):
+        parts.append("." + soupsieve.escape(rand.choice(CLASSES)))
+    for _ in range(rand.randint(0, 2)):
+        parts.append(
+            rand.choice([
+                ":not([abp-blocked-element])", ':not([width="0"])',
+                ':not([style*="display: none"])', "[class]",
+                ":first-child", ":nth-child(2)", ':not(.%s)' %
+                soupsieve.escape(rand.choice(CLASSES)), "[data-slot*='it\\'s']"
+            ]))
+    if not parts:
+        parts.append(rand.choice(TAGS))
+    return "".join(parts)
+
+
+def _random_selector(rand):
+    compounds = [_compound(rand) for _ in range(rand.randint(1, 4))]
+    combinators = [
+        rand.choice([" ", " ", ">", ">", "+", "~"])
+        for _ in range(len(compounds) - 1)
+    ]
+    selector = join_selector_compounds(compounds, combinators)
+    if rand.random() < 0.1:
+        selector += ", " + _compound(rand)
+    if rand.random() < 0.1:
+        selector = ":not([abp-blocked-element]) " + selector
+    return selector
+
+
+def _assert_same_selection(soup, element_index, selector):
+    try:
+        expected = soup.select(selector)
+    except Exception as e:
+        with pytest.raises(type(e)):
+            element_index.select(selector)
+        return False
+    assert [id(element) for element in element_index.select(selector)
+            ] == [id(element) for element in expected], selector
+    return len(expected) > 0
+
+
+def _parse(seed, parser_name):
+    soup = BeautifulSoup(_make_document(seed), parser_name)
+    return soup, ElementIndex(soup)
+
+
+@pytest.mark.parametrize("parser_name", PARSERS)
+def test_random_selectors_match_soup_select(parser_name):
+    rand = random.Random(1)
+    matched = 0
+    for seed in range(15):
+        soup, element_index = _parse(seed, parser_name)
+        for _ in range(60):
+            matched += _assert_same_selection(soup, element_index,
+                                              _random_selector(rand))
+    # the corpus is not only selectors that match nothing
+    assert matched > 100
+
+
+@pytest.mark.parametrize("parser_name", PARSERS)
+def test_element_selectors_match_soup_select(parser_name):
+    rand = random.Random(2)
+    matched = 0
+    for seed in range(10):
+        soup, element_index = _parse(seed, parser_name)
+        elements = soup.find_all(True)
+        for element in rand.sample(elements, min(len(elements), 15)):
+            for reduce_random_attributes in [False, True]:
+                selector = get_element_selector(
+                    element, reduce_random_attributes=reduce_random_attributes)
+                matched += _assert_same_selection(soup, element_index,
+                                                  selector)
+                _assert_same_selection(soup, element_index,
+                                       selector + IMG_SUFFIX)
+    assert matched > 50
+
+
+@pytest.mark.parametrize("parser_name", PARSERS)
+def test_iframe_parent_selectors_match_soup_select(parser_name):
+    rand = random.Random(3)
+    parent_selectors = 0
+    for seed in range(8):
+        soup, element_index = _parse(seed, parser_name)
+        iframes = soup.find_all("iframe")
+        for reduce_random_attributes in [False, True]:
+            selectors = find_iframe_parent_structure(
+                iframes,
+                reduce_random_attributes=reduce_random_attributes,
+                element_index=element_index)
+            # the sibling positions of the index give the same selectors
+            assert selectors == find_iframe_parent_structure(
+                iframes, reduce_random_attributes=reduce_random_attributes)
+            for selector, _ in rand.sample(selectors, min(len(selectors),
+                                                          10)):
+                parent_selectors += 1
+                for suffix in ["", IMG_SUFFIX, IFRAME_SUFFIX]:
+                    _assert_same_selection(soup, element_index,
+                                           selector + suffix)
+    assert parent_selectors > 20
+
+
+@pytest.mark.parametrize("parser_name", PARSERS)
+def test_handwritten_selectors_match_soup_select(parser_name):
+    soup, element_index = _parse(3, parser_name)
+    for selector in [
+            "div", "#fb\\:like", "#a\\.b", "#\\31 abc", ".sm\\:flex",
+            ".w-1\\/2", "div.ad.banner", "div > span", "div span img",
+            "li + li", "li ~ iframe", "div:not(.ad):not(#main) > img",
+            "div, iframe", "ul > li:nth-child(2) img", "* > iframe",
+            ":not([abp-blocked-element]) div > iframe", "section div.box",
+            "div[data-slot*='it\\'s']", "  div   >   img  "
+    ]:
+        _assert_same_selection(soup, element_index, selector)
+
+
+def test_split_selector_compounds():
+    assert split_selector_compounds("div:not([a='x y']) > img") == ([
+        "div:not([a='x y'])", "img"
+    ], [">"])
+    assert split_selector_compounds("a  b ~ c + d") == (["a", "b", "c", "d"],
+                                                        [" ", "~", "+"])
+    assert split_selector_compounds("#fb\\:like .a\\ b") == ([
+        "#fb\\:like", ".a\\ b"
+    ], [" "])
+    # selector lists, relative and dangling combinators are left to soupsieve
+    assert split_selector_compounds("a, b") is None
+    assert split_selector_compounds("> a") is None
+    assert split_selector_compounds("a >") is None
+    assert split_selector_compounds("a > > b") is None
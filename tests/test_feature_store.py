@@ -0,0 +1,239 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import os
+import pickle
+import random
+import time
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import cvinspector.ml.output_features_to_csv as output_features_to_csv
+from cvinspector.ml.feature_constants import CHUNK_COLUMN_NAME, CRAWL_URL_COLUMN_NAME, TARGET_COLUMN_NAME
+from cvinspector.ml.feature_store import FEATURE_STORE_SUFFIX, FeatureStoreWriter, read_features
+from cvinspector.ml.labeling import label_dataset_from_saved_clf
+
+COLUMNS = [CRAWL_URL_COLUMN_NAME, "some_feature", TARGET_COLUMN_NAME]
+WIDE_FEATURES = ["f%d" % index for index in range(8)]
+
+
+def _write_store(store_path, batches):
+    writer = FeatureStoreWriter(store_path, COLUMNS)
+    for rows in batches:
+        writer.write_rows(rows)
+    return writer
+
+
+def test_store_round_trip(tmp_path):
+    store_path = str(tmp_path / ("features" + FEATURE_STORE_SUFFIX))
+    _write_store(store_path, [[["a.com", 0.5, 1], ["b.com", "", 0]],
+                              [["c.com", 2, 1]]]).close()
+
+    features = read_features(store_path)
+    assert list(features.index) == ["a.com", "b.com", "c.com"]
+    assert features["some_feature"].isna().tolist() == [False, True, False]
+    assert features[TARGET_COLUMN_NAME].tolist() == [1, 0, 1]
+
+
+def test_rewrite_drops_partitions_of_earlier_run(tmp_path):
+    store_path = str(tmp_path / ("features" + FEATURE_STORE_SUFFIX))
+    _write_store(store_path, [[["a.com", 1, 1]], [["b.com", 2, 0]],
+                              [["c.com", 3, 1]]]).close()
+
+    writer = _write_store(store_path, [[["d.com", 4, 0]]])
+    # the earlier store stays readable until the new one is closed
+    assert list(read_features(store_path).index) == ["a.com", "b.com", "c.com"]
+    writer.close()
+
+    assert list(read_features(store_path).index) == ["d.com"]
+    assert sorted(os.listdir(str(tmp_path))) == [
+        "features" + FEATURE_STORE_SUFFIX
+    ]
+
+
+def test_unclosed_writer_leftovers_are_cleared(tmp_path):
+    store_path = str(tmp_path / ("features" + FEATURE_STORE_SUFFIX))
+    # a crashed run leaves its temporary partitions behind
+    _write_store(store_path, [[["a.com", 1, 1]], [["b.com", 2, 0]]])
+
+    _write_store(store_path, [[["c.com", 3, 1]]]).close()
+    assert list(read_features(store_path).index) == ["c.com"]
+
+
+class RecordingClassifier:
+    # remembers the columns it was asked to label
+    def fit(self, pd_data, y):
+        return self
+
+    def predict(self, pd_data):
+        self.columns = list(pd_data.columns)
+        with open(self.columns_path, 'w') as f:
+            f.write(",".join(self.columns))
+        return [1] * len(pd_data)
+
+
+def _write_wide_features(tmp_path, rows=20):
+    # a features csv and store with more columns than the model uses
+    columns = [CRAWL_URL_COLUMN_NAME, CHUNK_COLUMN_NAME] + WIDE_FEATURES + [
+        TARGET_COLUMN_NAME
+    ]
+    rand = random.Random(19)
+    data_rows = [["site%d.com" % index, index % 3] +
+                 [rand.random() for _ in WIDE_FEATURES] + [[-1, 0, 1][index % 3]]
+                 for index in range(rows)]
+    csv_path = str(tmp_path / "features.csv")
+    with open(csv_path, 'w', newline='') as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(columns)
+        csvwriter.writerows(data_rows)
+    store_path = str(tmp_path / ("features" + FEATURE_STORE_SUFFIX))
+    writer = FeatureStoreWriter(store_path, columns)
+    writer.write_rows(data_rows)
+    writer.close()
+    return csv_path, store_path
+
+
+@pytest.mark.parametrize("use_store", [False, True])
+def test_read_features_projection(tmp_path, use_store):
+    csv_path, store_path = _write_wide_features(tmp_path)
+    file_path = store_path if use_store else csv_path
+    features = read_features(file_path, columns=["f3", "f1", "missing"])
+    # the index is kept, the order is the one of the file
+    assert features.index.name == CRAWL_URL_COLUMN_NAME
+    assert list(features.columns) == ["f1", "f3"]
+    full_features = read_features(file_path)
+    assert features["f3"].tolist() == full_features["f3"].tolist()
+
+
+@pytest.mark.parametrize("use_store", [False, True])
+def test_label_from_saved_clf_reads_model_columns(tmp_path, use_store):
+    csv_path, store_path = _write_wide_features(tmp_path)
+    clf = RecordingClassifier()
+    clf.columns_path = str(tmp_path / "columns.txt")
+    clf_path = str(tmp_path / "clf.pkl")
+    with open(clf_path, 'wb') as f:
+        pickle.dump(clf, f)
+
+    label_dataset_from_saved_clf(store_path if use_store else csv_path,
+                                 clf_path,
+                                 "labeled.csv",
+                                 str(tmp_path),
+                                 test_features_only=["f1", "f2"])
+    with open(clf.columns_path) as f:
+        assert f.read() == "f1,f2"
+    labeled = pd.read_csv(str(tmp_path / "labeled.csv"), index_col=0)
+    assert len(labeled) == 20
+    assert CHUNK_COLUMN_NAME in labeled.columns
+    assert TARGET_COLUMN_NAME + "_orig" in labeled.columns
+
+
+class StopAfterRead(Exception):
+    pass
+
+
+def test_clean_for_training_reads_model_columns(tmp_path, monkeypatch):
+    csv_path, _ = _write_wide_features(tmp_path)
+    read_columns = []
+
+    def _recording_read_features(file_path, columns=None, index_col=0):
+        read_columns.append(columns)
+        raise StopAfterRead()
+
+    monkeypatch.setattr(output_features_to_csv, "read_features",
+                        _recording_read_features)
+    with pytest.raises(StopAfterRead):
+        output_features_to_csv._clean_scale_data_for_training(
+            csv_path,
+            "test",
+            str(tmp_path), [],
+            test_features_only=["f1", "f2"],
+            should_scale=False)
+    assert read_columns == [[
+        CRAWL_URL_COLUMN_NAME, "f1", "f2", TARGET_COLUMN_NAME
+    ]]
+
+
+def _make_feature_rows(count, feature_count, seed):
+    rand = random.Random(seed)
+    return [["https://site%d.com" % index, index % 10] +
+            [round(rand.random() * 1000, 3) for _ in range(feature_count)] +
+            [rand.choice([-1, 0, 1])] for index in range(count)]
+
+
+@pytest.mark.benchmark
+def test_benchmark_csv_vs_feature_store(tmp_path):
+    feature_names = ["feature_%d" % index for index in range(150)]
+    columns = [CRAWL_URL_COLUMN_NAME, CHUNK_COLUMN_NAME] + feature_names + [
+        TARGET_COLUMN_NAME
+    ]
+    rows = _make_feature_rows(100000, len(feature_names), 19)
+    model_columns = feature_names[:10] + [TARGET_COLUMN_NAME]
+    batch_size = 1000
+
+    # before: the csv rows, written like OutputCSVForceHeaderBase does
+    csv_path = str(tmp_path / "features.csv")
+    start = time.perf_counter()
+    with open(csv_path, 'w', newline='') as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(columns)
+        for index in range(0, len(rows), batch_size):
+            csvwriter.writerows(rows[index:index + batch_size])
+    csv_write_seconds = time.perf_counter() - start
+
+    store_path = str(tmp_path / ("features" + FEATURE_STORE_SUFFIX))
+    start = time.perf_counter()
+    writer = FeatureStoreWriter(store_path, columns)
+    for index in range(0, len(rows), batch_size):
+        writer.write_rows(rows[index:index + batch_size])
+    writer.close()
+    store_write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    csv_full = read_features(csv_path)
+    csv_full_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    store_full = read_features(store_path)
+    store_full_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    csv_projected = read_features(csv_path, columns=model_columns)
+    csv_projected_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    store_projected = read_features(store_path, columns=model_columns)
+    store_projected_seconds = time.perf_counter() - start
+
+    mb = 1024 * 1024
+    store_bytes = sum(
+        os.path.getsize(os.path.join(store_path, file_name))
+        for file_name in os.listdir(store_path))
+    print("\n100k rows x %d columns: csv %.1fMB, store %.1fMB\n"
+          "write: before (csv) %.2fs, after (store) %.2fs\n"
+          "full read: before %.2fs, after %.2fs\n"
+          "projected read (%d columns): before %.2fs, after %.2fs" %
+          (len(columns), os.path.getsize(csv_path) / mb, store_bytes / mb,
+           csv_write_seconds, store_write_seconds, csv_full_seconds,
+           store_full_seconds, len(model_columns), csv_projected_seconds,
+           store_projected_seconds))
+
+    assert list(store_full.columns) == list(csv_full.columns)
+    assert (store_full.index == csv_full.index).all()
+    pd.testing.assert_frame_equal(store_projected[feature_names[:10]],
+                                  csv_projected[feature_names[:10]])
+    assert store_full_seconds < csv_full_seconds
+    assert store_projected_seconds < csv_projected_seconds
@@ -0,0 +1,102 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+
+import pytest
+
+from cvinspector.common.filter_list_snapshot import clear_loaded_filter_list_snapshots, \
+    create_filter_matcher_from_snapshots, get_filter_list_snapshot_path, load_filter_list_snapshot
+from cvinspector.common.filter_matcher import create_filter_matcher
+
+RULES = """[Adblock Plus 2.0]
+||ads.example.com^
+@@||ads.example.com/allowed/
+||tracker.net^$third-party
+example.com##.ad
+"""
+
+URLS = [("https://ads.example.com/x.js", None, None),
+        ("https://ads.example.com/allowed/1", None, None),
+        ("https://tracker.net/p", "image", "https://news.com/"),
+        ("https://tracker.net/p", "image", "https://tracker.net/")]
+
+
+@pytest.fixture
+def filter_list_path(tmp_path):
+    clear_loaded_filter_list_snapshots()
+    path = tmp_path / "easylist.txt"
+    path.write_text(RULES)
+    yield str(path)
+    clear_loaded_filter_list_snapshots()
+
+
+def test_snapshot_matches_text(filter_list_path, tmp_path):
+    snapshot_directory = str(tmp_path / "snapshots")
+    snapshot = load_filter_list_snapshot(filter_list_path, snapshot_directory)
+
+    assert snapshot.get_text() == RULES
+    assert list(snapshot.iter_lines()) == RULES.split("\n")[:-1]
+    text_matcher = create_filter_matcher(filter_list_path)
+    snapshot_matcher = create_filter_matcher_from_snapshots(
+        filter_list_path, snapshot_directory=snapshot_directory)
+    for url, resource_type, page_url in URLS:
+        assert snapshot_matcher.matches(url, resource_type, page_url) == \
+            text_matcher.matches(url, resource_type, page_url)
+
+
+def test_snapshot_rebuilt_when_list_changes(filter_list_path, tmp_path):
+    snapshot_directory = str(tmp_path / "snapshots")
+    snapshot = load_filter_list_snapshot(filter_list_path, snapshot_directory)
+    assert load_filter_list_snapshot(filter_list_path,
+                                     snapshot_directory) is snapshot
+
+    with open(filter_list_path, "a") as filter_list_file:
+        filter_list_file.write("||new-ads.com^\n")
+    changed = load_filter_list_snapshot(filter_list_path, snapshot_directory)
+    assert changed is not snapshot
+    assert changed.get_filter_matcher().matches("https://new-ads.com/a.js")
+    assert os.path.isfile(
+        get_filter_list_snapshot_path(filter_list_path, snapshot_directory))
+
+
+def test_proxy_serves_cached_content(filter_list_path, tmp_path, monkeypatch):
+    pytest.importorskip("flask")
+    import cvinspector.scripts.subscription_proxy as subscription_proxy
+
+    loads = []
+    load_filter_list = subscription_proxy._load_filter_list
+
+    def _counting_load(path):
+        loads.append(path)
+        return load_filter_list(path)
+
+    monkeypatch.setattr(subscription_proxy, "_load_filter_list",
+                        _counting_load)
+    monkeypatch.setattr(subscription_proxy, "FILTER_LIST_SNAPSHOT_DIR",
+                        str(tmp_path / "snapshots"))
+    monkeypatch.setattr(subscription_proxy, "_FILTER_LIST_CONTENT", dict())
+
+    content = subscription_proxy.read_filter_list(filter_list_path)
+    assert content == RULES.encode("utf-8")
+    assert subscription_proxy.read_filter_list(filter_list_path) is content
+    assert len(loads) == 1
+
+    # a changed list is loaded (and its snapshot rebuilt) again
+    with open(filter_list_path, "a") as filter_list_file:
+        filter_list_file.write("||new-ads.com^\n")
+    assert subscription_proxy.read_filter_list(filter_list_path).endswith(
+        b"||new-ads.com^\n")
+    assert len(loads) == 2
@@ -0,0 +1,146 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import random
+import time
+
+import pytest
+
+from cvinspector.common.filter_matcher import create_filter_matcher
+from cvinspector.ml.output_features_to_csv import get_tracking_dict, write_tracking_urls_txt
+
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "fixtures", "filter_matcher")
+RULES_PATH = os.path.join(FIXTURE_DIRECTORY, "rules.txt")
+PARITY_PATH = os.path.join(FIXTURE_DIRECTORY, "parity.tsv")
+FILTER_LISTS_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "filter_lists")
+
+
+def _read_parity_cases():
+    cases = []
+    with open(PARITY_PATH) as parity_file:
+        for line in parity_file:
+            if line.startswith("#") or not line.strip():
+                continue
+            url, resource_type, page_url, blocked = line.rstrip("\n").split(
+                "\t")
+            cases.append((url, None if resource_type == "-" else resource_type,
+                          None if page_url == "-" else page_url,
+                          blocked == "true"))
+    return cases
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return create_filter_matcher(RULES_PATH)
+
+
+@pytest.mark.parametrize("url,resource_type,page_url,blocked",
+                         _read_parity_cases())
+def test_parity(matcher, url, resource_type, page_url, blocked):
+    assert matcher.matches(url, resource_type=resource_type,
+                           page_url=page_url) == blocked
+
+
+def _write_urls_file(path, lines):
+    with open(str(path), "w") as urls_file:
+        for line in lines:
+            urls_file.write(";;".join(line) + "\n")
+    return str(path)
+
+
+def test_write_tracking_urls_overwrites(tmp_path):
+    urls_path = _write_urls_file(tmp_path / "urls.txt", [
+        ("https://news.com/", "news.com", "https://tracker.net/p", "image"),
+        ("https://news.com/", "news.com", "https://news.com/logo.png",
+         "image")
+    ])
+    tracking_path = str(tmp_path / "tracking.txt")
+    write_tracking_urls_txt(RULES_PATH, urls_path, tracking_path)
+    # a rerun does not append to the previous output
+    write_tracking_urls_txt(RULES_PATH, urls_path, tracking_path)
+
+    with open(tracking_path) as tracking_file:
+        assert tracking_file.read().splitlines() == [
+            "https://news.com/;;news.com;;https://tracker.net/p;;image"
+        ]
+
+
+def test_tracking_dict_keeps_old_behavior_by_default(tmp_path):
+    tracking_path = _write_urls_file(tmp_path / "tracking.txt", [
+        ("https://news.com/", "news.com", "https://tracker.net/p", "image"),
+        ("news.com", "https://ads.example.com/x.js", "script")
+    ])
+
+    # only 3 field lines, like the original reader
+    assert get_tracking_dict(tracking_path) == {
+        "news.com": {
+            "https://ads.example.com/x.js": "script"
+        }
+    }
+    assert get_tracking_dict(tracking_path, remove_tracking_urls=True) == {
+        "news.com": {
+            "https://tracker.net/p": "image",
+            "https://ads.example.com/x.js": "script"
+        }
+    }
+
+
+def _easylist_urls(matcher, count):
+    # a mix of urls of blocked ad domains and of first party resources
+    rand = random.Random(0)
+    blocked_domains = []
+    for rule in matcher.rules:
+        if rule.pattern.startswith("||") and not rule.is_exception:
+            blocked_domains.append(rule.pattern[2:].split("^")[0].split("/")[0])
+    urls = []
+    for index in range(count):
+        page_url = "https://news%d.com/" % (index % 50)
+        if index % 3 == 0:
+            urls.append(("https://%s/x/%d.js" % (rand.choice(blocked_domains),
+                                                 index), "script", page_url))
+        else:
+            urls.append(("https://cdn%d.news%d.com/static/img/photo_%d.jpg?w=%d"
+                         % (index % 7, index % 50, index, index % 300), "image",
+                         page_url))
+    return urls
+
+
+@pytest.mark.benchmark
+def test_benchmark_easylist_throughput():
+    start = time.perf_counter()
+    matcher = create_filter_matcher([
+        os.path.join(FILTER_LISTS_DIRECTORY, "easylist.txt"),
+        os.path.join(FILTER_LISTS_DIRECTORY, "easyprivacy.txt")
+    ])
+    build_seconds = time.perf_counter() - start
+
+    urls = _easylist_urls(matcher, 20000)
+    start = time.perf_counter()
+    blocked_count = sum(
+        1 for url, resource_type, page_url in urls
+        if matcher.matches(url, resource_type=resource_type,
+                           page_url=page_url))
+    match_seconds = time.perf_counter() - start
+
+    urls_per_second = len(urls) / match_seconds
+    print("\neasylist+easyprivacy: build %.2fs, %d of %d urls blocked, "
+          "%.0f urls/s" % (build_seconds, blocked_count, len(urls),
+                           urls_per_second))
+    assert blocked_count > 0
+    assert urls_per_second > 1000
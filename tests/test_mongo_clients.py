@@ -0,0 +1,97 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from cvinspector.common.mongo_clients import MongoClientRegistry
+
+
+class CountingFactory:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created = []
+
+    def __call__(self, host, port, **kwargs):
+        client = mongomock.MongoClient(host, port)
+        with self.lock:
+            self.created.append((host, port, kwargs))
+        return client
+
+
+def test_one_client_per_process_across_threads():
+    factory = CountingFactory()
+    registry = MongoClientRegistry(client_factory=factory)
+    clients = []
+
+    def _get_client():
+        clients.append(registry.get_client("localhost", 27017))
+
+    threads = [threading.Thread(target=_get_client) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(factory.created) == 1
+    assert all(client is clients[0] for client in clients)
+    assert factory.created[0][2]["maxPoolSize"] == registry.max_pool_size
+
+
+def test_one_client_per_credentials():
+    factory = CountingFactory()
+    registry = MongoClientRegistry(client_factory=factory)
+    client = registry.get_client("localhost", 27017)
+    auth_client = registry.get_client("localhost",
+                                      27017,
+                                      username="user",
+                                      password="pass",
+                                      authSource="admin")
+
+    assert client is not auth_client
+    assert registry.get_client("localhost", 27017) is client
+    assert len(factory.created) == 2
+    assert factory.created[1][2]["authSource"] == "admin"
+
+
+def _child_client_count(registry, factory, queue):
+    registry.get_client("localhost", 27017)
+    registry.get_client("localhost", 27017)
+    queue.put((len(factory.created), len(registry.clients),
+               registry.pid == os.getpid()))
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_child_creates_its_own_client():
+    factory = CountingFactory()
+    registry = MongoClientRegistry(client_factory=factory)
+    registry.get_client("localhost", 27017)
+
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=_child_client_count,
+                              args=(registry, factory, queue))
+    process.start()
+    created, client_count, same_pid = queue.get(timeout=10)
+    process.join(10)
+
+    # the inherited client is dropped, the child makes exactly one of its own
+    assert (created, client_count, same_pid) == (2, 1, True)
+    assert len(factory.created) == 1
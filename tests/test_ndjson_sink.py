@@ -0,0 +1,204 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import http.client
+import json
+import os
+import socket
+
+import pytest
+
+from cvinspector.common.utils import JSON_DOMMUTATION_KEY, JSON_WEBREQUEST_KEY, iter_events_from_ndjson, \
+    get_ndjson_meta
+from cvinspector.data_collect.ndjson_sink import NDJSON_SINK_CONFIG_FILE_NAME, NDJSONSink
+
+EXTENSION_ORIGIN = "chrome-extension://abcdefghijklmnopabcdefghijklmnop"
+
+
+def _webrequest_events(count):
+    return [{
+        "type": "event",
+        "event": {
+            "requestId": str(index),
+            "url": "https://cdn.site.com/%d.js?a=é" % index,
+            "status": "onCompleted" if index % 3 else "onBeforeRequest",
+            "details": {"type": "script", "tabId": 3, "frameId": 0}
+        },
+        "time": 1586327346839 + index
+    } for index in range(count)]
+
+
+def _dom_events(count):
+    return [{
+        "type": "event",
+        "event": {
+            "type": "NodesAdded",
+            "target": {"selector": "div > p:nth-child(%d)" % index},
+            "nodes": []
+        },
+        "time": 1586327346839 + index
+    } for index in range(count)]
+
+
+@pytest.fixture
+def sink(tmp_path):
+    ndjson_sink = NDJSONSink(str(tmp_path), port=0)
+    ndjson_sink.start()
+    yield ndjson_sink
+    ndjson_sink.stop()
+
+
+def _request(sink, method, path, body=None, origin=EXTENSION_ORIGIN):
+    headers = {}
+    if origin:
+        headers["Origin"] = origin
+    connection = http.client.HTTPConnection(sink.host, sink.port, timeout=10)
+    try:
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def _stream(sink, stream_id, events, file_data, lines_per_append=4):
+    # what the extensions post: the buffered lines every flush, then the file data
+    for index in range(0, len(events), lines_per_append):
+        lines = "".join(
+            json.dumps(entry) + "\n"
+            for entry in events[index:index + lines_per_append])
+        assert _request(sink, "POST", "/append?stream=" + stream_id,
+                        lines.encode("utf-8"))[0] == 200
+    file_data = dict(file_data)
+    file_data["startTime"] = events[0]["time"] if events else ""
+    assert _request(sink, "POST", "/close?stream=" + stream_id,
+                    json.dumps(file_data))[0] == 200
+
+
+def _legacy_json(events_key, events, file_data):
+    # the fileData the extensions downloaded before streaming
+    legacy = {"url": file_data["url"], events_key: events}
+    for key, value in file_data.items():
+        if key not in ["url", "filename"]:
+            legacy[key] = value
+    legacy["startTime"] = events[0]["time"] if events else ""
+    return legacy
+
+
+@pytest.mark.parametrize("event_count", [0, 1, 10])
+def test_webrequests_round_trip_matches_legacy_json(sink, tmp_path,
+                                                    event_count):
+    events = _webrequest_events(event_count)
+    file_data = {
+        "url": "https://site.com/",
+        "filename": "site.com_abc__trial0--cvwebrequestsvanilla",
+        "schemaVersion": 2,
+        "endTime": 1586327350000
+    }
+    _stream(sink, "s1-1", events, file_data)
+
+    with open(str(tmp_path / (file_data["filename"] + ".json"))) as f:
+        assert json.load(f) == _legacy_json(JSON_WEBREQUEST_KEY, events,
+                                            file_data)
+    # without keep_ndjson only the json is left
+    assert os.listdir(str(tmp_path)) == [file_data["filename"] + ".json"]
+
+
+def test_dom_mutation_round_trip_keeps_ndjson(tmp_path):
+    sink = NDJSONSink(str(tmp_path), port=0, keep_ndjson=True)
+    sink.start()
+    try:
+        events = _dom_events(9)
+        file_data = {
+            "url": "https://site.com/a?b=c",
+            # chrome would have replaced the characters it does not allow in file names
+            "filename": "https://site.com/a?b=c--cvdommutation",
+            "endTime": 1586327350000
+        }
+        _stream(sink, "s1-2", events, file_data, lines_per_append=2)
+    finally:
+        sink.stop()
+
+    json_file_path = str(tmp_path / "https___site.com_a_b=c--cvdommutation.json")
+    with open(json_file_path) as f:
+        assert json.load(f) == _legacy_json(JSON_DOMMUTATION_KEY, events,
+                                            file_data)
+    ndjson_file_path = json_file_path[:-len(".json")] + ".ndjson"
+    assert list(iter_events_from_ndjson(ndjson_file_path)) == events
+    assert get_ndjson_meta(ndjson_file_path)["endTime"] == 1586327350000
+
+
+def test_streams_do_not_mix(sink, tmp_path):
+    first = _webrequest_events(5)
+    second = _webrequest_events(7)
+    for stream_id, events in [("s2-1", first), ("s2-2", second)]:
+        _stream(sink, stream_id, events, {
+            "url": "https://site.com/",
+            "filename": stream_id + "--cvwebrequests",
+            "schemaVersion": 2
+        })
+    with open(str(tmp_path / "s2-2--cvwebrequests.json")) as f:
+        assert json.load(f)[JSON_WEBREQUEST_KEY] == second
+
+
+@pytest.mark.parametrize("origin",
+                         [None, "https://evil.com", "null", "http://127.0.0.1"])
+def test_rejects_posts_from_pages(sink, tmp_path, origin):
+    status, _ = _request(sink,
+                         "POST",
+                         "/append?stream=s3-1",
+                         b'{"type": "event"}\n',
+                         origin=origin)
+    assert status == 403
+    status, _ = _request(sink,
+                         "POST",
+                         "/close?stream=s3-1",
+                         b'{"url": "x", "filename": "x"}',
+                         origin=origin)
+    assert status == 403
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_rejects_bad_stream_id(sink, tmp_path):
+    assert _request(sink, "POST", "/append?stream=../x", b"{}\n")[0] == 400
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_port_in_use_falls_back_to_free_port(tmp_path):
+    taken = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    taken.bind(("127.0.0.1", 0))
+    taken.listen(1)
+    taken_port = taken.getsockname()[1]
+    sink = NDJSONSink(str(tmp_path), port=taken_port)
+    try:
+        sink.start()
+        assert sink.port != taken_port
+        assert _request(sink, "GET", "/ping")[0] == 200
+    finally:
+        sink.stop()
+        taken.close()
+
+
+def test_extension_configs_point_to_sink(sink, tmp_path):
+    ext_path = tmp_path / "ext"
+    ext_path.mkdir()
+    sink.write_extension_configs([str(ext_path), str(tmp_path / "missing")])
+
+    config_path = ext_path / NDJSON_SINK_CONFIG_FILE_NAME
+    with open(str(config_path)) as f:
+        assert json.load(f) == {"url": "http://127.0.0.1:%d" % sink.port}
+    # extensions of a later crawl without the sink go back to the default port
+    sink.stop()
+    assert not config_path.exists()
@@ -0,0 +1,90 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import os
+import time
+from multiprocessing import Process, Queue
+
+from cvinspector.common.utils import OutputCSVProcess, put_output_rows
+
+PRODUCERS = 4
+ROWS_PER_PRODUCER = 250000
+BATCH_SIZE = 1000
+
+
+def _produce(output_queue, producer_index):
+    for start in range(0, ROWS_PER_PRODUCER, BATCH_SIZE):
+        put_output_rows(output_queue, [[producer_index, x]
+                                       for x in range(start, start + BATCH_SIZE)])
+
+
+def test_million_rows_without_loss(tmp_path):
+    csv_path = str(tmp_path / "rows.csv")
+    output_queue = Queue()
+    writer = OutputCSVProcess("1",
+                              "rows",
+                              csv_path,
+                              None,
+                              output_queue,
+                              header_row=["producer", "row"])
+    writer.start()
+
+    producers = [
+        Process(target=_produce, args=(output_queue, x))
+        for x in range(PRODUCERS)
+    ]
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+
+    start = time.perf_counter()
+    assert writer.close()
+    close_seconds = time.perf_counter() - start
+    print("\nclose() after %d rows: %.3fs" %
+          (PRODUCERS * ROWS_PER_PRODUCER, close_seconds))
+    assert close_seconds < 1
+    assert not writer.is_alive()
+
+    counts = [0] * PRODUCERS
+    seen = set()
+    with open(csv_path) as csv_file:
+        reader = csv.reader(csv_file)
+        assert next(reader) == ["producer", "row"]
+        for producer_index, row_index in reader:
+            seen.add((producer_index, row_index))
+            counts[int(producer_index)] += 1
+    # every row exactly once
+    assert counts == [ROWS_PER_PRODUCER] * PRODUCERS
+    assert len(seen) == PRODUCERS * ROWS_PER_PRODUCER
+
+
+class CrashingCSVProcess(OutputCSVProcess):
+    # dies before writing anything, like a writer killed by the OOM killer
+    def run(self):
+        os._exit(3)
+
+
+def test_close_gives_up_when_writer_died(tmp_path):
+    writer = CrashingCSVProcess("1", "rows", str(tmp_path / "rows.csv"), None,
+                                Queue())
+    writer.start()
+    writer.join()
+
+    start = time.perf_counter()
+    assert not writer.close(timeout=60)
+    assert time.perf_counter() - start < 5
+    assert writer.exitcode == 3
@@ -0,0 +1,242 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+
+import pytest
+
+import cvinspector.data_collect.page_settle as page_settle
+from cvinspector.data_collect.page_settle import SETTLE_MAX_PENDING_AGE, SETTLE_STATE_QUIET, SETTLE_STATE_TIMEOUT, \
+    SETTLE_STATE_WAITING, find_settle_time, get_event_times_from_counters, get_settle_state, wait_for_page_settle
+
+START = 1000.0
+
+
+class FakeClock:
+    # replaces the time module of page_settle, sleeping only moves the clock
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeDriver:
+    """
+    Answers the settle query like the extensions would. network_events and dom_events
+    are the times (seconds) of their events, pending holds (start, end) of requests.
+    """
+    def __init__(self,
+                 clock,
+                 network_events=(),
+                 dom_events=(),
+                 pending=(),
+                 answers=True,
+                 as_json_strings=False):
+        self.clock = clock
+        self.network_events = network_events
+        self.dom_events = dom_events
+        self.pending = pending
+        self.answers = answers
+        self.as_json_strings = as_json_strings
+        self.queries = 0
+
+    @staticmethod
+    def _last(events, now):
+        past = [event_time for event_time in events if event_time <= now]
+        return max(past) * 1000 if past else None
+
+    def execute_async_script(self, script):
+        self.queries += 1
+        now = self.clock.time()
+        if not self.answers:
+            # nobody answered within SETTLE_QUERY_TIMEOUT_MS
+            return {"now": now * 1000, "network": None, "dom": None}
+        network = {
+            "lastEventTime": self._last(self.network_events, now),
+            "pendingStartTimes": [
+                start * 1000 for start, end in self.pending
+                if start <= now < end
+            ]
+        }
+        dom = {"lastEventTime": self._last(self.dom_events, now)}
+        if self.as_json_strings:
+            network, dom = json.dumps(network), json.dumps(dom)
+        return {"now": now * 1000, "network": network, "dom": dom}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock(START)
+    monkeypatch.setattr(page_settle, "time", fake_clock)
+    return fake_clock
+
+
+def test_find_settle_time_without_events():
+    # never before min_wait, and at least one quiet window
+    assert find_settle_time([], START, quiet_window=3, min_wait=5) == START + 5
+    assert find_settle_time([], START, quiet_window=8, min_wait=5) == START + 8
+
+
+def test_find_settle_time_quiet_window_reached():
+    # a burst of activity, then quiet: settles one quiet window after the last event
+    events = [START + 1, START + 4, START + 6.5, START + 7]
+    assert find_settle_time(events, START, quiet_window=3,
+                            min_wait=5) == START + 10
+    # unsorted events give the same answer
+    assert find_settle_time(list(reversed(events)),
+                            START,
+                            quiet_window=3,
+                            min_wait=5) == START + 10
+
+
+def test_find_settle_time_ignores_events_after_quiet_window():
+    # the page was already quiet for 3 seconds at START + 5, the later event does not matter
+    events = [START + 1, START + 9]
+    assert find_settle_time(events, START, quiet_window=3,
+                            min_wait=5) == START + 5
+
+
+def test_find_settle_time_capped_at_max_wait():
+    events = [START + index for index in range(60)]
+    assert find_settle_time(events, START, quiet_window=3, max_wait=30,
+                            min_wait=5) == START + 30
+    assert find_settle_time(events, START, quiet_window=3,
+                            min_wait=5) == START + 62
+
+
+def test_get_settle_state():
+    events = [START + 1, START + 4.5]
+    kwargs = dict(quiet_window=3, max_wait=30, min_wait=5)
+    assert get_settle_state(events, START + 7, START,
+                            **kwargs) == SETTLE_STATE_WAITING
+    assert get_settle_state(events, START + 7.5, START,
+                            **kwargs) == SETTLE_STATE_QUIET
+    # no events yet: quiet once min_wait passed
+    assert get_settle_state([], START + 4, START, **kwargs) == SETTLE_STATE_WAITING
+    assert get_settle_state([], START + 5, START, **kwargs) == SETTLE_STATE_QUIET
+    # activity until the end
+    busy = [START + index for index in range(31)]
+    assert get_settle_state(busy, START + 29, START,
+                            **kwargs) == SETTLE_STATE_WAITING
+    assert get_settle_state(busy, START + 30, START,
+                            **kwargs) == SETTLE_STATE_TIMEOUT
+
+
+def test_event_times_from_counters_pending_requests():
+    now = START + 20
+    counters = {
+        "now": now * 1000,
+        "network": {
+            "lastEventTime": (START + 2) * 1000,
+            "pendingStartTimes": [(START + 15) * 1000]
+        },
+        "dom": {
+            "lastEventTime": (START + 4) * 1000
+        }
+    }
+    # a recent pending request is activity happening now
+    assert get_event_times_from_counters(counters) == [
+        START + 2, START + 4, now
+    ]
+
+    # a request pending for longer than max_pending_age (websocket, long polling) is not
+    counters["network"]["pendingStartTimes"] = [
+        (now - SETTLE_MAX_PENDING_AGE - 1) * 1000
+    ]
+    assert get_event_times_from_counters(counters) == [START + 2, START + 4]
+    assert get_event_times_from_counters(counters, max_pending_age=60) == [
+        START + 2, START + 4, now
+    ]
+
+
+def test_event_times_from_counters_without_events():
+    assert get_event_times_from_counters({
+        "now": START * 1000,
+        "network": None,
+        "dom": None
+    }) == []
+    assert get_event_times_from_counters({
+        "now": START * 1000,
+        "network": {"lastEventTime": None, "pendingStartTimes": []},
+        "dom": {}
+    }) == []
+
+
+@pytest.mark.parametrize("as_json_strings", [False, True])
+def test_wait_quiet_window_reached(clock, as_json_strings):
+    driver = FakeDriver(clock,
+                        network_events=[START + 1, START + 4.2],
+                        dom_events=[START + 2, START + 6.1],
+                        as_json_strings=as_json_strings)
+    state, waited = wait_for_page_settle(driver,
+                                         START,
+                                         30,
+                                         quiet_window=3,
+                                         min_wait=5,
+                                         poll_interval=0.5)
+    assert state == SETTLE_STATE_QUIET
+    # quiet window after the last dom event, within one poll interval
+    assert 9.1 <= waited <= 9.6
+
+
+def test_wait_ignores_long_pending_request(clock):
+    # a websocket opened at the start stays pending for the whole visit
+    driver = FakeDriver(clock,
+                        network_events=[START + 1],
+                        pending=[(START + 0.5, START + 1000)])
+    state, waited = wait_for_page_settle(driver,
+                                         START,
+                                         60,
+                                         quiet_window=3,
+                                         min_wait=5,
+                                         poll_interval=0.5)
+    assert state == SETTLE_STATE_QUIET
+    # it counts as activity until it is older than SETTLE_MAX_PENDING_AGE
+    assert SETTLE_MAX_PENDING_AGE + 0.5 <= waited <= SETTLE_MAX_PENDING_AGE + 4.5
+
+
+def test_wait_times_out_on_busy_page(clock):
+    driver = FakeDriver(clock,
+                        dom_events=[START + index * 0.5 for index in range(200)])
+    state, waited = wait_for_page_settle(driver,
+                                         START,
+                                         30,
+                                         quiet_window=3,
+                                         min_wait=5,
+                                         poll_interval=0.5)
+    assert state == SETTLE_STATE_TIMEOUT
+    assert waited == pytest.approx(30)
+
+
+def test_wait_without_extensions_waits_max_wait(clock):
+    driver = FakeDriver(clock, answers=False)
+    state, waited = wait_for_page_settle(driver, START, 20, poll_interval=0.5)
+    assert state == SETTLE_STATE_TIMEOUT
+    assert waited == pytest.approx(20)
+    assert driver.queries > 1
+
+
+def test_wait_survives_failing_queries(clock):
+    class FailingDriver(FakeDriver):
+        def execute_async_script(self, script):
+            raise RuntimeError("script timeout")
+
+    state, waited = wait_for_page_settle(FailingDriver(clock), START, 10)
+    assert state == SETTLE_STATE_TIMEOUT
+    assert waited == pytest.approx(10)
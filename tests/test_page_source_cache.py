@@ -0,0 +1,128 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import multiprocessing
+import random
+import resource
+import time
+
+import pytest
+
+from cvinspector.ml.page_source_cache import PAGE_SOURCE_PARSER_BUILTIN, PAGE_SOURCE_PARSER_HTML5, \
+    PAGE_SOURCE_PARSER_LXML, PageSourceCache, is_page_source_parser_available, parse_page_source
+
+HTML = "<html><body><p>hello world</p><noscript> enable js</noscript></body></html>"
+
+
+def test_default_parser_is_html_parser():
+    assert PageSourceCache().parser_name == PAGE_SOURCE_PARSER_BUILTIN
+
+
+def test_page_is_parsed_once(tmp_path):
+    page_path = tmp_path / "page.html"
+    page_path.write_text(HTML)
+    cache = PageSourceCache()
+
+    page = cache.get(str(page_path))
+    assert cache.get(str(page_path)) is page
+    assert cache.get_stats()["misses"] == 1
+    assert cache.get_stats()["hits"] == 1
+
+    # noscript is removed from the shared soup, but its words are kept apart
+    assert page.soup.select("noscript") == []
+    assert "enable" in page.raw_words
+    assert "enable" not in page.get_words()
+
+
+def _make_page(size, seed):
+    # a page with ads: nested blocks of text, images, iframes and inline scripts
+    rand = random.Random(seed)
+    blocks = []
+    length = 0
+    while length < size:
+        block = (
+            '<div class="col-md-%d block%d"><p>%s</p><noscript>enable js</noscript>'
+            '<img src="/i/%d.png" width="%d"><div id="ad-%d" class="ad">'
+            '<iframe src="https://ads.example.com/%d.html" style="display: %s"></iframe></div>'
+            '<script>var x%d = %d;</script><ul><li>%s</li><li>b</li></ul></div>\n'
+            % (rand.randint(1, 12), rand.randint(0, 50), " ".join(
+                "word%d" % rand.randint(0, 5000) for _ in range(30)),
+               rand.randint(0, 999), rand.choice([0, 1, 300]), len(blocks),
+               rand.randint(0, 999), rand.choice(["none", "block"]),
+               len(blocks), rand.randint(0, 10**6), "text" * rand.randint(1, 20)))
+        blocks.append(block)
+        length += len(block)
+    return "<html><head><title>t</title></head><body>\n%s</body></html>" % "".join(
+        blocks)
+
+
+def _measure_parser(parser_name, page_path, selectors, results):
+    # runs in its own process, so the peak RSS is the one of this parser alone
+    start = time.perf_counter()
+    # what the two PageSource extractors did before: parse the same html once each
+    for _ in range(2):
+        with open(page_path) as f:
+            parse_page_source(f.read(), parser_name)
+    before_seconds = time.perf_counter() - start
+
+    cache = PageSourceCache(parser_name=parser_name)
+    start = time.perf_counter()
+    page = cache.get(page_path)
+    assert cache.get(page_path) is page
+    after_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    element_index = page.get_element_index()
+    matches = sum(len(element_index.select(selector)) for selector in selectors)
+    select_seconds = time.perf_counter() - start
+
+    results.put((before_seconds, after_seconds, select_seconds, matches,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+@pytest.mark.benchmark
+def test_benchmark_page_source_parsers(tmp_path):
+    selectors = [
+        "iframe", "img", "div.ad > iframe", "#ad-10 iframe", "ul > li + li",
+        'div:not([abp-blocked-element]) > img:not([width="0"])'
+    ]
+    parsers = [
+        parser_name
+        for parser_name in [PAGE_SOURCE_PARSER_BUILTIN, PAGE_SOURCE_PARSER_LXML,
+                            PAGE_SOURCE_PARSER_HTML5]
+        if is_page_source_parser_available(parser_name)
+    ]
+    context = multiprocessing.get_context("fork")
+    print()
+    for size_mb in [1, 3, 5]:
+        page_path = str(tmp_path / ("page%d.html" % size_mb))
+        with open(page_path, 'w') as f:
+            f.write(_make_page(size_mb * 1024 * 1024, size_mb))
+        for parser_name in parsers:
+            results = context.Queue()
+            process = context.Process(target=_measure_parser,
+                                      args=(parser_name, page_path, selectors,
+                                            results))
+            process.start()
+            before_seconds, after_seconds, select_seconds, matches, peak_rss_mb = results.get()
+            process.join()
+            assert process.exitcode == 0
+
+            print("%dMB page, %s: parse per extractor (before) %.2fs, parse once "
+                  "and share (after) %.2fs, selectors %.3fs (%d matches), peak RSS %.0fMB"
+                  % (size_mb, parser_name, before_seconds, after_seconds,
+                     select_seconds, matches, peak_rss_mb))
+            assert matches > 0
+            assert after_seconds < before_seconds
@@ -0,0 +1,87 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+
+from cvinspector.common.utils import JSON_DOMMUTATION_KEY, JSON_WEBREQUEST_KEY
+from cvinspector.ml.plot import bin_time_series
+
+
+def _write_json(path, data):
+    with open(str(path), "w") as f:
+        if isinstance(data, str):
+            f.write(data)
+        else:
+            json.dump(data, f)
+    return str(path)
+
+
+def _dom_event(time_ms):
+    return {"event": "NodesAdded", "time": time_ms, "nodes": []}
+
+
+def _wr_event(time_ms):
+    return {"event": {"status": "onBeforeRequest", "requestTime": time_ms,
+                      "url": "https://example.com/ad.js"}}
+
+
+def test_bins_dom_and_webrequest_events(tmp_path):
+    dom_path = _write_json(tmp_path / "dom.json", {
+        JSON_DOMMUTATION_KEY: [_dom_event(1000), _dom_event(2500)]})
+    wr_path = _write_json(tmp_path / "wr.json", {
+        JSON_WEBREQUEST_KEY: [_wr_event(500)]})
+
+    range_keys, rows = bin_time_series(dom_path, wr_path, 1000,
+                                       max_seconds_later=60)
+    # starts at the earliest (webrequest) event, ends 2s after the last dom event
+    assert range_keys == [500, 1500, 2500, 3500]
+    assert rows.shape[0] == len(range_keys)
+
+
+def test_dom_file_without_events_key_gives_no_bins(tmp_path):
+    dom_path = _write_json(tmp_path / "dom.json", {"url": "example.com"})
+    wr_path = _write_json(tmp_path / "wr.json", {
+        JSON_WEBREQUEST_KEY: [_wr_event(500)]})
+
+    range_keys, rows = bin_time_series(dom_path, wr_path, 1000,
+                                       max_seconds_later=60)
+    assert range_keys == []
+    assert rows.shape[0] == 0
+
+
+def test_dom_file_without_timed_events_gives_no_bins(tmp_path):
+    dom_path = _write_json(tmp_path / "dom.json", {JSON_DOMMUTATION_KEY: []})
+    wr_path = _write_json(tmp_path / "wr.json", {
+        JSON_WEBREQUEST_KEY: [_wr_event(500)]})
+
+    range_keys, rows = bin_time_series(dom_path, wr_path, 1000,
+                                       max_seconds_later=60)
+    assert range_keys == []
+    assert rows.shape[0] == 0
+
+
+def test_unreadable_files(tmp_path):
+    bad_path = _write_json(tmp_path / "bad.json", "{not json")
+    dom_path = _write_json(tmp_path / "dom.json", {
+        JSON_DOMMUTATION_KEY: [_dom_event(1000)]})
+
+    range_keys, _ = bin_time_series(bad_path, dom_path, 1000,
+                                    max_seconds_later=60)
+    assert range_keys == []
+
+    # an unreadable webrequest file only drops the webrequest events
+    range_keys, _ = bin_time_series(dom_path, bad_path, 1000,
+                                    max_seconds_later=60)
+    assert range_keys == [1000, 2000]
@@ -0,0 +1,178 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import os
+import shutil
+import time
+
+import pytest
+
+import cvinspector.data_collect.profile_provisioner as profile_provisioner
+from cvinspector.data_collect.profile_provisioner import COPY_STRATEGY_AUTO, COPY_STRATEGY_COPY, \
+    COPY_STRATEGY_HARDLINK, ProfileProvisioner
+
+# layout of a chrome profile with the extensions installed
+EXTENSION_DIR = "Default/Extensions/cmedhionkhpnakcndndgjdbohmhepckk/3.8_0"
+LEVELDB_DIR = "Default/Local Extension Settings/cmedhionkhpnakcndndgjdbohmhepckk"
+
+
+def _write(path, size, seed=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pattern = bytes((seed + index) % 251 for index in range(4096))
+    with open(path, 'wb') as f:
+        f.write((pattern * (size // len(pattern) + 1))[:size])
+
+
+def _make_template(root, ldb_count=4, ldb_size=8192, other_size=4096):
+    template = str(root / "template")
+    for index in range(ldb_count):
+        _write(os.path.join(template, LEVELDB_DIR, "%06d.ldb" % index),
+               ldb_size, seed=index)
+    _write(os.path.join(template, LEVELDB_DIR, "MANIFEST-000001"), other_size)
+    _write(os.path.join(template, LEVELDB_DIR, "000003.log"), other_size)
+    _write(os.path.join(template, EXTENSION_DIR, "manifest.json"), other_size)
+    _write(os.path.join(template, EXTENSION_DIR, "lib/adblockplus.js"),
+           other_size * 4)
+    _write(os.path.join(template, "Default/Preferences"), other_size)
+    _write(os.path.join(template, "Local State"), other_size)
+    # lock of the browser that created the template
+    _write(os.path.join(template, "SingletonCookie"), 10)
+    os.symlink("Preferences", os.path.join(template, "Default/Preferences.link"))
+    return template
+
+
+def _rel_files(path):
+    rel_files = set()
+    for root, _, files in os.walk(path):
+        for name in files:
+            rel_files.add(
+                os.path.relpath(os.path.join(root, name),
+                                path).replace(os.sep, "/"))
+    return rel_files
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _no_reflink(src_path, dest_path):
+    raise OSError(errno.EOPNOTSUPP, "reflink not supported")
+
+
+@pytest.mark.parametrize(
+    "copy_strategy",
+    [COPY_STRATEGY_AUTO, COPY_STRATEGY_HARDLINK, COPY_STRATEGY_COPY])
+def test_provision_gives_same_files(tmp_path, copy_strategy):
+    template = _make_template(tmp_path)
+    dest = str(tmp_path / "trial")
+    ProfileProvisioner(template,
+                       copy_strategy=copy_strategy).provision(dest)
+
+    expected = _rel_files(template)
+    if copy_strategy != COPY_STRATEGY_COPY:
+        expected.remove("SingletonCookie")
+        assert os.readlink(os.path.join(
+            dest, "Default/Preferences.link")) == "Preferences"
+    assert _rel_files(dest) == expected
+    for rel_path in expected:
+        assert _read(os.path.join(dest, rel_path)) == _read(
+            os.path.join(template, rel_path))
+
+
+def test_hardlinks_only_leveldb_tables(tmp_path, monkeypatch):
+    monkeypatch.setattr(profile_provisioner, "reflink_file", _no_reflink)
+    template = _make_template(tmp_path)
+    dest = str(tmp_path / "trial")
+    provisioner = ProfileProvisioner(template)
+    provisioner.provision(dest)
+
+    for rel_path in _rel_files(dest) - {"Default/Preferences.link"}:
+        shares_inode = os.path.samefile(os.path.join(dest, rel_path),
+                                        os.path.join(template, rel_path))
+        assert shares_inode == rel_path.endswith(".ldb"), rel_path
+    stats = provisioner.get_stats()
+    assert stats["files_hardlinked"] == 4
+    assert stats["files_reflinked"] == 0
+
+    # a trial rewriting an extension file in place leaves the template alone
+    manifest = os.path.join(EXTENSION_DIR, "manifest.json")
+    template_manifest = _read(os.path.join(template, manifest))
+    with open(os.path.join(dest, manifest), 'r+b') as f:
+        f.write(b"rewritten")
+    assert _read(os.path.join(template, manifest)) == template_manifest
+
+
+def test_unsupported_hardlink_falls_back_to_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(profile_provisioner, "reflink_file", _no_reflink)
+
+    def _no_link(src_path, dest_path):
+        raise OSError(errno.EXDEV, "cross-device link")
+
+    monkeypatch.setattr(profile_provisioner.os, "link", _no_link)
+    template = _make_template(tmp_path)
+    provisioner = ProfileProvisioner(template)
+    for index in range(2):
+        provisioner.provision(str(tmp_path / ("trial%d" % index)))
+
+    stats = provisioner.get_stats()
+    assert stats["profiles"] == 2
+    assert stats["files_hardlinked"] == 0
+    assert not provisioner.use_hardlink
+    assert stats["files_copied"] == 2 * len(
+        [rel_path for rel_path in _rel_files(template)
+         if not rel_path.startswith("Singleton") and not rel_path.endswith(".link")])
+
+
+@pytest.mark.benchmark
+def test_benchmark_provision_before_after(tmp_path):
+    # synthetic 200MB profile: 180MB of extension leveldb tables, 20MB of other files
+    mb = 1024 * 1024
+    template = _make_template(tmp_path,
+                              ldb_count=90,
+                              ldb_size=2 * mb,
+                              other_size=mb)
+    for index in range(13):
+        _write(os.path.join(template, "Default/Cache/data_%d" % index), mb)
+    trials = 5
+
+    start = time.perf_counter()
+    for index in range(trials):
+        dest = str(tmp_path / ("copy%d" % index))
+        shutil.copytree(template, dest, symlinks=True)
+    copy_seconds = (time.perf_counter() - start) / trials
+    copy_bytes = sum(
+        os.path.getsize(os.path.join(template, rel_path))
+        for rel_path in _rel_files(template)
+        if not os.path.islink(os.path.join(template, rel_path)))
+    for index in range(trials):
+        shutil.rmtree(str(tmp_path / ("copy%d" % index)))
+
+    provisioner = ProfileProvisioner(template)
+    start = time.perf_counter()
+    for index in range(trials):
+        provisioner.provision(str(tmp_path / ("trial%d" % index)))
+    provision_seconds = (time.perf_counter() - start) / trials
+    stats = provisioner.get_stats()
+    provision_bytes = stats["bytes_copied"] / trials
+
+    print("\nprovision %.0fMB profile per trial: before %.3fs %.0fMB written, "
+          "after %.3fs %.1fMB written (reflinked %d, hardlinked %d, copied %d files)"
+          % (copy_bytes / mb, copy_seconds, copy_bytes / mb, provision_seconds,
+             provision_bytes / mb, stats["files_reflinked"] / trials,
+             stats["files_hardlinked"] / trials, stats["files_copied"] / trials))
+    assert provision_bytes < copy_bytes
+    assert provision_seconds < copy_seconds
@@ -0,0 +1,258 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import multiprocessing
+import os
+import threading
+import time
+
+import mongomock
+import pytest
+
+import cvinspector.common.filter_list_snapshot as filter_list_snapshot
+import cvinspector.diff_analysis.utils as diff_utils
+import cvinspector.diff_analysis.wr_diff_cache as wr_diff_cache
+from cvinspector.common.stage_runner import STAGE_STATUS_DISABLED, STAGE_STATUS_RAN, STAGE_STATUS_SKIPPED, \
+    Stage, StageRunner
+from cvinspector.common.trial_cache import TRIAL_CACHE
+from cvinspector.common.work_executor import WorkExecutorError
+
+
+class FakePipeline:
+    """
+    input.txt --> a (writes a.txt) --> b, c (read a.txt, write b.txt / c.txt) --> d
+    Records the order the stages ran in.
+    """
+    def __init__(self, directory, fail_stage=None, sleep_seconds=0):
+        self.directory = directory
+        self.fail_stage = fail_stage
+        self.sleep_seconds = sleep_seconds
+        self.lock = threading.Lock()
+        self.ran = []
+        self.input_path = self.path("input.txt")
+        if not os.path.isfile(self.input_path):
+            self.write("input.txt", "input")
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def write(self, file_name, content):
+        with open(self.path(file_name), "w") as opened_file:
+            opened_file.write(content)
+
+    def _stage_func(self, name, output_name):
+        def _run():
+            with self.lock:
+                self.ran.append(name)
+            time.sleep(self.sleep_seconds)
+            if name == self.fail_stage:
+                raise RuntimeError("stage %s failed" % name)
+            if output_name:
+                # outputs change with the input, like a real pipeline
+                with open(self.input_path) as input_file:
+                    self.write(output_name, name + input_file.read())
+            return name + "-result"
+
+        return _run
+
+    def create_runner(self, max_workers=1, rerun_stages=None, params=None,
+                      disabled=None):
+        runner = StageRunner(self.path("manifest.json"),
+                             max_workers=max_workers,
+                             rerun_stages=rerun_stages)
+        runner.add_stage(
+            Stage("a",
+                  self._stage_func("a", "a.txt"),
+                  input_paths=[self.input_path],
+                  output_paths=[self.path("a.txt")],
+                  params=params))
+        runner.add_stage(
+            Stage("b",
+                  self._stage_func("b", "b.txt"),
+                  depends_on=["a"],
+                  output_paths=[self.path("b.txt")],
+                  enabled=disabled != "b"))
+        runner.add_stage(
+            Stage("c",
+                  self._stage_func("c", "c.txt"),
+                  depends_on=["a"],
+                  output_paths=[self.path("c.txt")]))
+        runner.add_stage(
+            Stage("d", self._stage_func("d", None), depends_on=["b", "c"]))
+        return runner
+
+
+def test_dependencies_run_first(tmp_path):
+    pipeline = FakePipeline(str(tmp_path))
+    results = pipeline.create_runner().run()
+
+    assert pipeline.ran[0] == "a"
+    assert sorted(pipeline.ran[1:3]) == ["b", "c"]
+    assert pipeline.ran[3] == "d"
+    assert results == {
+        "a": "a-result",
+        "b": "b-result",
+        "c": "c-result",
+        "d": "d-result"
+    }
+
+
+def test_independent_stages_overlap(tmp_path):
+    pipeline = FakePipeline(str(tmp_path), sleep_seconds=0.3)
+    start = time.perf_counter()
+    pipeline.create_runner(max_workers=2).run()
+    # a, then b and c together, then d
+    assert time.perf_counter() - start < 1.15
+
+
+def test_unchanged_stages_are_skipped(tmp_path):
+    FakePipeline(str(tmp_path)).create_runner().run()
+
+    pipeline = FakePipeline(str(tmp_path))
+    runner = pipeline.create_runner()
+    results = runner.run()
+    assert pipeline.ran == []
+    assert set(runner.statuses.values()) == {STAGE_STATUS_SKIPPED}
+    # results of skipped stages come from the manifest
+    assert results["d"] == "d-result"
+
+
+def test_changed_input_reruns_stage_and_dependents(tmp_path):
+    FakePipeline(str(tmp_path)).create_runner().run()
+
+    pipeline = FakePipeline(str(tmp_path))
+    pipeline.write("input.txt", "new input")
+    pipeline.create_runner().run()
+    assert sorted(pipeline.ran) == ["a", "b", "c", "d"]
+
+
+def test_changed_params_and_removed_outputs_rerun(tmp_path):
+    FakePipeline(str(tmp_path)).create_runner(params=[1]).run()
+
+    pipeline = FakePipeline(str(tmp_path))
+    pipeline.create_runner(params=[2]).run()
+    # a reran, but wrote the same output, so its dependents are still current
+    assert pipeline.ran == ["a"]
+
+    pipeline = FakePipeline(str(tmp_path))
+    os.remove(pipeline.path("c.txt"))
+    pipeline.create_runner(params=[2]).run()
+    # the removed output is written again, the same as before
+    assert pipeline.ran == ["c"]
+
+
+def test_rerun_stages(tmp_path):
+    FakePipeline(str(tmp_path)).create_runner().run()
+
+    pipeline = FakePipeline(str(tmp_path))
+    pipeline.create_runner(rerun_stages=["b"]).run()
+    # b wrote the same output, so d still sees unchanged inputs
+    assert pipeline.ran == ["b"]
+
+
+def test_disabled_stage_does_not_block_dependents(tmp_path):
+    pipeline = FakePipeline(str(tmp_path))
+    runner = pipeline.create_runner(disabled="b")
+    runner.run()
+    assert "b" not in pipeline.ran
+    assert runner.statuses["b"] == STAGE_STATUS_DISABLED
+    assert runner.statuses["d"] == STAGE_STATUS_RAN
+
+
+def test_failure_stops_run_and_resumes(tmp_path):
+    pipeline = FakePipeline(str(tmp_path), fail_stage="c")
+    with pytest.raises(WorkExecutorError) as error:
+        pipeline.create_runner().run()
+    assert [x.task_name for x in error.value.failures] == ["c"]
+    assert "d" not in pipeline.ran
+
+    # the next run starts from the failed stage
+    pipeline = FakePipeline(str(tmp_path))
+    pipeline.create_runner().run()
+    assert pipeline.ran == ["c", "d"]
+
+
+def test_invalid_stages(tmp_path):
+    runner = StageRunner(None)
+    runner.add_stage(Stage("a", lambda: None, depends_on=["b"]))
+    runner.add_stage(Stage("b", lambda: None, depends_on=["a"]))
+    with pytest.raises(ValueError):
+        runner.run()
+
+    with pytest.raises(ValueError):
+        runner.add_stage(Stage("a", lambda: None))
+
+    runner = StageRunner(None, rerun_stages=["missing"])
+    runner.add_stage(Stage("a", lambda: None))
+    with pytest.raises(ValueError):
+        runner.run()
+
+
+def _use_trial_cache(queue):
+    TRIAL_CACHE.get_stats()
+    queue.put(True)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_fork_while_cache_lock_is_held():
+    # like a stage forking its workers while another stage is in the trial cache
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    with TRIAL_CACHE.lock:
+        process = context.Process(target=_use_trial_cache, args=(queue, ))
+        process.start()
+    assert queue.get(timeout=10)
+    process.join(10)
+
+
+def _use_shared_caches(queue):
+    resolver = diff_utils.get_crawl_instance_resolver(
+        mongomock.MongoClient().db.crawl_instances)
+    resolver.prefetch_ids(["missing"])
+    wr_diff_cache.get_wr_diff_cache_stats()
+    filter_list_snapshot.clear_loaded_filter_list_snapshots()
+    queue.put(True)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+@pytest.mark.parametrize("lock_name", [
+    "resolver", "resolvers", "wr_diff_cache", "loaded_snapshots"
+])
+def test_fork_while_shared_cache_lock_is_held(tmp_path, lock_name):
+    resolver = diff_utils.get_crawl_instance_resolver(
+        mongomock.MongoClient().db.crawl_instances)
+    cache = wr_diff_cache.enable_wr_diff_cache(str(tmp_path / "wr_diff"))
+    locks = {
+        "resolver": resolver.lock,
+        "resolvers": diff_utils._CRAWL_INSTANCE_RESOLVERS_LOCK,
+        "wr_diff_cache": cache.lock,
+        "loaded_snapshots": filter_list_snapshot._LOADED_SNAPSHOTS_LOCK
+    }
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    # a deadlocked child must not keep the test run waiting
+    process = context.Process(target=_use_shared_caches,
+                              args=(queue, ),
+                              daemon=True)
+    try:
+        with locks[lock_name]:
+            process.start()
+        assert queue.get(timeout=10)
+        process.join(10)
+        assert process.exitcode == 0
+    finally:
+        if process.is_alive():
+            process.kill()
+        wr_diff_cache.disable_wr_diff_cache()
@@ -0,0 +1,167 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import random
+import string
+import time
+
+import pytest
+
+from cvinspector.diff_analysis.subdomain_clusters import SUBDOMAIN_MATCH_THRESHOLD, SubdomainClusterIndex, \
+    get_bounded_levenshtein, get_subdomain_similarity
+
+ALPHABETS = ["ab", "abc", string.ascii_lowercase[:6],
+             string.ascii_lowercase + string.digits, "a-b.c"]
+
+
+def _brute_force_match(keys, subdomain, threshold=SUBDOMAIN_MATCH_THRESHOLD):
+    # the loop get_diff_requests_sets used: compare with every key, last one wins ties
+    best_key, best_similarity = None, threshold
+    for key in keys:
+        similarity = get_subdomain_similarity(key, subdomain)
+        if similarity >= best_similarity:
+            best_key, best_similarity = key, similarity
+    return best_key, best_similarity
+
+
+def _cluster(variant, control, use_index):
+    # variant subdomains start new clusters when nothing matches, control ones only match
+    keys = []
+    index = SubdomainClusterIndex()
+    matches = []
+    for subdomain in variant:
+        match = index.find_best_match(subdomain) if use_index else \
+            _brute_force_match(keys, subdomain)
+        matches.append(match)
+        if match[0] is None and subdomain not in keys:
+            keys.append(subdomain)
+            index.add(subdomain)
+    for subdomain in control:
+        matches.append(index.find_best_match(subdomain) if use_index else
+                       _brute_force_match(keys, subdomain))
+    return matches
+
+
+def _random_string(rand, alphabet, min_length, max_length):
+    return "".join(
+        rand.choice(alphabet)
+        for _ in range(rand.randint(min_length, max_length)))
+
+
+def _mutate(rand, alphabet, value):
+    # up to 3 random edits, so most mutations stay near the threshold
+    chars = list(value)
+    for _ in range(rand.randint(0, 3)):
+        operation = rand.random()
+        position = rand.randint(0, len(chars))
+        if operation < 0.33:
+            chars.insert(position, rand.choice(alphabet))
+        elif operation < 0.66 and chars:
+            chars.pop(min(position, len(chars) - 1))
+        elif chars:
+            chars[min(position, len(chars) - 1)] = rand.choice(alphabet)
+    return "".join(chars)
+
+
+def _random_site(rand):
+    alphabet = rand.choice(ALPHABETS)
+    bases = [
+        _random_string(rand, alphabet, 0, 12)
+        for _ in range(rand.randint(1, 6))
+    ]
+
+    def _subdomain():
+        if rand.random() < 0.7:
+            return _mutate(rand, alphabet, rand.choice(bases))
+        return _random_string(rand, alphabet, 0, 14)
+
+    variant = [_subdomain() for _ in range(rand.randint(1, 30))]
+    control = [_subdomain() for _ in range(rand.randint(0, 30))]
+    return variant, control
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_index_matches_brute_force(seed):
+    rand = random.Random(seed)
+    for _ in range(30):
+        variant, control = _random_site(rand)
+        assert _cluster(variant, control, True) == _cluster(
+            variant, control, False), (variant, control)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_bounded_levenshtein(seed):
+    rand = random.Random(seed)
+    for _ in range(500):
+        alphabet = rand.choice(ALPHABETS)
+        value = _random_string(rand, alphabet, 0, 10)
+        other_value = _mutate(rand, alphabet, value) if rand.random(
+        ) < 0.5 else _random_string(rand, alphabet, 0, 10)
+        max_distance = rand.randint(0, 6)
+        longest_length = max(len(value), len(other_value))
+        distance = round(
+            (1 - get_subdomain_similarity(value, other_value)) *
+            longest_length)
+        bounded = get_bounded_levenshtein(value, other_value, max_distance)
+        if distance <= max_distance:
+            assert bounded == distance
+        else:
+            assert bounded is None
+
+
+def test_ties_go_to_last_added():
+    index = SubdomainClusterIndex()
+    for key in ["cdn-1", "cdn-2", "cdn-3"]:
+        index.add(key)
+    assert index.find_best_match("cdn-4") == _brute_force_match(
+        ["cdn-1", "cdn-2", "cdn-3"], "cdn-4")
+    assert index.find_best_match("cdn-4")[0] == "cdn-3"
+    assert index.find_best_match("zzzzzzzz") == (None,
+                                                 SUBDOMAIN_MATCH_THRESHOLD)
+
+
+def _benchmark_subdomains(count):
+    rand = random.Random(count)
+    alphabet = string.ascii_lowercase + string.digits
+    subdomains = []
+    for _ in range(count):
+        kind = rand.random()
+        if kind < 0.6:
+            subdomains.append(_random_string(rand, alphabet, 6, 16))
+        elif kind < 0.8:
+            subdomains.append("cdn-%d" % rand.randint(0, 500))
+        else:
+            subdomains.append("edge" + _random_string(rand, alphabet, 3, 3) +
+                              ".eu")
+    return subdomains
+
+
+@pytest.mark.benchmark
+def test_benchmark_index_against_brute_force():
+    subdomains = _benchmark_subdomains(400)
+    control = subdomains[:200]
+
+    start = time.perf_counter()
+    indexed = _cluster(subdomains, control, True)
+    index_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    brute_force = _cluster(subdomains, control, False)
+    brute_force_seconds = time.perf_counter() - start
+
+    print("\ncluster 400 subdomains (+200 control): brute force %.2fs, "
+          "index %.3fs" % (brute_force_seconds, index_seconds))
+    assert indexed == brute_force
+    assert index_seconds < brute_force_seconds
@@ -0,0 +1,143 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import random
+import time
+
+import numpy as np
+import pytest
+
+from cvinspector.common.dommutation_utils import ATTRIBUTE_CHANGED, TEXT_CHANGED, DOM_CONTENT_LOADED
+from cvinspector.common.utils import ABP_BLOCKED_ELEMENT, ERR_BLOCKED_BY_CLIENT
+from cvinspector.ml.plot import get_time_series_bin_counts, get_time_series_bin_indexes, \
+    get_time_series_event_counts
+
+
+def _reference_range_key(event_time, range_keys):
+    # the linear scan the per-bin csv writer used before the numpy binning
+    for index, range_step in enumerate(range_keys):
+        next_time_index = index + 1
+        if next_time_index == len(range_keys):
+            if range_step <= event_time:
+                return range_step
+        else:
+            if range_step <= event_time <= range_keys[next_time_index]:
+                return range_step
+
+
+def _reference_bin_counts(events, event_times, range_keys):
+    events_binned = dict((k, []) for k in range_keys)
+    for event, event_time in zip(events, event_times):
+        events_binned[_reference_range_key(event_time, range_keys)].append(
+            event)
+
+    bin_counts = []
+    for bin_key in range_keys:
+        row = [0] * _count_columns()
+        for event in events_binned[bin_key]:
+            counts = get_time_series_event_counts(event)
+            if counts is not None:
+                row = [x + y for x, y in zip(row, counts)]
+        bin_counts.append(row)
+    return np.asarray(bin_counts, dtype=np.int64).reshape(
+        len(range_keys), _count_columns())
+
+
+def _count_columns():
+    return len(get_time_series_event_counts({
+        "type": "event",
+        "event": {"type": TEXT_CHANGED}
+    }))
+
+
+def _random_event(rand, event_time):
+    choice = rand.randrange(5)
+    if choice == 0:
+        return {"type": "event", "event": {"type": TEXT_CHANGED},
+                "time": event_time}
+    if choice == 1:
+        return {"type": "event", "event": {"type": DOM_CONTENT_LOADED},
+                "time": event_time}
+    if choice == 2:
+        attribute = rand.choice(["src", "class", ABP_BLOCKED_ELEMENT,
+                                 "anticv-hidden"])
+        return {"type": "event",
+                "event": {"type": ATTRIBUTE_CHANGED,
+                          "attribute": attribute,
+                          "targetType": rand.choice(["IFRAME", "DIV", None]),
+                          "newValue": rand.choice(["", "https://ads.com/"])},
+                "time": event_time}
+    if choice == 3:
+        error = rand.choice([ERR_BLOCKED_BY_CLIENT, "ERR_ABORTED"])
+        return {"type": "onErrorOccurred",
+                "event": {"requestTime": event_time,
+                          "details": {"error": "net::" + error}}}
+    # not counted at all
+    return {"type": "onBeforeRequest",
+            "event": {"requestTime": event_time}}
+
+
+def _random_trial(seed, event_count, time_step_ms=500):
+    rand = random.Random(seed)
+    first_time = 1586327346839
+    last_time = first_time + rand.randrange(1, 60000)
+    range_keys = list(range(first_time, last_time + 2000, time_step_ms))
+    event_times = []
+    for _ in range(event_count):
+        if rand.random() < 0.2:
+            # exactly on a bin boundary
+            event_times.append(rand.choice(range_keys))
+        else:
+            event_times.append(rand.randrange(first_time, last_time + 4000))
+    events = [_random_event(rand, x) for x in event_times]
+    return events, event_times, range_keys
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_bin_counts_match_reference(seed):
+    events, event_times, range_keys = _random_trial(seed, 500)
+    expected = _reference_bin_counts(events, event_times, range_keys)
+    actual = get_time_series_bin_counts(events, event_times, range_keys)
+    assert actual.tolist() == expected.tolist()
+
+
+def test_boundary_times_go_to_earlier_bin():
+    range_keys = [1000, 1500, 2000]
+    event_times = [1000, 1200, 1500, 1501, 2000, 9000]
+    expected = [
+        range_keys.index(_reference_range_key(x, range_keys))
+        for x in event_times
+    ]
+    assert get_time_series_bin_indexes(event_times,
+                                       range_keys).tolist() == expected
+    assert expected == [0, 0, 0, 1, 1, 2]
+
+
+@pytest.mark.benchmark
+def test_benchmark_bin_counts():
+    events, event_times, range_keys = _random_trial(0, 50000, time_step_ms=50)
+
+    start = time.perf_counter()
+    expected = _reference_bin_counts(events, event_times, range_keys)
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = get_time_series_bin_counts(events, event_times, range_keys)
+    numpy_seconds = time.perf_counter() - start
+
+    print("\nbin 50k events into %d bins: linear scan %.2fs, numpy %.2fs" %
+          (len(range_keys), reference_seconds, numpy_seconds))
+    assert actual.tolist() == expected.tolist()
+    assert numpy_seconds < reference_seconds
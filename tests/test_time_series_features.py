@@ -0,0 +1,343 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import random
+
+import numpy as np
+import pytest
+
+from cvinspector.ml.feature_extraction import CSV_BIN_NORM, CSV_BLOCKED, CSV_WR_BLOCKED, CSV_ELEM_BLOCKED, \
+    CSV_SNIPPET_BLOCKED, CSV_NODES_ADDED, CSV_NODES_REMOVED, CSV_ATTRIBUTE_CHANGED, CSV_TEXT_CHANGED, \
+    CSV_TOTAL_CHANGES, CSV_IFRAME_SRC_CHANGED, CSV_IFRAME_BLOCKED, IMPORTANT_CSV_KEYS, SPIKE_MIN, \
+    TimeSeriesDOMFeatureExtraction, get_avg_time_after_blocked, get_clusters, get_count_of_events_after_last_event
+from cvinspector.ml.plot import TIME_SERIES_VALUE_COLUMNS, write_time_series_csv
+from cvinspector.ml.time_series_store import TIME_SERIES_COLUMN_INDEX, load_time_series_rows
+
+_MIN = 10000
+
+# the csv.DictReader versions the numpy feature extraction replaced
+
+
+def _reference_has_spike(specific_keys, row):
+    for key in row.keys():
+        if key in specific_keys and int(row[key]) >= SPIKE_MIN:
+            return True
+    return False
+
+
+def _reference_count_of_events_after_last_event(specific_keys, last_event_key,
+                                                rows):
+    considered_rows = rows
+    last_event_index = 0
+    for index, row in enumerate(reversed(considered_rows), start=1):
+        if last_event_key in row and int(row[last_event_key]) > 0:
+            last_event_index = -1 * index
+            break
+
+    event_count = 0
+    if last_event_index < 0:
+        considered_rows = considered_rows[last_event_index:]
+        for row in considered_rows:
+            if _reference_has_spike(specific_keys, row):
+                event_count += 1
+    return event_count
+
+
+def _reference_avg_time_after_blocked(specific_keys,
+                                      blocked_key,
+                                      rows,
+                                      after_event_key=None):
+    considered_rows = rows
+    after_event_index = -1
+    if after_event_key is not None:
+        for index, row in enumerate(considered_rows, start=0):
+            if after_event_key in row and int(row[after_event_key]) > 0:
+                after_event_index = index
+                break
+
+    if after_event_index >= 0:
+        considered_rows = considered_rows[after_event_index:]
+
+    times = []
+    time_count = 0
+    found_first_block = False
+    for row in considered_rows:
+        if blocked_key in row:
+            if int(row[blocked_key]) > 0:
+                time_count = 0
+                found_first_block = True
+            elif _reference_has_spike(specific_keys, row):
+                if found_first_block:
+                    times.append(time_count)
+                    found_first_block = False
+                    time_count = 0
+        time_count += 1
+
+    if len(times) == 0:
+        return 0
+    return np.average(times)
+
+
+def _reference_clusters(property_name, rows):
+    clusters = []
+    threshold = 2
+    count = 0
+    current_cluster = []
+    for row in rows:
+        if int(row[property_name]) == 0:
+            if count > 0:
+                count -= 1
+        else:
+            count = threshold
+
+        if count > 0 and int(row[property_name]) >= SPIKE_MIN:
+            current_cluster.append(int(row[property_name]))
+
+        if count == 0:
+            if len(current_cluster) > 0:
+                clusters.append(current_cluster)
+                current_cluster = []
+
+    if len(current_cluster) > 0:
+        clusters.append(current_cluster)
+    return clusters
+
+
+def _reference_event_frequency(property_key, rows, spike_min=1):
+    event_count = 0
+    for row in rows:
+        if property_key in row:
+            if int(row[property_key]) >= spike_min:
+                event_count += 1
+
+    event_freq = 0
+    if len(rows) > 0:
+        event_freq = event_count / len(rows)
+    return event_count, event_freq
+
+
+def _reference_time_between_event(property_key, rows, spike_min=1):
+    time_gaps = []
+    last_event_time = -1
+    for index, row in enumerate(rows, start=1):
+        if property_key in row and int(row[property_key]) >= spike_min:
+            if last_event_time > 0:
+                time_gaps.append(index - last_event_time)
+            last_event_time = index
+
+    if len(time_gaps) == 0:
+        return 0
+    return np.average(time_gaps)
+
+
+def _reference_simple_trial_features(rows):
+    features = dict()
+    for spikes_key in [
+            "blocked_spikes", "wr_blocked_spikes", "elem_blocked_spikes",
+            "snippet_blocked_spikes"
+    ]:
+        features[spikes_key] = 0
+    for csv_key in [
+            CSV_NODES_ADDED, CSV_NODES_REMOVED, CSV_ATTRIBUTE_CHANGED,
+            CSV_TEXT_CHANGED
+    ]:
+        features[csv_key + "_spikes"] = 0
+        features["max_" + csv_key] = 0
+        features["min_" + csv_key] = _MIN
+
+    for row in rows:
+        if int(row[CSV_BLOCKED]) > 0:
+            features["blocked_spikes"] += 1
+            if int(row[CSV_WR_BLOCKED]) > 0:
+                features["wr_blocked_spikes"] += 1
+            if int(row[CSV_ELEM_BLOCKED]) > 0:
+                features["elem_blocked_spikes"] += 1
+            if int(row[CSV_SNIPPET_BLOCKED]) > 0:
+                features["snippet_blocked_spikes"] += 1
+
+        for csv_key in [
+                CSV_NODES_ADDED, CSV_NODES_REMOVED, CSV_ATTRIBUTE_CHANGED,
+                CSV_TEXT_CHANGED
+        ]:
+            value = int(row[csv_key])
+            if value >= SPIKE_MIN:
+                features[csv_key + "_spikes"] += 1
+                features["max_" + csv_key] = max(features["max_" + csv_key],
+                                                 value)
+                features["min_" + csv_key] = min(features["min_" + csv_key],
+                                                 value)
+    return features
+
+
+def _reference_last_time(rows):
+    for row in reversed(rows):
+        if int(row[CSV_TOTAL_CHANGES]) >= SPIKE_MIN:
+            return int(row[CSV_BIN_NORM])
+    return 0
+
+
+class _ReferenceFeatureExtraction(TimeSeriesDOMFeatureExtraction):
+    # the by half and by fifths features over the reference frequency and gaps
+    def get_event_frequency(self, property_key, rows, spike_min=1):
+        return _reference_event_frequency(property_key,
+                                          rows,
+                                          spike_min=spike_min)
+
+    def get_time_between_event(self, property_key, rows, spike_min=1):
+        return _reference_time_between_event(property_key,
+                                             rows,
+                                             spike_min=spike_min)
+
+
+def _make_bins(rand, bin_count):
+    # bursts of dom events, sparse blocks and iframe events, like the binned trials
+    rows = np.zeros((bin_count, len(TIME_SERIES_VALUE_COLUMNS)),
+                    dtype=np.int64)
+    rows[:, TIME_SERIES_COLUMN_INDEX[CSV_BIN_NORM]] = np.arange(bin_count)
+    burst = 0
+    for bin_index in range(bin_count):
+        if rand.random() < 0.08:
+            burst = rand.randint(1, 6)
+        for csv_key in IMPORTANT_CSV_KEYS:
+            if burst > 0 and rand.random() < 0.7:
+                rows[bin_index, TIME_SERIES_COLUMN_INDEX[csv_key]] = rand.choice(
+                    [1, 2, 3, 5, 12, 40])
+        burst = max(burst - 1, 0)
+        if rand.random() < 0.05:
+            for csv_key in [CSV_WR_BLOCKED, CSV_ELEM_BLOCKED,
+                            CSV_SNIPPET_BLOCKED]:
+                if rand.random() < 0.5:
+                    rows[bin_index,
+                         TIME_SERIES_COLUMN_INDEX[csv_key]] = rand.randint(1, 3)
+            rows[bin_index, TIME_SERIES_COLUMN_INDEX[CSV_BLOCKED]] = rows[
+                bin_index, [
+                    TIME_SERIES_COLUMN_INDEX[CSV_WR_BLOCKED],
+                    TIME_SERIES_COLUMN_INDEX[CSV_ELEM_BLOCKED],
+                    TIME_SERIES_COLUMN_INDEX[CSV_SNIPPET_BLOCKED]
+                ]].sum()
+        for csv_key in [
+                "dom_content_loaded", CSV_IFRAME_SRC_CHANGED,
+                CSV_IFRAME_BLOCKED
+        ]:
+            if rand.random() < 0.02:
+                rows[bin_index, TIME_SERIES_COLUMN_INDEX[csv_key]] = 1
+    rows[:, TIME_SERIES_COLUMN_INDEX[CSV_TOTAL_CHANGES]] = rows[:, [
+        TIME_SERIES_COLUMN_INDEX[csv_key] for csv_key in IMPORTANT_CSV_KEYS
+    ]].sum(axis=1)
+    return rows
+
+
+def _write_bins(tmp_path, name, rows):
+    output_file_name = str(tmp_path / name)
+    range_keys = [1586327346839 + 100 * index for index in range(len(rows))]
+    write_time_series_csv(output_file_name, range_keys, rows)
+    csv_path = output_file_name + ".csv"
+    with open(csv_path) as time_file:
+        dict_rows = list(csv.DictReader(time_file, delimiter=','))
+    return csv_path, dict_rows
+
+
+BIN_COUNTS = [0, 1, 2, 37, 250, 251]
+
+
+@pytest.fixture(params=[(seed, bin_count) for seed in range(4)
+                        for bin_count in BIN_COUNTS])
+def time_series(request, tmp_path):
+    seed, bin_count = request.param
+    rows = _make_bins(random.Random(seed * 1000 + bin_count), bin_count)
+    csv_path, dict_rows = _write_bins(tmp_path, "trial", rows)
+    numpy_rows = load_time_series_rows(csv_path)
+    assert numpy_rows.shape == (bin_count, len(TIME_SERIES_VALUE_COLUMNS))
+    return csv_path, numpy_rows, dict_rows
+
+
+def test_module_functions_match_reference(time_series):
+    _, rows, dict_rows = time_series
+    for last_event_key in [CSV_IFRAME_SRC_CHANGED, CSV_IFRAME_BLOCKED]:
+        assert get_count_of_events_after_last_event(
+            IMPORTANT_CSV_KEYS, last_event_key,
+            rows) == _reference_count_of_events_after_last_event(
+                IMPORTANT_CSV_KEYS, last_event_key, dict_rows)
+    for after_event_key in [None, "dom_content_loaded"]:
+        assert get_avg_time_after_blocked(
+            IMPORTANT_CSV_KEYS,
+            CSV_BLOCKED,
+            rows,
+            after_event_key=after_event_key) == _reference_avg_time_after_blocked(
+                IMPORTANT_CSV_KEYS,
+                CSV_BLOCKED,
+                dict_rows,
+                after_event_key=after_event_key)
+    for csv_key in IMPORTANT_CSV_KEYS:
+        assert get_clusters(csv_key,
+                            rows) == _reference_clusters(csv_key, dict_rows)
+
+
+def test_frequency_and_gaps_match_reference(time_series):
+    _, rows, dict_rows = time_series
+    extraction = TimeSeriesDOMFeatureExtraction("site.com", None)
+    reference = _ReferenceFeatureExtraction("site.com", None)
+    for csv_key in [CSV_BLOCKED, CSV_ELEM_BLOCKED] + IMPORTANT_CSV_KEYS:
+        for spike_min in [1, SPIKE_MIN]:
+            assert extraction.get_event_frequency(
+                csv_key, rows,
+                spike_min=spike_min) == _reference_event_frequency(
+                    csv_key, dict_rows, spike_min=spike_min)
+            assert extraction.get_time_between_event(
+                csv_key, rows,
+                spike_min=spike_min) == _reference_time_between_event(
+                    csv_key, dict_rows, spike_min=spike_min)
+        assert extraction.get_event_frequency_by_half_features(
+            csv_key,
+            rows) == reference.get_event_frequency_by_half_features(
+                csv_key, dict_rows)
+        assert extraction.get_event_frequency_by_fifths_features(
+            csv_key,
+            rows) == reference.get_event_frequency_by_fifths_features(
+                csv_key, dict_rows)
+
+
+def test_spike_statistics_match_reference(time_series):
+    csv_path, _, dict_rows = time_series
+    extraction = TimeSeriesDOMFeatureExtraction("site.com", None)
+    rows, features = extraction.get_simple_trial_features("trial 1", csv_path)
+
+    expected = _reference_simple_trial_features(dict_rows)
+    for spikes_key in [
+            "blocked_spikes", "wr_blocked_spikes", "elem_blocked_spikes",
+            "snippet_blocked_spikes"
+    ]:
+        assert features[spikes_key] == expected[spikes_key]
+    for csv_key in [
+            CSV_NODES_ADDED, CSV_NODES_REMOVED, CSV_ATTRIBUTE_CHANGED,
+            CSV_TEXT_CHANGED
+    ]:
+        assert features[csv_key + "_spikes"] == expected[csv_key + "_spikes"]
+        assert features["max_" + csv_key] == expected["max_" + csv_key]
+        assert features["min_" + csv_key] == expected["min_" + csv_key]
+
+    trial_features = extraction.get_trial_features("trial 1", csv_path)
+    assert trial_features["ts__last_time"] == _reference_last_time(dict_rows)
+
+
+def test_generated_bins_have_spikes_and_blocks():
+    # the fixtures above would not catch much on empty series
+    rows = _make_bins(random.Random(3), 250)
+    assert np.count_nonzero(rows[:, TIME_SERIES_COLUMN_INDEX[CSV_BLOCKED]]) > 0
+    assert np.count_nonzero(
+        rows[:, TIME_SERIES_COLUMN_INDEX[CSV_NODES_ADDED]] >= SPIKE_MIN) > 0
+    assert np.count_nonzero(
+        rows[:, TIME_SERIES_COLUMN_INDEX[CSV_IFRAME_BLOCKED]]) > 0
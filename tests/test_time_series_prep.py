@@ -0,0 +1,100 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import glob
+import os
+import queue
+
+import pytest
+
+from cvinspector.common.script_utils import URL_CRAWLED, TimeseriesPrepThread
+from cvinspector.common.utils import get_trial_label, iter_output_queue_rows, OutputQueueClose
+from cvinspector.common.work_executor import SiteTaskErrors, WorkExecutor
+from cvinspector.ml.output_features_to_csv import CV_DETECT_TARGET_NAME
+from cvinspector.ml.time_series_store import TIME_SERIES_STORE_SUFFIX
+
+TRIALS = 2
+
+
+def _row(url, chunk="chunk-1"):
+    row = {URL_CRAWLED: url, "Chunk": chunk, CV_DETECT_TARGET_NAME: "0"}
+    for trial_index in range(TRIALS):
+        trial_label = get_trial_label(trial_index)
+        for column in [
+                "File Path WR Vanilla", "File Path WR", "File Path DOM Vanilla",
+                "File Path DOM"
+        ]:
+            # no trial files: the row is still written, without time series
+            row[column + " " + trial_label] = ""
+    return row
+
+
+def _queued_rows(output_queue):
+    output_queue.put(OutputQueueClose())
+    return [
+        row for rows in iter_output_queue_rows(output_queue) for row in rows
+    ]
+
+
+def test_failed_row_does_not_drop_the_chunk(tmp_path):
+    missing_chunk = _row("no-chunk.com")
+    del missing_chunk["Chunk"]
+    missing_trial = _row("no-trial.com")
+    del missing_trial["File Path DOM " + get_trial_label(1)]
+    rows = [
+        _row("a.com"), missing_chunk,
+        _row("b.com"), missing_trial,
+        _row("c.com", chunk="chunk-2")
+    ]
+
+    output_queue = queue.Queue()
+    prep_thread = TimeseriesPrepThread(0,
+                                       "Thread-test",
+                                       rows,
+                                       str(tmp_path),
+                                       output_queue,
+                                       trials=TRIALS)
+    with pytest.raises(SiteTaskErrors) as error:
+        prep_thread.run()
+    assert [x.url for x in error.value.site_errors
+            ] == ["no-chunk.com", "no-trial.com"]
+    assert isinstance(error.value.site_errors[0].exception, KeyError)
+
+    # the other rows are saved and queued
+    assert sorted(row[0] for row in _queued_rows(output_queue)) == [
+        "a.com", "b.com", "c.com"
+    ]
+    for crawl_chunk in ["chunk-1", "chunk-2"]:
+        assert len(
+            glob.glob(
+                os.path.join(str(tmp_path), crawl_chunk,
+                             "*" + TIME_SERIES_STORE_SUFFIX))) == 1
+
+
+def test_failed_rows_are_reported_per_site(tmp_path):
+    missing_chunk = _row("no-chunk.com")
+    del missing_chunk["Chunk"]
+    output_queue = queue.Queue()
+    prep_thread = TimeseriesPrepThread(0,
+                                       "Thread-test",
+                                       [_row("a.com"), missing_chunk],
+                                       str(tmp_path),
+                                       output_queue,
+                                       trials=TRIALS)
+    with WorkExecutor(1, progress_callback=None) as executor:
+        executor.submit(prep_thread.run, task_name="Thread-test")
+        failures = executor.wait()
+    assert [x.url for x in failures] == ["no-chunk.com"]
+    assert [row[0] for row in _queued_rows(output_queue)] == ["a.com"]
@@ -0,0 +1,149 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+from cvinspector.data_collect.trial_scheduler import Trial, TrialScheduler, interleave_trials
+
+
+class FakeDriver:
+    def __init__(self, is_control, profile_path, display_name):
+        self.is_control = is_control
+        self.profile_path = profile_path
+        self.display_name = display_name
+
+
+class FakeBrowsers:
+    # fake factories for TrialScheduler, no chrome needed
+    def __init__(self, measure_seconds=0.02, failing_trial=None):
+        self.measure_seconds = measure_seconds
+        self.failing_trial = failing_trial
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.profiles_created = []
+        self.profiles_cleaned = []
+        self.displays_started = 0
+        self.displays_stopped = 0
+
+    def driver_factory(self, is_control, profile_path, display_name):
+        return "control" if is_control else "variant", FakeDriver(
+            is_control, profile_path, display_name)
+
+    def measure(self, driver, driver_name, trial, profile_path=None,
+                thread_name=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.measure_seconds)
+            if trial == self.failing_trial:
+                raise RuntimeError("trial failed")
+            return driver_name, trial.trial_number, driver.profile_path, driver.display_name
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def profile_factory(self, is_control, thread_name):
+        with self.lock:
+            profile_path = "profile-%d" % len(self.profiles_created)
+            self.profiles_created.append(profile_path)
+        return profile_path
+
+    def profile_cleaner(self, profile_path, thread_name):
+        with self.lock:
+            self.profiles_cleaned.append(profile_path)
+
+    def display_factory(self):
+        with self.lock:
+            self.displays_started += 1
+            display_number = self.displays_started
+        return object(), ":%d" % display_number
+
+    def display_cleaner(self, virtual_display):
+        with self.lock:
+            self.displays_stopped += 1
+
+    def create_scheduler(self, max_browsers):
+        return TrialScheduler(self.driver_factory,
+                              self.measure,
+                              max_browsers=max_browsers,
+                              profile_factory=self.profile_factory,
+                              profile_cleaner=self.profile_cleaner,
+                              display_factory=self.display_factory,
+                              display_cleaner=self.display_cleaner,
+                              thread_name="Test")
+
+
+def test_interleave_trials():
+    trials = interleave_trials([1, 2, 3], [0, 1, 2, 3])
+    assert trials == [
+        Trial(True, 1),
+        Trial(False, 0),
+        Trial(True, 2),
+        Trial(False, 1),
+        Trial(True, 3),
+        Trial(False, 2),
+        Trial(False, 3)
+    ]
+
+
+def test_results_in_trial_order():
+    browsers = FakeBrowsers()
+    trials = interleave_trials([1, 2, 3], [0, 1, 2, 3])
+    results = browsers.create_scheduler(3).run(trials)
+
+    assert [trial for trial, _ in results] == trials
+    for trial, (driver_name, trial_number, profile_path,
+                display_name) in results:
+        assert driver_name == ("control" if trial.is_control else "variant")
+        assert trial_number == trial.trial_number
+        assert profile_path.startswith("profile-")
+        assert display_name.startswith(":")
+
+
+def test_runs_up_to_max_browsers_concurrently():
+    browsers = FakeBrowsers(measure_seconds=0.1)
+    browsers.create_scheduler(3).run(
+        interleave_trials([1, 2, 3], [0, 1, 2, 3]))
+
+    assert browsers.max_running == 3
+    # one display per worker, one profile per trial, everything cleaned up
+    assert browsers.displays_started == 3
+    assert browsers.displays_stopped == 3
+    assert len(browsers.profiles_created) == 7
+    assert sorted(browsers.profiles_cleaned) == sorted(
+        browsers.profiles_created)
+
+
+def test_single_browser_is_sequential():
+    browsers = FakeBrowsers()
+    browsers.create_scheduler(1).run(interleave_trials([1], [0, 1]))
+    assert browsers.max_running == 1
+
+
+def test_failure_is_raised_after_all_trials():
+    trials = interleave_trials([1, 2], [0, 1, 2])
+    browsers = FakeBrowsers(failing_trial=Trial(False, 0))
+    with pytest.raises(RuntimeError):
+        browsers.create_scheduler(2).run(trials)
+
+    # the other trials still ran and every profile was cleaned up
+    assert len(browsers.profiles_created) == len(trials)
+    assert sorted(browsers.profiles_cleaned) == sorted(
+        browsers.profiles_created)
@@ -0,0 +1,262 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import copy
+import json
+import random
+import time
+
+import pytest
+
+from cvinspector.common.trial_cache import TRIAL_CACHE
+from cvinspector.common.utils import JSON_SCHEMA_VERSION_KEY, JSON_WEBREQUEST_KEY, VARIANT, \
+    WEBREQUEST_SCHEMA_VERSION, get_blocked_webrequests, get_webrequests_from_raw_json, load_webrequest_details, \
+    normalize_webrequests_json_file
+from cvinspector.common.webrequests_utils import get_webrequest_detail_value
+from cvinspector.diff_analysis.webrequests_core import get_wr_trial_aggregate
+
+DETAIL_NAMES = ["type", "statusCode", "responseHeaders", "error", "missing"]
+# a legacy string the extension cut off, it is not valid json
+BROKEN_DETAILS = '{"statusCode": 200, "type": "scr'
+
+
+def _details(rand, status):
+    details = {
+        "tabId": 3,
+        "frameId": rand.choice([0, 0, 4]),
+        "type": rand.choice(["script", "image", "xmlhttprequest", "sub_frame"])
+    }
+    if status == "onErrorOccurred":
+        details["error"] = rand.choice([
+            "net::ERR_BLOCKED_BY_CLIENT", "net::ERR_ABORTED",
+            "net::ERR_BLOCKED_BY_CLIENT"
+        ])
+        return details
+    details["statusCode"] = rand.choice([200, 200, 200, 204, 404])
+    response_headers = []
+    if rand.random() < 0.8:
+        response_headers.append({
+            "name": rand.choice(["Content-Type", "content-type"]),
+            "value": rand.choice(["text/javascript", "image/png",
+                                  "application/json; charset=utf-8"])
+        })
+    if rand.random() < 0.5:
+        response_headers.append({
+            "name": "Cache-Control",
+            "value": rand.choice(["no-cache", "max-age=3600"])
+        })
+    if rand.random() < 0.5:
+        response_headers.append({
+            "name": "Content-Length",
+            "value": rand.choice(["123", "45678", "unknown"])
+        })
+    details["responseHeaders"] = response_headers
+    return details
+
+
+def _make_events(seed, count, with_broken=True):
+    # events with details as objects (schema version 2)
+    rand = random.Random(seed)
+    events = []
+    for index in range(count):
+        status = rand.choice(
+            ["onBeforeRequest", "onCompleted", "onCompleted", "onErrorOccurred"])
+        details = _details(rand, status)
+        if rand.random() < 0.05:
+            details = None
+        events.append({
+            "type": "event",
+            "event": {
+                "requestId": str(index),
+                "url": "https://%s.site%d.com/%s/%d.js" %
+                (rand.choice(["www", "cdn", "ads"]), rand.randint(0, 30),
+                 rand.choice(["a", "b/c", "lib"]), rand.randint(0, 200)),
+                "status": status,
+                "details": details
+            },
+            "time": 1586327346839 + index
+        })
+    if with_broken:
+        events[0]["event"]["status"] = "onErrorOccurred"
+        events[1]["event"]["status"] = "onCompleted"
+    return events
+
+
+def _to_legacy(events, with_broken=True):
+    # what the extensions saved before: details as a JSON string
+    legacy_events = copy.deepcopy(events)
+    for index, entry in enumerate(legacy_events):
+        details = entry["event"]["details"]
+        if with_broken and index < 2:
+            entry["event"]["details"] = BROKEN_DETAILS
+        elif details is not None:
+            entry["event"]["details"] = json.dumps(details)
+    return legacy_events
+
+
+def _write_trial(file_path, events, schema_version=None):
+    file_data = {"url": "https://site.com", JSON_WEBREQUEST_KEY: events}
+    if schema_version:
+        file_data[JSON_SCHEMA_VERSION_KEY] = schema_version
+    with open(file_path, 'w') as f:
+        json.dump(file_data, f)
+    return file_path
+
+
+def _trial_files(tmp_path, seed, count=400):
+    events = _make_events(seed, count)
+    # the broken legacy details are dropped (None) by the normalizer
+    object_events = copy.deepcopy(events)
+    object_events[0]["event"]["details"] = None
+    object_events[1]["event"]["details"] = None
+    legacy_path = _write_trial(str(tmp_path / ("legacy%d.json" % seed)),
+                               _to_legacy(events))
+    object_path = _write_trial(str(tmp_path / ("object%d.json" % seed)),
+                               object_events, WEBREQUEST_SCHEMA_VERSION)
+    return legacy_path, object_path
+
+
+def _comparable_aggregate(aggregate):
+    # the trial instances differ (file_path), the rest must not
+    req_to_type, req_to_resource_type = aggregate[0], aggregate[1]
+    return (dict((url, (trial_inst["_id"], req_item["time"], content_type))
+                 for url, (trial_inst, req_item,
+                           content_type) in req_to_type.items()),
+            dict((url, (value["trial"]["_id"], value["request"]["time"],
+                        value["data"]))
+                 for url, value in req_to_resource_type.items()),
+            aggregate[2:])
+
+
+def _aggregate(file_paths):
+    crawl_trial_group = {VARIANT: dict()}
+    for index, file_path in enumerate(file_paths):
+        crawl_trial_group[VARIANT][str(index)] = {
+            "_id": "variant-%d" % index,
+            "file_path": file_path
+        }
+    return _comparable_aggregate(
+        get_wr_trial_aggregate(crawl_trial_group, VARIANT))
+
+
+def test_load_webrequest_details():
+    details = {"statusCode": 200, "type": "script"}
+    assert load_webrequest_details(json.dumps(details)) == details
+    assert load_webrequest_details(details) is details
+    with pytest.raises(ValueError):
+        load_webrequest_details(BROKEN_DETAILS)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_blocked_webrequests_same_for_both_schemas(tmp_path, seed):
+    legacy_path, object_path = _trial_files(tmp_path, seed)
+    blocked = get_blocked_webrequests(object_path)
+    assert get_blocked_webrequests(legacy_path) == blocked
+    assert blocked
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_wr_trial_aggregate_same_for_both_schemas(tmp_path, seed):
+    legacy_paths, object_paths = zip(
+        *[_trial_files(tmp_path, seed * 10 + trial) for trial in range(3)])
+    aggregate = _aggregate(object_paths)
+    assert _aggregate(legacy_paths) == aggregate
+    # the synthetic trials have content types, cache control and lengths
+    resource_data = [data for _, _, data in aggregate[1].values()]
+    assert any(data["cache_control"] != "none" for data in resource_data)
+    assert any(data["content_length"] > 0 for data in resource_data)
+
+
+def test_webrequest_detail_value_same_for_both_schemas():
+    events = _make_events(5, 500)
+    legacy_events = _to_legacy(events)
+    found = 0
+    for index, (entry, legacy_entry) in enumerate(zip(events, legacy_events)):
+        if index < 2:
+            # broken legacy details give nothing, like missing details
+            entry = copy.deepcopy(entry)
+            entry["event"]["details"] = None
+        for detail_name in DETAIL_NAMES:
+            value = get_webrequest_detail_value(entry, detail_name)
+            assert get_webrequest_detail_value(legacy_entry,
+                                               detail_name) == value
+            found += value is not None
+    assert found > 0
+    assert get_webrequest_detail_value(None, "type") is None
+
+
+def test_normalizer_upgrades_legacy_file(tmp_path):
+    legacy_path, object_path = _trial_files(tmp_path, 7)
+    output_path = str(tmp_path / "normalized.json")
+    assert normalize_webrequests_json_file(legacy_path, output_path)
+    with open(output_path) as f:
+        normalized = json.load(f)
+    with open(object_path) as f:
+        assert normalized == json.load(f)
+    assert normalized[JSON_SCHEMA_VERSION_KEY] == WEBREQUEST_SCHEMA_VERSION
+
+
+def test_normalizer_is_idempotent(tmp_path):
+    legacy_path, _ = _trial_files(tmp_path, 8)
+    assert normalize_webrequests_json_file(legacy_path)
+    with open(legacy_path, 'rb') as f:
+        normalized = f.read()
+
+    # a normalized (or new) file is left alone
+    assert not normalize_webrequests_json_file(legacy_path)
+    output_path = str(tmp_path / "again.json")
+    assert not normalize_webrequests_json_file(legacy_path, output_path)
+    with open(legacy_path, 'rb') as f:
+        assert f.read() == normalized
+    assert not (tmp_path / "again.json").exists()
+    assert get_webrequests_from_raw_json(legacy_path, "onCompleted")
+
+
+def _read_trial(file_path):
+    # what one diff group asks of a webrequests trial file
+    TRIAL_CACHE.clear()
+    blocked = get_blocked_webrequests(file_path)
+    values = [
+        get_webrequest_detail_value(webrequest, "type")
+        for webrequest in get_webrequests_from_raw_json(
+            file_path, "onCompleted")
+    ]
+    return blocked, values
+
+
+@pytest.mark.benchmark
+def test_benchmark_details_schema_before_after(tmp_path):
+    events = _make_events(50000, 50000, with_broken=False)
+    legacy_path = _write_trial(str(tmp_path / "legacy.json"),
+                               _to_legacy(events, with_broken=False))
+    object_path = _write_trial(str(tmp_path / "object.json"), events,
+                               WEBREQUEST_SCHEMA_VERSION)
+    runs = 3
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        legacy_result = _read_trial(legacy_path)
+    legacy_seconds = (time.perf_counter() - start) / runs
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        object_result = _read_trial(object_path)
+    object_seconds = (time.perf_counter() - start) / runs
+
+    print("\nparse 50k-event webrequests trial: before (details strings) "
+          "%.3fs, after (details objects) %.3fs" %
+          (legacy_seconds, object_seconds))
+    assert object_result == legacy_result
+    assert object_seconds < legacy_seconds
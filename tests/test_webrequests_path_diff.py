@@ -0,0 +1,222 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import random
+import string
+import time
+
+import pytest
+
+from cvinspector.common.webrequests_utils import get_domain_only_from_url, get_path_and_query_params, remove_last_path
+from cvinspector.diff_analysis.utils import contains_important_resource
+from cvinspector.diff_analysis.webrequests_core import _contains_any_path, _create_path_trie, _get_trimmed_path, \
+    get_important_path_to_requests, get_path_resource_mismatches
+
+PATH_PARTS = ["js", "img", "css", "ads", "v1", "lib"]
+RESOURCES = ["a.js", "b.png", "c.css", "d.gif", "e.html", "f", "g.jpg"]
+
+
+def _random_string(rand, length, alphabet=string.ascii_lowercase + string.digits):
+    return "".join(rand.choice(alphabet) for _ in range(length))
+
+
+def _make_urls(rand, count, slds):
+    urls = []
+    for _ in range(count):
+        subdomain = rand.choice(["www", "cdn", "static", _random_string(rand, 5)])
+        path = "/".join(
+            rand.choice(PATH_PARTS) for _ in range(rand.randint(1, 4)))
+        query = "?id=" + _random_string(rand, 3) if rand.random() < 0.5 else ""
+        urls.append("https://%s.%s/%s/%s%s" %
+                    (subdomain, rand.choice(slds), path,
+                     rand.choice(RESOURCES), query))
+    return urls
+
+
+def _make_sides(count, seed):
+    # two sides sharing most requests, with some paths requested a different number of times
+    rand = random.Random(seed)
+    slds = [_random_string(rand, 6) + ".com" for _ in range(20)]
+    shared = _make_urls(rand, count, slds)
+    control = [url for url in shared if rand.random() < 0.9] + \
+        _make_urls(rand, count // 5, slds)
+    variant = [url for url in shared if rand.random() < 0.9] + \
+        _make_urls(rand, count // 5, slds)
+    return control, variant
+
+
+def _reference_path_to_requests(webreqs):
+    # the grouping _get_wr_differences_only did inline, with list membership
+    path_to_request = dict()
+    trim_paths = []
+    for req in webreqs:
+        domain = get_domain_only_from_url(req)
+        path, _ = get_path_and_query_params(req)
+        if contains_important_resource(path):
+            path = remove_last_path(path)
+            if len(path) > 0:
+                trim_path = _get_trimmed_path(path)
+                if trim_path not in trim_paths:
+                    trim_paths.append(trim_path)
+                if (domain, path) not in path_to_request:
+                    path_to_request[(domain, path)] = []
+                path_to_request[(domain, path)].append(req)
+    return path_to_request, trim_paths
+
+
+def _reference_path_mismatch(control_webreqs, variant_webreqs):
+    # the grouping, mismatch and request filtering before the indexes
+    control_path_to_request, _ = _reference_path_to_requests(control_webreqs)
+    variant_path_to_request, _ = _reference_path_to_requests(variant_webreqs)
+    path_resource_mismatch_found = []
+    for key in control_path_to_request.keys():
+        if key in variant_path_to_request:
+            if len(control_path_to_request.get(key)) != len(
+                    variant_path_to_request.get(key)):
+                path_resource_mismatch_found.append(key)
+    control_mismatch = []
+    variant_mismatch = []
+    for key in path_resource_mismatch_found:
+        control_mismatch += control_path_to_request.get(key)
+        variant_mismatch += variant_path_to_request.get(key)
+    control_kept = [req for req in control_webreqs if req in control_mismatch]
+    variant_kept = [req for req in variant_webreqs if req in variant_mismatch]
+    return control_mismatch, variant_mismatch, control_kept, variant_kept
+
+
+def _indexed_path_mismatch(control_webreqs, variant_webreqs):
+    control_path_to_request, _ = get_important_path_to_requests(control_webreqs)
+    variant_path_to_request, _ = get_important_path_to_requests(variant_webreqs)
+    control_mismatch, variant_mismatch = get_path_resource_mismatches(
+        control_path_to_request, variant_path_to_request)
+    control_mismatch_set = set(control_mismatch)
+    variant_mismatch_set = set(variant_mismatch)
+    control_kept = [
+        req for req in control_webreqs if req in control_mismatch_set
+    ]
+    variant_kept = [
+        req for req in variant_webreqs if req in variant_mismatch_set
+    ]
+    return control_mismatch, variant_mismatch, control_kept, variant_kept
+
+
+def _reference_remove_paths(domain_paths, intersection_paths):
+    # get_diff_requests_sets rescanned every domain path per intersected path
+    remaining = set(domain_paths)
+    for intersected_path in intersection_paths:
+        for domain_path in list(remaining):
+            if intersected_path in domain_path:
+                remaining.remove(domain_path)
+    return remaining
+
+
+def _trie_remove_paths(domain_paths, intersection_paths):
+    path_trie = _create_path_trie(intersection_paths)
+    return set(domain_path for domain_path in domain_paths
+               if not _contains_any_path(domain_path, path_trie))
+
+
+def _make_domain_paths(rand, count):
+    domain_paths = set(
+        "%s.com/%s/%s" % (_random_string(rand, 5), _random_string(rand, 3),
+                          _random_string(rand, 6)) for _ in range(count))
+    intersection_paths = set(
+        "/" + _random_string(rand, 3) for _ in range(count // 10))
+    return domain_paths, intersection_paths
+
+
+def test_path_trie_matches_substring_scan():
+    rand = random.Random(1)
+    for _ in range(2000):
+        paths = set(
+            _random_string(rand, rand.randint(0, 4), "abc/")
+            for _ in range(rand.randint(1, 6)))
+        path_trie = _create_path_trie(paths)
+        for _ in range(10):
+            value = _random_string(rand, rand.randint(0, 12), "abc/")
+            assert _contains_any_path(value, path_trie) == any(
+                path in value for path in paths)
+
+
+def test_empty_trie_matches_nothing():
+    assert not _contains_any_path("a.com/js", _create_path_trie([]))
+    assert _contains_any_path("", _create_path_trie([""]))
+
+
+def test_important_path_to_requests_matches_reference():
+    control, variant = _make_sides(500, 2)
+    for webreqs in (control, variant):
+        path_to_request, trim_paths = get_important_path_to_requests(webreqs)
+        reference_path_to_request, reference_trim_paths = _reference_path_to_requests(
+            webreqs)
+        assert list(path_to_request.items()) == list(
+            reference_path_to_request.items())
+        assert trim_paths == reference_trim_paths
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_path_mismatch_matches_reference(seed):
+    control, variant = _make_sides(300, seed)
+    indexed = _indexed_path_mismatch(control, variant)
+    assert indexed == _reference_path_mismatch(control, variant)
+    # the synthetic sides do produce mismatches
+    assert indexed[0] and indexed[1]
+
+
+def test_path_removal_matches_reference():
+    rand = random.Random(3)
+    domain_paths, intersection_paths = _make_domain_paths(rand, 1000)
+    expected = _reference_remove_paths(domain_paths, intersection_paths)
+    assert _trie_remove_paths(domain_paths, intersection_paths) == expected
+    assert expected != domain_paths
+
+
+@pytest.mark.benchmark
+def test_benchmark_path_mismatch_before_after():
+    control, variant = _make_sides(20000, 20000)
+
+    start = time.perf_counter()
+    indexed = _indexed_path_mismatch(control, variant)
+    indexed_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = _reference_path_mismatch(control, variant)
+    reference_seconds = time.perf_counter() - start
+
+    print("\npath mismatch %d+%d requests: before %.2fs, after %.3fs" %
+          (len(control), len(variant), reference_seconds, indexed_seconds))
+    assert indexed == reference
+    assert indexed_seconds < reference_seconds
+
+
+@pytest.mark.benchmark
+def test_benchmark_path_removal_before_after():
+    rand = random.Random(10000)
+    domain_paths, intersection_paths = _make_domain_paths(rand, 10000)
+
+    start = time.perf_counter()
+    trie_remaining = _trie_remove_paths(domain_paths, intersection_paths)
+    trie_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference_remaining = _reference_remove_paths(domain_paths,
+                                                  intersection_paths)
+    reference_seconds = time.perf_counter() - start
+
+    print("\nremove %d intersected paths from %d domain paths: before %.2fs, "
+          "after %.3fs" % (len(intersection_paths), len(domain_paths),
+                           reference_seconds, trie_seconds))
+    assert trie_remaining == reference_remaining
+    assert trie_seconds < reference_seconds
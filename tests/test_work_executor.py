@@ -0,0 +1,164 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from cvinspector.common.script_utils import create_time_series_csvs, plot_time_series_process
+from cvinspector.common.work_executor import SiteTaskError, SiteTaskErrors, WorkExecutor, WorkExecutorError, \
+    WorkProcessError, join_work_processes
+
+
+def _noop():
+    return None
+
+
+def _fail(index):
+    raise ValueError("task %d" % index)
+
+
+def test_every_failure_is_recorded_before_wait_returns():
+    for _ in range(20):
+        with WorkExecutor(4, progress_callback=None) as executor:
+            for index in range(50):
+                executor.submit(_fail, index, url="site%d.com" % index)
+            failures = executor.wait()
+        assert len(failures) == 50
+        assert sorted(x.url for x in failures) == sorted(
+            "site%d.com" % x for x in range(50))
+
+
+def test_site_task_error_keeps_url():
+    def _fail_site():
+        raise SiteTaskError("inner.com", ValueError("bad"))
+
+    with WorkExecutor(1, progress_callback=None) as executor:
+        executor.submit(_fail_site, url="chunk")
+        with pytest.raises(WorkExecutorError) as error:
+            executor.wait(raise_failures=True)
+    assert error.value.failures[0].url == "inner.com"
+
+
+def test_site_task_errors_are_one_failure_per_site():
+    def _fail_sites():
+        raise SiteTaskErrors([
+            SiteTaskError("a.com", ValueError("a")),
+            SiteTaskError("b.com", KeyError("b"))
+        ])
+
+    calls = []
+    with WorkExecutor(1,
+                      progress_callback=lambda completed, submitted, task_name,
+                      failure: calls.append(failure)) as executor:
+        executor.submit(_fail_sites, task_name="chunk")
+        failures = executor.wait()
+    assert [(x.task_name, x.url) for x in failures] == [("chunk", "a.com"),
+                                                        ("chunk", "b.com")]
+    assert isinstance(failures[1].exception.exception, KeyError)
+    # one progress call for the task, with its first failure
+    assert [x.url for x in calls] == ["a.com"]
+
+
+def test_progress_callback_once_per_task():
+    calls = []
+    with WorkExecutor(
+            3,
+            progress_callback=lambda completed, submitted, task_name, failure:
+            calls.append((completed, failure is None))) as executor:
+        for index in range(10):
+            executor.submit(_noop if index % 2 else _fail, *(
+                [] if index % 2 else [index]))
+    assert sorted(x[0] for x in calls) == list(range(1, 11))
+    assert sum(1 for x in calls if x[1]) == 5
+
+
+def test_timed_out_task_releases_its_slot():
+    release = threading.Event()
+    executor = WorkExecutor(2,
+                            max_pending=2,
+                            task_timeout=0.2,
+                            progress_callback=None)
+    try:
+        executor.submit(release.wait, 10, task_name="hung")
+        failures = executor.wait()
+        assert [x.task_name for x in failures] == ["hung"]
+        assert isinstance(failures[0].exception, TimeoutError)
+
+        # both slots are free again although the hung thread still runs
+        submitted = threading.Event()
+
+        def _submit_two():
+            executor.submit(_noop)
+            executor.submit(_noop)
+            submitted.set()
+
+        threading.Thread(target=_submit_two, daemon=True).start()
+        assert submitted.wait(5)
+        assert len(executor.wait()) == 1
+    finally:
+        release.set()
+        executor.shutdown()
+
+    # the late finish of the hung task is not reported again, nor releases twice
+    time.sleep(0.1)
+    assert executor.completed == 3
+
+
+def test_noop_task_scheduling_overhead():
+    task_count = 5000
+    start = time.perf_counter()
+    with WorkExecutor(8, progress_callback=None) as executor:
+        for _ in range(task_count):
+            executor.submit(_noop)
+    seconds = time.perf_counter() - start
+
+    per_task_us = seconds / task_count * 1e6
+    print("\n%d no-op tasks in %.3fs, %.1fus per task" %
+          (task_count, seconds, per_task_us))
+    assert executor.completed == task_count
+    # generous bound, it is about 30-100us per task here
+    assert per_task_us < 2000
+
+
+def test_failed_task_fails_worker_process(tmp_path):
+    # rows without a chunk column fail in TimeseriesPrepThread
+    bad_rows = [{"URL Crawled": "site%d.com" % index} for index in range(3)]
+    process_list = [
+        multiprocessing.Process(target=plot_time_series_process,
+                                args=(index, rows, multiprocessing.Queue(),
+                                      str(tmp_path)),
+                                name="worker-%d" % index)
+        for index, rows in enumerate([[], bad_rows])
+    ]
+    for process in process_list:
+        process.start()
+    assert join_work_processes(process_list) == [("worker-1", 1)]
+
+
+def test_failed_worker_process_fails_stage(tmp_path):
+    csv_file_path = str(tmp_path / "groups.csv")
+    with open(csv_file_path, 'w', newline='') as csv_file:
+        csvwriter = csv.writer(csv_file)
+        csvwriter.writerow(["URL Crawled"])
+        csvwriter.writerow(["site.com"])
+
+    with pytest.raises(WorkProcessError) as error:
+        create_time_series_csvs(csv_file_path, str(tmp_path / "time_series"),
+                                None)
+    assert len(error.value.exitcodes) == 1
@@ -0,0 +1,140 @@
+#  Copyright (c) 2021 Hieu Le and the UCI Networking Group
+#  <https://athinagroup.eng.uci.edu>.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import ast
+import importlib.util
+import os
+
+import pytest
+
+import cvinspector.diff_analysis.webrequests_core as webrequests_core
+import cvinspector.diff_analysis.wr_diff_cache as wr_diff_cache
+from cvinspector.common.utils import CONTROL, VARIANT
+from cvinspector.diff_analysis.wr_diff_cache import WR_DIFF_CACHE_SUFFIX, WebRequestDiffCache, \
+    disable_wr_diff_cache, enable_wr_diff_cache, get_wr_diff_cache_key
+
+
+@pytest.fixture
+def trial_group(tmp_path):
+    crawl_trial_group = {CONTROL: dict(), VARIANT: dict()}
+    for crawl_type in [CONTROL, VARIANT]:
+        for trial_index in range(2):
+            file_path = tmp_path / ("%s_%d.json" % (crawl_type, trial_index))
+            file_path.write_text("{}")
+            crawl_trial_group[crawl_type][str(trial_index)] = {
+                "_id": "%s-%d" % (crawl_type, trial_index),
+                "file_path": str(file_path)
+            }
+    return crawl_trial_group
+
+
+DIFF_GROUP = {"_id": "group-1", "url": "example.com"}
+
+
+def test_get_put_hit(tmp_path, trial_group):
+    cache = WebRequestDiffCache(str(tmp_path / "cache"))
+    key = get_wr_diff_cache_key(DIFF_GROUP, trial_group, "crawl")
+    assert cache.get(key) is None
+
+    diff = ({"urls": ["a"]}, {"urls": ["b", "c"]})
+    cache.put(key, diff)
+    assert cache.get(key) == diff
+    assert cache.get_stats()["hits"] == 1
+    assert cache.get_stats()["misses"] == 1
+    assert cache.get_stats()["writes"] == 1
+
+
+def test_key_changes_with_trial_files(trial_group):
+    key = get_wr_diff_cache_key(DIFF_GROUP, trial_group, "crawl")
+    assert get_wr_diff_cache_key(DIFF_GROUP, trial_group, "crawl") == key
+    assert get_wr_diff_cache_key(DIFF_GROUP, trial_group, "other") != key
+    assert get_wr_diff_cache_key({"_id": "group-2"}, trial_group,
+                                 "crawl") != key
+
+    # a rewritten trial file invalidates the diff
+    with open(trial_group[VARIANT]["1"]["file_path"], "w") as trial_file:
+        trial_file.write('{"webRequests": []}')
+    assert get_wr_diff_cache_key(DIFF_GROUP, trial_group, "crawl") != key
+
+
+def test_key_changes_with_diff_code(trial_group, monkeypatch):
+    key = get_wr_diff_cache_key(DIFF_GROUP, trial_group, "crawl")
+
+    monkeypatch.setattr(wr_diff_cache, "WR_DIFF_CACHE_VERSION",
+                        wr_diff_cache.WR_DIFF_CACHE_VERSION + 1)
+    version_key = get_wr_diff_cache_key(DIFF_GROUP, trial_group, "crawl")
+    assert version_key != key
+
+    monkeypatch.setattr(wr_diff_cache, "get_wr_diff_code_fingerprint",
+                        lambda: "edited webrequests_core")
+    assert get_wr_diff_cache_key(DIFF_GROUP, trial_group,
+                                 "crawl") not in (key, version_key)
+
+
+def test_code_fingerprint_covers_webrequests_core():
+    assert "cvinspector.diff_analysis.webrequests_core" in wr_diff_cache.WR_DIFF_CACHE_CODE_MODULES
+    assert len(wr_diff_cache.get_wr_diff_code_fingerprint()) == 64
+
+
+def test_code_fingerprint_covers_diff_imports():
+    # the cvinspector modules webrequests_core computes the diff with
+    module_spec = importlib.util.find_spec(
+        "cvinspector.diff_analysis.webrequests_core")
+    with open(module_spec.origin) as module_file:
+        tree = ast.parse(module_file.read())
+    imported = set(node.module for node in ast.walk(tree)
+                   if isinstance(node, ast.ImportFrom)
+                   and node.module.startswith("cvinspector."))
+    imported.discard("cvinspector.diff_analysis.wr_diff_cache")
+    assert imported
+    assert imported <= set(wr_diff_cache.WR_DIFF_CACHE_CODE_MODULES)
+
+
+def test_unreadable_entry_is_a_miss(tmp_path):
+    cache = WebRequestDiffCache(str(tmp_path / "cache"))
+    with open(os.path.join(cache.directory, "bad" + WR_DIFF_CACHE_SUFFIX),
+              "wb") as cache_file:
+        cache_file.write(b"not a cache file")
+    assert cache.get("bad") is None
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_diff_computed_once_with_cache(tmp_path, trial_group, monkeypatch):
+    computed = []
+
+    def _fake_diff(crawl_trial_group, crawler_group_name, **kwargs):
+        computed.append(crawler_group_name)
+        return {"urls": []}, {"urls": ["https://ads.com/a.js"]}
+
+    monkeypatch.setattr(webrequests_core, "create_trial_group",
+                        lambda diff_group, crawl_collection: trial_group)
+    monkeypatch.setattr(webrequests_core, "_get_wr_differences_only",
+                        _fake_diff)
+
+    # no cache by default
+    webrequests_core.get_wr_differences_only(DIFF_GROUP, "crawl", None)
+    webrequests_core.get_wr_differences_only(DIFF_GROUP, "crawl", None)
+    assert len(computed) == 2
+
+    enable_wr_diff_cache(str(tmp_path / "cache"))
+    try:
+        first = webrequests_core.get_wr_differences_only(
+            DIFF_GROUP, "crawl", None)
+        second = webrequests_core.get_wr_differences_only(
+            DIFF_GROUP, "crawl", None)
+    finally:
+        disable_wr_diff_cache()
+    assert len(computed) == 3
+    assert first == second